@@ -0,0 +1,104 @@
+'''
+Wait without using CPU time, for jobs waiting for a lock, a slot or a download
+
+The DIRAC Watchdog kills jobs which use too little CPU time compared to the wall clock time.
+While a job waits, the file DISABLE_WATCHDOG_CPU_WALLCLOCK_CHECK is created in the job
+directory, so the Watchdog does not consider the job as stalled, and it is removed once the job
+stops waiting.
+
+The time between attempts grows exponentially up to a maximum and is randomised, so that jobs
+started at the same time do not all try again at the same moment.
+'''
+
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from DIRAC import gLogger
+
+__RCSID__ = "$Id$"
+
+LOG = gLogger.getSubLogger( "Backoff" )
+
+WATCHDOG_DISABLE_FILE = 'DISABLE_WATCHDOG_CPU_WALLCLOCK_CHECK'
+
+## Number of threads waiting in each job directory, and if the file was created by us
+_IDLE_LOCK = threading.Lock()
+_IDLE_PERIODS = {}
+
+@contextmanager
+def idlePeriod( jobDir = None ):
+  """ Declare to the Watchdog that the job is waiting and does not use CPU time
+
+  The file disabling the CPU check is only removed when the last waiting thread is done, and
+  never if it existed before, e.g. created by the job itself for a longer period.
+
+  :param str jobDir: directory where the job runs, the current directory by default
+  """
+  fullPath = os.path.join( jobDir or os.getcwd(), WATCHDOG_DISABLE_FILE )
+  with _IDLE_LOCK:
+    count, created = _IDLE_PERIODS.get( fullPath, ( 0, False ) )
+    if not count and not os.path.exists( fullPath ):
+      try:
+        with open( fullPath, 'w' ) as checkFile:
+          checkFile.write( 'Waiting, dont look at cpu' )
+        created = True
+      except IOError as err:
+        LOG.warn( "Could not disable the Watchdog CPU check:", str( err ) )
+    _IDLE_PERIODS[fullPath] = ( count + 1, created )
+  try:
+    yield
+  finally:
+    with _IDLE_LOCK:
+      count, created = _IDLE_PERIODS.pop( fullPath )
+      if count > 1:
+        _IDLE_PERIODS[fullPath] = ( count - 1, created )
+      elif created and os.path.exists( fullPath ):
+        os.remove( fullPath )
+
+class Backoff( object ):
+  """ Jittered exponential backoff between attempts, sleeping during an idle period
+  """
+  def __init__( self, initial = 15, maximum = 600, factor = 2, jitter = 0.5, jobDir = None ):
+    """
+    :param float initial: time to wait before the second attempt, in seconds
+    :param float maximum: maximum time to wait between two attempts, in seconds
+    :param float factor: the time to wait is multiplied by factor after each attempt
+    :param float jitter: the time to wait is randomly changed by up to this fraction
+    :param str jobDir: directory where the job runs, the current directory by default
+    """
+    self.initial = initial
+    self.maximum = maximum
+    self.factor = factor
+    self.jitter = jitter
+    self.jobDir = jobDir or os.getcwd()
+    self.delay = initial
+    self.waited = 0.
+
+  def reset( self ):
+    """ Start again with the initial time to wait, e.g. after a successful attempt """
+    self.delay = self.initial
+
+  def nextDelay( self, maximum = None ):
+    """ Return the time to wait before the next attempt, and increase it for the following one
+
+    :param float maximum: lower maximum for this attempt only, e.g. an estimated waiting time
+    """
+    delay = min( self.delay, self.maximum if maximum is None else maximum )
+    self.delay = min( self.delay * self.factor, self.maximum )
+    return max( 0., random.uniform( 1 - self.jitter, 1 + self.jitter ) * delay )
+
+  def wait( self, maximum = None ):
+    """ Sleep until the next attempt, without being considered stalled by the Watchdog
+
+    :param float maximum: lower maximum for this attempt only
+    :returns: the number of seconds waited
+    """
+    delay = self.nextDelay( maximum )
+    LOG.verbose( "Waiting %.0f seconds before the next attempt" % delay )
+    with idlePeriod( self.jobDir ):
+      time.sleep( delay )
+    self.waited += delay
+    return delay
@@ -12,10 +12,11 @@ import DIRAC
 from DIRAC                             import S_OK, S_ERROR
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
 from DIRAC.Core.Utilities.Subprocess   import systemCall
+from DIRAC.Core.DISET.RPCClient        import RPCClient
 
 from ILCDIRAC.Core.Utilities.DetectOS  import NativeMachine
 from ILCDIRAC.Core.Utilities.ResolveDependencies            import resolveDeps
-from ILCDIRAC.Core.Utilities.TARsoft   import installInAnyArea, installDependencies
+from ILCDIRAC.Core.Utilities.TARsoft   import installInAnyArea, installDependencies, prefetchPackages
 
 __RCSID__ = "$Id$"
 
@@ -142,12 +143,18 @@ class CombinedSoftwareInstallation(object):
     
     
     
+    toInstall = []
     for app in self.apps:
       res = checkCVMFS(self.jobConfig, app)
       if res['OK']:
         DIRAC.gLogger.notice('Software %s is available on CVMFS, skipping' % ", ".join(app) )
         continue
+      toInstall.append(app)
 
+    ## Download and extract all packages at the same time, they are then configured in order
+    installTimes = prefetchPackages(toInstall, self.jobConfig, areas)
+
+    for app in toInstall:
       ## First install the original package in any of the areas
       resInstall = installInAnyArea(areas, app, self.jobConfig)
       if not resInstall['OK']:
@@ -158,6 +165,12 @@ class CombinedSoftwareInstallation(object):
       if not resDeps['OK']:
         DIRAC.gLogger.error("Failed to install dependencies: ", resDeps['Message'])
         return S_ERROR("Failed to install dependencies")
+      ## Dependencies shared with an earlier application were already installed, keep their first time
+      for dep, seconds in resDeps['Value'].items():
+        installTimes.setdefault(dep, seconds)
+
+    if installTimes:
+      self.setInstallTimes(installTimes)
 
     if self.sharedArea:  
       #List content  
@@ -165,6 +178,22 @@ class CombinedSoftwareInstallation(object):
       
     return DIRAC.S_OK()
 
+  def setInstallTimes(self, installTimes):
+    """ Report the time spent installing each package as a job parameter, to tune the installation
+
+    :param dict installTimes: dictionary of (name, version): time in seconds
+    """
+    times = ", ".join("%s %s: %.0fs" % (app[0], app[1], seconds) for app, seconds in sorted(installTimes.items()))
+    DIRAC.gLogger.info("Software installation times:", times)
+    jobID = self.job.get('JobID')
+    if not jobID:
+      return S_ERROR('JobID not defined')
+    jobReport = RPCClient('WorkloadManagement/JobStateUpdate', timeout = 120)
+    res = jobReport.setJobParameter(int(jobID), 'SoftwareInstallationTimes', times)
+    if not res['OK']:
+      DIRAC.gLogger.warn("Failed to set the installation times:", res['Message'])
+    return res
+
 def listAreaDirectory(area):
   """ List the content of the given area
   """
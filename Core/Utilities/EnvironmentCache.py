@@ -0,0 +1,66 @@
+'''
+Cache of the environment of the applications, shared by all steps of a job
+
+Resolving the environment of an application looks up its dependencies in the configuration, searches
+the software folders for libraries and executables, and sources the environment script in a shell.
+This only depends on the platform, the application and its version, so it is done once per job and
+the result is kept in the workflow_commons, see
+:func:`~ILCDIRAC.Workflow.Modules.ModuleBase.ModuleBase._getEnvironmentCache`.
+'''
+
+from DIRAC import S_OK, gLogger
+from DIRAC.Core.Utilities.Subprocess import systemCall
+
+__RCSID__ = "$Id$"
+
+LOG = gLogger.getSubLogger( "EnvironmentCache" )
+
+## Key of the cache in the workflow_commons
+ENVIRONMENT_CACHE = 'EnvironmentCache'
+
+class EnvironmentCache( object ):
+  """ Environment of the applications used by the job, resolved once per platform, application and version
+  """
+  def __init__( self ):
+    self.entries = {}
+
+  def __repr__( self ):
+    """ The workflow_commons are printed by every step, so do not print the whole environments """
+    return "<EnvironmentCache of %s>" % ", ".join( sorted( "%s %s" % key[1:] for key in self.entries ) )
+
+  def getEntry( self, platform, application, version ):
+    """ Return the dictionary of values cached for this application, empty if nothing was resolved yet
+
+    :param str platform: platform of the job
+    :param str application: name of the application
+    :param str version: version of the application
+    :returns: dict, modified by the callers to store what they resolved
+    """
+    return self.entries.setdefault( ( platform, str( application ).lower(), str( version ) ), {} )
+
+  def getScriptEnvironment( self, platform, application, version, envScriptPath ):
+    """ Return the environment variables defined after sourcing the environment script
+
+    The script is only sourced in a shell the first time, or if another script is used for the application.
+    A non-zero status of the script is only logged, the callers check the variables they need.
+
+    :param str envScriptPath: path to the environment script of the application
+    :returns: S_OK with the dictionary of environment variables, S_ERROR
+    """
+    entry = self.getEntry( platform, application, version )
+    if entry.get( 'EnvScript' ) == envScriptPath:
+      return S_OK( entry['Environment'] )
+
+    ## the environment is printed even if the last command of the script fails, as in the shell of the application
+    res = systemCall( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', envScriptPath ] )
+    if not res['OK']:
+      LOG.error( "Failed to source the environment script:", res['Message'] )
+      return res
+    status, output, error = res['Value']
+    if status:
+      LOG.warn( "Environment script %s returned status %s:" % ( envScriptPath, status ), error )
+
+    environment = dict( variable.split( '=', 1 ) for variable in output.split( '\0' ) if '=' in variable )
+    entry['EnvScript'] = envScriptPath
+    entry['Environment'] = environment
+    return S_OK( environment )
@@ -6,13 +6,16 @@ Several file utilities
 '''
 
 import glob
+import hashlib
 import os
 import re
 import shutil
+import zlib
 
 from distutils import dir_util, errors #pylint: disable=no-name-in-module
 
 from DIRAC import S_OK, S_ERROR, gLogger
+from DIRAC.Core.Utilities.Adler                            import intAdlerToHex
 
 from DIRAC.DataManagementSystem.Client.DataManager         import DataManager
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations   import Operations 
@@ -25,6 +28,10 @@ from DIRAC.RequestManagementSystem.Client.ReqClient         import ReqClient
 
 __RCSID__ = "$Id$"
 
+CHECKSUM_BUFFER_SIZE = 8 * 1024 * 1024
+## checksums of the files already read: path: ( ( size, mtime ), checksums )
+_CHECKSUM_CACHE = {}
+
 def upload(path, appTar):
   """ Upload software tar ball to storage
   """
@@ -112,3 +119,40 @@ def fullCopy(srcdir, dstdir, item):
       except EnvironmentError, why:
         return S_ERROR(str(why))
   return S_OK()
+
+def getFileChecksums(fileName, digests=()):
+  """ Return the adler32 checksum and other digests of the file, reading it only once
+
+  The result is kept for the path, size and modification time of the file, so the modules
+  registering, uploading or sending a file to the failover do not read it again.
+
+  :param str fileName: path of the file
+  :param digests: names of other hashlib digests to compute, e.g. ('md5',)
+  :returns: S_OK with dict { 'ADLER32': adler32 as hex, digest: hexdigest }, S_ERROR
+  """
+  try:
+    fileStat = os.stat(fileName)
+    key = os.path.realpath(fileName)
+    fileVersion = (fileStat.st_size, fileStat.st_mtime)
+    cached = _CHECKSUM_CACHE.get(key)
+    if cached and cached[0] == fileVersion and all(digest in cached[1] for digest in digests):
+      return S_OK(dict(cached[1]))
+
+    adler = 1
+    hashes = dict((digest, hashlib.new(digest)) for digest in digests)
+    with open(fileName, 'rb') as inputFile:
+      while True:
+        data = inputFile.read(CHECKSUM_BUFFER_SIZE)
+        if not data:
+          break
+        adler = zlib.adler32(data, adler)
+        for fileHash in hashes.values():
+          fileHash.update(data)
+  except (EnvironmentError, ValueError) as why:
+    gLogger.error("Failed to compute checksum of file", "%s: %s" % (fileName, why))
+    return S_ERROR("Failed to compute checksum: %s" % why)
+
+  checksums = dict((digest, fileHash.hexdigest()) for digest, fileHash in hashes.items())
+  checksums['ADLER32'] = intAdlerToHex(adler)
+  _CHECKSUM_CACHE[key] = (fileVersion, checksums)
+  return S_OK(dict(checksums))
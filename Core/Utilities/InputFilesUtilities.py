@@ -12,23 +12,112 @@ import os
 
 from DIRAC import gLogger, S_OK, S_ERROR
 
+## Metadata obtained from the FileCatalog by this process, by LFN and by directory
+_FILE_METADATA = {}
+_DIRECTORY_METADATA = {}
+
+def resetMetadataCache():
+  """ Forget the metadata obtained from the FileCatalog, so that it is looked up again
+  """
+  _FILE_METADATA.clear()
+  _DIRECTORY_METADATA.clear()
+
+def getFileMetadata(lfns, fc=None):
+  """ Find from the FileCatalog the user metadata of the files
+
+  The metadata of all files is obtained in one query if the FileCatalog supports it, one query per file otherwise.
+  It is kept for the lifetime of the process, so only the files not seen before are looked up. The dictionaries
+  of metadata are shared with the cache and must not be modified.
+
+  :param list lfns: list of LFNs
+  :param fc: FileCatalogClient to use, a new one by default
+  :returns: S_OK with the dictionaries Successful (LFN: metadata) and Failed (LFN: error message)
+  """
+  result = {'Successful': {}, 'Failed': {}}
+  missing = set()
+  for lfn in lfns:
+    if lfn in _FILE_METADATA:
+      result['Successful'][lfn] = _FILE_METADATA[lfn]
+    else:
+      missing.add(lfn)
+  if not missing:
+    return S_OK(result)
+
+  fc = fc or FileCatalogClient()
+  found, failed = {}, {}
+  bulkQuery = getattr(fc, 'getFileUserMetadataBulk', None)
+  if bulkQuery is not None:
+    res = bulkQuery(sorted(missing))
+    if res['OK']:
+      found, failed = res['Value']['Successful'], res['Value']['Failed']
+    else:
+      gLogger.verbose("Failed to get Metadata of %d files in one query, asking for each file" % len(missing),
+                      res['Message'])
+      bulkQuery = None
+  if bulkQuery is None:
+    for lfn in sorted(missing):
+      res = fc.getFileUserMetadata(lfn)
+      if res['OK']:
+        found[lfn] = res['Value']
+      else:
+        failed[lfn] = res['Message']
+
+  for lfn, error in failed.items():
+    gLogger.warn("Failed to get Metadata from file: %s, because: %s" % (lfn, error))
+  _FILE_METADATA.update(found)
+  result['Successful'].update(found)
+  result['Failed'].update(failed)
+  return S_OK(result)
+
+def getDirectoryMetadata(paths, fc=None):
+  """ Find from the FileCatalog the user metadata of the directories
+
+  Like :func:`getFileMetadata` the metadata is kept for the lifetime of the process.
+
+  :param list paths: list of directories
+  :param fc: FileCatalogClient to use, a new one by default
+  :returns: S_OK with the dictionaries Successful (path: metadata) and Failed (path: error message)
+  """
+  result = {'Successful': {}, 'Failed': {}}
+  for path in set(paths):
+    if path not in _DIRECTORY_METADATA:
+      fc = fc or FileCatalogClient()
+      res = fc.getDirectoryUserMetadata(path)
+      if not res['OK']:
+        gLogger.warn("Failed to get Metadata from path: %s, because: %s" % (path, res['Message']))
+        result['Failed'][path] = res['Message']
+        continue
+      _DIRECTORY_METADATA[path] = res['Value']
+    result['Successful'][path] = _DIRECTORY_METADATA[path]
+  return S_OK(result)
+
+def _groupByDirectory(lfns):
+  """ Return a dictionary of directory: list of LFNs, ignoring empty LFNs
+  """
+  flist = {}
+  for lfn in lfns:
+    if lfn:
+      flist.setdefault(os.path.dirname(lfn), []).append(lfn)
+  return flist
+
 def getNumberOfEvents(inputfile):
   """ Find from the FileCatalog the number of events in a file
   """
+  flist = _groupByDirectory(inputfile)
 
-  files = inputfile
-  flist = {}
-  for myfile in files:
-    if not myfile:
-      continue
-    bpath = os.path.dirname(myfile)
-    if bpath not in flist:
-      flist[bpath] = [myfile]
-    else:
-      flist[bpath].append(myfile)
-      
+  ## The metadata is looked up in three queries: the files alone in their directory, the directories where the
+  ## number of events is not known yet, and the other files of the directories without NumberOfEvents
   fc = FileCatalogClient()
-  nbevts = {} 
+  singleFiles = set(files[0] for files in flist.values() if len(files) == 1)
+  fileMeta = getFileMetadata(singleFiles, fc)['Value']['Successful']
+  dirPaths = [path for path, files in flist.items()
+              if len(files) > 1 or "NumberOfEvents" not in fileMeta.get(files[0], {})]
+  dirMeta = getDirectoryMetadata(dirPaths, fc)['Value']['Successful']
+  otherFiles = [myfile for path in dirPaths if "NumberOfEvents" not in dirMeta.get(path, {})
+                for myfile in flist[path] if myfile not in singleFiles]
+  fileMeta.update(getFileMetadata(otherFiles, fc)['Value']['Successful'])
+
+  nbevts = {}
   luminosity = 0
   numberofevents = 0
   evttype = ''
@@ -39,26 +128,21 @@ def getNumberOfEvents(inputfile):
     found_nbevts = False
     found_lumi = False
 
-    if len(files) == 1:
-      res = fc.getFileUserMetadata(files[0])
-      if not res['OK']:
-        gLogger.warn("Failed to get Metadata from file: %s, because: %s" % (files[0], res['Message']))
-      else:
-        tags = res['Value']
-        if "NumberOfEvents" in tags and not found_nbevts:
-          numberofevents += int(tags["NumberOfEvents"])
-          found_nbevts = True
-          completeFailure = False
-        if "Luminosity" in tags and not found_lumi:
-          luminosity += float(tags["Luminosity"])
-          found_lumi = True
-        others.update(tags)
-        if found_nbevts:
-          continue
-
-    res = fc.getDirectoryUserMetadata(path)
-    if res['OK']:   
-      tags = res['Value']
+    if len(files) == 1 and files[0] in fileMeta:
+      tags = fileMeta[files[0]]
+      if "NumberOfEvents" in tags and not found_nbevts:
+        numberofevents += int(tags["NumberOfEvents"])
+        found_nbevts = True
+        completeFailure = False
+      if "Luminosity" in tags and not found_lumi:
+        luminosity += float(tags["Luminosity"])
+        found_lumi = True
+      others.update(tags)
+      if found_nbevts:
+        continue
+
+    if path in dirMeta:
+      tags = dirMeta[path]
       if "NumberOfEvents" in tags and not found_nbevts:
         numberofevents += len(files)*int(tags["NumberOfEvents"])
         found_nbevts = True
@@ -68,25 +152,21 @@ def getNumberOfEvents(inputfile):
         found_lumi = True
 
       evttype = tags.get("EvtType", evttype)
-      others.update(tags)    
-      if found_nbevts: 
+      others.update(tags)
+      if found_nbevts:
         continue
-    else:
-      gLogger.warn("Failed to get Metadata from path: %s, because: %s" % (path, res['Message']))
 
     for myfile in files:
-      res = fc.getFileUserMetadata(myfile)
-      if not res['OK']:
-        gLogger.warn("Failed to get Metadata from file: %s, because: %s" % (myfile, res['Message']))
+      if myfile not in fileMeta:
         continue
-      tags = res['Value']
+      tags = fileMeta[myfile]
       if "NumberOfEvents" in tags:
         numberofevents += int(tags["NumberOfEvents"])
         completeFailure = False
       if "Luminosity" in tags and not found_lumi:
         luminosity += float(tags["Luminosity"])
-      others.update(tags)  
-        
+      others.update(tags)
+
   nbevts['nbevts'] = numberofevents
   nbevts['lumi'] = luminosity
   nbevts['EvtType'] = evttype
@@ -101,3 +181,35 @@ def getNumberOfEvents(inputfile):
     return S_ERROR("Failed to get Number of Events")
 
   return S_OK(nbevts)
+
+def getNumberOfEventsPerFile(lfns):
+  """ Find from the FileCatalog the number of events in each file
+
+  The NumberOfEvents of a directory is the number of events in each of its files, so it is used for all files
+  of the directory, and the metadata of the files is only looked up if the directory does not have it.
+
+  :param list lfns: list of LFNs
+  :returns: S_OK with a dictionary of LFN: number of events, S_ERROR if it is not known for all files
+  """
+  flist = _groupByDirectory(lfns)
+
+  fc = FileCatalogClient()
+  dirMeta = getDirectoryMetadata(flist.keys(), fc)['Value']['Successful']
+  nbevts = {}
+  otherFiles = []
+  for path, files in flist.items():
+    if dirMeta.get(path, {}).get("NumberOfEvents") is not None:
+      nbevts.update(dict.fromkeys(files, int(dirMeta[path]["NumberOfEvents"])))
+    else:
+      otherFiles.extend(files)
+
+  for myfile, tags in getFileMetadata(otherFiles, fc)['Value']['Successful'].items():
+    if tags.get("NumberOfEvents") is not None:
+      nbevts[myfile] = int(tags["NumberOfEvents"])
+
+  missing = [lfn for lfn in lfns if lfn not in nbevts]
+  if missing:
+    gLogger.error("Did not obtain NumberOfEvents from FileCatalog for %d files" % len(missing), ", ".join(missing[:10]))
+    return S_ERROR("Failed to get Number of Events for %s" % ", ".join(missing[:10]))
+
+  return S_OK(nbevts)
@@ -0,0 +1,178 @@
+'''
+Cache of overlay background files shared by all jobs running on a node
+
+The files are stored under the cache directory in one directory per LFN and checksum, so a
+file changed in the catalog is never taken from the cache. The cache is bounded in size,
+the least recently used files are removed first. Concurrent jobs are serialised with a
+lock file: looking up files takes a shared lock, adding and removing files an exclusive one.
+
+Files are hard linked into the job directory, so removing them from the cache does not
+affect jobs still using them. If the cache is on another file system the files are copied.
+
+Downloaded files are only added to the cache if their size and checksum are those of the catalog,
+so a corrupt download is not used by the other jobs on the node.
+'''
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+from contextlib import contextmanager
+
+from DIRAC import S_OK, S_ERROR, gLogger
+from DIRAC.Core.Utilities.Adler import compareAdler
+
+from ILCDIRAC.Core.Utilities.FileUtils import getFileChecksums
+
+__RCSID__ = "$Id$"
+
+LOG = gLogger.getSubLogger( "OverlayCache" )
+
+## Checksum types of the catalog which are adler32 checksums
+ADLER_CHECKSUM_TYPES = ( 'AD', 'ADLER', 'ADLER32' )
+
+class OverlayCache( object ):
+  """ Size bounded, least recently used cache of overlay files on the worker node
+  """
+  def __init__( self, cacheDir, maxSize ):
+    """
+    :param str cacheDir: directory of the cache, created if needed
+    :param int maxSize: maximum size of the cache in bytes
+    """
+    self.cacheDir = cacheDir
+    self.maxSize = maxSize
+    self.lockFile = os.path.join( cacheDir, ".lock" )
+
+  @contextmanager
+  def _lock( self, exclusive ):
+    """ Hold the lock of the cache shared between all jobs on the node """
+    with open( self.lockFile, "a" ) as lock:
+      fcntl.flock( lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH )
+      try:
+        yield
+      finally:
+        fcntl.flock( lock, fcntl.LOCK_UN )
+
+  def _entry( self, lfn, checksum ):
+    """ Return the directory of the cache entry for the LFN and checksum """
+    return os.path.join( self.cacheDir, hashlib.sha1( "%s:%s" % ( lfn, checksum ) ).hexdigest() )
+
+  def _entries( self ):
+    """ Return the list of (last access time, size, path) for all entries in the cache """
+    entries = []
+    for name in os.listdir( self.cacheDir ):
+      path = os.path.join( self.cacheDir, name )
+      if not os.path.isdir( path ):
+        continue
+      size = sum( os.path.getsize( os.path.join( path, fileName ) ) for fileName in os.listdir( path ) )
+      entries.append( ( os.path.getmtime( path ), size, path ) )
+    return entries
+
+  def _evict( self, neededSize ):
+    """ Remove the least recently used entries until there is room for neededSize bytes, must hold the exclusive lock """
+    entries = sorted( self._entries() )
+    usedSize = sum( size for _atime, size, _path in entries )
+    for _atime, size, path in entries:
+      if usedSize + neededSize <= self.maxSize:
+        break
+      LOG.verbose( "Removing from the overlay cache", path )
+      shutil.rmtree( path, ignore_errors = True )
+      usedSize -= size
+    return usedSize + neededSize <= self.maxSize
+
+  def getFile( self, lfn, checksum, destination ):
+    """ Put the cached file for the LFN in the destination directory
+
+    :param str lfn: LFN of the file
+    :param str checksum: checksum of the file in the catalog
+    :param str destination: directory where the file is needed
+    :returns: S_OK with the path of the file, S_ERROR if the file is not in the cache
+    """
+    if not checksum or not os.path.isdir( self.cacheDir ):
+      return S_ERROR( "File not in cache" )
+    entry = self._entry( lfn, checksum )
+    cachedFile = os.path.join( entry, os.path.basename( lfn ) )
+    localFile = os.path.join( destination, os.path.basename( lfn ) )
+    try:
+      with self._lock( exclusive = False ):
+        if not os.path.exists( cachedFile ):
+          return S_ERROR( "File not in cache" )
+        _linkOrCopy( cachedFile, localFile )
+        os.utime( entry, None )
+    except ( IOError, OSError ) as err:
+      LOG.warn( "Could not get the file from the overlay cache", "%s: %s" % ( lfn, err ) )
+      return S_ERROR( "Could not get file from cache: %s" % err )
+    return S_OK( localFile )
+
+  def addFile( self, lfn, checksum, localFile, size = None, checksumType = 'AD' ):
+    """ Add a downloaded file to the cache, removing the least recently used files if needed
+
+    :param str lfn: LFN of the file
+    :param str checksum: checksum of the file in the catalog
+    :param str localFile: path of the downloaded file
+    :param int size: size of the file in the catalog, not checked if None
+    :param str checksumType: type of the checksum in the catalog
+    :returns: S_OK, S_ERROR
+    """
+    if not checksum:
+      return S_ERROR( "No checksum for %s" % lfn )
+    res = checkFile( localFile, checksum, size, checksumType )
+    if not res['OK']:
+      LOG.warn( "Not adding the file to the overlay cache", "%s: %s" % ( lfn, res['Message'] ) )
+      return res
+    entry = self._entry( lfn, checksum )
+    try:
+      if not os.path.isdir( self.cacheDir ):
+        os.makedirs( self.cacheDir )
+      with self._lock( exclusive = True ):
+        if os.path.isdir( entry ):
+          return S_OK()
+        if not self._evict( os.path.getsize( localFile ) ):
+          return S_ERROR( "File %s is larger than the overlay cache" % lfn )
+        ## Fill a temporary directory first so other jobs never see an incomplete file
+        tmpEntry = entry + ".tmp"
+        shutil.rmtree( tmpEntry, ignore_errors = True )
+        os.mkdir( tmpEntry )
+        _linkOrCopy( localFile, os.path.join( tmpEntry, os.path.basename( lfn ) ) )
+        os.rename( tmpEntry, entry )
+    except ( IOError, OSError ) as err:
+      LOG.warn( "Could not add the file to the overlay cache", "%s: %s" % ( lfn, err ) )
+      return S_ERROR( "Could not add file to cache: %s" % err )
+    return S_OK()
+
+def checkFile( localFile, checksum, size = None, checksumType = 'AD' ):
+  """ Check that a downloaded file has the size and checksum of the catalog. Only adler32
+  checksums are computed, for other checksum types only the size is checked
+
+  :param str localFile: path of the downloaded file
+  :param str checksum: checksum of the file in the catalog
+  :param int size: size of the file in the catalog, not checked if None
+  :param str checksumType: type of the checksum in the catalog
+  :returns: S_OK, S_ERROR if the file does not match
+  """
+  try:
+    localSize = os.path.getsize( localFile )
+  except OSError as err:
+    return S_ERROR( "Cannot check %s: %s" % ( localFile, err ) )
+  if size is not None and localSize != int( size ):
+    return S_ERROR( "Size of %s is %d instead of %s" % ( localFile, localSize, size ) )
+  if not checksum or str( checksumType ).upper() not in ADLER_CHECKSUM_TYPES:
+    return S_OK()
+  res = getFileChecksums( localFile )
+  if not res['OK']:
+    return res
+  if not compareAdler( res['Value']['ADLER32'], checksum ):
+    return S_ERROR( "Checksum of %s is %s instead of %s" % ( localFile, res['Value']['ADLER32'], checksum ) )
+  return S_OK()
+
+def _linkOrCopy( source, destination ):
+  """ Hard link the source to the destination, copy it if they are on different file systems """
+  if os.path.exists( destination ):
+    os.remove( destination )
+  try:
+    os.link( source, destination )
+  except OSError as err:
+    if err.errno not in ( errno.EXDEV, errno.EPERM, errno.EMLINK ):
+      raise
+    shutil.copy2( source, destination )
@@ -25,35 +25,36 @@ from ILCDIRAC.Workflow.Modules.OverlayInput               import allowedBkg
 
 __RCSID__ = "$Id$"
 
-def getNewLDLibs(platform, application, applicationVersion):
+def getNewLDLibs(platform, application, applicationVersion, cache=None):
   """ Prepare the LD_LIBRARY_PATH environment variable: make sure all lib folder are included
 
   :param string platform: System config used for the job
   :param string application: name of the application considered
   :param string applicationVersion: version of the application considered
+  :param cache: :class:`~ILCDIRAC.Core.Utilities.EnvironmentCache.EnvironmentCache` of the job, so the lib
+    folders are only looked for once per job
   :return: new LD_LIBRARY_PATH
   """
   log = gLogger.getSubLogger("GetLDLibs")
-  log.verbose("Getting all lib folders")
-  new_ld_lib_path = ""
-  deps = resolveDeps(platform, application, applicationVersion)
-  for dep in deps:
-    res = getSoftwareFolder(platform, dep["app"], dep['version'])
-    if not res['OK']:
-      continue
-    basedepfolder = res['Value']
-    if os.path.exists(os.path.join(basedepfolder, "lib")):
-      log.verbose("Found lib folder in %s" % (basedepfolder))
-      newlibdir = os.path.join(basedepfolder, "lib")
-      new_ld_lib_path = newlibdir
-      ####Remove the libc
-      removeLibc(new_ld_lib_path)
-    if os.path.exists(os.path.join(basedepfolder, "LDLibs")):
-      log.verbose("Found lib folder in %s" % (basedepfolder))
-      newlibdir = os.path.join(basedepfolder, "LDLibs")
-      new_ld_lib_path = newlibdir
-      ####Remove the libc
-      removeLibc(new_ld_lib_path)
+  entry = cache.getEntry(platform, application, applicationVersion) if cache is not None else {}
+  if 'LDLibs' not in entry:
+    log.verbose("Getting all lib folders")
+    new_ld_lib_path = ""
+    for basedepfolder in _getDependencyFolders(platform, application, applicationVersion, entry):
+      if os.path.exists(os.path.join(basedepfolder, "lib")):
+        log.verbose("Found lib folder in %s" % (basedepfolder))
+        newlibdir = os.path.join(basedepfolder, "lib")
+        new_ld_lib_path = newlibdir
+        ####Remove the libc
+        removeLibc(new_ld_lib_path)
+      if os.path.exists(os.path.join(basedepfolder, "LDLibs")):
+        log.verbose("Found lib folder in %s" % (basedepfolder))
+        newlibdir = os.path.join(basedepfolder, "LDLibs")
+        new_ld_lib_path = newlibdir
+        ####Remove the libc
+        removeLibc(new_ld_lib_path)
+    entry['LDLibs'] = new_ld_lib_path
+  new_ld_lib_path = entry['LDLibs']
   if "LD_LIBRARY_PATH" in os.environ:
     if new_ld_lib_path:
       new_ld_lib_path = new_ld_lib_path + ":%s" % os.environ["LD_LIBRARY_PATH"]
@@ -61,27 +62,27 @@ def getNewLDLibs(platform, application, applicationVersion):
       new_ld_lib_path = os.environ["LD_LIBRARY_PATH"]
   return new_ld_lib_path
 
-def getNewPATH(platform, application, applicationVersion):
+def getNewPATH(platform, application, applicationVersion, cache=None):
   """ Same as :func:`getNewLDLibs`,but for the PATH
 
   :param string platform: System config used for the job
   :param string application: name of the application considered
   :param string applicationVersion: version of the application considered
+  :param cache: :class:`~ILCDIRAC.Core.Utilities.EnvironmentCache.EnvironmentCache` of the job
   :return: new PATH
   """
   log = gLogger.getSubLogger("GetPaths")
-  log.verbose("Getting all PATH folders")
-  new_path = ""
-  deps = resolveDeps(platform, application, applicationVersion)
-  for dep in deps:
-    res = getSoftwareFolder(platform, dep['app'], dep['version'])
-    if not res['OK']:
-      continue
-    depfolder = res['Value']
-    if os.path.exists(os.path.join(depfolder, "bin")):
-      log.verbose("Found bin folder in %s" % (depfolder))
-      newpathdir = os.path.join(depfolder, "bin")
-      new_path = newpathdir
+  entry = cache.getEntry(platform, application, applicationVersion) if cache is not None else {}
+  if 'PATH' not in entry:
+    log.verbose("Getting all PATH folders")
+    new_path = ""
+    for depfolder in _getDependencyFolders(platform, application, applicationVersion, entry):
+      if os.path.exists(os.path.join(depfolder, "bin")):
+        log.verbose("Found bin folder in %s" % (depfolder))
+        newpathdir = os.path.join(depfolder, "bin")
+        new_path = newpathdir
+    entry['PATH'] = new_path
+  new_path = entry['PATH']
   if "PATH" in os.environ:
     if new_path:
       new_path = new_path + ":%s" % os.environ["PATH"]
@@ -89,6 +90,17 @@ def getNewPATH(platform, application, applicationVersion):
       new_path = os.environ["PATH"]  
   return new_path
 
+def _getDependencyFolders(platform, application, applicationVersion, entry):
+  """ Return the software folders of the dependencies which are installed, stored in the cache entry """
+  if 'DependencyFolders' not in entry:
+    folders = []
+    for dep in resolveDeps(platform, application, applicationVersion):
+      res = getSoftwareFolder(platform, dep["app"], dep['version'])
+      if res['OK']:
+        folders.append(res['Value'])
+    entry['DependencyFolders'] = folders
+  return entry['DependencyFolders']
+
 def prepareWhizardFile(input_in, evttype, energy, randomseed, nevts, lumi, output_in):
   """Prepares the whizard.in file to run
   
@@ -1,7 +1,10 @@
 '''
-Try some fancy splitting, DO NOT USE
+Split input files by number of events
 
-Based on :func:`DIRAC.SplitByFiles` idea, but doing the splitting by number of events
+Based on :func:`DIRAC.SplitByFiles` idea, but doing the splitting by number of events: each job processes the
+same number of events, possibly the end of one file and the beginning of the next ones. The number of events in
+each file is taken from the FileCatalog metadata, and the files and first event of each job are found from the
+cumulative number of events, without going through the events one by one.
 
 :since: Feb 10, 2010
 :author: sposs
@@ -9,7 +12,9 @@ Based on :func:`DIRAC.SplitByFiles` idea, but doing the splitting by number of e
 
 __RCSID__ = "$Id$"
 
-from ILCDIRAC.Core.Utilities.InputFilesUtilities import getNumberOfEvents
+from bisect import bisect_left, bisect_right
+
+from ILCDIRAC.Core.Utilities.InputFilesUtilities import getNumberOfEventsPerFile
 from DIRAC import S_OK, S_ERROR
 
 def SplitByFilesAndEvents(listoffiles, evtsperjob):
@@ -17,52 +22,40 @@ def SplitByFilesAndEvents(listoffiles, evtsperjob):
   files must have metadata number of events
 
   :param listoffiles: list of inputfiles
-  :param int eventsperjob: desired number of events per job
-  :returns: S_OK with a list of dictionaries
+  :param int evtsperjob: desired number of events per job
+  :returns: S_OK with a list of dictionaries, see :func:`splitEventRanges`
   """
-  mylist = [] 
-  total_evts = 0
-  for files in listoffiles:
-    myfdict = {}
-    resInfo =  getNumberOfEvents([files])
-    if not resInfo['OK'] or "nbevts" not in resInfo['Value']:
-      return S_ERROR("The file %s does not have attached number of events, cannot split" % files)
-    myfdict['file'] = files
-    myfdict['nbevts'] = resInfo['Value']['nbevts']
-    mylist.append(myfdict) 
-    total_evts += resInfo['Value']['nbevts']
+  if evtsperjob < 1:
+    return S_ERROR("The number of events per job must be positive")
+  resInfo = getNumberOfEventsPerFile(listoffiles)
+  if not resInfo['OK']:
+    return S_ERROR("Some files do not have attached number of events, cannot split: %s" % resInfo['Message'])
+  return S_OK(splitEventRanges(listoffiles, resInfo['Value'], evtsperjob))
 
-  #nb_jobs = total_evts/evtsperjob
-  joblist = []
-  jdict = {}
-  startfromevt = 0
-  cur_events = 0
-  for dummy_eventNumber in range(total_evts):
-    cur_events +=1
-    if not len(mylist):
-      break
-    item = mylist[0]
-    nb_evts_in_file = item['nbevts']
+def splitEventRanges(listoffiles, eventsPerFile, evtsperjob):
+  """ Compute the input files and events of each job, all jobs but the last one process evtsperjob events
+
+  :param list listoffiles: input files, in the order in which they are processed
+  :param dict eventsPerFile: number of events in each file
+  :param int evtsperjob: number of events per job
+  :returns: list of dictionaries with the 'files' of the job, the number of events to skip in the first file
+    as 'startFrom', and the number of events to process as 'nbevts'
+  """
+  ## firstEvents[i] is the index of the first event of file i in the whole dataset
+  firstEvents = [0]
+  for lfn in listoffiles:
+    firstEvents.append(firstEvents[-1] + eventsPerFile[lfn])
+  totalEvents = firstEvents[-1]
 
-    if cur_events == evtsperjob :
-      jdict['startFrom'] = startfromevt
-      if 'files' not in jdict:
-        jdict['files'] = []
-      jdict['files'].append(item['file'])
-      startfromevt = int(cur_events)
-      cur_events = 0
-      mylist.remove(item)
-      joblist.append(jdict)
-      continue
-    if cur_events > nb_evts_in_file:
-      if 'files' not in jdict:
-        jdict['files'] = []
-      jdict['files'].append(item['file'])
-      mylist.remove(item)
-      continue
-    #joblist.append(jdict)
-    #print "final jdict", jdict
-  return S_OK(joblist)
+  joblist = []
+  for startEvent in xrange(0, totalEvents, evtsperjob):
+    endEvent = min(startEvent + evtsperjob, totalEvents)
+    firstFile = bisect_right(firstEvents, startEvent) - 1
+    lastFile = bisect_left(firstEvents, endEvent)
+    joblist.append({'files': listoffiles[firstFile:lastFile],
+                    'startFrom': startEvent - firstEvents[firstFile],
+                    'nbevts': endEvent - startEvent})
+  return joblist
 
 if __name__=="__main__":
   from DIRAC.Core.Base import Script
@@ -76,4 +69,7 @@ if __name__=="__main__":
   LFNS = RES['Value']
   LFNS.sort()
   RES = SplitByFilesAndEvents(LFNS,70)
+  if not RES['OK']:
+    print RES['Message']
+    exit(1)
   print RES['Value'][1]
@@ -13,91 +13,60 @@ from ILCDIRAC.Core.Utilities.ResolveDependencies            import resolveDeps
 from ILCDIRAC.Core.Utilities.PrepareLibs                    import removeLibc, getLibsToIgnore
 from DIRAC.DataManagementSystem.Client.DataManager          import DataManager
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations    import Operations
-from ILCDIRAC.Core.Utilities.WasteCPU                       import wasteCPUCycles
-import os, urllib, tarfile, subprocess, shutil, time
+from ILCDIRAC.Core.Utilities.Backoff                        import Backoff
+from multiprocessing.pool import ThreadPool
+import os, urllib, urllib2, httplib, tarfile, subprocess, shutil, fcntl, errno, time
 from tarfile import TarError
 try:                      #FIXME: Deprecated import?
   import hashlib as md5
 except ImportError:
   import md5
 
-def createLock(lockname):
-  """ Need to lock the area to prevent 2 jobs to write in the same area
+## How long to wait for another job installing the same software, in seconds
+INSTALL_LOCK_TIMEOUT = 3600
+## Size of the blocks read from the network when extracting a tar ball while it is downloaded
+TAR_STREAM_BUFFER = 1024 * 1024
+
+def lockInstallation(lockname, jobDir = None):
+  """ Take the lock on the installation of a package, shared with the other jobs using the area
+
+  The lock is an fcntl lock on the file, released by the system if the job dies, so it cannot be left behind
+  by a failed installation. The lock file itself is never removed.
+
+  :param str lockname: path of the lock file
+  :param str jobDir: directory of the job, where the Watchdog is told that the job is waiting
+  :returns: S_OK with a tuple of the open lock file and if we had to wait for another job, S_ERROR
   """
   try:
-    with open(lockname,"w") as lock:
-      lock.write("Locking this directory\n")
+    lockFile = open(lockname, "a")
   except IOError as e:
     gLogger.error("Failed creating lock")
     return S_ERROR("Not allowed to write here: IOError %s" % (str(e)))
-  return S_OK()
-
-def checkLockAge(lockname):
-  """ Check if there is a lock, and in that case deal with it, potentially remove it after n minutes
-  """
-  overwrite = False
-  count = 0
+  backoff = Backoff(initial = 1, maximum = 30, jobDir = jobDir)
+  waited = False
   while True:
-    if not os.path.exists(lockname):
-      break
-    count += 1
-    gLogger.warn("Will wait one minute before proceeding")
-    res = wasteCPUCycles(60)
-    if not res['OK']:
-      continue
-    last_touch = time.time()
     try:
-      stat = os.stat(lockname)
-      last_touch = stat.st_atime
-    except OSError as x:
-      gLogger.warn("File not available: %s %s, assume removed" % (OSError, str(x))) 
-      break
-    loc_time = time.time()
-    if loc_time-last_touch > 30*60: ##this is where I say the file is too old to still be valid (30 minutes)
-      gLogger.info("File is %s seconds old" % str(loc_time-last_touch))
-      overwrite = True
-      res = clearLock(lockname)
-      if res['OK']:
-        break
-    if count > 60: #We have been waiting for 60 minutes, something is wrong, kill it
-      gLogger.error("Seems file stat is wrong, assume buggy, will fail installation")
-      #overwrite = True
-      res = clearLock(lockname)
-      return S_ERROR("Buggy lock, removed: %s" % res['OK'])
-      
-  return S_OK(overwrite)
-  
-def clearLock(lockname):
-  """ And we need to clear the lock once the operation is done
-  """
-  try:
-    os.unlink(lockname)
-  except OSError as e:
-    gLogger.error("Failed cleaning lock: OSError", "%s" % (str(e)))
-    return S_ERROR("Failed to clear lock: %s" % (str(e)) )
-  return S_OK()
-
-def deleteOld(folder_name):
-  """ Remove directories
-  """
-  gLogger.info("Deleting existing version %s" % folder_name)
-  if os.path.exists(folder_name):
-    if os.path.isdir(folder_name):
-      try:
-        shutil.rmtree(folder_name)
-      except OSError as x:
-        gLogger.error("Failed deleting %s because :" % (folder_name), "%s %s" % ( OSError, str(x)))
-    else:
-      try:
-        os.remove(folder_name)
-      except OSError as e:
-        gLogger.error("Failed deleting %s because :" % (folder_name),"OSError %s" % ( str(e)))
-  if os.path.exists(folder_name):
-    gLogger.error("Oh Oh, something was not right, the directory %s is still here" % folder_name) 
-  return S_OK()
-
-def downloadFile(tarballURL, app_tar, folder_name):
-  """ Get the file locally.
+      fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return S_OK((lockFile, waited))
+    except IOError as e:
+      if e.errno not in (errno.EAGAIN, errno.EACCES):
+        lockFile.close()
+        return S_ERROR("Failed to lock %s: %s" % (lockname, str(e)))
+    if backoff.waited > INSTALL_LOCK_TIMEOUT:
+      lockFile.close()
+      return S_ERROR("Waited too long for the lock %s" % lockname)
+    if not waited:
+      gLogger.info("Another job is installing the same software, waiting for it", lockname)
+      waited = True
+    backoff.wait()
+
+def unlockInstallation(lockFile):
+  """ Release the lock taken with :func:`lockInstallation` """
+  fcntl.flock(lockFile, fcntl.LOCK_UN)
+  lockFile.close()
+
+def downloadFile(tarballURL, app_tar, folder_name, destination = None):
+  """ Get the file locally, in the current directory or in destination.
   """
   #need to make sure the url ends with /, other wise concatenation below returns bad url
   if tarballURL[-1] != "/":
@@ -109,13 +78,16 @@ def downloadFile(tarballURL, app_tar, folder_name):
       gLogger.debug("Downloading software", '%s' % (folder_name))
       #Copy the file locally, don't try to read from remote, soooo slow
       #Use string conversion %s%s to set the address, makes the system more stable
-      urllib.urlretrieve("%s%s" % (tarballURL, app_tar), app_tar_base)
+      urllib.urlretrieve("%s%s" % (tarballURL, app_tar), os.path.join(destination, app_tar_base) if destination else app_tar_base)
     except IOError as err:
       gLogger.exception(str(err))
       return S_ERROR('Exception during url retrieve: %s' % str(err))
   else:
     datMan = DataManager()
-    resget = datMan.getFile("%s%s" % (tarballURL, app_tar))
+    if destination:
+      resget = datMan.getFile("%s%s" % (tarballURL, app_tar), destinationDir = destination)
+    else:
+      resget = datMan.getFile("%s%s" % (tarballURL, app_tar))
     if not resget['OK']:
       gLogger.error("File could not be downloaded from the grid")
       return resget
@@ -138,18 +110,66 @@ def tarMd5Check(app_tar_base, md5sum ):
   return S_OK()
 
 def installDependencies(app, config, areas):
-  """install dependencies for application"""
+  """install dependencies for application
+
+  The dependencies are downloaded and extracted at the same time, then checked and configured in order
+
+  :returns: S_OK with the dictionary of (name, version): time spent prefetching the dependency, S_ERROR
+  """
   appName    = app[0].lower()
   appVersion = app[1]
 
   deps = resolveDeps(config, appName, appVersion)
+  installTimes = prefetchPackages([ (dep["app"], dep["version"]) for dep in deps ], config, areas)
   for dep in deps:
     depapp = [ dep["app"], dep["version"] ]
     resDep = installInAnyArea(areas, depapp, config)
     if not resDep['OK']:
       return S_ERROR("Failed to install dependency: %s" % str(depapp))
 
-  return S_OK()
+  return S_OK(installTimes)
+
+def prefetchPackages(apps, config, areas):
+  """ Download and extract the packages at the same time, so that installing them afterwards only has to
+  check and configure them. The packages do not depend on each other until they are configured, which
+  changes the environment and the current directory and is left to :func:`installInAnyArea`.
+
+  Failures are only logged, they are reported when the package is installed.
+
+  :param list apps: list of (name, version) of the packages
+  :param str config: platform of the job
+  :param list areas: areas in which the packages can be installed, in order of preference
+  :returns: dictionary of (name, version): time spent on the package in seconds
+  """
+  apps = sorted(set(tuple(app) for app in apps))
+  nbWorkers = Operations().getValue('/Software/InstallWorkers', 4)
+  if not apps or nbWorkers < 2:
+    return {}
+
+  def prefetchPackage(app):
+    """ install one package in the first area possible, in a worker thread """
+    startTime = time.time()
+    res = getTarBallLocation(app, config, None)
+    if not res['OK']:
+      return app, time.time() - startTime
+    app_tar, tarballURL, overwrite, md5sum = res['Value']
+    ## Packages which are always installed again are left to installInAnyArea, to be installed only once
+    if overwrite:
+      return app, time.time() - startTime
+    for area in areas:
+      res = install(app, app_tar, tarballURL, overwrite, md5sum, area)
+      if res['OK']:
+        break
+      gLogger.warn('Failed to prefetch %s_%s in %s: %s' % (app[0], app[1], area, res['Message']))
+    return app, time.time() - startTime
+
+  gLogger.info('Installing %d packages with %d workers' % (len(apps), nbWorkers))
+  pool = ThreadPool(min(nbWorkers, len(apps)))
+  try:
+    return dict(pool.map(prefetchPackage, apps))
+  finally:
+    pool.close()
+    pool.join()
 
 def installInAnyArea(areas, app, jobConfig):
   """try to install app in any area of areas"""
@@ -197,6 +217,10 @@ def getTarBallLocation(app, config, dummy_area):
 
 def install(app, app_tar, tarballURL, overwrite, md5sum, area):
   """ Install the software
+
+  The tar ball is downloaded and extracted in a staging directory of the area named after its md5 sum, which
+  is then renamed to the final location. Other jobs see either the complete installation or none at all, and
+  only wait for the jobs installing the same software, on an fcntl lock.
   """
   appName    = app[0]
   appVersion = app[1]
@@ -204,136 +228,167 @@ def install(app, app_tar, tarballURL, overwrite, md5sum, area):
   #jar file does not contain .tgz nor tar.gz so the file name is untouched and folder_name = app_tar
   if appName == "slic":
     folder_name = "%s%s" % (appName, appVersion)
-  
-  appli_exists = False
   app_tar_base = os.path.basename(app_tar)
 
-  ###########################################
-  ###Go where the software is to be installed
-  os.chdir(area)
-  #We go back to the initial place at any return
-  ###########################################
-  ##Handle the locking
-  lockname = folder_name+".lock"
-  #Make sure the lock is not too old, or wait until it's gone
-  res = checkLockAge(lockname)
+  jobDir = os.getcwd()
+  area = os.path.join(jobDir, area)
+  installPath = os.path.join(area, folder_name)
+
+  #Check if the application is here and not to be overwritten, no need to lock: it is only published complete
+  if not overwrite and os.path.exists(installPath):
+    gLogger.info("Folder or file %s found in %s, skipping install !" % (folder_name, area))
+    return S_OK([folder_name, app_tar_base])
+
+  res = lockInstallation(os.path.join(area, ".%s.lock" % folder_name), jobDir)
   if not res['OK']:
     gLogger.error("Something uncool happened with the lock, will kill installation")
     gLogger.error("Message: %s" % res['Message'])
     return S_ERROR("Failed lock checks")
-
-  if 'Value' in res and res['Value']: #this means the lock file was very old, meaning that the installation failed elsewhere
-    overwrite = True
-
-  #Check if the application is here and not to be overwritten
-  if os.path.exists(folder_name):
-    appli_exists = True
-    if not overwrite:
+  lockFile, waited = res['Value']
+  try:
+    #Another job may have installed it while we were waiting for the lock
+    if os.path.exists(installPath) and (waited or not overwrite):
       gLogger.info("Folder or file %s found in %s, skipping install !" % (folder_name, area))
       return S_OK([folder_name, app_tar_base])
-  
-  ## If we are here, it means the application was never installed OR its overwrite flag is true
-    
-  #Now lock the area
-  res = createLock(lockname)##This will fail if not allowed to write here
-  if not res['OK']:
-    gLogger.error(res['Message'])
-    return res
-  
-  ## Cleanup old version in case it has to be overwritten (implies it's already here)
-  ## In particular the jar file of LCSIM
-  if appli_exists and overwrite:
-    gLogger.info("Overwriting %s found in %s" % (folder_name, area))
-    res = deleteOld(folder_name) 
-    if not res['OK']:#should be always OK for the time being
-      clearLock(lockname)
-      return res
-    ## Now application must have been removed
-  
-  ## If here, the application DOES NOT exist locally: either it was here and the overwrite flag was false and 
-  ## we returned earlier, either it was here and the overwrite flag was true and it was removed, or finally it
-  ## was never here so here appli_exists=False always
 
-  ## Now we can get the files and unpack them
-    
-  ## Downloading file from url
-  res = downloadFile(tarballURL, app_tar, folder_name)
-  if not res['OK']:
-    clearLock(lockname)
-    return res
-  
-  ## Check that the tar ball is there. Should never happen as download file catches the errors
-  if not os.path.exists("%s/%s" % (os.getcwd(), app_tar_base)):
-    gLogger.error('Failed to download software','%s' % (folder_name))
-    clearLock(lockname)
-    return S_ERROR('Failed to download software')
-
-  # FIXME: this is really bad style, suggestion: create 2 private methods that (download a file and check its md5)
-  # and (delete the old files and cleanup), then call the download_and_check method once and create a loop
-  # with a MAX_TRIES variable that cleans up the old files and tries to download again until MAX_TRIES are used up.
-  # The loop is only entered if download/md5check fail and if anything goes wrong in the loop, `continue` is called
-  # Could also think about creating a clearLockAndExit method that takes a string (lockname) and return value res
-  # and just calls clearLock(lockname) return res. Then replace these double calls in this method with return clearLockAndExit
-
-  ## Check that the downloaded file (or existing one) has the right checksum
-  res = tarMd5Check(app_tar_base, md5sum)
-  if not res['OK']:
-    gLogger.error("Will try getting the file again, who knows")
-    try:#Remove tar ball that we just got
-      os.unlink("%s/%s" % (os.getcwd(), app_tar_base))
-    except OSError:
-      gLogger.error("Failed to clean tar ball, something bad is happening")
-    ## Clean up existing stuff (if any, in particular the jar file)
-    res = deleteOld(folder_name)
-    if not res['OK']:#should be always OK for the time being
-      clearLock(lockname)
-      return res
-    res = downloadFile(tarballURL, app_tar, folder_name)
+    stagingDir = os.path.join(area, ".%s.%s.installing" % (folder_name, md5sum or "nomd5"))
+    res = stageInstallation(app_tar, tarballURL, md5sum, folder_name, stagingDir)
     if not res['OK']:
-      clearLock(lockname)
       return res
-    res = tarMd5Check(app_tar_base, md5sum)
-    if not res['OK']:
-      gLogger.error("Hash failed again, something is really wrong, cannot continue.")
-      clearLock(lockname)
-      return S_ERROR("MD5 check failed")
-  
 
-  if tarfile.is_tarfile(app_tar_base):##needed because LCSIM is jar file
-    app_tar_to_untar = tarfile.open(app_tar_base)
+    ## Publish the installation, the old one is moved away first if it has to be overwritten
+    try:
+      if os.path.lexists(installPath):
+        gLogger.info("Overwriting %s found in %s" % (folder_name, area))
+        os.rename(installPath, os.path.join(stagingDir, "old"))
+      os.rename(res['Value'], installPath)
+    except OSError as e:
+      gLogger.error("Failed to publish the installation:", str(e))
+      return S_ERROR("Failed to publish the installation of %s: %s" % (folder_name, str(e)))
+    shutil.rmtree(stagingDir, ignore_errors = True)
+  finally:
+    unlockInstallation(lockFile)
+
+  return S_OK([folder_name, app_tar_base])
+
+class _HashingReader(object):
+  """ File object computing the md5 sum of what is read from another one """
+  def __init__(self, fileObj):
+    self.fileObj = fileObj
+    self.md5 = md5.md5()
+
+  def read(self, size = -1):
+    """ read and add to the md5 sum """
+    data = self.fileObj.read(size)
+    self.md5.update(data)
+    return data
+
+def streamTarBall(tarballURL, app_tar, md5sum, extractDir):
+  """ Extract the tar ball while it is downloaded, its md5 sum is checked once it is complete
+
+  :returns: S_OK, S_ERROR
+  """
+  if tarballURL[-1] != "/":
+    tarballURL += "/"
+  gLogger.debug("Downloading and extracting software", app_tar)
+  try:
+    remote = urllib2.urlopen("%s%s" % (tarballURL, app_tar))
     try:
-      app_tar_to_untar.extractall()
-    except TarError as e:
+      reader = _HashingReader(remote)
+      tarfile.open(fileobj = reader, mode = "r|*").extractall(extractDir)
+      ## the end of the file is needed for the md5 sum
+      while reader.read(TAR_STREAM_BUFFER):
+        pass
+    finally:
+      remote.close()
+  except (IOError, OSError, TarError, httplib.HTTPException) as err:
+    return S_ERROR("Exception while extracting %s: %s" % (app_tar, str(err)))
+  if md5sum and md5sum != reader.md5.hexdigest():
+    gLogger.error('Hash does not correspond, found %s, expected %s' % (reader.md5.hexdigest(), md5sum))
+    return S_ERROR("Hash does not correspond")
+  return S_OK()
+
+def stageInstallation(app_tar, tarballURL, md5sum, folder_name, stagingDir):
+  """ Download and extract the tar ball in the staging directory, must hold the installation lock
+
+  Tar balls from a web server are extracted while they are downloaded. A tar ball left in the staging directory
+  by a failed installation is used again if its md5 sum is correct.
+
+  :returns: S_OK with the path of the extracted folder_name, S_ERROR
+  """
+  app_tar_base = os.path.basename(app_tar)
+  tarball = os.path.join(stagingDir, app_tar_base)
+  extractDir = os.path.join(stagingDir, "extract")
+  try:
+    if not os.path.isdir(stagingDir):
+      os.makedirs(stagingDir)
+    for oldContent in (extractDir, os.path.join(stagingDir, "old")):
+      if os.path.exists(oldContent):
+        shutil.rmtree(oldContent)
+    os.mkdir(extractDir)
+  except OSError as e:
+    gLogger.error("Failed to create the staging directory:", str(e))
+    return S_ERROR("Failed to create the staging directory: %s" % str(e))
+
+  stagedPath = os.path.join(extractDir, folder_name)
+  extracted = False
+  downloaded = bool(md5sum) and os.path.exists(tarball) and tarMd5Check(tarball, md5sum)['OK']
+  if downloaded:
+    gLogger.info("Using the tar ball already downloaded", tarball)
+  elif tarballURL.find("http://") > -1 and app_tar.endswith((".tgz", ".tar.gz")):
+    res = streamTarBall(tarballURL, app_tar, md5sum, extractDir)
+    if res['OK']:
+      extracted = True
+    else:
+      gLogger.warn("Failed to extract the tar ball while downloading it, downloading it first:", res['Message'])
+      shutil.rmtree(extractDir)
+      os.mkdir(extractDir)
+
+  if not extracted and not downloaded:
+    for attempt in xrange(2):
+      if os.path.exists(tarball):
+        os.unlink(tarball)
+      res = downloadFile(tarballURL, app_tar, folder_name, stagingDir)
+      if not res['OK']:
+        return res
+      ## Check that the tar ball is there. Should never happen as download file catches the errors
+      if not os.path.exists(tarball):
+        gLogger.error('Failed to download software','%s' % (folder_name))
+        return S_ERROR('Failed to download software')
+      if tarMd5Check(tarball, md5sum)['OK']:
+        break
+      if attempt:
+        gLogger.error("Hash failed again, something is really wrong, cannot continue.")
+        return S_ERROR("MD5 check failed")
+      gLogger.error("Will try getting the file again, who knows")
+
+  if not extracted and not tarfile.is_tarfile(tarball):##needed because LCSIM is jar file
+    shutil.move(tarball, stagedPath)
+    return S_OK(stagedPath)
+
+  if not extracted:
+    try:
+      tarfile.open(tarball).extractall(extractDir)
+    except (TarError, IOError, OSError) as e:
       gLogger.error("Could not extract tar ball %s because of %s, cannot continue !" % (app_tar_base, str(e)))
-      clearLock(lockname)
       return S_ERROR("Could not extract tar ball %s because of %s, cannot continue !"%(app_tar_base, str(e)))
-    if folder_name.count("slic"):
-      slicname = folder_name
-      members = app_tar_to_untar.getmembers()
-      fileexample = members[0].name
-      basefolder = fileexample.split("/")[0]
-      try:
-        os.rename(basefolder, slicname)
-      except OSError as e:
-        gLogger.error("Failed renaming slic:", str(e))
-        clearLock(lockname)
-        return S_ERROR("Could not rename slic directory")
-  try:
-    dircontent = os.listdir(folder_name)
-    if not len(dircontent):
-      clearLock(lockname)
-      return S_ERROR("Folder %s is empty, considering install as failed" % folder_name)
-  except OSError:
-    pass
-  
-  #Everything went fine, we try to clear the lock  
-  clearLock(lockname)
-    
-  return S_OK([folder_name, app_tar_base]) 
+  if folder_name.count("slic"):
+    try:
+      basefolder, = os.listdir(extractDir)
+      os.rename(os.path.join(extractDir, basefolder), stagedPath)
+    except (ValueError, OSError) as e:
+      gLogger.error("Failed renaming slic:", str(e))
+      return S_ERROR("Could not rename slic directory")
+  if not os.path.isdir(stagedPath):
+    return S_ERROR("Tar ball %s does not contain the folder %s" % (app_tar_base, folder_name))
+  if not os.listdir(stagedPath):
+    return S_ERROR("Folder %s is empty, considering install as failed" % folder_name)
+  return S_OK(stagedPath)
 
 def check(app, area, res_from_install):
   """ Now that the tar ball is here, we need to check that all is there
   """
+  jobDir = os.getcwd()
   ###########################################
   ###Go where the software is to be installed
   os.chdir(area)
@@ -380,6 +435,7 @@ def check(app, area, res_from_install):
 def configure(app, area, res_from_check):
   """ Configure our applications: set the proper env variables
   """
+  jobDir = os.getcwd()
   ###########################################
   ###Go where the software is to be installed
   os.chdir(area)
@@ -415,6 +471,7 @@ def configure(app, area, res_from_check):
 def clean(area, res_from_install):
   """ After install, clean the tar balls and go back to initial directory
   """
+  jobDir = os.getcwd()
   ###########################################
   ###Go where the software is to be installed
   os.chdir(area)
@@ -7,9 +7,20 @@ Several utilities to "guess" the files names and the paths
 __RCSID__ = "$Id$"
 
 import os
+import time
 from DIRAC import S_OK, S_ERROR
 from DIRAC import gLogger
+from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
 from ILCDIRAC.Core.Utilities.FilenameEncoder import FilenameEncoder, decodeFilename
+from ILCDIRAC.Core.Utilities.Backoff import Backoff
+
+## Marker files next to input files downloaded in the background by the DownloadInputData module
+DOWNLOADING_SUFFIX = ".downloading"
+DOWNLOAD_FAILED_SUFFIX = ".downloadFailed"
+## Default of /DownloadInputData/WaitTimeout: how long to wait for input files still being downloaded, in seconds
+DOWNLOAD_WAIT_TIMEOUT = 6 * 3600
+DOWNLOAD_POLL_INTERVAL = 5
+DOWNLOAD_MAX_POLL_INTERVAL = 60
 ###############################################################################
 def getProdFilenameFromInput( inputfile, outfileOriginal, prodID, jobID ) :
   '''  Build the output file names based on inputfile name and job property
@@ -121,6 +132,9 @@ def resolveIFpaths(inputfiles):
   for mydir in os.listdir(os.getcwd()):
     if os.path.isdir(mydir):
       listofdirs.append(mydir)
+  res = _waitForDownloads(listoffiles, listofdirs)
+  if not res['OK']:
+    return res
   filesnotfound = []
   for infile in listoffiles:
     filefound = False
@@ -140,3 +154,35 @@ def resolveIFpaths(inputfiles):
     return S_ERROR("resolveIFPath: Input file(s) '%s' not found locally" % (", ".join(filesnotfound)))
   log.verbose("Found all input files")
   return S_OK(listofpaths)
+
+def _waitForDownloads(listoffiles, listofdirs):
+  """ Wait until the input files that are still downloaded in the background are complete
+
+  Stops waiting as soon as the download of one of the files failed.
+
+  :param list listoffiles: names of the input files
+  :param list listofdirs: directories where the files can be
+  :returns: S_OK, S_ERROR if a download failed or the files are not complete after /DownloadInputData/WaitTimeout
+  """
+  log = gLogger.getSubLogger("ResolveInputFiles")
+  waitTimeout = Operations().getValue("/DownloadInputData/WaitTimeout", DOWNLOAD_WAIT_TIMEOUT)
+  paths = [os.path.join(os.getcwd(), mydir, infile) for infile in listoffiles for mydir in [''] + listofdirs]
+  startTime = time.time()
+  backoff = Backoff(initial=DOWNLOAD_POLL_INTERVAL, maximum=DOWNLOAD_MAX_POLL_INTERVAL)
+  pending = [path for path in paths if os.path.exists(path + DOWNLOADING_SUFFIX)]
+  while True:
+    failed = [path for path in paths if os.path.exists(path + DOWNLOAD_FAILED_SUFFIX)]
+    if failed:
+      for path in failed:
+        with open(path + DOWNLOAD_FAILED_SUFFIX) as marker:
+          log.error("Download of input file failed:", "%s: %s" % (os.path.basename(path), marker.read()))
+      return S_ERROR("resolveIFPath: Input file(s) '%s' not found locally, download failed" %
+                     ", ".join(os.path.basename(path) for path in failed))
+    if not pending:
+      return S_OK()
+    if time.time() - startTime > waitTimeout:
+      return S_ERROR("resolveIFPath: Input file(s) '%s' not found locally, still downloading" %
+                     ", ".join(os.path.basename(path) for path in pending))
+    log.info("Waiting for %d input file(s) to be downloaded" % len(pending))
+    backoff.wait()
+    pending = [path for path in pending if os.path.exists(path + DOWNLOADING_SUFFIX)]
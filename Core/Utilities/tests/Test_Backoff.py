@@ -0,0 +1,66 @@
+"""Test Backoff """
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+from ILCDIRAC.Core.Utilities.Backoff import Backoff, idlePeriod, WATCHDOG_DISABLE_FILE
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.Core.Utilities.Backoff'
+
+class BackoffTest( unittest.TestCase ):
+  """Test the Backoff"""
+
+  def setUp( self ):
+    self.jobDir = tempfile.mkdtemp()
+    self.watchdogFile = os.path.join( self.jobDir, WATCHDOG_DISABLE_FILE )
+
+  def tearDown( self ):
+    shutil.rmtree( self.jobDir )
+
+  def test_delays( self ):
+    backoff = Backoff( initial = 10, maximum = 60, jitter = 0, jobDir = self.jobDir )
+    self.assertEquals( [ backoff.nextDelay() for _ in xrange( 5 ) ], [ 10, 20, 40, 60, 60 ] )
+    backoff.reset()
+    self.assertEquals( backoff.nextDelay(), 10 )
+    self.assertEquals( backoff.nextDelay( maximum = 5 ), 5 )
+    self.assertEquals( backoff.nextDelay(), 40 )
+
+  def test_jitter( self ):
+    backoff = Backoff( initial = 100, maximum = 100, jitter = 0.5, jobDir = self.jobDir )
+    for _ in xrange( 100 ):
+      self.assertTrue( 50 <= backoff.nextDelay() <= 150 )
+
+  def test_wait( self ):
+    backoff = Backoff( initial = 10, maximum = 60, jitter = 0, jobDir = self.jobDir )
+    with patch( '%s.time.sleep' % MODULE_NAME, new=lambda _delay: self.assertTrue( os.path.exists( self.watchdogFile ) ) ):
+      self.assertEquals( backoff.wait(), 10 )
+      self.assertEquals( backoff.wait(), 20 )
+    self.assertEquals( backoff.waited, 30 )
+    self.assertFalse( os.path.exists( self.watchdogFile ) )
+
+  def test_idle_nested( self ):
+    with idlePeriod( self.jobDir ):
+      with idlePeriod( self.jobDir ):
+        self.assertTrue( os.path.exists( self.watchdogFile ) )
+      self.assertTrue( os.path.exists( self.watchdogFile ) )
+    self.assertFalse( os.path.exists( self.watchdogFile ) )
+
+  def test_idle_keeps_existing_file( self ):
+    open( self.watchdogFile, 'w' ).close()
+    with idlePeriod( self.jobDir ):
+      pass
+    self.assertTrue( os.path.exists( self.watchdogFile ) )
+
+  def test_idle_cannot_write( self ):
+    with idlePeriod( os.path.join( self.jobDir, 'doesNotExist' ) ):
+      pass
+    self.assertFalse( os.path.exists( self.watchdogFile ) )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( BackoffTest )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
@@ -58,6 +58,7 @@ class TestCombinedSWInstallation( unittest.TestCase ):
   def test_execute( self ):
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[ { 'app' : 'dependency123', 'version' : '3.4' } ])), \
          patch('%s.Operations.getSections' % MODULE_NAME, new=Mock(return_value=S_OK(['x86_64-slc5-gcc43-opt']))), \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={})), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_OK())), \
          patch('%s.NativeMachine.CMTSupportedConfig' % MODULE_NAME, new=Mock(return_value=['x86_64-slc5-gcc43-opt'])):
       self.csi = CombinedSoftwareInstallation( TestCombinedSWInstallation.STD_DICT )
@@ -91,6 +92,7 @@ class TestCombinedSWInstallation( unittest.TestCase ):
   def test_execute_locally( self ):
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[ { 'app' : 'dependency123', 'version' : '3.4' } ])), \
          patch('%s.Operations.getSections' % MODULE_NAME, new=Mock(return_value=S_OK([]))), \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={})), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_OK())), \
          patch('%s.checkCVMFS' % MODULE_NAME, new=Mock(side_effect=[S_OK(), S_ERROR()])), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(side_effect=[S_OK(), S_OK()])), \
@@ -105,6 +107,7 @@ class TestCombinedSWInstallation( unittest.TestCase ):
   def test_execute_installfails( self ):
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[ { 'app' : 'dependency123', 'version' : '3.4' } ])), \
          patch('%s.Operations.getSections' % MODULE_NAME, new=Mock(return_value=S_OK([]))), \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={})), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_OK())), \
          patch('%s.checkCVMFS' % MODULE_NAME, new=Mock(side_effect=[S_OK(), S_ERROR()])), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_ERROR('could not install my test program'))), \
@@ -119,7 +122,8 @@ class TestCombinedSWInstallation( unittest.TestCase ):
   def test_execute_install_dependency_fails( self ):
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[ { 'app' : 'dependency123', 'version' : '3.4' } ])), \
          patch('%s.Operations.getSections' % MODULE_NAME, new=Mock(return_value=S_OK([]))), \
-         patch('%s.installDependencies' % MODULE_NAME, new=Mock(side_effect=[S_OK(), S_ERROR()])), \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={})), \
+         patch('%s.installDependencies' % MODULE_NAME, new=Mock(side_effect=[S_OK({}), S_ERROR()])), \
          patch('%s.createSharedArea' % MODULE_NAME, new=Mock(return_value=False)), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_OK())):
       import copy
@@ -132,6 +136,7 @@ class TestCombinedSWInstallation( unittest.TestCase ):
   def test_execute_nosharedarea( self ):
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[ { 'app' : 'dependency123', 'version' : '3.4' } ])), \
          patch('%s.Operations.getSections' % MODULE_NAME, new=Mock(return_value=S_OK([]))), \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={})), \
          patch('%s.getSharedAreaLocation' % MODULE_NAME, new=Mock(return_value='')), \
          patch('%s.createSharedArea' % MODULE_NAME, new=Mock(return_value=True)), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_OK())):
@@ -142,6 +147,35 @@ class TestCombinedSWInstallation( unittest.TestCase ):
       result = self.csi.execute()
       assertDiracSucceeds( result, self )
 
+  def test_execute_reports_install_times( self ):
+    times = { ( 'dependency123', '3.4' ) : 12.3, ( 'mypackagev1', '0' ) : 45.6 }
+    with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[ { 'app' : 'dependency123', 'version' : '3.4' } ])), \
+         patch('%s.Operations.getSections' % MODULE_NAME, new=Mock(return_value=S_OK([]))), \
+         patch('%s.checkCVMFS' % MODULE_NAME, new=Mock(side_effect=[S_ERROR(), S_ERROR()])), \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value=times)) as prefetch_mock, \
+         patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_OK())), \
+         patch('%s.installDependencies' % MODULE_NAME, new=Mock(side_effect=[ S_OK( { ( 'libdep', '1.0' ) : 7.0 } ),
+                                                                             S_OK( { ( 'libdep', '1.0' ) : 0.1 } ) ])), \
+         patch('%s.createSharedArea' % MODULE_NAME, new=Mock(return_value=False)), \
+         patch('%s.RPCClient' % MODULE_NAME) as rpc_mock:
+      rpc_mock.return_value.setJobParameter.return_value = S_OK()
+      import copy
+      custom_dict = copy.deepcopy( TestCombinedSWInstallation.STD_DICT )
+      custom_dict['Job']['JobID'] = '1234'
+      self.csi = CombinedSoftwareInstallation( custom_dict )
+      self.csi.ceConfigs = []
+      self.csi.sharedArea = ''
+      assertDiracSucceeds( self.csi.execute(), self )
+      prefetch_mock.assert_called_once_with( [ ( 'dependency123', '3.4' ), ( 'mypackagev1', '0' ) ],
+                                             'mytestconfig', [ self.csi.localArea ] )
+      rpc_mock.return_value.setJobParameter.assert_called_once_with( 1234, 'SoftwareInstallationTimes',
+                                                                      'dependency123 3.4: 12s, libdep 1.0: 7s, mypackagev1 0: 46s' )
+
+  def test_set_install_times_nojobid( self ):
+    with patch('%s.RPCClient' % MODULE_NAME) as rpc_mock:
+      assertDiracFailsWith( self.csi.setInstallTimes( { ( 'myprogram', 'v6765' ) : 1.0 } ), 'jobid not defined', self )
+      self.assertFalse( rpc_mock.called )
+
   def test_listareadir_nofail( self ):
     with patch('%s.systemCall' % MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'important_message', 'my_subprocess_error_msg']))), \
          patch('%s.DIRAC.gLogger.info' % MODULE_NAME, new=Mock(side_effect=[True, KeyError('injecting this into logger call')])) as mock_log:
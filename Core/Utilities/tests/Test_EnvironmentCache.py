@@ -0,0 +1,73 @@
+"""Test EnvironmentCache """
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch, MagicMock as Mock
+
+from DIRAC import S_OK, S_ERROR
+from ILCDIRAC.Core.Utilities.EnvironmentCache import EnvironmentCache
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracFailsWith, assertDiracSucceeds
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.Core.Utilities.EnvironmentCache'
+
+class EnvironmentCacheTest( unittest.TestCase ):
+  """Test the EnvironmentCache"""
+
+  def setUp( self ):
+    self.tmpdir = tempfile.mkdtemp()
+    self.envScript = os.path.join( self.tmpdir, 'env.sh' )
+    with open( self.envScript, 'w' ) as script:
+      script.write( 'echo "not part of the environment"\n' )
+      script.write( 'export MARLIN_DLL=/lib/libA.so:/lib/libB.so\n' )
+      script.write( 'export MULTILINE="first\nsecond=2"\n' )
+    self.cache = EnvironmentCache()
+
+  def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
+
+  def test_entries( self ):
+    entry = self.cache.getEntry( 'x86_64-slc5-gcc43-opt', 'Marlin', 'v0111Prod' )
+    entry['LDLibs'] = '/some/lib'
+    self.assertIs( self.cache.getEntry( 'x86_64-slc5-gcc43-opt', 'marlin', 'v0111Prod' ), entry )
+    self.assertEquals( self.cache.getEntry( 'x86_64-slc5-gcc43-opt', 'marlin', 'v0112' ), {} )
+    self.assertEquals( repr( self.cache ), '<EnvironmentCache of marlin v0111Prod, marlin v0112>' )
+
+  def test_script_environment( self ):
+    result = self.cache.getScriptEnvironment( 'platform', 'marlin', 'v1', self.envScript )
+    assertDiracSucceeds( result, self )
+    self.assertEquals( result['Value']['MARLIN_DLL'], '/lib/libA.so:/lib/libB.so' )
+    self.assertEquals( result['Value']['MULTILINE'], 'first\nsecond=2' )
+    self.assertIn( 'PATH', result['Value'] )
+    ## the script is not sourced again
+    with patch('%s.systemCall' % MODULE_NAME) as system_mock:
+      self.assertIs( self.cache.getScriptEnvironment( 'platform', 'marlin', 'v1', self.envScript )['Value'], result['Value'] )
+      self.assertFalse( system_mock.called )
+
+  def test_script_fails( self ):
+    with open( self.envScript, 'a' ) as script:
+      script.write( 'false\n' )
+    with patch('%s.LOG' % MODULE_NAME) as log_mock:
+      result = self.cache.getScriptEnvironment( 'platform', 'marlin', 'v1', self.envScript )
+    assertDiracSucceeds( result, self )
+    self.assertEquals( result['Value']['MARLIN_DLL'], '/lib/libA.so:/lib/libB.so' )
+    self.assertEquals( self.cache.getEntry( 'platform', 'marlin', 'v1' )['Environment'], result['Value'] )
+    self.assertTrue( log_mock.warn.called )
+
+  def test_script_call_fails( self ):
+    with patch('%s.systemCall' % MODULE_NAME, new=Mock(return_value=S_ERROR( 'no shell' ))):
+      assertDiracFailsWith( self.cache.getScriptEnvironment( 'platform', 'marlin', 'v1', self.envScript ),
+                            'no shell', self )
+    self.assertEquals( self.cache.getEntry( 'platform', 'marlin', 'v1' ), {} )
+
+  def test_other_script( self ):
+    with patch('%s.systemCall' % MODULE_NAME, new=Mock(side_effect=[ S_OK( [ 0, 'A=1\0', '' ] ), S_OK( [ 0, 'A=2\0', '' ] ) ])):
+      self.assertEquals( self.cache.getScriptEnvironment( 'platform', 'marlin', 'v1', 'first.sh' )['Value'], { 'A' : '1' } )
+      self.assertEquals( self.cache.getScriptEnvironment( 'platform', 'marlin', 'v1', 'second.sh' )['Value'], { 'A' : '2' } )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( EnvironmentCacheTest )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 """Test the FileUtils class"""
 
+import hashlib
+import os
+import shutil
 import sys
+import tempfile
 import unittest
+import zlib
 from distutils import errors
 from mock import patch, MagicMock as Mock
 
@@ -251,6 +256,34 @@ class TestFileUtils( unittest.TestCase ):
       copytree_mock.assert_called_once_with( '/my/src/directory/other__file.stdhep', '/my/destination/dir/other__file.stdhep' )
 
 
+  def test_getfilechecksums( self ):
+    from ILCDIRAC.Core.Utilities.FileUtils import getFileChecksums
+    tmpdir = tempfile.mkdtemp()
+    try:
+      fileName = os.path.join( tmpdir, 'output.slcio' )
+      with open( fileName, 'w' ) as outputFile:
+        outputFile.write( 'some events' * 1000 )
+      result = getFileChecksums( fileName, ( 'md5', ) )
+      assertDiracSucceeds( result, self )
+      self.assertEquals( result['Value']['ADLER32'], '%08x' % ( zlib.adler32( 'some events' * 1000 ) & 0xffffffff ) )
+      self.assertEquals( result['Value']['md5'], hashlib.md5( 'some events' * 1000 ).hexdigest() )
+      ## the checksum is not computed again for the same file
+      with patch('%s.zlib.adler32' % MODULE_NAME, new=Mock()) as adler_mock:
+        self.assertEquals( getFileChecksums( fileName )['Value']['ADLER32'], result['Value']['ADLER32'] )
+        self.assertFalse( adler_mock.called )
+      ## but it is when the file changed
+      with open( fileName, 'w' ) as outputFile:
+        outputFile.write( 'other events' )
+      os.utime( fileName, ( 1, 1 ) )
+      result = getFileChecksums( fileName )
+      self.assertEquals( result['Value']['ADLER32'], '%08x' % ( zlib.adler32( 'other events' ) & 0xffffffff ) )
+    finally:
+      shutil.rmtree( tmpdir )
+
+  def test_getfilechecksums_missing( self ):
+    from ILCDIRAC.Core.Utilities.FileUtils import getFileChecksums
+    assertDiracFailsWith( getFileChecksums( '/my/missing/file.slcio' ), 'failed to compute checksum', self )
+
   def test_fullcopy( self ):
     from ILCDIRAC.Core.Utilities.FileUtils import fullCopy
     with patch('%s.glob.glob' % MODULE_NAME, new=Mock(return_value=['/my/src/directory/file_1_globbed.log','/my/src/directory/other__file.stdhep', 'lastfile_in_list.txt'])), \
@@ -4,8 +4,10 @@ tests for InputFilesUtilities
 """
 import unittest
 from mock import MagicMock as Mock, patch
-from ILCDIRAC.Core.Utilities.InputFilesUtilities import getNumberOfEvents
-from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracSucceedsWith_equals
+from ILCDIRAC.Core.Utilities.InputFilesUtilities import getNumberOfEvents, getNumberOfEventsPerFile, \
+  getFileMetadata, resetMetadataCache
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracSucceedsWith_equals, assertDiracFailsWith, \
+  assertDiracSucceeds
 
 from DIRAC import gLogger, S_OK, S_ERROR
 
@@ -22,6 +24,7 @@ class TestgetNumberOfEvents( unittest.TestCase ):
     self.inputfile = "/ilc/prod/ilc/mc-dbd/generated/500-TDR_ws/6f_eeWW/v01-16-p05_500/00005160/000/E500-TDR_ws.I108640.P6f_eexyev.eL.pR_gen_5160_2_065.stdhep"
     self.inputfiles = [ self.inputfile, self.inputfile ]
     gLogger.setLevel("DEBUG")
+    resetMetadataCache()
 
   def tearDown(self):
     """ Remove the fake files
@@ -31,6 +34,7 @@ class TestgetNumberOfEvents( unittest.TestCase ):
   def test_getNumberOfEvents(self):
     """test getNumberOfEvents Single File Success..................................................."""
     fcMock = Mock()
+    del fcMock.getFileUserMetadataBulk
     fcMock.getDirectoryUserMetadata = Mock(return_value=S_OK({"NumberOfEvents":500}))
     fcMock.getFileUserMetadata = Mock(return_value=S_OK({"NumberOfEvents":500}))
 
@@ -41,6 +45,7 @@ class TestgetNumberOfEvents( unittest.TestCase ):
   def test_getNumberOfEvents_2(self):
     """test getNumberOfEvents Multiple File Success................................................."""
     fcMock = Mock()
+    del fcMock.getFileUserMetadataBulk
     fcMock.getDirectoryUserMetadata = Mock(return_value=S_OK({"NumberOfEvents":500}))
     fcMock.getFileUserMetadata = Mock(return_value=S_OK({"NumberOfEvents":500}))
     with patch( "%s.FileCatalogClient" % MODULE_NAME, new=Mock(return_value=fcMock)):
@@ -50,6 +55,7 @@ class TestgetNumberOfEvents( unittest.TestCase ):
   def test_getNumberOfEvents_Fail(self):
     """test getNumberOfEvents Single File Failure..................................................."""
     fcMock = Mock()
+    del fcMock.getFileUserMetadataBulk
     fcMock.getDirectoryUserMetadata = Mock(return_value=S_ERROR("No Such File"))
     fcMock.getFileUserMetadata = Mock(return_value=S_ERROR("No Such File"))
     with patch( "%s.FileCatalogClient" % MODULE_NAME, new=Mock(return_value=fcMock)):
@@ -59,6 +65,7 @@ class TestgetNumberOfEvents( unittest.TestCase ):
   def test_getNumberOfEvents_Fail2(self):
     """test getNumberOfEvents Multiple File Failure................................................."""
     fcMock = Mock()
+    del fcMock.getFileUserMetadataBulk
     fcMock.getDirectoryUserMetadata = Mock(return_value=S_ERROR("No Such File"))
     fcMock.getFileUserMetadata = Mock(return_value=S_ERROR("No Such File"))
     with patch( "%s.FileCatalogClient" % MODULE_NAME, new=Mock(return_value=fcMock)):
@@ -82,6 +89,7 @@ class TestgetNumberOfEvents( unittest.TestCase ):
                             '/other' : S_OK( { 'NumberOfEvents' : None, 'Luminosity' : None } ),
                             '/one/file' : S_OK( {} ) }
     fcMock = Mock()
+    del fcMock.getFileUserMetadataBulk
     fcMock.getDirectoryUserMetadata = Mock(side_effect=lambda path: directory_meta_dict[path])
     fcMock.getFileUserMetadata = Mock(side_effect=lambda filename : file_meta_dict[filename] )
     with patch( "%s.FileCatalogClient" % MODULE_NAME, new=Mock(return_value=fcMock)):
@@ -101,6 +109,7 @@ class TestgetNumberOfEvents( unittest.TestCase ):
                             '/other' : S_ERROR( { 'NumberOfEvents' : None, 'Luminosity' : None } ),
                             '/one/file' : S_OK( {} ) }
     fcMock = Mock()
+    del fcMock.getFileUserMetadataBulk
     fcMock.getDirectoryUserMetadata = Mock(side_effect=lambda path: directory_meta_dict[path])
     fcMock.getFileUserMetadata = Mock(side_effect=lambda filename : file_meta_dict[filename] )
     with patch( "%s.FileCatalogClient" % MODULE_NAME, new=Mock(return_value=fcMock)):
@@ -109,6 +118,67 @@ class TestgetNumberOfEvents( unittest.TestCase ):
                                       { 'AdditionalMeta': {}, 'EvtType' : '', 'lumi' : 14.5, 'nbevts' : 28 },
                                       self )
 
+  def test_getnumberofeventsperfile( self ):
+    file_meta_dict = { '/unique/dir/file3' : S_OK( { 'Luminosity' : '49.2' } ),
+                       '/one/file/myfile' : S_OK( { 'NumberOfEvents' : '14' } ),
+                       '/other/myfile2' : S_ERROR( 'no such file' ) }
+    directory_meta_dict = { '/a/b/c/Dir1' : S_OK( { 'NumberOfEvents' : 100 } ),
+                            '/unique/dir' : S_OK( { 'NumberOfEvents' : None } ),
+                            '/other' : S_ERROR( 'no such directory' ),
+                            '/one/file' : S_OK( {} ) }
+    fcMock = Mock()
+    del fcMock.getFileUserMetadataBulk
+    fcMock.getDirectoryUserMetadata = Mock(side_effect=lambda path: directory_meta_dict[path])
+    fcMock.getFileUserMetadata = Mock(side_effect=lambda filename : file_meta_dict[filename] )
+    with patch( "%s.FileCatalogClient" % MODULE_NAME, new=Mock(return_value=fcMock)):
+      assertDiracSucceedsWith_equals( getNumberOfEventsPerFile( [ '/a/b/c/Dir1/someFile', '/a/b/c/Dir1/other_file',
+                                                                  '/one/file/myfile' ] ),
+                                      { '/a/b/c/Dir1/someFile' : 100, '/a/b/c/Dir1/other_file' : 100,
+                                        '/one/file/myfile' : 14 }, self )
+      assertDiracFailsWith( getNumberOfEventsPerFile( [ '/a/b/c/Dir1/someFile', '/unique/dir/file3', '/other/myfile2' ] ),
+                            'Failed to get Number of Events for /unique/dir/file3, /other/myfile2', self )
+    self.assertEquals( fcMock.getFileUserMetadata.call_count, 3 )
+
+  def test_getnumberofevents_bulk( self ):
+    fcMock = Mock()
+    fcMock.getFileUserMetadataBulk = Mock(return_value=S_OK( { 'Successful' : { '/a/Dir1/file1' : { 'NumberOfEvents' : 10 },
+                                                                                '/a/Dir1/file2' : { 'NumberOfEvents' : 20 } },
+                                                               'Failed' : { '/a/Dir1/file3' : 'no such file' } } ))
+    fcMock.getDirectoryUserMetadata = Mock(return_value=S_OK( { 'EvtType' : 'gghad' } ))
+    with patch( "%s.FileCatalogClient" % MODULE_NAME, new=Mock(return_value=fcMock)):
+      assertDiracSucceedsWith_equals( getNumberOfEvents( [ '/a/Dir1/file1', '/a/Dir1/file2', '/a/Dir1/file3' ] ),
+                                      { 'AdditionalMeta': { 'EvtType' : 'gghad' }, 'EvtType' : 'gghad',
+                                        'lumi' : 0, 'nbevts' : 30 }, self )
+    fcMock.getFileUserMetadataBulk.assert_called_once_with( [ '/a/Dir1/file1', '/a/Dir1/file2', '/a/Dir1/file3' ] )
+    self.assertFalse( fcMock.getFileUserMetadata.called )
+
+  def test_getfilemetadata_cached( self ):
+    fcMock = Mock()
+    fcMock.getFileUserMetadataBulk = Mock(side_effect=[ S_OK( { 'Successful' : { '/a/file1' : { 'NumberOfEvents' : 10 } },
+                                                                'Failed' : { '/a/file2' : 'no such file' } } ),
+                                                        S_OK( { 'Successful' : { '/a/file2' : { 'NumberOfEvents' : 20 } },
+                                                                'Failed' : {} } ) ])
+    assertDiracSucceedsWith_equals( getFileMetadata( [ '/a/file1', '/a/file2' ], fcMock ),
+                                    { 'Successful' : { '/a/file1' : { 'NumberOfEvents' : 10 } },
+                                      'Failed' : { '/a/file2' : 'no such file' } }, self )
+    assertDiracSucceedsWith_equals( getFileMetadata( [ '/a/file1', '/a/file2' ], fcMock ),
+                                    { 'Successful' : { '/a/file1' : { 'NumberOfEvents' : 10 },
+                                                       '/a/file2' : { 'NumberOfEvents' : 20 } },
+                                      'Failed' : {} }, self )
+    fcMock.getFileUserMetadataBulk.assert_called_with( [ '/a/file2' ] )
+    assertDiracSucceeds( getFileMetadata( [ '/a/file1', '/a/file2' ], fcMock ), self )
+    self.assertEquals( fcMock.getFileUserMetadataBulk.call_count, 2 )
+
+  def test_getfilemetadata_bulk_fails( self ):
+    fcMock = Mock()
+    fcMock.getFileUserMetadataBulk = Mock(return_value=S_ERROR( 'Unknown method' ))
+    fcMock.getFileUserMetadata = Mock(return_value=S_OK( { 'NumberOfEvents' : 10 } ))
+    assertDiracSucceedsWith_equals( getFileMetadata( [ '/a/file1', '/a/file2' ], fcMock ),
+                                    { 'Successful' : { '/a/file1' : { 'NumberOfEvents' : 10 },
+                                                       '/a/file2' : { 'NumberOfEvents' : 10 } },
+                                      'Failed' : {} }, self )
+    self.assertEquals( fcMock.getFileUserMetadata.call_count, 2 )
+
 if __name__ == "__main__":
   SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( TestgetNumberOfEvents )
   TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
@@ -0,0 +1,112 @@
+"""Test OverlayCache """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+from ILCDIRAC.Core.Utilities.OverlayCache import OverlayCache, checkFile
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracFailsWith, assertDiracSucceeds, \
+  assertDiracSucceedsWith_equals
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.Core.Utilities.OverlayCache'
+
+class OverlayCacheTest( unittest.TestCase ):
+  """Test the OverlayCache"""
+
+  def setUp( self ):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cacheDir = os.path.join( self.tmpdir, 'cache' )
+    self.jobDir = os.path.join( self.tmpdir, 'job' )
+    os.mkdir( self.jobDir )
+    self.cache = OverlayCache( self.cacheDir, 100 )
+
+  def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
+
+  def _makeFile( self, name, size, content = 'x' ):
+    """ Create a file of the given size in the job directory """
+    path = os.path.join( self.jobDir, name )
+    with open( path, 'w' ) as localFile:
+      localFile.write( content * size )
+    return path
+
+  @staticmethod
+  def _adler( size, content = 'x' ):
+    """ Return the adler32 checksum of a file created by _makeFile """
+    return '%08x' % ( zlib.adler32( content * size ) & 0xffffffff )
+
+  def test_add_and_get( self ):
+    localFile = self._makeFile( 'gghad_1.slcio', 10 )
+    assertDiracSucceeds( self.cache.addFile( '/ilc/prod/gghad_1.slcio', self._adler( 10 ), localFile, size = 10 ), self )
+    os.remove( localFile )
+    assertDiracSucceedsWith_equals( self.cache.getFile( '/ilc/prod/gghad_1.slcio', self._adler( 10 ), self.jobDir ), localFile, self )
+    self.assertEquals( os.path.getsize( localFile ), 10 )
+
+  def test_get_not_cached( self ):
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', 'abc123', self.jobDir ), 'not in cache', self )
+
+  def test_get_other_checksum( self ):
+    localFile = self._makeFile( 'gghad_1.slcio', 10 )
+    assertDiracSucceeds( self.cache.addFile( '/ilc/prod/gghad_1.slcio', self._adler( 10 ), localFile ), self )
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', 'def456', self.jobDir ), 'not in cache', self )
+
+  def test_no_checksum( self ):
+    localFile = self._makeFile( 'gghad_1.slcio', 10 )
+    assertDiracFailsWith( self.cache.addFile( '/ilc/prod/gghad_1.slcio', None, localFile ), 'no checksum', self )
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', None, self.jobDir ), 'not in cache', self )
+
+  def test_evict_least_recently_used( self ):
+    for index in xrange( 2 ):
+      localFile = self._makeFile( 'gghad_%d.slcio' % index, 40 )
+      assertDiracSucceeds( self.cache.addFile( '/ilc/prod/gghad_%d.slcio' % index, self._adler( 40 ), localFile ), self )
+      os.remove( localFile )
+      ## the access times must be different
+      os.utime( self.cache._entry( '/ilc/prod/gghad_%d.slcio' % index, self._adler( 40 ) ), ( time.time() - 100 + index, time.time() - 100 + index ) )
+    assertDiracSucceeds( self.cache.getFile( '/ilc/prod/gghad_0.slcio', self._adler( 40 ), self.jobDir ), self )
+    localFile = self._makeFile( 'gghad_2.slcio', 40 )
+    assertDiracSucceeds( self.cache.addFile( '/ilc/prod/gghad_2.slcio', self._adler( 40 ), localFile ), self )
+    assertDiracSucceeds( self.cache.getFile( '/ilc/prod/gghad_0.slcio', self._adler( 40 ), self.jobDir ), self )
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', self._adler( 40 ), self.jobDir ), 'not in cache', self )
+    assertDiracSucceeds( self.cache.getFile( '/ilc/prod/gghad_2.slcio', self._adler( 40 ), self.jobDir ), self )
+
+  def test_file_too_large( self ):
+    localFile = self._makeFile( 'gghad_1.slcio', 200 )
+    assertDiracFailsWith( self.cache.addFile( '/ilc/prod/gghad_1.slcio', self._adler( 200 ), localFile ), 'larger than the overlay cache', self )
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', self._adler( 200 ), self.jobDir ), 'not in cache', self )
+
+  def test_cached_file_survives_eviction( self ):
+    localFile = self._makeFile( 'gghad_1.slcio', 60 )
+    assertDiracSucceeds( self.cache.addFile( '/ilc/prod/gghad_1.slcio', self._adler( 60 ), localFile ), self )
+    otherFile = self._makeFile( 'gghad_2.slcio', 60 )
+    assertDiracSucceeds( self.cache.addFile( '/ilc/prod/gghad_2.slcio', self._adler( 60 ), otherFile ), self )
+    self.assertEquals( os.path.getsize( localFile ), 60 )
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', self._adler( 60 ), self.jobDir ), 'not in cache', self )
+
+  def test_corrupt_file_not_added( self ):
+    localFile = self._makeFile( 'gghad_1.slcio', 10 )
+    assertDiracFailsWith( self.cache.addFile( '/ilc/prod/gghad_1.slcio', self._adler( 10, 'y' ), localFile ),
+                          'checksum of', self )
+    assertDiracFailsWith( self.cache.addFile( '/ilc/prod/gghad_1.slcio', self._adler( 10 ), localFile, size = 11 ),
+                          'size of', self )
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', self._adler( 10, 'y' ), self.jobDir ),
+                          'not in cache', self )
+    assertDiracFailsWith( self.cache.getFile( '/ilc/prod/gghad_1.slcio', self._adler( 10 ), self.jobDir ),
+                          'not in cache', self )
+
+  def test_checkFile( self ):
+    localFile = self._makeFile( 'gghad_1.slcio', 10 )
+    assertDiracSucceeds( checkFile( localFile, self._adler( 10 ).lstrip( '0' ), 10 ), self )
+    assertDiracFailsWith( checkFile( localFile, self._adler( 10, 'y' ) ), 'checksum of', self )
+    ## only the size can be checked for other checksum types
+    assertDiracSucceeds( checkFile( localFile, 'd41d8cd98f00b204e9800998ecf8427e', 10, 'MD5' ), self )
+    assertDiracFailsWith( checkFile( localFile, 'd41d8cd98f00b204e9800998ecf8427e', 9, 'MD5' ), 'size of', self )
+    assertDiracFailsWith( checkFile( os.path.join( self.jobDir, 'missing' ), self._adler( 10 ) ), 'cannot check', self )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( OverlayCacheTest )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
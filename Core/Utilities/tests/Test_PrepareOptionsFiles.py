@@ -255,6 +255,22 @@ class TestPrepareOptionsFilePatch( unittest.TestCase ):
       self.assertEquals( "testfolder/bin",
                          PrepareOptionFiles.getNewPATH(None, None, None) )
 
+  def test_getnewldlibs_and_path_cached( self ):
+    from ILCDIRAC.Core.Utilities.EnvironmentCache import EnvironmentCache
+    cache = EnvironmentCache()
+    with patch("%s.getSoftwareFolder" % MODULE_NAME, new=Mock(side_effect=[S_ERROR(), S_OK('aFolder')])) as folder_mock, \
+         patch("%s.resolveDeps" % MODULE_NAME, new=Mock(return_value=[self.dep1, self.dep2])) as deps_mock, \
+         patch("%s.os.path.exists" % MODULE_NAME, new=Mock(return_value=True)) as exists_mock, \
+         patch("%s.removeLibc" % MODULE_NAME, new=Mock(return_value=True)) as mock_removelibc, \
+         patch("%s.os.environ" % MODULE_NAME, { 'LD_LIBRARY_PATH' : '/old/lib', 'PATH' : '/old/bin' }):
+      for _ in xrange(2):
+        self.assertEquals( 'aFolder/LDLibs:/old/lib', PrepareOptionFiles.getNewLDLibs('platform', 'Marlin', 'v1', cache=cache) )
+        self.assertEquals( 'aFolder/bin:/old/bin', PrepareOptionFiles.getNewPATH('platform', 'marlin', 'v1', cache=cache) )
+      deps_mock.assert_called_once_with( 'platform', 'Marlin', 'v1' )
+      self.assertEquals( folder_mock.call_count, 2 )
+      self.assertEquals( exists_mock.call_count, 3 )
+      self.assertEquals( mock_removelibc.call_count, 2 )
+
   def test_prepareWhizFile( self ):
     file_contents = [ [ 'asdseed123', '314s.sqrtsfe89u', 'n_events143417',
                         'write_events_file', 'processidprocess_id"123',
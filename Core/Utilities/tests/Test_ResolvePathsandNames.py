@@ -5,7 +5,10 @@ import os
 import tempfile
 import shutil
 
-from ILCDIRAC.Core.Utilities.resolvePathsAndNames import getProdFilename, resolveIFpaths, getProdFilenameFromInput
+from mock import patch, MagicMock as Mock
+
+from ILCDIRAC.Core.Utilities.resolvePathsAndNames import getProdFilename, resolveIFpaths, getProdFilenameFromInput, \
+  DOWNLOADING_SUFFIX, DOWNLOAD_FAILED_SUFFIX
 
 class ResolvePathsAndNamesTests(unittest.TestCase):
   '''  Test resolvePathsAndNames  '''
@@ -42,6 +45,49 @@ class ResolvePathsAndNamesTests(unittest.TestCase):
     self.assertTrue('Value' in res, res.keys())
     self.assertEqual(res['Value'], [os.path.abspath(self.realloc)])
 
+  def test_resolvepaths_waitfordownload(self):
+    """test ResolvePathsAndNames resolvePaths waits for files downloaded in the background.........."""
+    marker = self.realloc + DOWNLOADING_SUFFIX
+    open(marker, "w").close()
+    with patch("ILCDIRAC.Core.Utilities.resolvePathsAndNames.time.sleep",
+               side_effect=lambda _interval: os.remove(marker)) as sleepMock:
+      res = resolveIFpaths(self.inputfiles)
+    self.assertTrue(res['OK'], res)
+    self.assertEqual(res['Value'], [os.path.abspath(self.realloc)])
+    self.assertEqual(sleepMock.call_count, 1)
+
+  def test_resolvepaths_downloadtimeout(self):
+    """test ResolvePathsAndNames resolvePaths fails if files are downloaded for too long............"""
+    marker = self.realloc + DOWNLOADING_SUFFIX
+    open(marker, "w").close()
+    opsMock = Mock()
+    opsMock.getValue.return_value = -1
+    try:
+      with patch("ILCDIRAC.Core.Utilities.resolvePathsAndNames.Operations", new=Mock(return_value=opsMock)):
+        res = resolveIFpaths(self.inputfiles)
+    finally:
+      os.remove(marker)
+    self.assertFalse(res['OK'])
+    self.assertIn("still downloading", res['Message'])
+    opsMock.getValue.assert_called_once_with("/DownloadInputData/WaitTimeout", 6 * 3600)
+
+  def test_resolvepaths_downloadfailed(self):
+    """test ResolvePathsAndNames resolvePaths stops waiting as soon as a download failed............"""
+    os.remove(self.realloc)
+    marker = self.realloc + DOWNLOADING_SUFFIX
+    open(marker, "w").close()
+    with open(self.realloc + DOWNLOAD_FAILED_SUFFIX, "w") as failedMarker:
+      failedMarker.write("No replica")
+    with patch("ILCDIRAC.Core.Utilities.resolvePathsAndNames.time.sleep") as sleepMock:
+      res = resolveIFpaths(self.inputfiles)
+    os.remove(marker)
+    os.remove(self.realloc + DOWNLOAD_FAILED_SUFFIX)
+    open(self.realloc, "w").close()
+    self.assertFalse(res['OK'])
+    self.assertIn("not found locally", res['Message'])
+    self.assertIn("download failed", res['Message'])
+    self.assertFalse(sleepMock.called)
+
   def test_ildprod_sim(self):
     """test getOridFilenameFromInput Sim ..........................................................."""
     indir = "/ilc/prod/ilc/ild/test/temp1/gensplit/500-TDR_ws/3f/run001/"
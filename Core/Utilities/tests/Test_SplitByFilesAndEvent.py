@@ -0,0 +1,60 @@
+"""Test SplitByFilesAndEvent """
+
+import unittest
+from mock import patch, MagicMock as Mock
+
+from DIRAC import S_OK, S_ERROR
+from ILCDIRAC.Core.Utilities.SplitByFilesAndEvent import SplitByFilesAndEvents, splitEventRanges
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracFailsWith, assertDiracSucceedsWith_equals
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.Core.Utilities.SplitByFilesAndEvent'
+
+class SplitByFilesAndEventTest( unittest.TestCase ):
+  """Test the splitting by events"""
+
+  def setUp( self ):
+    self.files = [ '/ilc/prod/file1', '/ilc/prod/file2', '/ilc/prod/file3', '/ilc/prod/file4' ]
+    self.events = { '/ilc/prod/file1' : 30, '/ilc/prod/file2' : 0, '/ilc/prod/file3' : 50, '/ilc/prod/file4' : 25 }
+
+  def test_split( self ):
+    self.assertEquals( splitEventRanges( self.files, self.events, 40 ),
+                       [ { 'files' : [ '/ilc/prod/file1', '/ilc/prod/file2', '/ilc/prod/file3' ], 'startFrom' : 0, 'nbevts' : 40 },
+                         { 'files' : [ '/ilc/prod/file3' ], 'startFrom' : 10, 'nbevts' : 40 },
+                         { 'files' : [ '/ilc/prod/file4' ], 'startFrom' : 0, 'nbevts' : 25 } ] )
+
+  def test_split_file_boundaries( self ):
+    self.assertEquals( splitEventRanges( self.files, self.events, 30 ),
+                       [ { 'files' : [ '/ilc/prod/file1' ], 'startFrom' : 0, 'nbevts' : 30 },
+                         { 'files' : [ '/ilc/prod/file3' ], 'startFrom' : 0, 'nbevts' : 30 },
+                         { 'files' : [ '/ilc/prod/file3', '/ilc/prod/file4' ], 'startFrom' : 30, 'nbevts' : 30 },
+                         { 'files' : [ '/ilc/prod/file4' ], 'startFrom' : 10, 'nbevts' : 15 } ] )
+
+  def test_split_all_events( self ):
+    files = [ '/ilc/prod/file%d' % index for index in xrange( 1000 ) ]
+    events = dict( ( lfn, 1 + index % 7 ) for index, lfn in enumerate( files ) )
+    jobs = splitEventRanges( files, events, 123 )
+    self.assertEquals( sum( job['nbevts'] for job in jobs ), sum( events.values() ) )
+    self.assertTrue( all( job['nbevts'] == 123 for job in jobs[:-1] ) )
+    self.assertEquals( jobs[0]['files'][0], files[0] )
+    self.assertEquals( jobs[-1]['files'][-1], files[-1] )
+
+  def test_split_no_events( self ):
+    self.assertEquals( splitEventRanges( [], {}, 10 ), [] )
+
+  def test_split_by_files_and_events( self ):
+    with patch('%s.getNumberOfEventsPerFile' % MODULE_NAME, new=Mock(return_value=S_OK( self.events ))) as events_mock:
+      result = SplitByFilesAndEvents( self.files, 100 )
+      events_mock.assert_called_once_with( self.files )
+    assertDiracSucceedsWith_equals( result, [ { 'files' : self.files, 'startFrom' : 0, 'nbevts' : 100 },
+                                              { 'files' : [ '/ilc/prod/file4' ], 'startFrom' : 20, 'nbevts' : 5 } ], self )
+
+  def test_split_by_files_and_events_fails( self ):
+    with patch('%s.getNumberOfEventsPerFile' % MODULE_NAME, new=Mock(return_value=S_ERROR( 'no metadata' ))):
+      assertDiracFailsWith( SplitByFilesAndEvents( self.files, 100 ), 'cannot split: no metadata', self )
+    assertDiracFailsWith( SplitByFilesAndEvents( self.files, 0 ), 'must be positive', self )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( SplitByFilesAndEventTest )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
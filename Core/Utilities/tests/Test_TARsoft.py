@@ -2,8 +2,13 @@
 """Test the TAR Software class"""
 
 import unittest
+import fcntl
+import hashlib
 import os
+import shutil
 import sys
+import tarfile
+import tempfile
 from mock import mock_open, patch, MagicMock as Mock
 
 from DIRAC import S_OK, S_ERROR
@@ -53,136 +58,9 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
       return realimport(name, globals, locals, fromlist, level)
     backup_import = builtins.__import__
     builtins.__import__ = myimport
-    from ILCDIRAC.Core.Utilities.TARsoft import createLock #pylint: disable=unused-variable
+    from ILCDIRAC.Core.Utilities.TARsoft import lockInstallation #pylint: disable=unused-variable
     builtins.__import__ = backup_import
 
-  def test_createlock( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import createLock
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open(), create=True) as mo:
-      mo.side_effect = ( h for h in handles )
-      assertDiracSucceeds( createLock( 'testfile.py' ), self )
-      mo.assert_called_once_with( 'testfile.py', 'w' )
-      expected = [ [ 'Locking this directory\n' ] ]
-      self.assertEquals(len(file_contents), len(expected))
-      for (index, handle) in enumerate(handles):
-        cur_handle = handle.__enter__()
-        self.assertEquals(len(expected[index]), handle.__enter__.return_value.write.call_count)
-        for entry in expected[index]:
-          cur_handle.write.assert_any_call(entry)
-
-  def test_createlock_ioerr( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import createLock
-    with patch('%s.open' % MODULE_NAME, new=Mock(side_effect=IOError('some_test_open_error')), create=True):
-      assertDiracFailsWith( createLock('myfile.txt'),
-                            'not allowed to write here: ioerror some_test_open_error', self )
-
-  def test_check_lock_age_no_lock( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=False)):
-      result = checkLockAge( 'mylockfile.txt' )
-      assertDiracSucceedsWith_equals( result, False, self )
-
-  def test_check_lock_age_stat_fails( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.os.stat' % MODULE_NAME, new=Mock(side_effect=OSError('some_test_stat_error'))), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME, new=Mock(return_value=S_OK())):
-      result = checkLockAge( 'mylockfile.txt' )
-      assertDiracSucceedsWith_equals( result, False, self )
-
-  def test_check_lock_age_clear_lock_success( self ):
-    import time
-    from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
-    stat_mock = Mock()
-    stat_mock.st_atime = time.time() - 1801 # lastTouch old enough
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.os.stat' % MODULE_NAME, new=Mock(return_value=stat_mock)), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME, new=Mock(side_effect=[S_ERROR(), S_OK(), S_OK()])), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(side_effect=[S_ERROR(), S_OK(True)])):
-      result = checkLockAge( 'mylockfile.txt' )
-      assertDiracSucceedsWith_equals( result, True, self )
-
-  def test_check_lock_age_timeout( self ):
-    import time
-    from ILCDIRAC.Core.Utilities.TARsoft import checkLockAge
-    stat_mock = Mock()
-    stat_mock.st_atime = time.time()
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.os.stat' % MODULE_NAME, new=Mock(return_value=stat_mock)), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=S_OK(True))):
-      result = checkLockAge( 'mylockfile.txt' )
-      assertDiracFailsWith( result, 'buggy lock, removed: True', self )
-
-  def test_clear_lock( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import clearLock
-    with patch('%s.os.unlink' % MODULE_NAME, new=Mock(return_value=True)):
-      assertDiracSucceeds( clearLock( 'mylock' ), self )
-
-  def test_clear_lock_oserr( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import clearLock
-    with patch('%s.os.unlink' % MODULE_NAME, new=Mock(side_effect=OSError('test_unlink_some_err'))):
-      assertDiracFailsWith( clearLock( 'mylock' ), 'failed to clear lock: test_unlink_some_err', self )
-
-  def test_delete_old( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import deleteOld
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=False)):
-      assertDiracSucceeds( deleteOld('testfile'), self )
-
-  def test_delete_old_file( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import deleteOld
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[True, False])) as exists_mock, \
-         patch('%s.os.path.isdir' % MODULE_NAME, new=Mock(return_value=False)) as isdir_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)) as remove_mock:
-      assertDiracSucceeds( deleteOld('testFile_deleteMe.txt'), self )
-      file_to_check = 'testFile_deleteMe.txt'
-      remove_mock.assert_called_once_with( file_to_check )
-      isdir_mock.assert_called_once_with( file_to_check )
-      exists_mock.assert_called_with( file_to_check )
-
-  def test_delete_old_file_fails( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import deleteOld
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[True, True])) as exists_mock, \
-         patch('%s.os.path.isdir' % MODULE_NAME, new=Mock(return_value=False)) as isdir_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=OSError('test_remove_cannot_error'))) as remove_mock, \
-         patch('%s.gLogger.error' % MODULE_NAME) as err_mock:
-      assertDiracSucceeds( deleteOld('testFile_deleteMe2.txt'), self )
-      file_to_check = 'testFile_deleteMe2.txt'
-      remove_mock.assert_called_once_with( file_to_check )
-      isdir_mock.assert_called_once_with( file_to_check )
-      exists_mock.assert_called_with( file_to_check )
-      assertMockCalls( err_mock, [
-        ( 'Failed deleting testFile_deleteMe2.txt because :', 'OSError test_remove_cannot_error' ),
-        'Oh Oh, something was not right, the directory testFile_deleteMe2.txt is still here' ], self )
-
-  def test_delete_old_dir( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import deleteOld
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[True, False])) as exists_mock, \
-         patch('%s.os.path.isdir' % MODULE_NAME, new=Mock(return_value=True)) as isdir_mock, \
-         patch('%s.shutil.rmtree' % MODULE_NAME, new=Mock(return_value=True)) as remove_mock:
-      assertDiracSucceeds( deleteOld('/delete/this'), self )
-      file_to_check = '/delete/this'
-      remove_mock.assert_called_once_with( file_to_check )
-      isdir_mock.assert_called_once_with( file_to_check )
-      exists_mock.assert_called_with( file_to_check )
-
-  def test_delete_old_dir_fails( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import deleteOld
-    with patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[True, True])) as exists_mock, \
-         patch('%s.os.path.isdir' % MODULE_NAME, new=Mock(return_value=True)) as isdir_mock, \
-         patch('%s.shutil.rmtree' % MODULE_NAME, new=Mock(side_effect=OSError('test_remove_dir_cannot_error'))) as remove_mock, \
-         patch('%s.gLogger.error' % MODULE_NAME) as err_mock:
-      assertDiracSucceeds( deleteOld('/delete/that'), self )
-      file_to_check = '/delete/that'
-      remove_mock.assert_called_once_with( file_to_check )
-      isdir_mock.assert_called_once_with( file_to_check )
-      exists_mock.assert_called_with( file_to_check )
-      assertMockCalls( err_mock, [
-        ( 'Failed deleting /delete/that because :', "<type 'exceptions.OSError'> test_remove_dir_cannot_error" ),
-        'Oh Oh, something was not right, the directory /delete/that is still here' ], self )
-
   def test_download_file( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import downloadFile
     with patch('%s.urllib.urlretrieve' % MODULE_NAME) as url_mock:
@@ -247,9 +125,11 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
   def test_install_deps( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import installDependencies
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[{ 'app' : 'myappname1', 'version' : '203.0' }, { 'app' : 'myappname2', 'version' : '138.1' }])) as dep_mock, \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={ ( 'myappname1', '203.0' ) : 3.0 })) as prefetch_mock, \
          patch('%s.installInAnyArea' % MODULE_NAME) as install_mock:
       result = installDependencies( ( 'AppName', 'appvers' ), 'myconf', 'myareas' )
-      assertDiracSucceeds( result, self )
+      assertDiracSucceedsWith_equals( result, { ( 'myappname1', '203.0' ) : 3.0 }, self )
+      prefetch_mock.assert_called_once_with( [ ( 'myappname1', '203.0' ), ( 'myappname2', '138.1' ) ], 'myconf', 'myareas' )
       assertMockCalls( install_mock, [ ( 'myareas', [ 'myappname1', '203.0' ], 'myconf' ),
                                        ( 'myareas', [ 'myappname2', '138.1' ], 'myconf' ) ],
                        self, only_these_calls = False )
@@ -258,6 +138,7 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
   def test_install_deps_nodeps( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import installDependencies
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[])) as dep_mock, \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={})), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(return_value=S_OK())) as install_mock:
       result = installDependencies( ( 'AppName', 'appvers' ), 'myconf', 'myareas' )
       assertDiracSucceeds( result, self )
@@ -267,6 +148,7 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
   def test_install_deps_installation_fails( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import installDependencies
     with patch('%s.resolveDeps' % MODULE_NAME, new=Mock(return_value=[{ 'app' : 'myappname1', 'version' : '203.0' }, { 'app' : 'myappname2', 'version' : '138.1' }])) as dep_mock, \
+         patch('%s.prefetchPackages' % MODULE_NAME, new=Mock(return_value={})), \
          patch('%s.installInAnyArea' % MODULE_NAME, new=Mock(side_effect=[S_OK(), S_ERROR()])) as install_mock:
       result = installDependencies( ( 'AppName', 'appvers' ), 'myconf', 'myareas' )
       assertDiracFailsWith( result, "failed to install dependency: ['myappname2', '138.1']", self )
@@ -868,226 +750,199 @@ class TestTARsoft( unittest.TestCase ): #pylint: disable=too-many-public-methods
       log_mock.assert_called_once_with(
         'Failed to clean useless tar balls, deal with it: mytestappName testv12' )
 
+class TestTARsoftInstall( unittest.TestCase ):
+  """ Tests the installation of tar balls, in a temporary area """
+
+  def setUp( self ):
+    self.tmpdir = tempfile.mkdtemp()
+    self.area = os.path.join( self.tmpdir, 'area' )
+    os.mkdir( self.area )
+    self.source = os.path.join( self.tmpdir, 'source' )
+    os.makedirs( os.path.join( self.source, 'myapp_v1', 'lib' ) )
+    with open( os.path.join( self.source, 'myapp_v1', 'lib', 'libmyapp.so' ), 'w' ) as libFile:
+      libFile.write( 'not really a library' )
+    self.tarball = os.path.join( self.source, 'myapp_v1.tar.gz' )
+    with tarfile.open( self.tarball, 'w:gz' ) as tarFile:
+      tarFile.add( os.path.join( self.source, 'myapp_v1' ), 'myapp_v1' )
+    with open( self.tarball ) as tarFile:
+      self.md5sum = hashlib.md5( tarFile.read() ).hexdigest()
+
+  def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
+
+  def _download( self, _url, app_tar, _folder, destination ):
+    """ Replaces downloadFile, copies the tar ball to the destination """
+    shutil.copy( os.path.join( self.source, app_tar ), destination )
+    return S_OK()
+
   def test_install( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    extract_mock = Mock()
-    extract_mock.getmembers.return_value =  ['member0/file1.txt', 'member1']
-    with patch('%s.os.chdir' % MODULE_NAME) as chdir_mock, \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(True))) as checklock_mock, \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])) as exists_mock, \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())) as createlock_mock, \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_OK())) as deleteold_mock, \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK())) as download_mock, \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=S_OK())) as clearlock_mock, \
-         patch('%s.tarMd5Check' % MODULE_NAME, new=Mock(return_value=S_OK())) as md5check_mock, \
-         patch('%s.tarfile.is_tarfile' % MODULE_NAME, new=Mock(return_value=False)) as tarcheck_mock, \
-         patch('%s.os.listdir' % MODULE_NAME, new=Mock(side_effect=OSError(''))) as listdir_mock, \
-         patch('%s.os.rename' % MODULE_NAME) as rename_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')), \
-         patch('%s.os.unlink' % MODULE_NAME) as remove_mock:
-      result = install(('appname', 'appvers'), 'myapptarbase.tar.gz', 'tarballURL', False, 'Mymd5sumTest',
-                       'mytestArea')
-      assertDiracSucceedsWith_equals( result, ['myapptarbase', 'myapptarbase.tar.gz'], self )
-      clearlock_mock.assert_called_once_with( 'myapptarbase.lock' )
-      listdir_mock.assert_called_once_with( 'myapptarbase' )
-      self.assertFalse( rename_mock.called )
-      self.assertFalse( remove_mock.called )
-      self.assertFalse( deleteold_mock.called )
-      createlock_mock.assert_called_once_with( 'myapptarbase.lock' )
-      download_mock.assert_called_once_with( 'tarballURL', 'myapptarbase.tar.gz', 'myapptarbase' )
-      tarcheck_mock.assert_called_once_with( 'myapptarbase.tar.gz' )
-      checklock_mock.assert_called_once_with( 'myapptarbase.lock' )
-      chdir_mock.assert_called_once_with( 'mytestArea' )
-      md5check_mock.assert_called_once_with( 'myapptarbase.tar.gz', 'Mymd5sumTest' )
-      assertMockCalls( exists_mock, [ 'myapptarbase', '/my/cwd/test/myapptarbase.tar.gz' ], self )
-
-  def test_install_checklockage_fails( self ):
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)) as download_mock:
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum, self.area )
+      assertDiracSucceedsWith_equals( result, [ 'myapp_v1', 'myapp_v1.tar.gz' ], self )
+      self.assertTrue( os.path.exists( os.path.join( self.area, 'myapp_v1', 'lib', 'libmyapp.so' ) ) )
+      self.assertEquals( sorted( os.listdir( self.area ) ), [ '.myapp_v1.lock', 'myapp_v1' ] )
+      ## The second installation finds it without downloading anything
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum, self.area )
+      assertDiracSucceedsWith_equals( result, [ 'myapp_v1', 'myapp_v1.tar.gz' ], self )
+      self.assertEquals( download_mock.call_count, 1 )
+
+  def test_install_overwrite( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_checklockage_failed'))):
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', True, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'failed lock checks', self )
+    os.makedirs( os.path.join( self.area, 'myapp_v1', 'oldlib' ) )
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)):
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', True, self.md5sum, self.area )
+      assertDiracSucceeds( result, self )
+    self.assertEquals( os.listdir( os.path.join( self.area, 'myapp_v1' ) ), [ 'lib' ] )
+    self.assertEquals( sorted( os.listdir( self.area ) ), [ '.myapp_v1.lock', 'myapp_v1' ] )
 
-  def test_install_createlock_fails( self ):
+  def test_install_md5_wrong( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_createlock_failed_err'))):
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', True, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'test_createlock_failed_err', self )
-
-  def test_install_already_installed( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)):
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', False, 'md5sum', 'area')
-      assertDiracSucceedsWith_equals( result, ['app_tar', 'app_tar.tar.gz'], self )
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)) as download_mock:
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, 'wrongmd5', self.area )
+      assertDiracFailsWith( result, 'md5 check failed', self )
+      self.assertEquals( download_mock.call_count, 2 )
+    self.assertFalse( os.path.exists( os.path.join( self.area, 'myapp_v1' ) ) )
 
-  def test_install_delete_old_fails( self ):
+  def test_install_reuse_tarball( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_deleteold_file_error'))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock:
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', True, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'test_deleteold_file_error', self )
-      clearlock_mock.assert_called_once_with( 'app_tar.lock' )
+    stagingDir = os.path.join( self.area, '.myapp_v1.%s.installing' % self.md5sum )
+    os.makedirs( os.path.join( stagingDir, 'extract', 'myapp_v1' ) )
+    shutil.copy( self.tarball, stagingDir )
+    with patch('%s.downloadFile' % MODULE_NAME) as download_mock:
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum, self.area )
+      assertDiracSucceeds( result, self )
+      self.assertFalse( download_mock.called )
+    self.assertTrue( os.path.exists( os.path.join( self.area, 'myapp_v1', 'lib', 'libmyapp.so' ) ) )
+    self.assertFalse( os.path.exists( stagingDir ) )
 
   def test_install_download_fails( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=False)), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_download_file_error'))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock:
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', False, 'md5sum', 'area')
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_download_file_error'))):
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum, self.area )
       assertDiracFailsWith( result, 'test_download_file_error', self )
-      clearlock_mock.assert_called_once_with( 'app_tar.lock' )
+    self.assertFalse( os.path.exists( os.path.join( self.area, 'myapp_v1' ) ) )
 
   def test_install_downloaded_file_doesnt_exist( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=False)) as exists_mock, \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')):
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', False, 'md5sum', 'area')
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK())):
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum, self.area )
       assertDiracFailsWith( result, 'failed to download software', self )
-      clearlock_mock.assert_called_once_with( 'app_tar.lock' )
-      assertMockCalls( exists_mock, [ 'app_tar', '/my/cwd/test/app_tar.tar.gz' ], self )
-
-  def test_install_md5check_cannot_remove_old_file( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')), \
-         patch('%s.tarMd5Check' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_md5check_fails'))), \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_ERROR('deleteold_test_error'))), \
-         patch('%s.os.unlink' % MODULE_NAME, new=Mock(side_effect=OSError('my_os_err_test'))), \
-         patch('%s.gLogger.error' % MODULE_NAME, new=Mock(return_value=True)) as log_mock:
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', False, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'deleteold_test_error', self )
-      log_mock.assert_called_with('Failed to clean tar ball, something bad is happening')
-      clearlock_mock.assert_called_once_with( 'app_tar.lock' )
-
-  def test_install_md5check_download_file_fails( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=[S_OK(True), S_ERROR('download_file_test_err')])), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')), \
-         patch('%s.tarMd5Check' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_md5check_fails'))), \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.os.unlink' % MODULE_NAME):
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', False, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'download_file_test_err', self )
-      clearlock_mock.assert_called_once_with( 'app_tar.lock' )
-
-  def test_install_second_md5check_fails( self ):
-    from ILCDIRAC.Core.Utilities.TARsoft import install
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')), \
-         patch('%s.tarMd5Check' % MODULE_NAME, new=Mock(return_value=S_ERROR('test_md5check_fails'))), \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.os.unlink' % MODULE_NAME):
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', False, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'md5 check failed', self )
-      clearlock_mock.assert_called_once_with( 'app_tar.lock' )
 
   def test_install_tarfile_extract_fails( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
     from tarfile import TarError
     untar_me_mock = Mock()
-    untar_me_mock.extractall.side_effect=TarError('custom_tar_test_err')
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')), \
-         patch('%s.tarMd5Check' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.os.unlink' % MODULE_NAME), \
-         patch('%s.tarfile.is_tarfile' % MODULE_NAME, new=Mock(return_value=True)) as istar_mock, \
-         patch('%s.tarfile.open' % MODULE_NAME, new=Mock(return_value=untar_me_mock)) as tar_open_mock:
-      result = install(('appname', 'appvers'), 'app_tar.tar.gz', 'tarballURL', False, 'md5sum', 'area')
+    untar_me_mock.extractall.side_effect = TarError('custom_tar_test_err')
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)), \
+         patch('%s.tarfile.open' % MODULE_NAME, new=Mock(return_value=untar_me_mock)):
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum, self.area )
       assertDiracFailsWith(
-        result, 'Could not extract tar ball app_tar.tar.gz because of custom_tar_test_err, cannot continue ',
+        result, 'Could not extract tar ball myapp_v1.tar.gz because of custom_tar_test_err, cannot continue ',
         self )
-      clearlock_mock.assert_called_once_with( 'app_tar.lock' )
-      istar_mock.assert_called_once_with( 'app_tar.tar.gz' )
-      tar_open_mock.assert_called_once_with( 'app_tar.tar.gz' )
+    self.assertFalse( os.path.exists( os.path.join( self.area, 'myapp_v1' ) ) )
 
-  def test_install_tarfile_isslic_rename_fails( self ):
+  def test_install_wrong_folder( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    untar_member0 = Mock()
-    untar_member0.name = 'member0/file1.txt'
-    untar_me_mock = Mock()
-    untar_me_mock.getmembers.return_value = [untar_member0, 'member1']
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')), \
-         patch('%s.tarMd5Check' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.os.unlink' % MODULE_NAME), \
-         patch('%s.tarfile.is_tarfile' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.tarfile.open' % MODULE_NAME, new=Mock(return_value=untar_me_mock)), \
-         patch('%s.os.rename' % MODULE_NAME, new=Mock(side_effect=OSError('test_cannot_rename_err'))) as rename_mock:
-      result = install(('appname', 'appvers'), 'slic.tar.gz', 'tarballURL', False, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'Could not rename slic directory', self )
-      clearlock_mock.assert_called_once_with( 'slic.lock' )
-      rename_mock.assert_called_once_with( 'member0', 'slic' )
-      self.assertTrue( untar_me_mock.extractall.called )
-
-  def test_install_tarfile_isslic_listdir_empty( self ):
+    os.rename( self.tarball, os.path.join( self.source, 'otherapp_v1.tar.gz' ) )
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)):
+      result = install( ( 'otherapp', 'v1' ), 'otherapp_v1.tar.gz', 'tarballURL', False, '', self.area )
+      assertDiracFailsWith( result, 'does not contain the folder otherapp_v1', self )
+    self.assertFalse( os.path.exists( os.path.join( self.area, 'otherapp_v1' ) ) )
+
+  def test_install_slic( self ):
     from ILCDIRAC.Core.Utilities.TARsoft import install
-    untar_member0 = Mock()
-    untar_member0.name = 'member0/file1.txt'
-    untar_me_mock = Mock()
-    untar_me_mock.getmembers.return_value = [untar_member0, 'member1']
-    with patch('%s.os.chdir' % MODULE_NAME), \
-         patch('%s.checkLockAge' % MODULE_NAME, new=Mock(return_value=S_OK(False))), \
-         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=[False, True])), \
-         patch('%s.createLock' % MODULE_NAME, new=Mock(return_value=S_OK())), \
-         patch('%s.downloadFile' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.clearLock' % MODULE_NAME, new=Mock(return_value=True)) as clearlock_mock, \
-         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/my/cwd/test')), \
-         patch('%s.tarMd5Check' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.deleteOld' % MODULE_NAME, new=Mock(return_value=S_OK(True))), \
-         patch('%s.os.unlink' % MODULE_NAME), \
-         patch('%s.tarfile.is_tarfile' % MODULE_NAME, new=Mock(return_value=True)), \
-         patch('%s.tarfile.open' % MODULE_NAME, new=Mock(return_value=untar_me_mock)), \
-         patch('%s.os.rename' % MODULE_NAME, new=Mock(return_value=True)) as rename_mock, \
-         patch('%s.os.listdir' % MODULE_NAME, new=Mock(return_value=[])) as listdir_mock:
-      result = install(('appname', 'appvers'), 'slic.tar.gz', 'tarballURL', False, 'md5sum', 'area')
-      assertDiracFailsWith( result, 'folder ', self )
-      clearlock_mock.assert_called_once_with( 'slic.lock' )
-      rename_mock.assert_called_once_with( 'member0', 'slic' )
-      self.assertTrue( untar_me_mock.extractall.called )
-      listdir_mock.assert_called_once_with( 'slic' )
+    os.rename( self.tarball, os.path.join( self.source, 'slic.tar.gz' ) )
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)):
+      result = install( ( 'slic', 'v2' ), 'slic.tar.gz', 'tarballURL', False, '', self.area )
+      assertDiracSucceedsWith_equals( result, [ 'slicv2', 'slic.tar.gz' ], self )
+    self.assertTrue( os.path.exists( os.path.join( self.area, 'slicv2', 'lib', 'libmyapp.so' ) ) )
+
+  def test_install_jar( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import install
+    with open( os.path.join( self.source, 'lcsim.jar' ), 'w' ) as jarFile:
+      jarFile.write( 'not really a jar' )
+    with patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)):
+      result = install( ( 'lcsim', 'v1' ), 'lcsim.jar', 'tarballURL', False, '', self.area )
+      assertDiracSucceedsWith_equals( result, [ 'lcsim.jar', 'lcsim.jar' ], self )
+    self.assertTrue( os.path.isfile( os.path.join( self.area, 'lcsim.jar' ) ) )
+
+  def test_install_locked( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import install
+    lockFile = open( os.path.join( self.area, '.myapp_v1.lock' ), 'a' )
+    fcntl.flock( lockFile, fcntl.LOCK_EX )
+    def installedByOtherJob( _delay ):
+      """ the other job publishes the installation and releases the lock """
+      shutil.copytree( os.path.join( self.source, 'myapp_v1' ), os.path.join( self.area, 'myapp_v1' ) )
+      fcntl.flock( lockFile, fcntl.LOCK_UN )
+    with patch('ILCDIRAC.Core.Utilities.Backoff.time.sleep', new=Mock(side_effect=installedByOtherJob)) as sleep_mock, \
+         patch('%s.downloadFile' % MODULE_NAME) as download_mock:
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', True, self.md5sum, self.area )
+      assertDiracSucceeds( result, self )
+      self.assertEquals( sleep_mock.call_count, 1 )
+      self.assertFalse( download_mock.called )
+    lockFile.close()
+
+  def test_install_lock_timeout( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import install
+    lockFile = open( os.path.join( self.area, '.myapp_v1.lock' ), 'a' )
+    fcntl.flock( lockFile, fcntl.LOCK_EX )
+    with patch('ILCDIRAC.Core.Utilities.Backoff.time.sleep'), \
+         patch('%s.INSTALL_LOCK_TIMEOUT' % MODULE_NAME, new=10):
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum, self.area )
+      assertDiracFailsWith( result, 'failed lock checks', self )
+    lockFile.close()
+
+  def test_install_streamed( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import install
+    with patch('%s.urllib2.urlopen' % MODULE_NAME, new=Mock(side_effect=lambda _url: open( self.tarball ))) as url_mock, \
+         patch('%s.downloadFile' % MODULE_NAME) as download_mock:
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'http://some.host/tarballs', False, self.md5sum, self.area )
+      assertDiracSucceedsWith_equals( result, [ 'myapp_v1', 'myapp_v1.tar.gz' ], self )
+      url_mock.assert_called_once_with( 'http://some.host/tarballs/myapp_v1.tar.gz' )
+      self.assertFalse( download_mock.called )
+    self.assertTrue( os.path.exists( os.path.join( self.area, 'myapp_v1', 'lib', 'libmyapp.so' ) ) )
+    self.assertEquals( sorted( os.listdir( self.area ) ), [ '.myapp_v1.lock', 'myapp_v1' ] )
+
+  def test_install_streamed_fails( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import install
+    from StringIO import StringIO
+    with patch('%s.urllib2.urlopen' % MODULE_NAME, new=Mock(return_value=StringIO( 'not a tar ball' ))), \
+         patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)) as download_mock:
+      result = install( ( 'myapp', 'v1' ), 'myapp_v1.tar.gz', 'http://some.host/tarballs', False, self.md5sum, self.area )
+      assertDiracSucceeds( result, self )
+      self.assertEquals( download_mock.call_count, 1 )
+    self.assertTrue( os.path.exists( os.path.join( self.area, 'myapp_v1', 'lib', 'libmyapp.so' ) ) )
+
+  def test_stream_tarball_md5_wrong( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import streamTarBall
+    with patch('%s.urllib2.urlopen' % MODULE_NAME, new=Mock(side_effect=lambda _url: open( self.tarball ))):
+      assertDiracFailsWith( streamTarBall( 'http://some.host/', 'myapp_v1.tar.gz', 'wrongmd5', self.area ),
+                            'hash does not correspond', self )
+
+  def test_prefetch( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import prefetchPackages
+    shutil.copy( self.tarball, os.path.join( self.source, 'otherapp_v1.tar.gz' ) )
+    tarballs = { ( 'myapp', 'v1' ) : S_OK( ( 'myapp_v1.tar.gz', 'tarballURL', False, self.md5sum ) ),
+                 ( 'otherapp', 'v1' ) : S_OK( ( 'otherapp_v1.tar.gz', 'tarballURL', False, '' ) ),
+                 ( 'overwritten', 'v1' ) : S_OK( ( 'overwritten_v1.tar.gz', 'tarballURL', True, '' ) ),
+                 ( 'unknown', 'v1' ) : S_ERROR( 'no tar ball' ) }
+    with patch('%s.getTarBallLocation' % MODULE_NAME, new=Mock(side_effect=lambda app, _config, _dummy: tarballs[app])), \
+         patch('%s.downloadFile' % MODULE_NAME, new=Mock(side_effect=self._download)) as download_mock:
+      result = prefetchPackages( [ [ 'myapp', 'v1' ], ( 'otherapp', 'v1' ), ( 'overwritten', 'v1' ),
+                                   ( 'unknown', 'v1' ), ( 'myapp', 'v1' ) ], 'myconf',
+                                 [ os.path.join( self.tmpdir, 'doesNotExist' ), self.area ] )
+      self.assertEquals( sorted( result ), sorted( tarballs ) )
+      self.assertEquals( download_mock.call_count, 2 )
+    self.assertTrue( os.path.exists( os.path.join( self.area, 'myapp_v1', 'lib', 'libmyapp.so' ) ) )
+    ## otherapp_v1.tar.gz contains myapp_v1, so it cannot be installed
+    self.assertFalse( os.path.exists( os.path.join( self.area, 'otherapp_v1' ) ) )
+
+  def test_prefetch_one_worker( self ):
+    from ILCDIRAC.Core.Utilities.TARsoft import prefetchPackages
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(return_value=1)), \
+         patch('%s.getTarBallLocation' % MODULE_NAME) as tarball_mock:
+      assertEqualsImproved( prefetchPackages( [ ( 'myapp', 'v1' ) ], 'myconf', [ self.area ] ), {}, self )
+      self.assertFalse( tarball_mock.called )
 
 MODULE_NAME = 'ILCDIRAC.Core.Utilities.TARsoft'
@@ -21,12 +21,17 @@ Send notification about changes
 
 """
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
+import copy
+import os
+import threading
 import time
 import itertools
 
 from DIRAC                                                     import S_OK, S_ERROR
 from DIRAC.Core.Base.AgentModule                               import AgentModule
+from DIRAC.Core.Utilities.List                                 import breakListIntoChunks
 
 from DIRAC.WorkloadManagementSystem.Client.JobMonitoringClient import JobMonitoringClient
 from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
@@ -34,8 +39,9 @@ from DIRAC.TransformationSystem.Client.TransformationClient import Transformatio
 from DIRAC.RequestManagementSystem.Client.ReqClient import ReqClient
 from DIRAC.FrameworkSystem.Client.NotificationClient import NotificationClient
 
-from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo
+from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo, serverCredentials
 from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo import TaskInfoException
+from ILCDIRAC.ILCTransformationSystem.Utilities.DataRecoveryState import DataRecoveryState
 from ILCDIRAC.Interfaces.API.DiracILC import DiracILC
 
 __RCSID__ = "$Id$"
@@ -69,6 +75,35 @@ class DataRecoveryAgent( AgentModule ):
     self.reqClient = ReqClient()
     self.diracILC = DiracILC()
     self.inputFilesProcessed = set()
+    self.todo = None
+    self.__setupChecks()
+    self.jobCache = defaultdict( lambda: (0, 0) )
+    ## state of the jobs from previous cycles, kept in a file, see initialize
+    self.jobState = None
+    self.decisions = {}
+    ## jobs whose outputs are being removed, with the actions to do once they are removed
+    self.jobsToClean = []
+    self.recheckInterval = self.am_getOption( 'RecheckInterval', 86400 )
+    self.printEveryNJobs = self.am_getOption( 'PrintEvery', 200 )
+    self.jobChunkSize = self.am_getOption( 'JobChunkSize', 500 )
+    self.jdlWorkers = self.am_getOption( 'JDLWorkers', 10 )
+    self.catalogChunkSize = self.am_getOption( 'CatalogChunkSize', 1000 )
+    self.productionWorkers = self.am_getOption( 'ProductionWorkers', 4 )
+    self.removalWorkers = self.am_getOption( 'RemovalWorkers', 4 )
+    self.removalChunkSize = self.am_getOption( 'RemovalChunkSize', 200 )
+    self.counterLock = threading.Lock()
+    ##Notification
+    self.notesToSend = ""
+    self.addressTo = self.am_getOption( 'MailTo', ["andre.philippe.sailer@cern.ch"] )
+    self.addressFrom = self.am_getOption( 'MailFrom', "ilcdirac-admin@cern.ch" )
+    self.subject = "DataRecoveryAgent"
+
+  def __setupChecks( self ):
+    """create the checks and actions for the jobs, with their counters
+
+    The checks use the inputFilesProcessed of this instance, see __treatProductionAndNotify. For the checks
+    with Clean the outputs of the job are removed before the Actions are done, see checkJob
+    """
     self.todo = {'MCGeneration':
                  [ dict( Message="MCGeneration: OutputExists: Job 'Done'",
                          ShortMessage="MCGeneration: job 'Done' ",
@@ -108,19 +143,22 @@ class DataRecoveryAgent( AgentModule ):
                          ShortMessage="Other Tasks --> Cleanup",
                          Counter=0,
                          Check=lambda job: job.inputFile in self.inputFilesProcessed and not job.allFilesMissing(),
-                         Actions=lambda job,tInfo: [ job.setJobFailed(tInfo), job.cleanOutputs(tInfo) ]
+                         Clean=True,
+                         Actions=lambda job,tInfo: [ job.setJobFailed(tInfo) ]
                        ),
                    dict( Message="InputFile missing: mark job 'Failed', mark input 'Deleted', clean",
                          ShortMessage="Input Missing --> Job 'Failed, Input 'Deleted', Cleanup",
                          Counter=0,
                          Check=lambda job: job.inputFile and not job.inputFileExists and job.fileStatus != "Deleted",
-                         Actions=lambda job,tInfo: [ job.cleanOutputs(tInfo), job.setJobFailed(tInfo), job.setInputDeleted(tInfo) ]
+                         Clean=True,
+                         Actions=lambda job,tInfo: [ job.setJobFailed(tInfo), job.setInputDeleted(tInfo) ]
                        ),
                    dict( Message="InputFile Deleted, output Exists: mark job 'Failed', clean",
                          ShortMessage="Input Deleted --> Job 'Failed, Cleanup",
                          Counter=0,
                          Check=lambda job: job.inputFile and not job.inputFileExists and job.fileStatus == "Deleted" and not job.allFilesMissing(),
-                         Actions=lambda job,tInfo: [ job.cleanOutputs(tInfo), job.setJobFailed(tInfo) ]
+                         Clean=True,
+                         Actions=lambda job,tInfo: [ job.setJobFailed(tInfo) ]
                        ),
                    ## All Output Exists
                    dict( Message="Output Exists, job Failed, input not Processed --> Job Done, Input Processed",
@@ -201,7 +239,8 @@ class DataRecoveryAgent( AgentModule ):
                                            job.status=='Failed' and \
                                            job.fileStatus in ASSIGNEDSTATES and \
                                            job.inputFileExists,
-                         Actions=lambda job,tInfo: [job.cleanOutputs(tInfo),job.setInputUnused(tInfo)]
+                         Clean=True,
+                         Actions=lambda job,tInfo: [job.setInputUnused(tInfo)]
                          #Actions=lambda job,tInfo: []
                        ),
                    dict( Message="Some missing, job Done, input Assigned --> cleanup, job Failed, Input 'Unused'",
@@ -212,7 +251,8 @@ class DataRecoveryAgent( AgentModule ):
                                            job.status=='Done' and \
                                            job.fileStatus in ASSIGNEDSTATES and \
                                            job.inputFileExists,
-                         Actions=lambda job,tInfo: [job.cleanOutputs(tInfo),job.setInputUnused(tInfo),job.setJobFailed(tInfo)]
+                         Clean=True,
+                         Actions=lambda job,tInfo: [job.setInputUnused(tInfo),job.setJobFailed(tInfo)]
                          #Actions=lambda job,tInfo: []
                        ),
                    dict( Message="Some missing, job Done --> job Failed",
@@ -236,16 +276,16 @@ class DataRecoveryAgent( AgentModule ):
                         ),
                  ]
                 }
-    self.jobCache = defaultdict( lambda: (0, 0) )
-    self.printEveryNJobs = self.am_getOption( 'PrintEvery', 200 )
-    ##Notification
-    self.notesToSend = ""
-    self.addressTo = self.am_getOption( 'MailTo', ["andre.philippe.sailer@cern.ch"] )
-    self.addressFrom = self.am_getOption( 'MailFrom', "ilcdirac-admin@cern.ch" )
-    self.subject = "DataRecoveryAgent"
 
-    
     #############################################################################
+  def initialize(self):
+    """Open the file with the state of the jobs from the previous cycles
+    """
+    stateFile = self.am_getOption( 'StateFile', os.path.join( self.am_getWorkDirectory(), 'DataRecoveryState.sqlite' ) )
+    self.jobState = DataRecoveryState( stateFile )
+    return S_OK()
+
+  #############################################################################
   def beginExecution(self):
     """Resets defaults after one cycle
     """
@@ -260,6 +300,13 @@ class DataRecoveryAgent( AgentModule ):
     self.addressTo = self.am_getOption( 'MailTo', ["andre.philippe.sailer@cern.ch"] )
     self.addressFrom = self.am_getOption( 'MailFrom', "ilcdirac-admin@cern.ch" )
     self.printEveryNJobs = self.am_getOption( 'PrintEvery', 200 )
+    self.jobChunkSize = self.am_getOption( 'JobChunkSize', 500 )
+    self.jdlWorkers = self.am_getOption( 'JDLWorkers', 10 )
+    self.catalogChunkSize = self.am_getOption( 'CatalogChunkSize', 1000 )
+    self.recheckInterval = self.am_getOption( 'RecheckInterval', 86400 )
+    self.productionWorkers = self.am_getOption( 'ProductionWorkers', 4 )
+    self.removalWorkers = self.am_getOption( 'RemovalWorkers', 4 )
+    self.removalChunkSize = self.am_getOption( 'RemovalChunkSize', 200 )
 
     return S_OK()
   #############################################################################
@@ -272,27 +319,60 @@ class DataRecoveryAgent( AgentModule ):
     if not transformations['OK']:
       self.log.error( "Failure to get transformations", transformations['Message'] )
       return S_ERROR( "Failure to get transformations" )
+    if self.jobState:
+      self.jobState.removeOtherProductions( transformations['Value'].keys() )
+    productions = []
     for prodID,values in transformations['Value'].iteritems():
       if prodID in self.productionsToIgnore:
         self.log.notice( "Ignoring Production: %s " % prodID )
         continue
-      self.__resetCounters()
-      self.inputFilesProcessed = set()
+      productions.append( ( prodID, values ) )
+
+    ## the productions are treated in parallel, so small productions do not wait for the large ones
+    self.__resetCounters()
+    pool = ThreadPool( self.productionWorkers )
+    try:
+      pool.map( self.__treatProductionAndNotify, productions )
+    finally:
+      pool.close()
+      pool.join()
+    self.log.notice( "All productions:" )
+    self.printSummary()
+
+    return S_OK()
+
+  def __treatProductionAndNotify( self, production ):
+    """treat one production and send the notification, runs in a thread of the pool
+
+    Each production is treated by a copy of the agent with its own counters, notes and processed input
+    files. The clients, jobCache and jobState are shared. The counters are added to the ones of the agent.
+    The production uses the server certificate, so the files of other productions are not removed meanwhile
+    """
+    with serverCredentials():
+      prodID, values = production
       transType, transName = values
+      agent = copy.copy( self )
+      agent.__setupChecks()
+      agent.inputFilesProcessed = set()
+      agent.decisions = {}
+      agent.jobsToClean = []
+      agent.notesToSend = ""
       self.log.notice( "Running over Production: %s " % prodID )
-      self.treatProduction( int(prodID), transName, transType )
+      agent.treatProduction( int(prodID), transName, transType )
 
-      if self.notesToSend and self.__notOnlyKeepers( transType ):
+      if agent.notesToSend and agent.__notOnlyKeepers( transType ):
         ##remove from the jobCache because something happened
         self.jobCache.pop( int(prodID), None )
         notification = NotificationClient()
         for address in self.addressTo:
-          result = notification.sendMail( address, "%s: %s" %( self.subject, prodID ), self.notesToSend, self.addressFrom, localAttempt = False )
+          result = notification.sendMail( address, "%s: %s" %( self.subject, prodID ), agent.notesToSend, self.addressFrom, localAttempt = False )
           if not result['OK']:
             self.log.error( 'Cannot send notification mail', result['Message'] )
-      self.notesToSend = ""
 
-    return S_OK()
+      with self.counterLock:
+        for name, checks in agent.todo.iteritems():
+          for index, do in enumerate( checks ):
+            self.todo[name][index]['Counter'] += do['Counter']
 
   def getEligibleTransformations( self, status, typeList ):
     """ Select transformations of given status and type.
@@ -311,7 +391,7 @@ class DataRecoveryAgent( AgentModule ):
     """run this thing for given production"""
 
     tInfo = TransformationInfo( prodID, transName, transType, self.enabled,
-                                self.tClient, self.fcClient, self.jobMon )
+                                self.tClient, self.fcClient, self.jobMon, self.catalogChunkSize )
     jobs, nDone, nFailed = tInfo.getJobs(statusList=self.jobStatus)
 
     if self.jobCache[prodID][0] == nDone and self.jobCache[prodID][1] == nFailed:
@@ -328,12 +408,66 @@ class DataRecoveryAgent( AgentModule ):
       tasksDict = tInfo.checkTasksStatus()
       lfnTaskDict = dict( [ ( tasksDict[taskID]['LFN'],taskID ) for taskID in tasksDict ] )
 
+    if self.jobState:
+      jobs = self.__selectJobsToCheck( prodID, jobs, tasksDict, lfnTaskDict )
+    self.decisions = {}
+
     self.checkAllJobs( jobs, tInfo, tasksDict, lfnTaskDict )
     self.printSummary()
 
+    if self.jobState:
+      ## in dry run nothing was done, so the jobs are checked again next time
+      now = time.time()
+      self.jobState.setJobs( prodID, [ ( job.jobID, job.status, now,
+                                         self.decisions.get( job.jobID ) if self.enabled else None,
+                                         job.inputFile,
+                                         self.__getDependencies( job.inputFile, tasksDict, lfnTaskDict ) )
+                                       for job in jobs.values() ] )
+
+  def __getDependencies( self, inputFile, tasksDict, lfnTaskDict ):
+    """return what the decision for a job depends on besides the job itself: the last task of its input file,
+    and the status and error count of the file in that task, None without tasks"""
+    if not tasksDict or not lfnTaskDict or inputFile not in lfnTaskDict:
+      return None
+    taskID = lfnTaskDict[inputFile]
+    return "%s:%s:%s" % ( taskID, tasksDict[taskID]['Status'], tasksDict[taskID]['ErrorCount'] )
+
+  def __selectJobsToCheck( self, prodID, jobs, tasksDict=None, lfnTaskDict=None ):
+    """only keep the jobs whose status or dependencies changed since they were checked, which did not lead to a
+    decision, or which were not checked for RecheckInterval seconds. The jobs sharing their input file with one
+    of these jobs are checked again too"""
+    knownJobs = self.jobState.getJobs( prodID )
+    keepDecision = self.todo['OtherProductions'][0]['ShortMessage']
+    now = time.time()
+    unchangedJobs = {}
+    changedInputFiles = set()
+    for jobID, job in jobs.iteritems():
+      state = knownJobs.get( int(jobID) )
+      if state and state['Decision'] and state['Status'] == job.status and \
+         state['Dependencies'] == self.__getDependencies( state['InputFile'], tasksDict, lfnTaskDict ) and \
+         now - state['LastChecked'] < self.recheckInterval:
+        unchangedJobs[jobID] = state
+      elif state and state['InputFile']:
+        changedInputFiles.add( state['InputFile'] )
+    jobsToCheck = OrderedDict()
+    for jobID, job in jobs.iteritems():
+      state = unchangedJobs.get( jobID )
+      if state and state['InputFile'] not in changedInputFiles:
+        ## the other jobs of this input file must know it was processed
+        if state['Decision'] == keepDecision:
+          self.inputFilesProcessed.add( state['InputFile'] )
+        continue
+      jobsToCheck[jobID] = job
+    self.log.notice( "Checking %d of %d jobs, the others did not change" % ( len(jobsToCheck), len(jobs) ) )
+    return jobsToCheck
+
 
   def checkJob( self, job, tInfo ):
-    """ deal with the job """
+    """ deal with the job
+
+    If the check cleans the outputs, they are only queued for removal and the job is kept in jobsToClean,
+    its actions are done by applyCleanedJobs if all its outputs were removed
+    """
     checks = self.todo['MCGeneration'] if job.tType.startswith('MCGeneration') else self.todo['OtherProductions']
     for do in checks:
       if do['Check'](job):
@@ -342,28 +476,83 @@ class DataRecoveryAgent( AgentModule ):
         self.log.notice( job )
         self.notesToSend += do['Message']+'\n'
         self.notesToSend += str(job)+'\n'
-        do['Actions'](job, tInfo)
+        if do.get( 'Clean' ):
+          job.cleanOutputs(tInfo)
+          self.jobsToClean.append( ( job, do['Actions'] ) )
+        else:
+          do['Actions'](job, tInfo)
+        self.decisions[job.jobID] = do['ShortMessage']
         return
+    self.decisions[job.jobID] = "No Action"
 
   def checkAllJobs( self, jobs, tInfo, tasksDict=None, lfnTaskDict=None ):
-    """run over all jobs and do checks"""
+    """run over all jobs and do checks
+
+    The requests and JDLs are obtained for chunks of jobs at once, the existence of the files for all
+    jobs at once, then the checks are done for each job, and the outputs to clean and their descendants
+    are removed for all jobs at once
+    """
     fileJobDict = defaultdict(list)
     counter = 0
     startTime = time.time()
     nJobs = len(jobs)
+    timing = defaultdict(float)
     self.log.notice( "Running over all the jobs" )
-    for job in jobs.values():
-      counter += 1
-      if counter % self.printEveryNJobs == 0:
-        self.log.notice( "%d/%d: %3.1fs " % (counter, nJobs, float(time.time() - startTime) ) )
+    jobsToCheck = []
+    pool = ThreadPool( self.jdlWorkers )
+    try:
+      for jobChunk in breakListIntoChunks( jobs.values(), self.jobChunkSize ):
+        phaseStart = time.time()
+        requests = self.__getRequests( jobChunk )
+        timing['Requests'] += time.time() - phaseStart
+
+        phaseStart = time.time()
+        jdls = self.__getJDLs( jobChunk, pool )
+        timing['JDLs'] += time.time() - phaseStart
+
+        phaseStart = time.time()
+        for job in jobChunk:
+          counter += 1
+          if counter % self.printEveryNJobs == 0:
+            self.log.notice( "%d/%d: %3.1fs " % (counter, nJobs, float(time.time() - startTime) ) )
+          while True:
+            try:
+              job.checkRequests( self.reqClient, requests )
+              if job.pendingRequest:
+                self.log.warn( "Job has Pending requests:\n%s" % job )
+                break
+              job.getJobInformation( self.diracILC, jdls.get( job.jobID ) )
+              jobsToCheck.append( job )
+              break # get out of the while loop
+            except RuntimeError as e:
+              self.log.error( "+++++ Failure for job: %d " % job.jobID )
+              self.log.error( "+++++ Exception: ", str(e) )
+              ## runs these again because of RuntimeError
+        timing['Checks'] += time.time() - phaseStart
+    finally:
+      pool.close()
+      pool.join()
+
+    phaseStart = time.time()
+    existence = tInfo.checkFilesExistence( jobsToCheck )
+    timing['Existence'] += time.time() - phaseStart
+
+    phaseStart = time.time()
+    for job in jobsToCheck:
+      while True:
+        try:
+          ## jobs whose files could not be checked at once check their own files
+          job.checkFileExistance( self.fcClient, existence.get( job.jobID ) )
+          break
+        except RuntimeError as e:
+          self.log.error( "+++++ Failure for job: %d " % job.jobID )
+          self.log.error( "+++++ Exception: ", str(e) )
+    timing['Checks'] += time.time() - phaseStart
+
+    phaseStart = time.time()
+    for job in jobsToCheck:
       while True:
         try:
-          job.checkRequests( self.reqClient )
-          if job.pendingRequest:
-            self.log.warn( "Job has Pending requests:\n%s" % job )
-            break
-          job.getJobInformation( self.diracILC )
-          job.checkFileExistance( self.fcClient )
           if tasksDict and lfnTaskDict:
             try:
               job.getTaskInfo( tasksDict, lfnTaskDict )
@@ -379,6 +568,63 @@ class DataRecoveryAgent( AgentModule ):
           self.log.error( "+++++ Failure for job: %d " % job.jobID )
           self.log.error( "+++++ Exception: ", str(e) )
           ## runs these again because of RuntimeError
+    timing['Checks'] += time.time() - phaseStart
+
+    ## the outputs of all jobs and their descendants are removed together, the jobs whose outputs could not all be
+    ## removed are checked again
+    phaseStart = time.time()
+    failedJobs = tInfo.removeQueuedFiles( self.removalWorkers, self.removalChunkSize )
+    for jobID in failedJobs:
+      self.decisions.pop( jobID, None )
+    for line in tInfo.getRemovalSummary():
+      self.notesToSend += line + '\n'
+    timing['Removal'] += time.time() - phaseStart
+
+    phaseStart = time.time()
+    self.applyCleanedJobs( tInfo, failedJobs )
+    timing['Checks'] += time.time() - phaseStart
+    self.log.notice( "Checked %d jobs in %3.1fs: %s" % ( nJobs, float(time.time() - startTime),
+                                                         ", ".join( "%s %3.1fs" % item for item in sorted( timing.items() ) ) ) )
+
+  def applyCleanedJobs( self, tInfo, failedJobs ):
+    """do the actions of the jobs in jobsToClean whose outputs were all removed, the other jobs are left as they are
+
+    :param tInfo: TransformationInfo of the production
+    :param set failedJobs: jobIDs whose outputs could not all be removed
+    """
+    jobsToClean = self.jobsToClean
+    self.jobsToClean = []
+    for job, actions in jobsToClean:
+      if job.jobID in failedJobs:
+        self.log.warn( "Not all outputs of job %d were removed, it is checked again in the next cycle" % job.jobID )
+        continue
+      while True:
+        try:
+          actions(job, tInfo)
+          break # get out of the while loop
+        except RuntimeError as e:
+          self.log.error( "+++++ Failure for job: %d " % job.jobID )
+          self.log.error( "+++++ Exception: ", str(e) )
+          ## runs these again because of RuntimeError
+
+  def __getRequests( self, jobChunk ):
+    """get the requests for all jobs in the chunk, returns None if that fails and each job gets its own"""
+    result = self.reqClient.readRequestsForJobs( [ job.jobID for job in jobChunk ] )
+    if not result['OK']:
+      self.log.warn( "Failed to get requests for the jobs", result['Message'] )
+      return None
+    return result['Value']['Successful']
+
+  def __getJDLs( self, jobChunk, pool ):
+    """get the JDLs of all jobs in the chunk with several threads, jobs whose JDL could not be obtained are left out"""
+    def getJDL( jobID ):
+      """get the JDL of one job"""
+      return jobID, self.diracILC.getJobJDL( int(jobID) )
+    jdls = {}
+    for jobID, result in pool.map( getJDL, [ job.jobID for job in jobChunk ] ):
+      if result['OK']:
+        jdls[jobID] = result['Value']
+    return jdls
 
   def printSummary( self ):
     """print summary of changes"""
@@ -408,7 +654,7 @@ class DataRecoveryAgent( AgentModule ):
     self.notesToSend += str(job)+'\n'
     self.todo['OtherProductions'][-1]['Counter'] += 1
     job.cleanOutputs(tInfo)
-    job.setJobFailed(tInfo)
+    self.jobsToClean.append( ( job, lambda job, tInfo: [ job.setJobFailed(tInfo) ] ) )
     # if job.inputFile is not None:
     #   job.setInputDeleted(tInfo)
 
@@ -2,9 +2,13 @@
 This agent takes care of uploading production logs for Inactive productions.
 
 Get the files by walking the tree from the BaseLogPath option (in the CS, under the Agents sections). 
-Puts them in tar files that are created in the BasePath(same as BaseLogPath)/LogsTar folder, created if needed.
-Deletes the logs once the tar file exists.
-Uploads them to the ArchivalSE: defined in Operations, under Transformations/ArchivalSE
+LOG directories which did not change since the previous cycle, when they had nothing to archive, are not
+walked again: their modification time is kept in the IndexFile.
+Puts them in tar files of at most MaxTarBallSize bytes that are created in the BasePath/LogsTars folder,
+created if needed.
+Deletes the logs once the tar file containing them is complete.
+Uploads them to the ArchivalSE: defined in Operations, under Transformations/ArchivalSE, while the next
+tar file is created.
 Deletes the tar files.
 The LFN path is given in the CS, Operations, under Transformations/BaseLogLFN
 
@@ -21,11 +25,14 @@ from DIRAC.Resources.Storage.StorageElement                     import StorageEl
 
 from DIRAC import S_OK, S_ERROR, gLogger
 
-import os, tarfile, subprocess
+from multiprocessing.pool import ThreadPool
+import json, os, shutil, tarfile, subprocess
 
 __RCSID__ = "$Id$"
 
 ACTIVE_STATUS = ["Active", 'Completing']
+## suffix of the tar ball being written, renamed once it is complete
+PARTIAL_SUFFIX = ".part"
 
 class TarTheProdLogsAgent( AgentModule ):
   '''
@@ -46,6 +53,10 @@ class TarTheProdLogsAgent( AgentModule ):
     self.ops = None
     self.storageElement = None
     self.baselfn = ""
+    self.maxTarBallSize = 2 * 1024**3
+    self.indexFile = ""
+    ## modification time of the LOG directories which had nothing to archive, by path
+    self.index = {}
 
   def initialize(self):
     """Sets defaults
@@ -60,6 +71,10 @@ class TarTheProdLogsAgent( AgentModule ):
     if not self.baselogpath:
       return S_ERROR("Missing mandatory option BaseLogPath")
 
+    self.maxTarBallSize = self.am_getOption("MaxTarBallSize", self.maxTarBallSize)
+    self.indexFile = self.am_getOption("IndexFile", os.path.join(self.am_getWorkDirectory(), "TarTheLogsIndex.json"))
+    self.index = self.loadIndex()
+
     self.ops = Operations()
 
     dest_se = self.ops.getValue("Transformations/ArchiveSE", "")
@@ -105,17 +120,10 @@ class TarTheProdLogsAgent( AgentModule ):
       if not res["OK"]:
         self.log.error("Could not get the tar ball:", res["Message"])
         continue
-      
-      tarBall = res["Value"]
-      res = self.uploadToStorage(prod, tarBall)
-      if not res["OK"]:
-        self.log.error("Failed putting the file to storage:", res["Message"])
-      else:
-        res = self.cleanTarBall(tarBall)
-        if not res["OK"]:
-          self.log.error("Failed removing the Tar Ball", res["Message"])
-          
-      
+      if res['Value']['Failed']:
+        self.log.error("Failed to upload the tar balls, they are uploaded again in the next cycle:",
+                       ", ".join(sorted(res['Value']['Failed'])))
+
     return S_OK()
   
   def cleanupPrevious(self):
@@ -135,9 +143,13 @@ class TarTheProdLogsAgent( AgentModule ):
       prod = root.rstrip("/").split("/")[-1]
       for tfile in files:
         tarballpath = os.path.join(root, tfile)
+        if tfile.endswith(PARTIAL_SUFFIX):
+          ## its logs were not removed, they go into a new tar ball
+          self.cleanTarBall(tarballpath)
+          continue
         res = self.uploadToStorage(prod, tarballpath)
         if not res['OK']:
-          self.log.error("Failed to upload again %s to the SE")
+          self.log.error("Failed to upload again %s to the SE" % tarballpath, res['Message'])
           continue
         res = self.cleanTarBall(tarballpath)
         if not res["OK"]:
@@ -145,16 +157,63 @@ class TarTheProdLogsAgent( AgentModule ):
             
     return S_OK()
   
+  def loadIndex(self):
+    """ Read the modification times of the LOG directories which had nothing to archive in previous cycles
+    """
+    if not os.path.exists(self.indexFile):
+      return {}
+    try:
+      with open(self.indexFile) as indexFile:
+        return json.load(indexFile)
+    except (IOError, ValueError) as err:
+      self.log.warn("Cannot read the index of the LOG directories, walking all of them:", str(err))
+      return {}
+
+  def saveIndex(self):
+    """ Write the modification times of the LOG directories, replacing the file only once it is complete
+    """
+    try:
+      with open(self.indexFile + ".tmp", "w") as indexFile:
+        json.dump(self.index, indexFile)
+      os.rename(self.indexFile + ".tmp", self.indexFile)
+    except (IOError, OSError) as err:
+      self.log.warn("Cannot write the index of the LOG directories:", str(err))
+
+  def __isUnchanged(self, path):
+    """ True if the LOG directory had nothing to archive and was not modified since
+    """
+    if path not in self.index:
+      return False
+    try:
+      return os.stat(path).st_mtime == self.index[path]
+    except OSError:
+      return False
+
   def getDirectories(self):
     """ List the directories below the base
+
+    The log folders in the LOG directories are not walked, and the LOG directories which did not change since
+    they had nothing to archive are skipped.
     """
     final_dirs = {}
+    index = {}
     for root, dirs, dummy_files in os.walk(self.baselogpath):
-      if root.split("/")[-1] == "LOG" and len(dirs) > 1:
-        logDirs = sorted(dirs) ## sort them so we can remove the last one
+      unchanged = [folder for folder in dirs if self.__isUnchanged(os.path.join(root, folder))]
+      for folder in unchanged:
+        index[os.path.join(root, folder)] = self.index[os.path.join(root, folder)]
+        dirs.remove(folder)
+      if root.split("/")[-1] != "LOG":
+        continue
+      logDirs = sorted(dirs) ## sort them so we can remove the last one
+      del dirs[:]
+      if len(logDirs) > 1:
         del logDirs[-1]
         final_dirs[root]=logDirs
+      else:
+        index[root] = os.stat(root).st_mtime
 
+    self.index = index
+    self.saveIndex()
     return S_OK(final_dirs)
 
   def getProductionIDs(self, directories_and_files):
@@ -209,7 +268,7 @@ class TarTheProdLogsAgent( AgentModule ):
     """ Put the file to the Storage Element
     """
     ##FIXME: I don't think this does the right thing at the moment
-    final_lfn_path = self.baselfn+"/"+prod
+    final_lfn_path = "%s/%s" % (self.baselfn, prod)
     res = self.storageElement.isFile(final_lfn_path)
     if not res["OK"]:
       return res
@@ -225,39 +284,93 @@ class TarTheProdLogsAgent( AgentModule ):
     fileDict = {lfn : tarballpath}
     self.log.info( "putFile", fileDict )
     res = self.storageElement.putFile( fileDict )
-    if res['OK']:
-      if res['Value']['Failed']:
-        self.log.error( "putFile", res['Value']['Failed'] )
-    else:
+    if not res['OK']:
       self.log.error( "putFile", res['Message'] )
-      
+      return res
+    if res['Value']['Failed']:
+      self.log.error( "putFile", res['Value']['Failed'] )
+      return S_ERROR( "Failed to upload %s" % tarballpath )
+
     return S_OK()
 
+  def uploadAndCleanTarBall(self, prod, tarBall):
+    """ Upload the tar ball to the storage and remove it, it is kept for the next cycle if the upload fails
+    """
+    res = self.uploadToStorage(prod, tarBall)
+    if not res["OK"]:
+      self.log.error("Failed putting the file to storage:", res["Message"])
+      return res
+    res = self.cleanTarBall(tarBall)
+    if not res["OK"]:
+      self.log.error("Failed removing the Tar Ball", res["Message"])
+    return res
+
   def createTarBallAndCleanTheLogs(self, prod, prodFiles):
-    """ Create and return the path to the tar ball containing all the prod files
-    The file name contains the first and last taskID included. Allows easy finding of
-    the right tar ball.
+    """ Create the tar balls containing all the prod files, upload and remove them
+
+    The files are added one after the other to a tar ball, which is closed once it reaches maxTarBallSize,
+    so it is larger by at most the last file. Its files are removed, and it is uploaded while the next one
+    is created. The file name contains the first and last taskID included. Allows easy finding of the right
+    tar ball.
+
+    :returns: S_OK with the Successful list of uploaded tar balls and the Failed dictionary of the errors of
+              the tar balls kept for the next cycle, S_ERROR if a tar ball could not be created, the files not
+              included in a complete tar ball are kept
     """
-    starttaskid = int(prodFiles[0].split("_")[-2])
-    lasttaskid = int(prodFiles[-1].split("_")[-2])
-    name = os.path.join(self.baselogpath, prod, prod+"_"+ starttaskid + "_to_"+ lasttaskid +"_logs.tgz")
-    try: 
-      tarFile = tarfile.open( name, "w:gz" )
-      for fd in prodFiles:
-        tarFile.add( fd )
-      tarFile.close()
-      for fd in prodFiles:
-        os.remove( fd )
-    except Exception, e:
+    tarDir = os.path.join(self.basepath, "LogsTars", str(prod))
+    chunkFiles = []
+    tarFile = None
+    partName = os.path.join(tarDir, "%s_logs.tgz%s" % (prod, PARTIAL_SUFFIX))
+    uploader = ThreadPool(1)
+    uploads = []
+    try:
+      if not os.path.isdir(tarDir):
+        os.makedirs(tarDir)
+      for index, fd in enumerate(prodFiles):
+        if tarFile is None:
+          tarFile = tarfile.open(partName, "w:gz")
+        tarFile.add(fd)
+        chunkFiles.append(fd)
+        ## the data kept by the compressor is written out, otherwise it is not counted in the size
+        tarFile.fileobj.flush()
+        if index == len(prodFiles) - 1 or os.path.getsize(partName) >= self.maxTarBallSize:
+          tarFile.close()
+          tarFile = None
+          name = os.path.join(tarDir, "%s_%d_to_%d_logs.tgz" % (prod, self.__sortbyJob(chunkFiles[0]),
+                                                               self.__sortbyJob(chunkFiles[-1])))
+          os.rename(partName, name)
+          for committed in chunkFiles:
+            if os.path.isdir(committed):
+              shutil.rmtree(committed)
+            else:
+              os.remove(committed)
+          chunkFiles = []
+          ## only one tar ball is uploaded at a time, so at most two are on the disk
+          if uploads:
+            uploads[-1][1].wait()
+          uploads.append((name, uploader.apply_async(self.uploadAndCleanTarBall, (prod, name))))
+    except (IOError, OSError, tarfile.TarError) as e:
+      if tarFile is not None:
+        tarFile.close()
+      if os.path.exists(partName):
+        os.remove(partName)
       return S_ERROR("Failed with %s" % str(e))
-    return S_OK(name)
+    finally:
+      uploader.close()
+      uploader.join()
+    failed = {}
+    for name, upload in uploads:
+      res = upload.get()
+      if not res["OK"]:
+        failed[name] = res["Message"]
+    return S_OK({'Successful': [name for name, _upload in uploads if name not in failed], 'Failed': failed})
 
 
   def tarTheFolders(self, listOfFolders, outputFileName ):
     """ make a tarBall out of the list of folders"""
     cmd = ['tar','cjf',outputFileName, '--remove-files']
     cmd = cmd + listOfFolders
-    print "Creating",outputFileName
+    self.log.info("Creating", outputFileName)
     result = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     outAndErr = result.communicate()
     self.log.error( "Error from Tar\n%s" %outAndErr[1])
@@ -267,7 +380,7 @@ class TarTheProdLogsAgent( AgentModule ):
     cmd = ['find', basefolder, '-type','d', '-empty' ,'-print', '-delete']
     result = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = result.communicate()
-    print "Removed folders\n", out
+    self.log.info("Removed folders\n", out)
     if len (err):
       self.log.error("Errors in find\n",err)
 
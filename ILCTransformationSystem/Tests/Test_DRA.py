@@ -2,6 +2,7 @@
 
 import unittest
 import sys
+import time
 from StringIO import StringIO
 from collections import defaultdict
 
@@ -30,6 +31,10 @@ class TestDRA( unittest.TestCase ):
     self.dra.tClient=Mock( name="transMock", spec=DIRAC.TransformationSystem.Client.TransformationClient.TransformationClient )
     self.dra.fcClient=Mock( name="fcMock", spec=DIRAC.Resources.Catalog.FileCatalogClient.FileCatalogClient )
     self.dra.jobMon=Mock( name="jobMonMock", spec=DIRAC.WorkloadManagementSystem.Client.JobMonitoringClient.JobMonitoringClient)
+    self.dra.diracILC=Mock( name="dILCMock" )
+    self.dra.diracILC.getJobJDL.return_value = S_OK( {} )
+    self.dra.reqClient.readRequestsForJobs.return_value = S_OK( { 'Successful' : {}, 'Failed' : {} } )
+    self.dra.fcClient.exists.return_value = S_OK( { 'Successful' : {}, 'Failed' : {} } )
     self.dra.printEveryNJobs = 10
 
   def tearDown ( self ):
@@ -128,6 +133,78 @@ class TestDRA( unittest.TestCase ):
       self.dra.treatProduction( prodID=1234, transName="TestProd12", transType="MCReconstruction" ) ##returns None
     self.assertIn( "Skipping production 1234", out.getvalue().strip().splitlines()[0] )
 
+  def test_treatProduction_state( self ):
+    """test for DataRecoveryAgent treatProduction with state of previous cycles......................"""
+    from collections import OrderedDict
+    from ILCDIRAC.ILCTransformationSystem.Utilities.DataRecoveryState import DataRecoveryState
+    unchanged, changed, keeper, checkedLongAgo = [ self.getTestMock( index ) for index in xrange( 4 ) ]
+    for index, job in enumerate( ( unchanged, changed, keeper, checkedLongAgo ) ):
+      job.jobID = index
+      job.inputFile = "input%d.lfn" % index
+    jobs = OrderedDict( ( job.jobID, job ) for job in ( unchanged, changed, keeper, checkedLongAgo ) )
+    getJobMock = Mock( name = "getJobMOck" )
+    getJobMock.getJobs.return_value = ( jobs, 50, 50 )
+    now = time.time()
+    self.dra.jobState = Mock( name = "stateMock", spec = DataRecoveryState )
+    self.dra.jobState.getJobs.return_value = {
+      0 : dict( Status = "Done", LastChecked = now, Decision = "No Action", InputFile = "input0.lfn",
+                Dependencies = None ),
+      1 : dict( Status = "Failed", LastChecked = now, Decision = "No Action", InputFile = "input1.lfn",
+                Dependencies = None ),
+      2 : dict( Status = "Done", LastChecked = now, Decision = "Other Tasks --> Keep", InputFile = "input2.lfn",
+                Dependencies = None ),
+      3 : dict( Status = "Done", LastChecked = now - 2 * self.dra.recheckInterval, Decision = "No Action",
+                InputFile = "input3.lfn", Dependencies = None ),
+    }
+    self.dra.checkAllJobs = Mock()
+    self.dra.enabled = True
+    with patch("%s.TransformationInfo" % MODULE_NAME, new=Mock( return_value = getJobMock ) ):
+      self.dra.treatProduction( prodID=1234, transName="TestProd12", transType="MCGeneration" )
+    checkedJobs = self.dra.checkAllJobs.call_args[0][0]
+    self.assertEqual( [ 1, 3 ], checkedJobs.keys() )
+    self.assertIn( "input2.lfn", self.dra.inputFilesProcessed )
+    prodID, jobStates = self.dra.jobState.setJobs.call_args[0]
+    self.assertEqual( 1234, prodID )
+    self.assertEqual( [ 1, 3 ], [ jobState[0] for jobState in jobStates ] )
+
+  def test_treatProduction_state_dependencies( self ):
+    """test for DataRecoveryAgent treatProduction rechecking jobs whose tasks or input file changed......"""
+    from collections import OrderedDict
+    from ILCDIRAC.ILCTransformationSystem.Utilities.DataRecoveryState import DataRecoveryState
+    jobs = OrderedDict()
+    for jobID, inputFile in enumerate( ( "input0.lfn", "input1.lfn", "input2.lfn", "input2.lfn", "input4.lfn" ) ):
+      job = self.getTestMock( jobID )
+      job.jobID = jobID
+      job.inputFile = inputFile
+      job.status = "Failed" if jobID == 2 else "Done"
+      jobs[jobID] = job
+    getJobMock = Mock( name = "getJobMOck" )
+    getJobMock.getJobs.return_value = ( jobs, 50, 50 )
+    getJobMock.checkTasksStatus.return_value = {
+      10 : dict( FileID = 1, LFN = "input0.lfn", Status = "Assigned", ErrorCount = 0 ),
+      11 : dict( FileID = 2, LFN = "input1.lfn", Status = "Assigned", ErrorCount = 0 ),
+      ## a new task for input1 was created since job 1 was checked
+      21 : dict( FileID = 2, LFN = "input1.lfn", Status = "Assigned", ErrorCount = 1 ),
+      12 : dict( FileID = 3, LFN = "input2.lfn", Status = "Assigned", ErrorCount = 0 ),
+      14 : dict( FileID = 4, LFN = "input4.lfn", Status = "Assigned", ErrorCount = 0 ),
+    }
+    now = time.time()
+    self.dra.jobState = Mock( name = "stateMock", spec = DataRecoveryState )
+    self.dra.jobState.getJobs.return_value = dict(
+      ( jobID, dict( Status = "Done", LastChecked = now, Decision = "No Action", InputFile = inputFile,
+                     Dependencies = dependencies ) )
+      for jobID, inputFile, dependencies in ( ( 0, "input0.lfn", "10:Assigned:0" ), ( 1, "input1.lfn", "11:Assigned:0" ),
+                                              ( 2, "input2.lfn", "12:Assigned:0" ), ( 3, "input2.lfn", "12:Assigned:0" ),
+                                              ( 4, "input4.lfn", "14:Assigned:0" ) ) )
+    self.dra.checkAllJobs = Mock()
+    self.dra.enabled = True
+    with patch("%s.TransformationInfo" % MODULE_NAME, new=Mock( return_value = getJobMock ) ):
+      self.dra.treatProduction( prodID=1234, transName="TestProd12", transType="MCReconstruction" )
+    ## 1: new task for its input file, 2: status changed, 3: same input file as 2
+    checkedJobs = self.dra.checkAllJobs.call_args[0][0]
+    self.assertEqual( [ 1, 2, 3 ], checkedJobs.keys() )
+    _prodID, jobStates = self.dra.jobState.setJobs.call_args[0]
+    self.assertEqual( [ "21:Assigned:1", "12:Assigned:0", "12:Assigned:0" ], [ jobState[5] for jobState in jobStates ] )
 
   def test_checkJob( self ):
     """test for DataRecoveryAgent checkJob MCGeneration............................................."""
@@ -237,8 +314,13 @@ class TestDRA( unittest.TestCase ):
     self.dra.inputFilesProcessed = set( [testJob.inputFile] )
     self.dra.checkJob( testJob, tInfoMock )
     self.assertIn( testJob.inputFile , self.dra.inputFilesProcessed )
-    self.assertIn( "setJobFailed", tInfoMock.method_calls[0] )
-    self.assertIn( "cleanOutputs", tInfoMock.method_calls[1] )
+    ## the job is only failed once its outputs are removed
+    self.assertEqual( 1, len( tInfoMock.method_calls ) )
+    self.assertIn( "cleanOutputs", tInfoMock.method_calls[0] )
+    self.assertEqual( [ testJob ], [ job for job, _actions in self.dra.jobsToClean ] )
+    self.dra.applyCleanedJobs( tInfoMock, set() )
+    self.assertIn( "setJobFailed", tInfoMock.method_calls[1] )
+    self.assertEqual( [], self.dra.jobsToClean )
     self.assertEqual( self.dra.todo["OtherProductions"][0]["Counter"] , 1 )
     self.assertEqual( self.dra.todo["OtherProductions"][1]["Counter"] , 1 )
     self.assertEqual( self.dra.todo["OtherProductions"][2]["Counter"] , 1 )
@@ -264,6 +346,7 @@ class TestDRA( unittest.TestCase ):
     testJob.fileStatus = "Exists"
     self.dra.inputFilesProcessed = set( )
     self.dra.checkJob( testJob, tInfoMock )
+    self.dra.applyCleanedJobs( tInfoMock, set() )
     self.assertIn( "cleanOutputs",    tInfoMock.method_calls[0] )
     self.assertIn( "setJobFailed",    tInfoMock.method_calls[1] )
     self.assertIn( "setInputDeleted", tInfoMock.method_calls[2] )
@@ -292,6 +375,7 @@ class TestDRA( unittest.TestCase ):
     testJob.fileStatus = "Deleted"
     self.dra.inputFilesProcessed = set( )
     self.dra.checkJob( testJob, tInfoMock )
+    self.dra.applyCleanedJobs( tInfoMock, set() )
     self.assertIn( "cleanOutputs",    tInfoMock.method_calls[0] )
     self.assertIn( "setJobFailed",    tInfoMock.method_calls[1] )
     self.assertEqual( self.dra.todo["OtherProductions"][0]["Counter"] , 1 )
@@ -478,6 +562,7 @@ class TestDRA( unittest.TestCase ):
     testJob.fileStatus = "Assigned"
     self.dra.inputFilesProcessed = set()
     self.dra.checkJob( testJob, tInfoMock )
+    self.dra.applyCleanedJobs( tInfoMock, set() )
     self.assertIn( "cleanOutputs",   tInfoMock.method_calls[0] )
     self.assertIn( "setInputUnused", tInfoMock.method_calls[1] )
     self.assertEqual( self.dra.todo["OtherProductions"][0]["Counter"] , 1 )
@@ -505,6 +590,7 @@ class TestDRA( unittest.TestCase ):
     testJob.fileStatus = "Assigned"
     self.dra.inputFilesProcessed = set()
     self.dra.checkJob( testJob, tInfoMock )
+    self.dra.applyCleanedJobs( tInfoMock, set() )
     self.assertIn( "cleanOutputs",   tInfoMock.method_calls[0] )
     self.assertIn( "setInputUnused", tInfoMock.method_calls[1] )
     self.assertIn( "setJobFailed", tInfoMock.method_calls[2] )
@@ -616,6 +702,7 @@ class TestDRA( unittest.TestCase ):
     testJob.fileStatus = "Processed"
     self.dra.inputFilesProcessed = set()
     self.dra._DataRecoveryAgent__failJobHard( testJob, tInfoMock ) #pylint: disable=protected-access, no-member
+    self.dra.applyCleanedJobs( tInfoMock, set() )
     self.assertIn( "cleanOutputs", tInfoMock.method_calls[0] )
     self.assertIn( "setJobFailed", tInfoMock.method_calls[1] )
     self.assertEqual( self.dra.todo["OtherProductions"][0]["Counter"] , 1 )
@@ -752,9 +839,87 @@ class TestDRA( unittest.TestCase ):
     self.dra.checkAllJobs( mockJobs, tInfoMock, taskDict, lfnTaskDict = True )
     self.assertIn( "Failing job hard", out.getvalue().strip() )
 
+  def test_checkAllJobs_bulk( self ):
+    """test for DataRecoveryAgent checkAllJobs getting the information for chunks of jobs............"""
+    from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo
+    tInfoMock = Mock( name = "tInfoMock", spec=TransformationInfo )
+    mockJobs = dict([ (i, self.getTestMock( nameID = i ) ) for i in xrange(5) ] )
+    for i, job in mockJobs.items():
+      job.jobID = i
+      job.outputFiles = [ "/my/file_%d.lfn" % i ]
+    mockJobs[3].pendingRequest = True
+    self.dra.diracILC.getJobJDL.side_effect = lambda jobID: S_ERROR( "No JDL" ) if jobID == 2 else S_OK( { 'JobID' : jobID } )
+    self.dra.jobChunkSize = 3
+    tInfoMock.checkFilesExistence.return_value = { 0 : { "/my/file_0.lfn" : True } }
+    out = StringIO()
+    sys.stdout = out
+    self.dra.checkAllJobs( mockJobs, tInfoMock )
+    self.assertEqual( self.dra.reqClient.readRequestsForJobs.call_count, 2 )
+    self.assertEqual( self.dra.diracILC.getJobJDL.call_count, 5 )
+    mockJobs[0].getJobInformation.assert_called_once_with( self.dra.diracILC, { 'JobID' : 0 } )
+    mockJobs[2].getJobInformation.assert_called_once_with( self.dra.diracILC, None )
+    checkedJobs = [ mockJobs[i] for i in ( 0, 1, 2, 4 ) ]
+    tInfoMock.checkFilesExistence.assert_called_once_with( checkedJobs )
+    self.assertFalse( tInfoMock.findDescendants.called )
+    mockJobs[0].checkFileExistance.assert_called_once_with( self.dra.fcClient, { "/my/file_0.lfn" : True } )
+    mockJobs[1].checkFileExistance.assert_called_once_with( self.dra.fcClient, None )
+    self.assertFalse( mockJobs[3].getJobInformation.called )
+    self.assertFalse( mockJobs[3].checkFileExistance.called )
+    self.assertIn( "Checked 5 jobs", out.getvalue() )
+
+  def test_checkAllJobs_removal( self ):
+    """test for DataRecoveryAgent checkAllJobs removing the outputs of all jobs at once................"""
+    from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo
+    tInfoMock = Mock( name = "tInfoMock", spec=TransformationInfo )
+    tInfoMock.checkFilesExistence.return_value = {}
+    tInfoMock.removeQueuedFiles.return_value = { 1 }
+    tInfoMock.getRemovalSummary.return_value = [ "Removal at SE-A: 3 files removed, 1 failed, 2.0 files/s" ]
+    mockJobs = dict([ (i, self.getTestMock( nameID = i ) ) for i in xrange(2) ] )
+    for i, job in mockJobs.items():
+      job.jobID = i
+    self.dra.removalWorkers = 3
+    self.dra.removalChunkSize = 100
+    self.dra.checkJob = Mock( side_effect = lambda job, tInfo: self.dra.decisions.update( { job.jobID : "Cleaned" } ) )
+    out = StringIO()
+    sys.stdout = out
+    self.dra.checkAllJobs( mockJobs, tInfoMock )
+    tInfoMock.removeQueuedFiles.assert_called_once_with( 3, 100 )
+    self.assertEqual( { 0 : "Cleaned" }, self.dra.decisions )
+    self.assertIn( "Removal at SE-A: 3 files removed", self.dra.notesToSend )
+
+  def test_checkAllJobs_removal_fails( self ):
+    """test for DataRecoveryAgent checkAllJobs changing nothing for jobs whose outputs were not removed......"""
+    from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo
+    tInfoMock = Mock( name = "tInfoMock", spec=TransformationInfo )
+    tInfoMock.checkFilesExistence.return_value = {}
+    tInfoMock.getRemovalSummary.return_value = []
+    mockJobs = dict([ (i, self.getTestMock( nameID = i ) ) for i in xrange(2) ] )
+    for i, job in mockJobs.items():
+      job.jobID = i
+      job.status = "Failed"
+      job.allFilesExist.return_value = False
+      job.allFilesMissing.return_value = False
+      job.someFilesMissing.return_value = True
+    def removeQueuedFiles( *_args ):
+      """the outputs of all jobs are queued before any is removed, the removal fails for job 0"""
+      self.assertTrue( all( job.cleanOutputs.called for job in mockJobs.values() ) )
+      self.assertFalse( any( job.setInputUnused.called for job in mockJobs.values() ) )
+      return { 0 }
+    tInfoMock.removeQueuedFiles.side_effect = removeQueuedFiles
+    self.dra.inputFilesProcessed = set()
+    out = StringIO()
+    sys.stdout = out
+    self.dra.checkAllJobs( mockJobs, tInfoMock )
+    for job in mockJobs.values():
+      job.cleanOutputs.assert_called_once_with( tInfoMock )
+    self.assertFalse( mockJobs[0].setInputUnused.called )
+    mockJobs[1].setInputUnused.assert_called_once_with( tInfoMock )
+    self.assertEqual( { 1 : "Output Missing --> Cleanup, Input Unused" }, self.dra.decisions )
+    self.assertEqual( [], self.dra.jobsToClean )
+    self.assertIn( "Not all outputs of job 0 were removed", out.getvalue() )
+
   def test_execute( self ):
     """test for DataRecoveryAgent execute .........................................................."""
-    self.dra.treatProduction = Mock()
 
     out = StringIO()
     sys.stdout = out
@@ -776,7 +941,8 @@ class TestDRA( unittest.TestCase ):
                                                                        124: ("MCGeneration", "Trafo124"),
                                                                        125: ("MCGeneration", "Trafo125")}
                                                                    ) )
-    res = self.dra.execute()
+    with patch.object( DataRecoveryAgent, "treatProduction", autospec=True ):
+      res = self.dra.execute()
     self.assertTrue( res["OK"] )
     self.assertIn( "Will ignore the following productions: [123, 456, 789]", out.getvalue() )
     self.assertIn( "Ignoring Production: 123", out.getvalue() )
@@ -788,11 +954,15 @@ class TestDRA( unittest.TestCase ):
                                                                        124: ("MCGeneration", "Trafo124"),
                                                                        125: ("MCGeneration", "Trafo125")}
                                                                    ) )
-    self.dra.notesToSend = "Da hast du deine Karte"
+    def treatProduction( agent, prodID, _transName, _transType ):
+      """the agent treating production 124 has notes to send"""
+      if prodID == 124:
+        agent.notesToSend = "Da hast du deine Karte"
     sendmailMock = Mock()
     sendmailMock.sendMail.return_value = S_OK("Nice Card")
     notificationMock = Mock( return_value = sendmailMock )
-    with patch("%s.NotificationClient" % MODULE_NAME, new=notificationMock ):
+    with patch("%s.NotificationClient" % MODULE_NAME, new=notificationMock ), \
+         patch.object( DataRecoveryAgent, "treatProduction", autospec=True, side_effect=treatProduction ):
       res = self.dra.execute()
     self.assertTrue( res["OK"] )
     self.assertIn( "Will ignore the following productions: [123, 456, 789]", out.getvalue() )
@@ -803,11 +973,11 @@ class TestDRA( unittest.TestCase ):
     gLogger.notice( "JobCache: %s" % self.dra.jobCache )
 
     ## sending notes fails
-    self.dra.notesToSend = "Da hast du deine Karte"
     sendmailMock = Mock()
     sendmailMock.sendMail.return_value = S_ERROR("No stamp")
     notificationMock = Mock( return_value = sendmailMock )
-    with patch("%s.NotificationClient" % MODULE_NAME, new=notificationMock ):
+    with patch("%s.NotificationClient" % MODULE_NAME, new=notificationMock ), \
+         patch.object( DataRecoveryAgent, "treatProduction", autospec=True, side_effect=treatProduction ):
       res = self.dra.execute()
     self.assertTrue( res["OK"] )
     self.assertNotIn( 124, self.dra.jobCache ) ## was popped
@@ -817,6 +987,30 @@ class TestDRA( unittest.TestCase ):
     self.assertEqual( "", self.dra.notesToSend )
 
 
+  def test_execute_counters( self ):
+    """test for DataRecoveryAgent execute with separate counters for each production................"""
+    def treatProduction( agent, prodID, _transName, _transType ):
+      """every production finds a different number of jobs to keep"""
+      agent.todo['OtherProductions'][0]['Counter'] += prodID
+      agent.inputFilesProcessed.add( "input%d.lfn" % prodID )
+      agent.notesToSend = "Notes for %d" % prodID
+    self.dra.productionsToIgnore = []
+    self.dra.productionWorkers = 2
+    self.dra.getEligibleTransformations = Mock( return_value = S_OK( dict( ( prodID, ("MCSimulation", "Trafo%d" % prodID) )
+                                                                           for prodID in ( 1, 2, 3 ) ) ) )
+    with patch.object( DataRecoveryAgent, "treatProduction", autospec=True, side_effect=treatProduction ), \
+         patch("%s.serverCredentials" % MODULE_NAME ) as credentialsMock, \
+         patch("%s.NotificationClient" % MODULE_NAME ) as notificationMock:
+      res = self.dra.execute()
+    self.assertTrue( res["OK"] )
+    ## the productions use the server certificate, files are not removed at the same time
+    self.assertEqual( 3, credentialsMock.call_count )
+    self.assertEqual( 6, self.dra.todo['OtherProductions'][0]['Counter'] )
+    self.assertEqual( set(), self.dra.inputFilesProcessed )
+    self.assertEqual( "", self.dra.notesToSend )
+    ## only keepers, so no notification
+    notificationMock.assert_not_called()
+
   def test_printSummary( self ):
     """test DataRecoveryAgent printSummary.........................................................."""
     out = StringIO()
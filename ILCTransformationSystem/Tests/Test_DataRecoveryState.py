@@ -0,0 +1,68 @@
+"""Test the DataRecoveryState"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ILCDIRAC.ILCTransformationSystem.Utilities.DataRecoveryState import DataRecoveryState
+
+__RCSID__ = "$Id$"
+
+class TestDataRecoveryState( unittest.TestCase ):
+  """Test the DataRecoveryState"""
+
+  def setUp( self ):
+    self.tmpdir = tempfile.mkdtemp()
+    self.fileName = os.path.join( self.tmpdir, 'state.sqlite' )
+    self.state = DataRecoveryState( self.fileName )
+
+  def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
+
+  def test_setJobs( self ):
+    """test DataRecoveryState setJobs and getJobs..................................................."""
+    self.assertEqual( {}, self.state.getJobs( 1234 ) )
+    self.state.setJobs( 1234, [ ( 1, "Done", 10.0, "No Action", "/ilc/input1.lfn", "11:Assigned:0" ),
+                                ( 2, "Failed", 10.0, None, "/ilc/input2.lfn", None ) ] )
+    self.state.setJobs( 1234, [ ( 1, "Failed", 20.0, "Other Tasks --> Keep", "/ilc/input1.lfn", "12:Processed:1" ) ] )
+    jobs = self.state.getJobs( 1234 )
+    self.assertEqual( dict( Status = "Failed", LastChecked = 20.0, Decision = "Other Tasks --> Keep",
+                            InputFile = "/ilc/input1.lfn", Dependencies = "12:Processed:1" ), jobs[1] )
+    self.assertIsNone( jobs[2]['Decision'] )
+    self.assertEqual( {}, self.state.getJobs( 4321 ) )
+
+  def test_persistent( self ):
+    """test DataRecoveryState keeps the state in the file..........................................."""
+    self.state.setJobs( 1234, [ ( 1, "Done", 10.0, "No Action", "/ilc/input1.lfn", None ) ] )
+    newState = DataRecoveryState( self.fileName )
+    self.assertEqual( [ 1 ], newState.getJobs( 1234 ).keys() )
+
+  def test_removeOtherProductions( self ):
+    """test DataRecoveryState removeOtherProductions................................................"""
+    self.state.setJobs( 1234, [ ( 1, "Done", 10.0, "No Action", "/ilc/input1.lfn", None ) ] )
+    self.state.setJobs( 4321, [ ( 2, "Done", 10.0, "No Action", "/ilc/input2.lfn", None ) ] )
+    self.state.removeOtherProductions( [ 4321 ] )
+    self.assertEqual( {}, self.state.getJobs( 1234 ) )
+    self.assertEqual( [ 2 ], self.state.getJobs( 4321 ).keys() )
+    self.state.removeOtherProductions( [] )
+    self.assertEqual( {}, self.state.getJobs( 4321 ) )
+
+  def test_oldFile( self ):
+    """test DataRecoveryState adds the Dependencies to a file written without them......................"""
+    import sqlite3
+    oldFileName = os.path.join( self.tmpdir, 'old.sqlite' )
+    connection = sqlite3.connect( oldFileName )
+    with connection:
+      connection.execute( "CREATE TABLE Jobs ( JobID INTEGER PRIMARY KEY, ProdID INTEGER NOT NULL, "
+                          "Status TEXT, LastChecked REAL, Decision TEXT, InputFile TEXT )" )
+      connection.execute( "INSERT INTO Jobs VALUES ( 1, 1234, 'Done', 10.0, 'No Action', '/ilc/input1.lfn' )" )
+    connection.close()
+    oldState = DataRecoveryState( oldFileName )
+    self.assertIsNone( oldState.getJobs( 1234 )[1]['Dependencies'] )
+    oldState.setJobs( 1234, [ ( 2, "Done", 10.0, "No Action", "/ilc/input2.lfn", "12:Assigned:0" ) ] )
+    self.assertEqual( "12:Assigned:0", oldState.getJobs( 1234 )[2]['Dependencies'] )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( TestDataRecoveryState )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 3 ).run( SUITE )
@@ -456,7 +456,6 @@ class TestJI( unittest.TestCase ):
     reqMock.Status = "Done"
     reqClient = Mock( name="reqMock", spec=DIRAC.RequestManagementSystem.Client.ReqClient.ReqClient )
     reqClient.readRequestsForJobs.return_value = S_OK( {"Successful":{1234: reqMock } } )
-    reqClient.getRequestStatus.return_value = S_OK( 'Done' )
     self.jbi.jobID = 1234
     self.jbi.checkRequests( reqClient )
     self.assertFalse( self.jbi.pendingRequest )
@@ -469,6 +468,7 @@ class TestJI( unittest.TestCase ):
     self.jbi.jobID = 1234
     self.jbi.checkRequests( reqClient )
     self.assertTrue( self.jbi.pendingRequest )
+    self.assertFalse( reqClient.getRequestStatus.called )
 
     ## Failed to get Request
     reqMock = Mock()
@@ -512,6 +512,34 @@ class TestJI( unittest.TestCase ):
     self.assertIn( "Failed to check existance: No FC", str(cme.exception) )
 
 
+  def test_checkFileExistance_bulk( self ):
+    """ILCTransformation.Utilities.JobInfo.checkFileExistance with existence of many jobs..........."""
+    fcMock = Mock( name="fcMock", spec=DIRAC.Resources.Catalog.FileCatalogClient.FileCatalogClient )
+    self.jbi.inputFile = "inputFile"
+    self.jbi.outputFiles = ["outputFile1", "outputFile2", "unknownFile"]
+    self.jbi.checkFileExistance( fcMock, { "inputFile": True, "outputFile1": False, "outputFile2": True, "otherJobFile": True } )
+    self.assertTrue( self.jbi.inputFileExists )
+    self.assertEqual( self.jbi.outputFileStatus, ["Missing", "Exists", "Unknown"] )
+    self.assertFalse( fcMock.exists.called )
+
+  def test_checkRequests_bulk( self ):
+    """ILCTransformation.Utilities.JobInfo.checkRequests with requests of many jobs................."""
+    reqClient = Mock( name="reqMock", spec=DIRAC.RequestManagementSystem.Client.ReqClient.ReqClient )
+    self.jbi.jobID = 1234
+    self.jbi.checkRequests( reqClient, { 1234: Mock( RequestID = 9876, Status = 'Waiting' ),
+                                         1235: Mock( RequestID = 9877, Status = 'Done' ) } )
+    self.assertTrue( self.jbi.pendingRequest )
+    self.jbi.checkRequests( reqClient, { 1234: Mock( RequestID = 9876, Status = 'Canceled' ) } )
+    self.assertFalse( self.jbi.pendingRequest )
+    self.assertFalse( reqClient.getRequestStatus.called )
+    self.assertFalse( reqClient.readRequestsForJobs.called )
+
+  def test_getJobInformation_bulk( self ):
+    """ILCTransformation.Utilities.JobInfo.getJobInformation with a JDL already obtained............"""
+    self.jbi.getJobInformation( self.diracILC, self.jdl1 )
+    self.assertEqual( 10256, self.jbi.taskID )
+    self.assertFalse( self.diracILC.getJobJDL.called )
+
   def test__str__( self ):
     """ILCTransformation.Utilities.JobInfo.__str__.................................................."""
     jbi = JobInfo( jobID=123, status="Failed", tID=1234, tType = "MCReconstruction" )
@@ -0,0 +1,177 @@
+"""Test the ProductionSummary"""
+
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock as Mock
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.Core.Utilities.InputFilesUtilities import resetMetadataCache
+from ILCDIRAC.ILCTransformationSystem.Utilities.ProductionSummary import ProductionSummary, parseAdditionalInfo, \
+  translateDetail, writeHTML, writeJSON, writeCSV
+
+__RCSID__ = "$Id$"
+
+PROD_DIR = '/ilc/prod/clic/500gev/ee_qq/ILD/SIM/00001234/000'
+XSECTION = "{'xsection': {'sum': {'xsection': %s, 'err_xsection': 0.1}}}"
+
+class TestProductionSummary( unittest.TestCase ):
+  """Test the ProductionSummary"""
+
+  def setUp( self ):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cacheFile = os.path.join( self.tmpdir, 'cache.json' )
+    resetMetadataCache()
+    self.lfns = [ '%s/ee_qq_%d.slcio' % ( PROD_DIR, index ) for index in xrange( 3 ) ]
+    self.fileMeta = dict( ( lfn, { 'NumberOfEvents' : 100, 'Luminosity' : 2.5, 'AdditionalInfo' : XSECTION % 10. } )
+                          for lfn in self.lfns )
+    self.fcMock = Mock()
+    self.fcMock.findFilesByMetadata.return_value = S_OK( self.lfns )
+    self.fcMock.getDirectoryUserMetadata.return_value = S_OK( { 'EvtType' : 'ee_qq', 'Energy' : '500',
+                                                                'DetectorType' : 'ILD' } )
+    self.fcMock.getFileUserMetadataBulk.side_effect = \
+      lambda lfns: S_OK( { 'Successful' : dict( ( lfn, self.fileMeta[lfn] ) for lfn in lfns ), 'Failed' : {} } )
+    self.tMock = Mock()
+    self.tMock.getTransformationInputDataQuery.return_value = S_OK( { 'ProdID' : 1000 } )
+    self.transformation = dict( TransformationID = 1234, Type = 'MCSimulation', Status = 'Active',
+                                LastUpdate = '2017-01-01 10:00:00', Description = 'ee to qq' )
+
+  def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
+
+  def getSummary( self, **kwargs ):
+    """ Return a ProductionSummary with the mocked clients """
+    return ProductionSummary( self.tMock, self.fcMock, { 'ee_qq' : { 'Detail' : 'e1E1 -> qQ' } },
+                              cacheFile = self.cacheFile, **kwargs )
+
+  def test_summary( self ):
+    """test ProductionSummary getSummaries......................................................."""
+    summaries = self.getSummary().getSummaries( [ self.transformation ] )
+    self.assertEqual( 1, len( summaries ) )
+    summary = summaries[0]
+    self.assertEqual( 300, summary['NumberOfEvents'] )
+    self.assertEqual( 3, summary['nb_files'] )
+    self.assertEqual( 10., summary['CrossSection'] )
+    self.assertEqual( 1000, summary['MomProdID'] )
+    self.assertEqual( translateDetail( 'e1E1 -> qQ' ), summary['detail'] )
+    self.fcMock.getFileUserMetadataBulk.assert_called_once_with( self.lfns[:1] )
+    self.fcMock.findFilesByMetadata.assert_called_once_with( { 'ProdID' : 1234, 'Datatype' : 'SIM' } )
+
+  def test_full_detail( self ):
+    """test ProductionSummary getSummaries with every file......................................."""
+    self.fileMeta[self.lfns[1]] = { 'NumberOfEvents' : 50, 'AdditionalInfo' : XSECTION % 40. }
+    summary = self.getSummary( fullDetail = True ).getSummaries( [ self.transformation ] )[0]
+    self.assertEqual( 250, summary['NumberOfEvents'] )
+    self.assertEqual( 20., summary['CrossSection'] )
+    self.fcMock.getFileUserMetadataBulk.assert_called_once_with( self.lfns )
+
+  def test_ancestors( self ):
+    """test ProductionSummary getSummaries takes the cross section of the oldest ancestors......."""
+    for lfn in self.lfns:
+      self.fileMeta[lfn] = { 'NumberOfEvents' : 100 }
+    self.fileMeta['/ilc/gen/1.stdhep'] = { 'Luminosity' : 1.0, 'AdditionalInfo' : XSECTION % 30. }
+    self.fcMock.getFileAncestors.return_value = S_OK( { 'Successful' : { self.lfns[0] : { '/ilc/gen/1.stdhep' : 2,
+                                                                                          '/ilc/sim/1.slcio' : 1 } },
+                                                        'Failed' : {} } )
+    summary = self.getSummary().getSummaries( [ self.transformation ] )[0]
+    self.assertEqual( 30., summary['CrossSection'] )
+    self.assertEqual( 300, summary['NumberOfEvents'] )
+
+  def test_cached( self ):
+    """test ProductionSummary reuses the summaries until the production changes.................."""
+    first = self.getSummary().getSummaries( [ self.transformation ] )
+    self.assertTrue( os.path.exists( self.cacheFile ) )
+    resetMetadataCache()
+    self.assertEqual( first, self.getSummary().getSummaries( [ self.transformation ] ) )
+    self.assertEqual( 1, self.fcMock.findFilesByMetadata.call_count )
+    ## a full detail summary cannot be taken from a summary of the first file only
+    self.getSummary( fullDetail = True ).getSummaries( [ self.transformation ] )
+    self.assertEqual( 2, self.fcMock.findFilesByMetadata.call_count )
+    self.transformation['LastUpdate'] = '2017-01-02 10:00:00'
+    self.getSummary().getSummaries( [ self.transformation ] )
+    self.assertEqual( 3, self.fcMock.findFilesByMetadata.call_count )
+    self.transformation['Status'] = 'Completed'
+    self.getSummary().getSummaries( [ self.transformation ] )
+    self.assertEqual( 4, self.fcMock.findFilesByMetadata.call_count )
+
+  def test_corrupt_cache( self ):
+    """test ProductionSummary ignores a cache file which cannot be read.........................."""
+    with open( self.cacheFile, 'w' ) as cacheFile:
+      cacheFile.write( '{ not json' )
+    self.assertEqual( 1, len( self.getSummary().getSummaries( [ self.transformation ] ) ) )
+    with open( self.cacheFile ) as cacheFile:
+      self.assertIn( '1234', json.load( cacheFile ) )
+
+  def test_failures( self ):
+    """test ProductionSummary skips productions which cannot be summarised......................."""
+    merge = dict( self.transformation, TransformationID = 1235, Type = 'Merge' )
+    empty = dict( self.transformation, TransformationID = 1236 )
+    self.fcMock.findFilesByMetadata.side_effect = [ S_OK( [] ) ]
+    self.assertEqual( [], self.getSummary().getSummaries( [ merge, empty ] ) )
+    self.fcMock.findFilesByMetadata.side_effect = [ S_ERROR( 'catalog down' ) ]
+    self.assertEqual( [], self.getSummary().getSummaries( [ self.transformation ] ) )
+    with open( self.cacheFile ) as cacheFile:
+      self.assertEqual( {}, json.load( cacheFile ) )
+
+  def test_parseAdditionalInfo( self ):
+    """test parseAdditionalInfo does not evaluate the metadata..................................."""
+    self.assertEqual( { 'xsection' : { 'sum' : { 'xsection' : 1.5 } } },
+                      parseAdditionalInfo( "{'xsection': {'sum': {'xsection': 1.5}}}" ) )
+    self.assertEqual( {}, parseAdditionalInfo( "{'a': __import__('os').getcwd()}" ) )
+    self.assertEqual( {}, parseAdditionalInfo( "[1, 2]" ) )
+
+  def test_write( self ):
+    """test writing the summaries as HTML, JSON and CSV.........................................."""
+    gen = dict( self.transformation, Type = 'MCGeneration', TransformationID = 1000 )
+    self.fcMock.getDirectoryUserMetadata.side_effect = [ S_OK( { 'EvtType' : 'ee_qq', 'Energy' : '500' } ),
+                                                         S_OK( { 'EvtType' : 'ee_qq', 'Energy' : '500',
+                                                                 'DetectorType' : 'ILD' } ) ]
+    self.fcMock.findFilesByMetadata.side_effect = [ S_OK( [ '/ilc/prod/gen/ee_qq_1.stdhep' ] ), S_OK( self.lfns ) ]
+    self.fileMeta['/ilc/prod/gen/ee_qq_1.stdhep'] = { 'NumberOfEvents' : 100, 'Luminosity' : 2.5 }
+    summaries = self.getSummary( nbWorkers = 1 ).getSummaries( [ gen, self.transformation ] )
+    self.assertEqual( [ 1000, 1234 ], [ summary['ProdID'] for summary in summaries ] )
+    htmlFile = os.path.join( self.tmpdir, 'tables.html' )
+    writeHTML( summaries, htmlFile )
+    with open( htmlFile ) as html:
+      content = html.read()
+    self.assertIn( '<h1>gen prods</h1>', content )
+    self.assertIn( '<h1>ILD prods</h1>', content )
+    self.assertIn( '<h2>SIM</h2>', content )
+    jsonFile = os.path.join( self.tmpdir, 'tables.json' )
+    writeJSON( summaries, jsonFile )
+    with open( jsonFile ) as jsonSummaries:
+      self.assertEqual( summaries, json.load( jsonSummaries ) )
+    csvFile = os.path.join( self.tmpdir, 'tables.csv' )
+    writeCSV( summaries, csvFile )
+    with open( csvFile ) as csvSummaries:
+      rows = list( csv.DictReader( csvSummaries ) )
+    self.assertEqual( [ '1000', '1234' ], [ row['ProdID'] for row in rows ] )
+    self.assertEqual( [ '', 'ILD' ], [ row['DetectorType'] for row in rows ] )
+    self.assertEqual( '300', rows[1]['NumberOfEvents'] )
+
+  def test_write_cached_unicode( self ):
+    """test writing summaries with non-ASCII descriptions read back from the cache..............."""
+    self.transformation['Description'] = u'e\u207a e\u207b \u2192 qq'
+    self.getSummary().getSummaries( [ self.transformation ] )
+    resetMetadataCache()
+    summaries = self.getSummary().getSummaries( [ self.transformation ] )
+    self.assertEqual( 1, self.fcMock.findFilesByMetadata.call_count )
+    self.assertIsInstance( summaries[0]['detail'], unicode )
+    htmlFile = os.path.join( self.tmpdir, 'tables.html' )
+    writeHTML( summaries, htmlFile )
+    with open( htmlFile ) as html:
+      self.assertIn( u'e\u207a e\u207b \u2192 qq'.encode( 'utf-8' ), html.read() )
+    csvFile = os.path.join( self.tmpdir, 'tables.csv' )
+    writeCSV( summaries, csvFile )
+    with open( csvFile ) as csvSummaries:
+      self.assertEqual( u'e\u207a e\u207b \u2192 qq'.encode( 'utf-8' ),
+                        list( csv.DictReader( csvSummaries ) )[0]['proddetail'] )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( TestProductionSummary )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
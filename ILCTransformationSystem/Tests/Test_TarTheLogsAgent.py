@@ -0,0 +1,150 @@
+"""Test the TarTheLogsAgent"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from mock import MagicMock as Mock, patch
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.ILCTransformationSystem.Agent.TarTheLogsAgent import TarTheProdLogsAgent, PARTIAL_SUFFIX
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.ILCTransformationSystem.Agent.TarTheLogsAgent'
+
+class TestTarTheLogs( unittest.TestCase ):
+  """Test the TarTheLogsAgent"""
+
+  @patch("DIRAC.Core.Base.AgentModule.PathFinder", new=Mock())
+  @patch("DIRAC.ConfigurationSystem.Client.PathFinder.getSystemInstance", new=Mock() )
+  def setUp( self ):
+    self.tmpdir = tempfile.mkdtemp()
+    self.agent = TarTheProdLogsAgent( agentName="ILCTransformationSystem/TarTheLogsAgent", loadName="TestTar" )
+    self.agent.basepath = self.tmpdir
+    self.agent.baselogpath = os.path.join( self.tmpdir, 'ilc', 'prod' )
+    self.agent.indexFile = os.path.join( self.tmpdir, 'index.json' )
+    self.logDir = os.path.join( self.agent.baselogpath, 'clic', 'ee_qq', 'SIM', 'LOG' )
+    self.agent.uploadToStorage = Mock( return_value = S_OK() )
+
+  def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
+
+  def makeLogFolder( self, taskID, size = 100 ):
+    """ Create the log folder of a task, with one log file of the given size """
+    folder = os.path.join( self.logDir, "ee_qq_1234_%d_log" % taskID )
+    os.makedirs( folder )
+    with open( os.path.join( folder, 'job.log' ), 'w' ) as logFile:
+      logFile.write( os.urandom( size ) )
+    return folder
+
+  def test_getDirectories( self ):
+    """test TarTheLogsAgent getDirectories skips the LOG directories which did not change........"""
+    for taskID in xrange( 3 ):
+      self.makeLogFolder( taskID )
+    res = self.agent.getDirectories()
+    self.assertEqual( { self.logDir : [ "ee_qq_1234_0_log", "ee_qq_1234_1_log" ] }, res['Value'] )
+    self.assertEqual( {}, self.agent.index )
+    for taskID in xrange( 2 ):
+      shutil.rmtree( os.path.join( self.logDir, "ee_qq_1234_%d_log" % taskID ) )
+    self.assertEqual( {}, self.agent.getDirectories()['Value'] )
+    self.assertIn( self.logDir, self.agent.index )
+    self.assertTrue( os.path.exists( self.agent.indexFile ) )
+
+    ## the LOG directory is not walked again
+    self.agent.index = self.agent.loadIndex()
+    walked = []
+    osWalk = os.walk
+    def walk( top, *args ):
+      """ os.walk keeping the directories walked, it is also called for each sub directory """
+      walked.append( top )
+      return osWalk( top, *args )
+    with patch( "%s.os.walk" % MODULE_NAME, new=walk ):
+      self.assertEqual( {}, self.agent.getDirectories()['Value'] )
+    self.assertIn( self.logDir, self.agent.index )
+    self.assertIn( os.path.dirname( self.logDir ), walked )
+    self.assertNotIn( self.logDir, walked )
+
+    ## a new log folder changes the modification time of the LOG directory
+    os.utime( self.logDir, ( 0, 0 ) )
+    self.makeLogFolder( 3 )
+    self.assertEqual( { self.logDir : [ "ee_qq_1234_2_log" ] }, self.agent.getDirectories()['Value'] )
+
+  def test_createTarBalls( self ):
+    """test TarTheLogsAgent createTarBallAndCleanTheLogs makes tar balls of limited size........."""
+    folders = [ self.makeLogFolder( taskID, size = 100000 ) for taskID in xrange( 5 ) ]
+    self.agent.maxTarBallSize = 150000
+    res = self.agent.createTarBallAndCleanTheLogs( 1234, folders )
+    tarDir = os.path.join( self.tmpdir, 'LogsTars', '1234' )
+    self.assertEqual( [ os.path.join( tarDir, name ) for name in ( '1234_0_to_1_logs.tgz', '1234_2_to_3_logs.tgz',
+                                                                    '1234_4_to_4_logs.tgz' ) ],
+                      res['Value']['Successful'] )
+    self.assertEqual( {}, res['Value']['Failed'] )
+    self.assertEqual( 3, self.agent.uploadToStorage.call_count )
+    self.assertEqual( [], os.listdir( tarDir ) )
+    self.assertFalse( any( os.path.exists( folder ) for folder in folders ) )
+
+  def test_createTarBalls_smallFiles( self ):
+    """test TarTheLogsAgent createTarBallAndCleanTheLogs counts the data kept by the compressor......"""
+    folders = [ self.makeLogFolder( taskID, size = 1000 ) for taskID in xrange( 4 ) ]
+    self.agent.maxTarBallSize = 1500
+    res = self.agent.createTarBallAndCleanTheLogs( 1234, folders )
+    tarDir = os.path.join( self.tmpdir, 'LogsTars', '1234' )
+    self.assertEqual( [ os.path.join( tarDir, name ) for name in ( '1234_0_to_1_logs.tgz', '1234_2_to_3_logs.tgz' ) ],
+                      res['Value']['Successful'] )
+
+  def test_createTarBalls_uploadFails( self ):
+    """test TarTheLogsAgent createTarBallAndCleanTheLogs keeps the tar balls which were not uploaded..."""
+    folders = [ self.makeLogFolder( taskID ) for taskID in xrange( 2 ) ]
+    self.agent.uploadToStorage.return_value = S_ERROR( "SE down" )
+    res = self.agent.createTarBallAndCleanTheLogs( 1234, folders )
+    self.assertEqual( [], res['Value']['Successful'] )
+    tarBallName, error = res['Value']['Failed'].items()[0]
+    self.assertEqual( "SE down", error )
+    self.assertTrue( os.path.exists( tarBallName ) )
+    with tarfile.open( tarBallName ) as tarBall:
+      self.assertEqual( 2, len( [ member for member in tarBall.getnames() if member.endswith( 'job.log' ) ] ) )
+
+    ## the tar ball is uploaded again in the next cycle
+    self.agent.uploadToStorage.return_value = S_OK()
+    self.agent.cleanupPrevious()
+    self.agent.uploadToStorage.assert_called_with( '1234', tarBallName )
+    self.assertFalse( os.path.exists( tarBallName ) )
+
+  def test_execute_uploadFails( self ):
+    """test TarTheLogsAgent execute reports the tar balls which were not uploaded...................."""
+    self.makeLogFolder( 0 )
+    self.makeLogFolder( 1 )
+    self.agent.uploadToStorage.return_value = S_ERROR( "SE down" )
+    self.agent.transIsStopped = Mock( return_value = S_OK( True ) )
+    self.agent.log = Mock()
+    self.assertTrue( self.agent.execute()['OK'] )
+    tarBallName = os.path.join( self.tmpdir, 'LogsTars', '1234', '1234_0_to_0_logs.tgz' )
+    self.agent.log.error.assert_any_call( "Failed to upload the tar balls, they are uploaded again in the next cycle:",
+                                          tarBallName )
+
+  def test_createTarBalls_fails( self ):
+    """test TarTheLogsAgent createTarBallAndCleanTheLogs keeps the logs if the tar ball fails......."""
+    folders = [ self.makeLogFolder( 0 ), os.path.join( self.logDir, 'doesNotExist_1234_1_log' ) ]
+    res = self.agent.createTarBallAndCleanTheLogs( 1234, folders )
+    self.assertFalse( res['OK'] )
+    self.assertTrue( os.path.exists( folders[0] ) )
+    self.assertEqual( [], os.listdir( os.path.join( self.tmpdir, 'LogsTars', '1234' ) ) )
+    self.assertFalse( self.agent.uploadToStorage.called )
+
+  def test_cleanupPrevious_partial( self ):
+    """test TarTheLogsAgent cleanupPrevious removes incomplete tar balls............................"""
+    tarDir = os.path.join( self.tmpdir, 'LogsTars', '1234' )
+    os.makedirs( tarDir )
+    partName = os.path.join( tarDir, '1234_logs.tgz' + PARTIAL_SUFFIX )
+    open( partName, 'w' ).close()
+    self.agent.cleanupPrevious()
+    self.assertFalse( os.path.exists( partName ) )
+    self.assertFalse( self.agent.uploadToStorage.called )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( TestTarTheLogs )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
@@ -2,6 +2,7 @@
 
 import unittest
 import sys
+import threading
 from StringIO import StringIO
 from collections import OrderedDict
 
@@ -11,7 +12,8 @@ from DIRAC import S_OK, S_ERROR, gLogger
 import DIRAC
 
 from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo import JobInfo
-from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo
+from ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo import TransformationInfo, serverCredentials, \
+  shifterCredentials
 
 __RCSID__ = "$Id$"
 
@@ -258,78 +260,171 @@ class TestTI( unittest.TestCase ):
         self.assertEqual( res['Value'], "added record" )
         logMock.addLoggingRecord.assert_called_once_with( 1234, status = "Failed", minor = "minorstatus", source = 'DataRecoveryAgent' )
 
-  def test_findAllDescendants( self ):
-    """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo findAllDescendents............."""
-    self.tri.fcClient.getFileDescendents = Mock( return_value = S_OK( { "Successful": { "lfn1": ["lfnD1", "lfnD2"],
-                                                                                        "lfnD1": ["lfnDD1", "lfnDD2"]
-                                                                                      }
-                                                                      } )
-                                               )
-    descList = self.tri._TransformationInfo__findAllDescendants( lfnList = [] )
-    self.assertEqual( descList, ["lfnDD1", "lfnDD2","lfnD1", "lfnD2" ] )
-
-    self.tri.fcClient.getFileDescendents = Mock( return_value = S_ERROR("Cannot get descendants") )
-    descList = self.tri._TransformationInfo__findAllDescendants( lfnList = [] )
-    self.assertEqual( descList, [] )
+  def test_checkFilesExistence( self ):
+    """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo checkFilesExistence............"""
+    jobs = []
+    for jobID in xrange( 3 ):
+      job = JobInfo( jobID, "Done", 1234, "MCReconstruction" )
+      job.inputFile = "in%d" % jobID
+      job.outputFiles = [ "out%d" % jobID ]
+      jobs.append( job )
+    self.tri.catalogChunkSize = 4
+    self.tri.fcClient.exists.side_effect = [ S_OK( { "Successful": { "in0": True, "in1": True, "out0": True, "out1": False },
+                                                     "Failed": {} } ),
+                                             S_ERROR( "Catalog down" ) ]
+    existence = self.tri.checkFilesExistence( jobs )
+    self.assertEqual( self.tri.fcClient.exists.call_count, 2 )
+    self.tri.fcClient.exists.assert_any_call( ["in0", "in1", "in2", "out0"] )
+    self.assertEqual( existence, { 0: { "in0": True, "out0": True }, 1: { "in1": True, "out1": False } } )
+
+  def test_findDescendants( self ):
+    """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo findDescendants................"""
+    filesToRemove = OrderedDict( [ ( "out0", { 0 } ), ( "out1", { 1 } ), ( "out2", { 1, 2 } ), ( "out3", { 3 } ) ] )
+    self.tri.catalogChunkSize = 2
+    self.tri.fcClient.getFileDescendents.side_effect = [ S_OK( { "Successful": { "out0": ["desc0", "descdesc0"] },
+                                                                 "Failed": { "out1": "No such file" } } ),
+                                                         S_ERROR( "Catalog down" ) ]
+    self.assertEqual( { 1, 2, 3 }, self.tri.findDescendants( filesToRemove ) )
+    self.tri.fcClient.getFileDescendents.assert_any_call( ["out0", "out1"], range(1,8) )
+    self.tri.fcClient.getFileDescendents.assert_any_call( ["out2", "out3"], range(1,8) )
+    self.assertEqual( { 0 }, filesToRemove["desc0"] )
+    self.assertEqual( { 0 }, filesToRemove["descdesc0"] )
+    self.assertEqual( 6, len( filesToRemove ) )
 
   def test_cleanOutputs( self ):
     """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo cleanOutputs..................."""
-    descList = ["lfnDD1", "lfnDD2","lfnD1", "lfnD2"]
-
-    jobInfo = Mock( spec=JobInfo )
+    jobInfo = Mock( spec=JobInfo, jobID = 1 )
     jobInfo.outputFiles = ["lfn1", "lfn2"]
     jobInfo.outputFileStatus = ["Exists", "Missing"]
+    self.tri.cleanOutputs( jobInfo )
+    self.assertEqual( [ "lfn1" ], self.tri.filesToRemove.keys() )
+    otherJob = Mock( spec=JobInfo, jobID = 2, outputFiles = [ "lfn1", "lfn3" ], outputFileStatus = [ "Exists", "Exists" ] )
+    self.tri.cleanOutputs( otherJob )
+    self.assertEqual( { 1, 2 }, self.tri.filesToRemove["lfn1"] )
+    self.assertEqual( { 2 }, self.tri.filesToRemove["lfn3"] )
+    ## the descendants are only found when the files are removed
+    self.assertFalse( self.tri.fcClient.getFileDescendents.called )
+
+    ### nothing to remove
+    for outputFiles, outputFileStatus in ( ( [], [] ), ( None, [] ), ( [ "lfn4" ], [ "Missing" ] ) ):
+      jobInfo = Mock( spec=JobInfo, jobID = 3, outputFiles = outputFiles, outputFileStatus = outputFileStatus )
+      self.tri.cleanOutputs( jobInfo )
+    self.assertEqual( [ "lfn1", "lfn3" ], self.tri.filesToRemove.keys() )
 
+  def test_removeQueuedFiles_dryRun( self ):
+    """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo removeQueuedFiles in dry run......"""
     self.tri.enabled = False
-    self.tri._TransformationInfo__findAllDescendants = Mock( return_value = descList )
+    self.tri.filesToRemove["lfn1"] = { 1 }
+    self.tri.fcClient.getFileDescendents.return_value = S_OK( { "Successful": { "lfn1": [ "lfnD1" ] }, "Failed": {} } )
     out = StringIO()
     sys.stdout = out
-    self.tri.cleanOutputs( jobInfo )
+    with patch( "ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.DataManager" ) as dmMock:
+      self.assertEqual( set(), self.tri.removeQueuedFiles() )
+    self.assertFalse( dmMock.called )
     self.assertIn( "Would have removed these files", out.getvalue() )
-    self.assertIn( "lfn1", out.getvalue() )
-    self.assertNotIn( "lfn2", out.getvalue() )
-
-    remMock = Mock( name = "remmock" )
-    remMock.removeFile.return_value = S_ERROR( "arg" )
+    self.assertIn( "lfnD1", out.getvalue() )
+    self.assertEqual( {}, self.tri.filesToRemove )
 
+  def test_removeQueuedFiles( self ):
+    """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo removeQueuedFiles..............."""
     self.tri.enabled = True
-    self.tri._TransformationInfo__findAllDescendants = Mock( return_value = descList )
+    self.assertEqual( set(), self.tri.removeQueuedFiles() )
+    for lfn, jobIDs in ( ( "lfn1", { 1 } ), ( "lfn2", { 1 } ), ( "lfn3", { 3 } ), ( "lfn5", { 5 } ) ):
+      self.tri.filesToRemove[lfn] = jobIDs
+    self.tri.fcClient.getFileDescendents.return_value = S_OK( { "Successful": { "lfn2": [ "lfnD1" ] },
+                                                                "Failed": { "lfn5": "Catalog error" } } )
+    self.tri.fcClient.getReplicas.return_value = S_OK( { "Successful": { "lfn1": { "SE-A": "pfn" },
+                                                                         "lfn2": { "SE-A": "pfn" },
+                                                                         "lfnD1": { "SE-B": "pfn", "SE-A": "pfn" } },
+                                                         "Failed": { "lfn3": "No such file" } } )
+    results = { ( "lfn1", "lfn2" ): S_OK( { "Successful": { "lfn1": "OK" }, "Failed": { "lfn2": "SomeReason" } } ),
+                ( "lfnD1", ): S_OK( { "Successful": { "lfnD1": "OK" }, "Failed": {} } ),
+                ( "lfn3", ): S_ERROR( "arg" ) }
+    remMock = Mock( name = "remmock" )
+    remMock.removeFile.side_effect = lambda lfns: results[ tuple( lfns ) ]
     out = StringIO()
     sys.stdout = out
-    with patch("ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.DataManager",
-               return_value=remMock,
-               autospec=True ):
-      with self.assertRaisesRegexp( RuntimeError, "Failed to remove LFNs: arg" ):
-        self.tri.cleanOutputs( jobInfo )
-
-    remMock = Mock( name = "remmock" )
-    remMock.removeFile.return_value =  S_OK({"Successful": {"lfn1":"OK", "lfn2":"OK"},
-                                             "Failed": {"lfnD2":"SomeReason",
-                                                        "lfnD3":"SomeReason",
-                                                        "lfnDD2":"SomeOtherReason"} } )
-
-    self.tri.enabled = True
-    with patch("ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.DataManager",
-               autospec=True,
-               return_value=remMock ):
-      self.tri.cleanOutputs( jobInfo )
+    with patch( "ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.DataManager",
+                autospec=True, return_value=remMock ) as dmMock, \
+         patch( "ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.gConfigurationData" ) as confMock:
+      self.assertEqual( { 1, 3, 5 }, self.tri.removeQueuedFiles( nWorkers = 2 ) )
+    dmMock.assert_called_once_with()
+    ## the outputs of job 5 are kept as its descendants are not known
+    self.assertEqual( 3, remMock.removeFile.call_count )
+    self.assertEqual( [ "false", "true" ], [ call[0][1] for call in confMock.setOptionInCFG.call_args_list ] )
     self.assertIn( "Successfully removed 2 files", out.getvalue() )
-
-    ### nothing to remove
-    jobInfo = Mock( spec=JobInfo )
-    jobInfo.outputFiles = []
-    self.tri._TransformationInfo__findAllDescendants = Mock( return_value = descList )
-    self.tri.cleanOutputs( jobInfo )
-    self.tri._TransformationInfo__findAllDescendants.assert_not_called()
-
-    ### nothing to remove
-    jobInfo = Mock( spec=JobInfo )
-    jobInfo.outputFiles = ["lfn1", "lfn2"]
-    jobInfo.outputFileStatus = ["Missing", "Missing"]
-    self.tri._TransformationInfo__findAllDescendants = Mock( return_value = [] )
-    self.tri.cleanOutputs( jobInfo )
-    self.tri._TransformationInfo__findAllDescendants.assert_called_once_with(jobInfo.outputFiles)
-
+    self.assertEqual( {}, self.tri.filesToRemove )
+    self.assertEqual( dict( Removed = 2, Failed = 1 ),
+                      dict( ( key, self.tri.removalStats["SE-A"][key] ) for key in ( "Removed", "Failed" ) ) )
+    summary = self.tri.getRemovalSummary()
+    self.assertIn( "Removal at SE-B: 1 files removed, 0 failed", summary[1] )
+    self.assertIn( "Removal at Unknown: 0 files removed, 1 failed", summary[2] )
+    self.assertIn( "Failed to remove 1 files with error: SomeReason", summary )
+    self.assertIn( "Failed to remove 1 files with error: arg", summary )
+
+    ## without replicas all files are removed together
+    self.tri.filesToRemove["lfn4"] = { 4 }
+    self.tri.fcClient.getFileDescendents.return_value = S_OK( { "Successful": {}, "Failed": {} } )
+    self.tri.fcClient.getReplicas.return_value = S_ERROR( "Catalog down" )
+    remMock.removeFile.side_effect = None
+    remMock.removeFile.return_value = S_OK( { "Successful": { "lfn4": "OK" }, "Failed": {} } )
+    with patch( "ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.DataManager",
+                autospec=True, return_value=remMock ), \
+         patch( "ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.gConfigurationData" ):
+      self.assertEqual( set(), self.tri.removeQueuedFiles() )
+    self.assertEqual( 1, self.tri.removalStats["Unknown"]["Removed"] )
+
+  def test_shifterCredentials( self ):
+    """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo shifterCredentials.............."""
+    with patch( "ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.gConfigurationData" ) as confMock:
+      with shifterCredentials():
+        confMock.setOptionInCFG.assert_called_once_with( '/DIRAC/Security/UseServerCertificate', 'false' )
+      confMock.setOptionInCFG.assert_called_with( '/DIRAC/Security/UseServerCertificate', 'true' )
+      self.assertEqual( 2, confMock.setOptionInCFG.call_count )
+      ## the server credentials of the thread itself do not block it
+      done = threading.Event()
+      def removeInProduction():
+        """ remove files while treating a production """
+        with serverCredentials():
+          with shifterCredentials():
+            pass
+          with shifterCredentials():
+            pass
+        done.set()
+      thread = threading.Thread( target = removeInProduction )
+      thread.daemon = True
+      thread.start()
+      self.assertTrue( done.wait( 5 ) )
+      self.assertEqual( 6, confMock.setOptionInCFG.call_count )
+
+  def test_shifterCredentials_exclusive( self ):
+    """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo shifterCredentials exclusive...."""
+    otherProduction = threading.Event()
+    removed = threading.Event()
+    def removeFiles():
+      """ remove files while another production is treated """
+      with serverCredentials():
+        with shifterCredentials():
+          removed.set()
+    def treatOtherProduction( started ):
+      """ contact services while the other production wants to remove files """
+      with serverCredentials():
+        started.set()
+        otherProduction.wait( 5 )
+    started = threading.Event()
+    threads = [ threading.Thread( target = treatOtherProduction, args = ( started, ) ),
+                threading.Thread( target = removeFiles ) ]
+    with patch( "ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo.gConfigurationData" ):
+      for thread in threads:
+        thread.daemon = True
+        thread.start()
+        started.wait( 5 )
+      ## the removal waits for the other production
+      self.assertFalse( removed.wait( 0.2 ) )
+      otherProduction.set()
+      self.assertTrue( removed.wait( 5 ) )
+      for thread in threads:
+        thread.join( 5 )
 
   def test_getJobs( self ):
     """ILCDIRAC.ILCTransformationSystem.Utilities.TransformationInfo getJobs........................"""
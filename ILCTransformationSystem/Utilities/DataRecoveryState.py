@@ -0,0 +1,63 @@
+"""DataRecoveryState: what the DataRecoveryAgent knew about each job in previous cycles
+
+The state is kept in a local sqlite file, so it survives restarts of the agent. For each job
+the status, the time it was last checked, the decision taken, its input file and what the decision
+depends on besides the job itself (e.g. the last task of the input file) are stored.
+"""
+
+import sqlite3
+import threading
+
+__RCSID__ = "$Id$"
+
+class DataRecoveryState( object ):
+  """ store the state of the jobs checked by the DataRecoveryAgent """
+  def __init__( self, fileName ):
+    self.fileName = fileName
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect( fileName, check_same_thread = False )
+    with self.lock, self.connection:
+      self.connection.execute( "CREATE TABLE IF NOT EXISTS Jobs ( JobID INTEGER PRIMARY KEY, ProdID INTEGER NOT NULL, "
+                               "Status TEXT, LastChecked REAL, Decision TEXT, InputFile TEXT, Dependencies TEXT )" )
+      self.connection.execute( "CREATE INDEX IF NOT EXISTS JobsProdID ON Jobs ( ProdID )" )
+      ## files written before the dependencies were stored, their jobs are checked again
+      columns = [ row[1] for row in self.connection.execute( "PRAGMA table_info( Jobs )" ) ]
+      if 'Dependencies' not in columns:
+        self.connection.execute( "ALTER TABLE Jobs ADD COLUMN Dependencies TEXT" )
+
+  def getJobs( self, prodID ):
+    """return the state of all known jobs of the production
+
+    :param int prodID: production ID
+    :returns: dict of jobID: dict( Status, LastChecked, Decision, InputFile, Dependencies )
+    """
+    with self.lock:
+      rows = self.connection.execute( "SELECT JobID, Status, LastChecked, Decision, InputFile, Dependencies FROM Jobs "
+                                      "WHERE ProdID=?", ( int(prodID), ) ).fetchall()
+    return dict( ( jobID, dict( Status=status, LastChecked=lastChecked, Decision=decision, InputFile=inputFile,
+                                Dependencies=dependencies ) )
+                 for jobID, status, lastChecked, decision, inputFile, dependencies in rows )
+
+  def setJobs( self, prodID, jobStates ):
+    """store the state of the jobs of the production, in one transaction
+
+    :param int prodID: production ID
+    :param list jobStates: list of tuples ( jobID, status, lastChecked, decision, inputFile, dependencies )
+    """
+    with self.lock, self.connection:
+      self.connection.executemany( "INSERT OR REPLACE INTO Jobs ( JobID, ProdID, Status, LastChecked, Decision, InputFile, "
+                                   "Dependencies ) VALUES ( ?, ?, ?, ?, ?, ?, ? )",
+                                   [ ( int(jobID), int(prodID), status, lastChecked, decision, inputFile, dependencies )
+                                     for jobID, status, lastChecked, decision, inputFile, dependencies in jobStates ] )
+
+  def removeOtherProductions( self, prodIDs ):
+    """forget the jobs of all productions not in the list
+
+    :param list prodIDs: production IDs to keep
+    """
+    prodIDs = [ int(prodID) for prodID in prodIDs ]
+    with self.lock, self.connection:
+      if not prodIDs:
+        self.connection.execute( "DELETE FROM Jobs" )
+        return
+      self.connection.execute( "DELETE FROM Jobs WHERE ProdID NOT IN ( %s )" % ",".join( "?" * len(prodIDs) ), prodIDs )
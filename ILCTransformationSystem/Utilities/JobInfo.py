@@ -64,9 +64,14 @@ class JobInfo( object ):
     """check if some files are missing and therefore some files exist """
     return not ( self.allFilesExist() or self.allFilesMissing() )
   
-  def getJobInformation( self, dILC ):
-    """get all the information for the job"""
-    jdlParameters = self.__getJDL( dILC )
+  def getJobInformation( self, dILC, jdlParameters=None ):
+    """get all the information for the job
+
+    :param dILC: DiracILC instance used to get the JDL
+    :param dict jdlParameters: JDL of the job if it was already obtained, otherwise it is obtained from dILC
+    """
+    if jdlParameters is None:
+      jdlParameters = self.__getJDL( dILC )
     self.__getOutputFiles( jdlParameters )
     self.__getTaskID( jdlParameters )
     self.__getInputFile( jdlParameters )
@@ -96,17 +101,26 @@ class JobInfo( object ):
     self.taskFileID = taskDict['FileID']
     self.errorCount = taskDict['ErrorCount']
 
-  def checkFileExistance( self, fcClient ):
-    """check if input and outputfile still exist"""
+  def getAllFiles( self ):
+    """return the list of the input file and the output files of the job"""
     lfns = []
     if self.inputFile:
       lfns = [self.inputFile]
-    lfns = lfns + self.outputFiles
-    reps = fcClient.exists( lfns )
-    if not reps['OK']:
-      raise RuntimeError( "Failed to check existance: %s" % reps['Message'] )
-    statuses = reps['Value']
-    success = statuses['Successful']
+    return lfns + self.outputFiles
+
+  def checkFileExistance( self, fcClient, success=None ):
+    """check if input and outputfile still exist
+
+    :param fcClient: FileCatalogClient used to check the files
+    :param dict success: existence of the files ( lfn: bool ) if it was already obtained for many jobs,
+                         otherwise the files of this job are checked with the fcClient
+    """
+    if success is None:
+      reps = fcClient.exists( self.getAllFiles() )
+      if not reps['OK']:
+        raise RuntimeError( "Failed to check existance: %s" % reps['Message'] )
+      statuses = reps['Value']
+      success = statuses['Successful']
     if self.inputFile:
       self.inputFileExists = True if (self.inputFile in success and success[self.inputFile]) else False
     for lfn in self.outputFiles:
@@ -117,16 +131,20 @@ class JobInfo( object ):
       else:
         self.outputFileStatus.append("Unknown")
       
-  def checkRequests( self, reqClient ):
-    """check if there are pending Requests"""
-    result = reqClient.readRequestsForJobs( [self.jobID] )
-    if not result['OK']:
-      raise RuntimeError( "Failed to check Requests: %s " % result['Message'] )
-    if self.jobID in result['Value']['Successful']:
-      request = result['Value']['Successful'][self.jobID]
-      requestID = request.RequestID
-      dbStatus = reqClient.getRequestStatus( requestID ).get( 'Value', 'Unknown' )
-      self.pendingRequest = dbStatus not in ("Done","Canceled")
+  def checkRequests( self, reqClient, requests=None ):
+    """check if there are pending Requests
+
+    :param reqClient: ReqClient used to get the requests
+    :param dict requests: requests of many jobs ( jobID: Request ) if they were already obtained,
+                          otherwise the request of this job is obtained from the reqClient
+    """
+    if requests is None:
+      result = reqClient.readRequestsForJobs( [self.jobID] )
+      if not result['OK']:
+        raise RuntimeError( "Failed to check Requests: %s " % result['Message'] )
+      requests = result['Value']['Successful']
+    if self.jobID in requests:
+      self.pendingRequest = requests[self.jobID].Status not in ("Done","Canceled")
     
   def __getJDL( self, dILC ):
     """return jdlParameterDictionary for this job"""
@@ -0,0 +1,342 @@
+"""ProductionSummary: number of events and cross section of the productions, for dirac-ilc-production-summary
+
+The metadata of the files of a production is obtained in bulk with
+:func:`~ILCDIRAC.Core.Utilities.InputFilesUtilities.getFileMetadata`, and several productions are summarised at
+the same time. The summaries are kept in a file between runs, and used again as long as the Status and LastUpdate
+of the production did not change, so only new or modified productions are looked up in the FileCatalog.
+"""
+
+import ast
+import csv
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+from DIRAC                                                     import gLogger, S_OK, S_ERROR
+from DIRAC.Core.Utilities                                      import DEncode
+
+from ILCDIRAC.Core.Utilities.HTML                              import Table
+from ILCDIRAC.Core.Utilities.InputFilesUtilities               import getFileMetadata, getDirectoryMetadata
+
+__RCSID__ = "$Id$"
+
+LOG = gLogger.getSubLogger( "ProductionSummary" )
+
+## Datatype of the files of each type of production
+DATATYPES = { 'MCGeneration' : 'gen', 'MCSimulation' : 'SIM',
+              'MCReconstruction' : 'DST', 'MCReconstruction_Overlay' : 'DST' }
+## Sections of the detector tables for each type of production
+SECTIONS = { 'MCSimulation' : 'SIM', 'MCReconstruction' : 'REC', 'MCReconstruction_Overlay' : 'REC' }
+## Detectors with their title in the HTML tables
+DETECTORS = [ ( 'ILD', 'ILD prods', 'ILC CDR prods' ), ( 'SID', 'SID prods', 'SID CDR prods' ),
+              ( 'sid', 'sid dbd prods', 'sid DBD prods' ) ]
+CSV_COLUMNS = [ 'ProdID', 'prodtype', 'Status', 'DetectorType', 'Energy', 'EvtType', 'detail', 'nb_files',
+                'NumberOfEvents', 'CrossSection', 'MomProdID', 'proddetail' ]
+
+def translateDetail(detail):
+  """ Replace whizard naming convention by human conventions
+  """
+  detail = detail.replace('v','n1:n2:n3:N1:N2:N3')
+  detail = detail.replace('qli','u:d:s:U:D:S')
+  detail = detail.replace('ql','u:d:s:c:b:U:D:S:C:B')
+  detail = detail.replace('q','u:d:s:c:b:t')
+  detail = detail.replace('Q','U:D:S:C:B:T')
+  detail = detail.replace('e1','e-')
+  detail = detail.replace('E1','e+')
+  detail = detail.replace('e2','mu-')
+  detail = detail.replace('E2','mu+')
+  detail = detail.replace('e3','tau-')
+  detail = detail.replace('E3','tau+')
+  detail = detail.replace('n1','nue')
+  detail = detail.replace('N1','nueb')
+  detail = detail.replace('n2','numu')
+  detail = detail.replace('N2','numub')
+  detail = detail.replace('n3','nutau')
+  detail = detail.replace('N3','nutaub')
+  detail = detail.replace('U','ubar')
+  detail = detail.replace('C','cbar')
+  detail = detail.replace('T','tbar')
+  detail = detail.replace('tbareV','TeV')
+  detail = detail.replace('D','dbar')
+  detail = detail.replace('S','sbar')
+  detail = detail.replace('B','bbar')
+  detail = detail.replace('Z0','Z')
+  detail = detail.replace('Z','Z0')
+  detail = detail.replace('gghad','gamma gamma -> hadrons')
+  detail = detail.replace(',','')
+  detail = detail.replace('n N','nu nub')
+  detail = detail.replace('se--','seL-')
+  detail = detail.replace('se-+','seL+')
+  detail = detail.replace(' -> ','->')
+  detail = detail.replace('->',' -> ')
+  detail = detail.replace(' H ->',', H ->')
+  detail = detail.replace(' Z0 ->',', Z0 ->')
+  detail = detail.replace(' W ->',', W ->')
+  
+  return detail
+
+def parseAdditionalInfo( addinfo ):
+  """ Return the dictionary stored in the AdditionalInfo metadata of a file
+
+  It was written either with str() of a dictionary or with DEncode. It is only parsed as literals, never evaluated.
+
+  :param str addinfo: value of the AdditionalInfo metadata
+  :returns: dict, empty if it cannot be parsed
+  """
+  try:
+    if "{" in addinfo:
+      info = ast.literal_eval( addinfo )
+    else:
+      info = DEncode.decode( addinfo )[0]
+  except Exception as err: ##cannot do anything else because decode raises base Exception #pylint: disable=W0703
+    LOG.warn( "Cannot parse AdditionalInfo %r:" % addinfo, str( err ) )
+    return {}
+  return info if isinstance( info, dict ) else {}
+
+def getCrossSection( addinfo ):
+  """ Return the total cross section stored in the AdditionalInfo of a file, None if there is none """
+  xsection = addinfo.get( 'xsection' )
+  if not isinstance( xsection, dict ) or not isinstance( xsection.get( 'sum' ), dict ):
+    return None
+  return xsection['sum'].get( 'xsection' )
+
+class ProductionSummary( object ):
+  """ summarise productions, keeping the summaries in a file between runs """
+  def __init__( self, tClient, fcClient, processesDict, cacheFile = None, fullDetail = False, nbWorkers = 4 ):
+    """
+    :param tClient: TransformationClient
+    :param fcClient: FileCatalogClient
+    :param dict processesDict: dictionary of the processes from the ProcessList, for the details of the channels
+    :param str cacheFile: file where the summaries are kept between runs, not kept if None
+    :param bool fullDetail: use the metadata of every file, instead of only the first one of each production
+    :param int nbWorkers: number of productions summarised at the same time
+    """
+    self.tClient = tClient
+    self.fcClient = fcClient
+    self.processesDict = processesDict
+    self.cacheFile = cacheFile
+    self.fullDetail = fullDetail
+    self.nbWorkers = nbWorkers
+    self.cache = self._loadCache()
+
+  def _loadCache( self ):
+    """ Return the summaries of the previous runs, by ProdID """
+    if not self.cacheFile or not os.path.exists( self.cacheFile ):
+      return {}
+    try:
+      with open( self.cacheFile ) as cacheFile:
+        return json.load( cacheFile )
+    except ( IOError, ValueError ) as err:
+      LOG.warn( "Cannot read the summaries from %s, starting again:" % self.cacheFile, str( err ) )
+      return {}
+
+  def _saveCache( self ):
+    """ Write the summaries to the cache file, replacing it only once it is complete """
+    if not self.cacheFile:
+      return
+    tmpFile = self.cacheFile + '.tmp'
+    try:
+      with open( tmpFile, 'w' ) as cacheFile:
+        json.dump( self.cache, cacheFile )
+      os.rename( tmpFile, self.cacheFile )
+    except ( IOError, OSError ) as err:
+      LOG.warn( "Cannot write the summaries to %s:" % self.cacheFile, str( err ) )
+
+  def _getCached( self, transformation ):
+    """ Return the summary of the previous run if the production did not change since, None otherwise """
+    cached = self.cache.get( str( transformation['TransformationID'] ) )
+    if cached is None or ( self.fullDetail and not cached['FullDetail'] ):
+      return None
+    if cached['Status'] != transformation['Status'] or cached['LastUpdate'] != str( transformation['LastUpdate'] ):
+      return None
+    return cached['Summary']
+
+  def getSummaries( self, transformations ):
+    """ Return the summaries of the productions
+
+    :param list transformations: dictionaries of the productions, as returned by TransformationClient.getTransformations
+    :returns: list of dictionaries with the directory metadata, number of events and cross section of the productions,
+              sorted by ProdID, without the productions which could not be summarised
+    """
+    summaries = {}
+    toSummarise = []
+    for transformation in transformations:
+      summary = self._getCached( transformation )
+      if summary is None:
+        toSummarise.append( transformation )
+      else:
+        summaries[transformation['TransformationID']] = summary
+    LOG.notice( "Summarising %d productions, %d did not change" % ( len( toSummarise ), len( summaries ) ) )
+
+    if toSummarise:
+      pool = ThreadPool( max( 1, min( self.nbWorkers, len( toSummarise ) ) ) )
+      try:
+        results = pool.map( self._summarise, toSummarise )
+      finally:
+        pool.close()
+        pool.join()
+      for transformation, res in zip( toSummarise, results ):
+        prodID = transformation['TransformationID']
+        if not res['OK']:
+          LOG.warn( "Cannot summarise production %s:" % prodID, res['Message'] )
+          continue
+        summaries[prodID] = res['Value']
+        self.cache[str( prodID )] = dict( Status = transformation['Status'],
+                                          LastUpdate = str( transformation['LastUpdate'] ),
+                                          FullDetail = self.fullDetail, Summary = res['Value'] )
+      self._saveCache()
+
+    return [ summaries[prodID] for prodID in sorted( summaries ) ]
+
+  def _summarise( self, transformation ):
+    """ Return the summary of one production """
+    prodID = transformation['TransformationID']
+    prodtype = transformation['Type']
+    if prodtype not in DATATYPES:
+      return S_ERROR( "Invalid query for %s productions" % prodtype )
+
+    res = self.fcClient.findFilesByMetadata( { 'ProdID' : prodID, 'Datatype' : DATATYPES[prodtype] } )
+    if not res['OK']:
+      return res
+    lfns = res['Value']
+    if not lfns:
+      return S_ERROR( "No files found for prod %s" % prodID )
+    path = os.path.dirname( lfns[0] )
+    res = getDirectoryMetadata( [ path ], self.fcClient )
+    if path not in res['Value']['Successful']:
+      return S_ERROR( "No meta data found for %s" % path )
+
+    summary = dict( res['Value']['Successful'][path] )
+    summary.update( ProdID = prodID, proddetail = transformation['Description'], prodtype = prodtype,
+                    Status = transformation['Status'], nb_files = len( lfns ) )
+
+    if self.fullDetail:
+      lumi, nbevts, xsections = self._getFileInfo( lfns )
+    else:
+      lumi, nbevts, xsections = self._getFileInfo( lfns[:1] )
+      lumi *= len( lfns )
+      nbevts *= len( lfns )
+    if not lumi:
+      lumi, _, xsections = self._getFileInfo( self._getOldestAncestors( lfns ) )
+    summary['CrossSection'] = sum( xsections ) / len( xsections ) if xsections else 0.0
+    if nbevts:
+      summary['NumberOfEvents'] = nbevts
+    summary.setdefault( 'NumberOfEvents', 0 )
+
+    evtType = summary.get( 'EvtType', '' )
+    summary['detail'] = translateDetail( self.processesDict.get( evtType, {} ).get( 'Detail', evtType ) )
+
+    summary['MomProdID'] = 0
+    if prodtype != 'MCGeneration':
+      res = self.tClient.getTransformationInputDataQuery( str( prodID ) )
+      if res['OK'] and 'ProdID' in res['Value']:
+        summary['MomProdID'] = res['Value']['ProdID']
+    return S_OK( summary )
+
+  def _getFileInfo( self, lfns ):
+    """ Return the luminosity, the number of events and the list of cross sections of the files """
+    lumi = 0.
+    nbevts = 0
+    xsections = []
+    metadata = getFileMetadata( lfns, self.fcClient )['Value']['Successful']
+    for lfn in lfns:
+      if lfn not in metadata:
+        continue
+      meta = metadata[lfn]
+      if 'Luminosity' in meta:
+        lumi += float( meta['Luminosity'] )
+      if 'NumberOfEvents' in meta:
+        nbevts += int( meta['NumberOfEvents'] )
+      if 'AdditionalInfo' in meta:
+        xsection = getCrossSection( parseAdditionalInfo( meta['AdditionalInfo'] ) )
+        if xsection is not None:
+          xsections.append( xsection )
+    return lumi, nbevts, xsections
+
+  def _getOldestAncestors( self, lfns ):
+    """ Return the ancestors of the files up to four generations back, only those of the oldest generation """
+    res = self.fcClient.getFileAncestors( lfns, [ 1, 2, 3, 4 ] )
+    if not res['OK']:
+      LOG.warn( "Failed to get the ancestors:", res['Message'] )
+      return []
+    depths = {}
+    for ancestors in res['Value']['Successful'].values():
+      for ancestor, depth in ancestors.items():
+        depths.setdefault( ancestor, depth )
+    if not depths:
+      return []
+    oldest = max( depths.values() )
+    return sorted( ancestor for ancestor, depth in depths.items() if depth == oldest )
+
+def _encode( value ):
+  """ Return unicode values, e.g. the strings of the cached summaries, as utf-8 encoded str """
+  return value.encode( 'utf-8' ) if isinstance( value, unicode ) else value
+
+def writeHTML( summaries, fileName ):
+  """ Write the tables of the productions, for generation and for each detector """
+  detectors = dict( ( detector, { 'SIM' : [], 'REC' : [] } ) for detector, _, _ in DETECTORS )
+  generation = []
+  for channel in summaries:
+    if 'DetectorType' not in channel:
+      generation.append( tuple( _encode( value ) for value in
+                                ( channel['detail'], channel.get( 'Energy' ), channel['ProdID'], channel['nb_files'],
+                                  channel['NumberOfEvents'] / channel['nb_files'], channel['NumberOfEvents'],
+                                  channel['CrossSection'], channel['proddetail'] ) ) )
+      continue
+    if channel['DetectorType'] not in detectors or channel['prodtype'] not in SECTIONS:
+      LOG.error( "This is unknown detector", channel['DetectorType'] )
+      continue
+    detectors[channel['DetectorType']][SECTIONS[channel['prodtype']]].append( tuple( _encode( value ) for value in
+      ( channel['detail'], channel.get( 'Energy' ), channel['DetectorType'], channel['ProdID'], channel['nb_files'],
+        channel['NumberOfEvents'] / channel['nb_files'], channel['NumberOfEvents'], channel['CrossSection'],
+        channel['MomProdID'], channel['proddetail'] ) ) )
+
+  with open( fileName, "w" ) as of:
+    of.write( """<!DOCTYPE html>
+<html>
+ <head>
+<title> Production summary </title>
+</head>
+<body>
+""" )
+    if generation:
+      of.write( "<h1>gen prods</h1>\n" )
+      table = Table( header_row = ( 'Channel', 'Energy', 'ProdID', 'Tasks', 'Average Evts/task', 'Statistics',
+                                    'Cross Section (fb)', 'Comment' ) )
+      table.rows.extend( generation )
+      of.write( str( table ) )
+      LOG.info( "Gen prods" )
+      LOG.info( str( table ) )
+
+    for detector, title, logTitle in DETECTORS:
+      if not any( detectors[detector].values() ):
+        continue
+      of.write( "<h1>%s</h1>\n" % title )
+      for ptype in ( 'SIM', 'REC' ):
+        if not detectors[detector][ptype]:
+          continue
+        of.write( "<h2>%s</h2>\n" % ptype )
+        table = Table( header_row = ( 'Channel', 'Energy', 'Detector', 'ProdID', 'Number of Files', 'Events/File',
+                                      'Statistics', 'Cross Section (fb)', 'Origin ProdID', 'Comment' ) )
+        table.rows.extend( detectors[detector][ptype] )
+        of.write( str( table ) )
+        LOG.info( "%s %s" % ( logTitle, ptype ) )
+        LOG.info( str( table ) )
+
+    of.write( """
+</body>
+</html>
+""" )
+
+def writeJSON( summaries, fileName ):
+  """ Write the summaries as a list of dictionaries """
+  with open( fileName, "w" ) as of:
+    json.dump( summaries, of, indent = 1, sort_keys = True )
+
+def writeCSV( summaries, fileName ):
+  """ Write the main columns of the summaries, one line per production """
+  with open( fileName, "wb" ) as of:
+    writer = csv.DictWriter( of, CSV_COLUMNS, extrasaction = 'ignore' )
+    writer.writeheader()
+    for summary in summaries:
+      writer.writerow( dict( ( key, _encode( value ) ) for key, value in summary.items() ) )
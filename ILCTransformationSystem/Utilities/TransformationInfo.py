@@ -1,7 +1,11 @@
 """TransformationInfo class to be used by ILCTransformation System"""
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from itertools import izip_longest
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
 from DIRAC                                                     import gLogger, S_OK
 from DIRAC.ConfigurationSystem.Client.ConfigurationData        import gConfigurationData
@@ -12,10 +16,62 @@ from ILCDIRAC.ILCTransformationSystem.Utilities.JobInfo        import JobInfo
 
 __RCSID__ = "$Id$"
 
+## The credentials are a global option, these keep track of which threads use which credentials,
+## see serverCredentials and shifterCredentials
+_CREDENTIALS_CONDITION = threading.Condition()
+_CREDENTIALS_STATE = dict( ServerUsers=0, ShifterWaiting=0, Shifter=False )
+_THREAD_CREDENTIALS = threading.local()
+
+@contextmanager
+def serverCredentials():
+  """ Contact the services with the server certificate, e.g. while treating one production
+
+  Waits while another thread uses the shifter credentials, or waits to use them.
+  """
+  with _CREDENTIALS_CONDITION:
+    while _CREDENTIALS_STATE['Shifter'] or _CREDENTIALS_STATE['ShifterWaiting']:
+      _CREDENTIALS_CONDITION.wait()
+    _CREDENTIALS_STATE['ServerUsers'] += 1
+  _THREAD_CREDENTIALS.serverUses = getattr( _THREAD_CREDENTIALS, 'serverUses', 0 ) + 1
+  try:
+    yield
+  finally:
+    _THREAD_CREDENTIALS.serverUses -= 1
+    with _CREDENTIALS_CONDITION:
+      _CREDENTIALS_STATE['ServerUsers'] -= 1
+      _CREDENTIALS_CONDITION.notify_all()
+
+@contextmanager
+def shifterCredentials():
+  """ Use the shifter credentials instead of the server certificate, e.g. to remove files
+
+  The option is global, so this waits until no other thread contacts services with the server
+  certificate, and the other threads wait until the shifter credentials are not used anymore.
+  The server credentials held by the calling thread are given up in the meantime.
+  """
+  ownUses = getattr( _THREAD_CREDENTIALS, 'serverUses', 0 )
+  with _CREDENTIALS_CONDITION:
+    _CREDENTIALS_STATE['ServerUsers'] -= ownUses
+    _CREDENTIALS_STATE['ShifterWaiting'] += 1
+    _CREDENTIALS_CONDITION.notify_all()
+    while _CREDENTIALS_STATE['Shifter'] or _CREDENTIALS_STATE['ServerUsers']:
+      _CREDENTIALS_CONDITION.wait()
+    _CREDENTIALS_STATE['ShifterWaiting'] -= 1
+    _CREDENTIALS_STATE['Shifter'] = True
+    gConfigurationData.setOptionInCFG( '/DIRAC/Security/UseServerCertificate', 'false' )
+  try:
+    yield
+  finally:
+    with _CREDENTIALS_CONDITION:
+      gConfigurationData.setOptionInCFG( '/DIRAC/Security/UseServerCertificate', 'true' )
+      _CREDENTIALS_STATE['Shifter'] = False
+      _CREDENTIALS_STATE['ServerUsers'] += ownUses
+      _CREDENTIALS_CONDITION.notify_all()
+
 class TransformationInfo( object ):
   """ hold information about transformations """
   def __init__( self, transformationID, transName, transType, enabled,
-                tClient, fcClient, jobMon ):
+                tClient, fcClient, jobMon, catalogChunkSize=1000 ):
     self.log = gLogger.getSubLogger( "TInfo" )
     self.enabled = enabled
     self.tID = transformationID
@@ -24,6 +80,12 @@ class TransformationInfo( object ):
     self.jobMon = jobMon
     self.fcClient = fcClient
     self.transType = transType
+    self.catalogChunkSize = catalogChunkSize
+    ## files to remove with the jobs they belong to, filled by cleanOutputs and emptied by removeQueuedFiles
+    self.filesToRemove = OrderedDict()
+    ## per SE statistics and errors of the removals, for the summary
+    self.removalStats = defaultdict( lambda: dict( Removed=0, Failed=0, Time=0. ) )
+    self.removalErrors = defaultdict( list )
 
   def checkTasksStatus( self ):
     """Check the status for the task of given transformation and taskID"""
@@ -128,53 +190,153 @@ class TransformationInfo( object ):
 
     return result
 
-  def __findAllDescendants( self, lfnList ):
-    """finds all descendants of a list of LFNs"""
-    allDescendants = []
-    result = self.fcClient.getFileDescendents( lfnList, range(1,8) )
-    if not result['OK']:
-      return allDescendants
-    for dummy_lfn, descendants in result['Value']['Successful'].items():
-      allDescendants.extend( descendants )
-    return allDescendants
+  def checkFilesExistence( self, jobs ):
+    """check the existence of the input and output files of many jobs at once
 
-  def cleanOutputs( self, jobInfo ):
-    """remove all job outputs"""
-    if len(jobInfo.outputFiles) == 0:
-      return
-    descendants = self.__findAllDescendants( jobInfo.outputFiles )
-    existingOutputFiles = [ lfn for lfn, status in izip_longest(jobInfo.outputFiles, jobInfo.outputFileStatus) if status=="Exists" ]
-    filesToDelete = existingOutputFiles + descendants
+    The LFNs of all jobs are checked in chunks of catalogChunkSize files.
 
-    if not filesToDelete:
-      return
+    :param list jobs: list of JobInfo
+    :returns: dict of jobID: dict( lfn: bool ) for the jobs whose files could all be checked
+    """
+    lfns = set()
+    for job in jobs:
+      lfns.update( job.getAllFiles() )
+    existence = {}
+    for lfnChunk in breakListIntoChunks( sorted( lfns ), self.catalogChunkSize ):
+      result = self.fcClient.exists( lfnChunk )
+      if not result['OK']:
+        self.log.warn( "Failed to check existence of %d files" % len(lfnChunk), result['Message'] )
+        continue
+      existence.update( result['Value']['Successful'] )
+    self.log.notice( "Checked existence of %d files, %d could not be checked" % ( len(lfns), len(lfns) - len(existence) ) )
+
+    jobExistence = {}
+    for job in jobs:
+      jobFiles = job.getAllFiles()
+      if all( lfn in existence for lfn in jobFiles ):
+        jobExistence[job.jobID] = dict( ( lfn, existence[lfn] ) for lfn in jobFiles )
+    return jobExistence
+
+  def findDescendants( self, filesToRemove ):
+    """find the descendants of the files to remove for all files at once, and add them to the files to remove
+    with the jobs of their ancestors
+
+    :param dict filesToRemove: lfn: set of jobIDs
+    :returns: set of jobIDs whose descendants could not all be found
+    """
+    failedJobs = set()
+    for lfnChunk in breakListIntoChunks( filesToRemove.keys(), self.catalogChunkSize ):
+      result = self.fcClient.getFileDescendents( lfnChunk, range(1,8) )
+      if not result['OK']:
+        self.log.warn( "Failed to get descendants of %d files" % len(lfnChunk), result['Message'] )
+        failed = lfnChunk
+      else:
+        failed = result['Value']['Failed']
+        ## files without descendants are neither Successful nor Failed
+        for lfn, descendants in result['Value']['Successful'].items():
+          for descendant in descendants:
+            filesToRemove.setdefault( descendant, set() ).update( filesToRemove[lfn] )
+      for lfn in failed:
+        failedJobs.update( filesToRemove[lfn] )
+    return failedJobs
 
-    if not self.enabled:
-      self.log.notice( "Would have removed these files: \n +++ %s " % "\n +++ ".join(filesToDelete) )
-      return
-    self.log.notice( "Remove these files: \n +++ %s " % "\n +++ ".join(filesToDelete) )
+  def cleanOutputs( self, jobInfo ):
+    """queue the existing job outputs for removal, their descendants are found and all are removed by
+    removeQueuedFiles"""
+    for lfn, status in izip_longest( jobInfo.outputFiles or [], jobInfo.outputFileStatus ):
+      if status == "Exists":
+        self.filesToRemove.setdefault( lfn, set() ).add( jobInfo.jobID )
+
+  def removeQueuedFiles( self, nWorkers=4, chunkSize=200 ):
+    """remove the files queued by cleanOutputs and their descendants for all jobs, with several threads
+
+    The descendants of all files are found first, in chunks of catalogChunkSize files. The files are grouped
+    by the storage elements of their replicas, so the time of each removal can be attributed to the storage
+    elements, and removed in chunks of chunkSize files. All threads use the same DataManager and the shifter
+    credentials.
+
+    :param int nWorkers: number of chunks removed at the same time
+    :param int chunkSize: number of files removed in one call
+    :returns: set of jobIDs whose files could not all be removed
+    """
+    if not self.filesToRemove:
+      return set()
+    filesToRemove = self.filesToRemove
+    self.filesToRemove = OrderedDict()
+    failedJobs = self.findDescendants( filesToRemove )
+    ## without all their descendants the outputs of these jobs are kept, they are cleaned in a later cycle
+    for lfn in [ lfn for lfn, jobIDs in filesToRemove.items() if jobIDs & failedJobs ]:
+      del filesToRemove[lfn]
 
-    errorReasons = {}
-    successfullyRemoved = 0
+    if not self.enabled:
+      self.log.notice( "Would have removed these files: \n +++ %s " % "\n +++ ".join(filesToRemove) )
+      return set()
+    self.log.notice( "Remove these files: \n +++ %s " % "\n +++ ".join(filesToRemove) )
 
-    for lfnList in breakListIntoChunks( filesToDelete, 200 ):
+    storageElements = {}
+    for lfnChunk in breakListIntoChunks( filesToRemove.keys(), self.catalogChunkSize ):
+      result = self.fcClient.getReplicas( lfnChunk )
+      if not result['OK']:
+        self.log.warn( "Failed to get replicas of %d files" % len(lfnChunk), result['Message'] )
+        continue
+      for lfn, replicas in result['Value']['Successful'].items():
+        storageElements[lfn] = tuple( sorted( replicas ) )
+    lfnsPerSEs = defaultdict( list )
+    for lfn in filesToRemove:
+      lfnsPerSEs[storageElements.get( lfn ) or ( 'Unknown', )].append( lfn )
+    removals = [ ( ses, lfnChunk ) for ses, lfns in lfnsPerSEs.items() for lfnChunk in breakListIntoChunks( lfns, chunkSize ) ]
+
+    dataManager = DataManager()
+    def removeChunk( removal ):
+      """remove one chunk of files and measure the time it took"""
+      start = time.time()
+      result = dataManager.removeFile( removal[1] )
+      return removal, result, time.time() - start
+
+    pool = ThreadPool( max( 1, min( nWorkers, len(removals) ) ) )
+    try:
       ## this is needed to remove the file with the Shifter credentials and not with the server credentials
-      gConfigurationData.setOptionInCFG( '/DIRAC/Security/UseServerCertificate', 'false' )
-      result = DataManager().removeFile( lfnList )
-      gConfigurationData.setOptionInCFG( '/DIRAC/Security/UseServerCertificate', 'true' )
+      with shifterCredentials():
+        results = pool.map( removeChunk, removals )
+    finally:
+      pool.close()
+      pool.join()
+
+    errorReasons = defaultdict( list )
+    successfullyRemoved = 0
+    for ( ses, lfnChunk ), result, duration in results:
       if not result['OK']:
-        self.log.error("Failed to remove LFNs", result['Message'])
-        raise RuntimeError( "Failed to remove LFNs: %s" % result['Message'] )
-      for lfn, err in result['Value']['Failed'].items():
-        reason = str(err)
-        if reason not in errorReasons.keys():
-          errorReasons[reason] = []
-        errorReasons[reason].append( lfn )
-      successfullyRemoved += len( result['Value']['Successful'].keys() )
+        self.log.error( "Failed to remove LFNs", result['Message'] )
+        failed = dict.fromkeys( lfnChunk, result['Message'] )
+        removed = 0
+      else:
+        failed = result['Value']['Failed']
+        removed = len( result['Value']['Successful'] )
+      for lfn, err in failed.items():
+        errorReasons[str(err)].append( lfn )
+        failedJobs.update( filesToRemove.get( lfn, () ) )
+      successfullyRemoved += removed
+      for se in ses:
+        self.removalStats[se]['Removed'] += removed
+        self.removalStats[se]['Failed'] += len( failed )
+        self.removalStats[se]['Time'] += duration
 
     for reason, lfns in errorReasons.items():
       self.log.error("Failed to remove %d files with error: %s" % (len(lfns), reason))
+      self.removalErrors[reason].extend( lfns )
     self.log.notice("Successfully removed %d files" % successfullyRemoved)
+    return failedJobs
+
+  def getRemovalSummary( self ):
+    """return the lines summarising the removals done by removeQueuedFiles, per SE and per error"""
+    lines = []
+    for se, stats in sorted( self.removalStats.items() ):
+      rate = stats['Removed'] / stats['Time'] if stats['Time'] else 0.
+      lines.append( "Removal at %s: %d files removed, %d failed, %3.1f files/s" %
+                    ( se, stats['Removed'], stats['Failed'], rate ) )
+    for reason, lfns in sorted( self.removalErrors.items() ):
+      lines.append( "Failed to remove %d files with error: %s" % ( len(lfns), reason ) )
+    return lines
 
   def getJobs( self, statusList=None ):
     """get done and failed jobs"""
@@ -179,6 +179,21 @@ class UserJobTestCase( unittest.TestCase ):
       self.log_mock.info.assert_called_with( info_message )
       mock_parametric.assert_any_call( 'NumberOfEvents', [1, 2], 'NbOfEvts' )
 
+  @patch("%s.UserJob._toInt" % MODULE_NAME, new=Mock(return_value=1))
+  @patch("%s.UserJob._checkJobConsistency" % MODULE_NAME, new=Mock(return_value=True))
+  @patch("%s.UserJob._splitByFilesAndEvents" % MODULE_NAME, new=Mock(return_value=[
+    "InputData", [['data1', 'data2'], ['data2']], 'ParametricInputData',
+    ('NumberOfEvents', [10, 5], 'NbOfEvts'), ('StartFrom', [0, 3], 'StartFrom')]))
+  def test_split_byfilesandevents( self ):
+    self.ujo.splittingOption = "byFilesAndEvents"
+
+    with patch("%s.UserJob.setParameterSequence" % MODULE_NAME) as mock_parametric:
+      assertDiracSucceeds( self.ujo._split(), self )
+      mock_parametric.assert_any_call( "InputData", [['data1', 'data2'], ['data2']], 'ParametricInputData' )
+      mock_parametric.assert_any_call( 'NumberOfEvents', [10, 5], 'NbOfEvts' )
+      mock_parametric.assert_any_call( 'StartFrom', [0, 3], 'StartFrom' )
+      mock_parametric.assert_any_call( 'JobIndexList', [0, 1], addToWorkflow='JobIndex' )
+
   @patch("%s.UserJob._toInt" % MODULE_NAME, new=Mock(return_value=1))
   @patch("%s.UserJob._checkJobConsistency" % MODULE_NAME, new=Mock(return_value=True))
   @patch("%s.UserJob._atomicSubmission" % MODULE_NAME, new=Mock(return_value=("Atomic", [], False)))
@@ -283,6 +298,27 @@ class UserJobTestCase( unittest.TestCase ):
     self.assertFalse( self.ujo._splitByData() )
     self.log_mock.error.assert_called_once()
 
+  def test_splitbyfilesandevents( self ):
+    self.ujo._data = ['data1', 'data2']
+    self.ujo.eventsPerJob = 10
+    jobs = [ { 'files' : ['data1', 'data2'], 'startFrom' : 0, 'nbevts' : 10 },
+             { 'files' : ['data2'], 'startFrom' : 3, 'nbevts' : 5 } ]
+    with patch("%s.SplitByFilesAndEvents" % MODULE_NAME, new=Mock(return_value=S_OK(jobs))) as split_mock:
+      assertEqualsImproved( self.ujo._splitByFilesAndEvents(),
+                            [ "InputData", [['data1', 'data2'], ['data2']], 'ParametricInputData',
+                              ('NumberOfEvents', [10, 5], 'NbOfEvts'), ('StartFrom', [0, 3], 'StartFrom') ], self )
+      split_mock.assert_called_once_with( ['data1', 'data2'], 10 )
+    self.assertIsNone( self.ujo.splittingOption )
+
+  def test_splitbyfilesandevents_fails( self ):
+    self.ujo._data = ['data1', 'data2']
+    self.ujo.eventsPerJob = 10
+    with patch("%s.SplitByFilesAndEvents" % MODULE_NAME, new=Mock(return_value=S_ERROR('no metadata'))):
+      self.assertFalse( self.ujo._splitByFilesAndEvents() )
+    self.ujo.eventsPerJob = None
+    self.assertFalse( self.ujo._splitByFilesAndEvents() )
+    assertEqualsImproved( self.log_mock.error.call_count, 2, self )
+
   def test_splitbyevents_1st_case( self ):
     app1 = Fcc()
     app2 = Fcc()
@@ -354,4 +390,10 @@ class UserJobTestCase( unittest.TestCase ):
       self.assertIn( data, self.ujo._data )
 
     assertEqualsImproved( self.ujo.splittingOption, "byData", self )
+
+  def test_setsplitfilesandevents( self ):
+    self.ujo.setSplitFilesAndEvents( "/path/to/data1", 1000 )
+    assertEqualsImproved( self.ujo._data, ["/path/to/data1"], self )
+    assertEqualsImproved( self.ujo.eventsPerJob, 1000, self )
+    assertEqualsImproved( self.ujo.splittingOption, "byFilesAndEvents", self )
     
\ No newline at end of file
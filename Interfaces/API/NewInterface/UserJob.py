@@ -20,6 +20,7 @@ from DIRAC import S_OK
 from DIRAC.Core.Security.ProxyInfo                          import getProxyInfo
 from DIRAC.Core.Utilities.List import breakListIntoChunks
 
+from ILCDIRAC.Core.Utilities.SplitByFilesAndEvent import SplitByFilesAndEvents
 from ILCDIRAC.Interfaces.API.NewInterface.Job import Job
 from ILCDIRAC.Interfaces.API.DiracILC import DiracILC
 
@@ -249,10 +250,12 @@ class UserJob(Job):
   # * _checkJobConsistency
   # * setSplitEvents
   # * setSplitInputData
+  # * setSplitFilesAndEvents
   # * setSplitDoNotAlterOutputFilename
   # * _split
   # * _splitByData
   # * _splitByEvents
+  # * _splitByFilesAndEvents
   # * _toInt
   #
   # Given the type of splitting (Events or Data), these methods compute
@@ -300,6 +303,31 @@ class UserJob(Job):
 
     self.splittingOption = "byData"
 
+  def setSplitFilesAndEvents( self, lfns, eventsPerJob ):
+    """sets split parameters for doing splitting over input data, with the same number of events in each job
+
+    The number of events in each file is taken from the FileCatalog metadata. A job can process the end of a file
+    and the beginning of the next ones, the events to skip in its first file are given to the applications as the
+    StartFrom parameter, so this is only useful for applications which can skip events, like DDSim or Mokka.
+
+    Example usage:
+
+    >>> job = UserJob()
+    >>> job.setSplitFilesAndEvents( listOfLFNs, eventsPerJob=1000 )
+
+    :param lfns: Logical File Names
+    :type lfns: list of LFNs
+    :param int eventsPerJob: The events processed by a single job, the last job processes the remaining events
+
+    """
+    self._data = lfns if isinstance(lfns, list) else [lfns]
+    self.eventsPerJob = eventsPerJob
+
+    self._addParameter( self.workflow, 'NbOfEvts', 'JDL', -1, 'Number of Events' )
+    self._addParameter( self.workflow, 'StartFrom', 'JDL', 0, 'Events to skip in the first input file' )
+
+    self.splittingOption = "byFilesAndEvents"
+
   def setSplitDoNotAlterOutputFilename( self, value=True):
     """if this option is set the output data lfns will _not_ include the JobIndex
 
@@ -327,6 +355,7 @@ class UserJob(Job):
     # FIXME: move somewhere more prominent
     self._switch = { "byEvents": self._splitByEvents,
                      "byData": self._splitByData,
+                     "byFilesAndEvents": self._splitByFilesAndEvents,
                      None: self._atomicSubmission,
                    }
 
@@ -348,6 +377,9 @@ class UserJob(Job):
    
     if sequenceType != "Atomic":
       self.setParameterSequence(sequenceType, sequenceList, addToWorkflow)
+      ## other parameters changing with the job, with a value for each job
+      for otherType, otherList, otherAddToWorkflow in sequence[3:]:
+        self.setParameterSequence(otherType, otherList, otherAddToWorkflow)
       self.setParameterSequence( 'JobIndexList', range(len(sequenceList)), addToWorkflow='JobIndex' )
       self._addParameter( self.workflow, 'JobIndex', 'int', 0, 'JobIndex' )
 
@@ -497,6 +529,38 @@ class UserJob(Job):
 
     return ['NumberOfEvents', mapEventJob, 'NbOfEvts']
 
+  #############################################################################
+  def _splitByFilesAndEvents(self):
+    """a job is submitted per subset of events of the input data.
+
+    :return: parameter name and parameter values for setParameterSequence(), followed by the sequences of the
+      number of events and of the events to skip in the first file
+    :rtype: list of (str, list, bool/str)
+
+    """
+
+    # reset split attribute to avoid infinite loop
+    self.splittingOption = None
+
+    self.log.info("Job splitting: splitting 'byFilesAndEvents' method...")
+
+    if not self._data or not self.eventsPerJob:
+      errorMessage = "Job splitting: missing input data or number of events per job"
+      self.log.error(errorMessage)
+      return False
+
+    result = SplitByFilesAndEvents(self._data, self.eventsPerJob)
+    if not result['OK']:
+      self.log.error("Job splitting: failed to split the input data by events:", result['Message'])
+      return False
+    jobs = result['Value']
+
+    self.log.info("Job splitting: submission consists of %d job(s)" % len(jobs))
+
+    return ["InputData", [ job['files'] for job in jobs ], 'ParametricInputData',
+            ('NumberOfEvents', [ job['nbevts'] for job in jobs ], 'NbOfEvts'),
+            ('StartFrom', [ job['startFrom'] for job in jobs ], 'StartFrom')]
+
   #############################################################################
   def _toInt(self, number):
     """casts number parameter to an integer.
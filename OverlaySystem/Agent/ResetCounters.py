@@ -6,6 +6,8 @@ Created on Jul 25, 2011
 
 __RCSID__ = "$Id$"
 
+import time
+
 from DIRAC.Core.Base.AgentModule                               import AgentModule
 from DIRAC                                                     import S_OK, gLogger
 from DIRAC.WorkloadManagementSystem.Client.JobMonitoringClient import JobMonitoringClient
@@ -30,25 +32,25 @@ class ResetCounters ( AgentModule ):
   def execute(self):
     """ This is called by the Agent Reactor
     """
+    start = time.time()
     res = self.ovc.getSites()
     if not res['OK']:
       return res
-    sitedict = {}
     sites = res['Value']
     gLogger.info("Will update info for sites %s" % sites)
-    for site in sites:
-      attribdict = {"Site" : site, "ApplicationStatus": 'Getting overlay files'}
-      res = self.jobmon.getCurrentJobCounters(attribdict)
-      if not res['OK']:
-        continue
-      if 'Running' in res['Value']:
-        sitedict[site] = res['Value']['Running']
-      else:
-        sitedict[site] = 0
-    gLogger.info("Setting new values %s" % sitedict)    
+    ## Sites without jobs getting the overlay files do not appear in the counters
+    sitedict = dict.fromkeys(sites, 0)
+    res = self.jobmon.getCounters(['Site'], {"Status": 'Running', "ApplicationStatus": 'Getting overlay files'})
+    if not res['OK']:
+      gLogger.error("Failed to get the number of jobs per site", res['Message'])
+      return res
+    for attribdict, count in res['Value']:
+      if attribdict['Site'] in sitedict:
+        sitedict[attribdict['Site']] = count
+    gLogger.info("Setting new values %s" % sitedict)
     res = self.ovc.setJobsAtSites(sitedict)
     if not res['OK']:
       gLogger.error(res['Message'])
       return res
-    
+    gLogger.info("Updated %d sites in %.2f seconds" % (len(sitedict), time.time() - start))
     return S_OK()
@@ -0,0 +1,50 @@
+"""Test the ResetCounters agent"""
+
+import unittest
+
+from mock import MagicMock as Mock, patch
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.OverlaySystem.Agent.ResetCounters import ResetCounters
+
+__RCSID__ = "$Id$"
+
+class TestResetCounters( unittest.TestCase ):
+  """Test the ResetCounters agent"""
+
+  @patch("DIRAC.Core.Base.AgentModule.PathFinder", new=Mock())
+  @patch("DIRAC.ConfigurationSystem.Client.PathFinder.getSystemInstance", new=Mock() )
+  def setUp( self ):
+    self.agent = ResetCounters( agentName="Overlay/ResetCounters", loadName="TestReset" )
+    self.agent.ovc = Mock( name="ovcMock" )
+    self.agent.jobmon = Mock( name="jobMonMock" )
+    self.agent.ovc.getSites.return_value = S_OK( [ 'Site1', 'Site2', 'Site3' ] )
+    self.agent.ovc.setJobsAtSites.return_value = S_OK()
+
+  def test_execute( self ):
+    """test ResetCounters execute sets the counters of all sites from one getCounters call..........."""
+    self.agent.jobmon.getCounters.return_value = S_OK( [ ( { 'Site' : 'Site1' }, 3 ),
+                                                         ( { 'Site' : 'Site3' }, 1 ),
+                                                         ( { 'Site' : 'OtherSite' }, 7 ) ] )
+    self.assertTrue( self.agent.execute()['OK'] )
+    self.agent.jobmon.getCounters.assert_called_once_with( [ 'Site' ],
+                                                           { 'Status' : 'Running',
+                                                             'ApplicationStatus' : 'Getting overlay files' } )
+    self.agent.ovc.setJobsAtSites.assert_called_once_with( { 'Site1' : 3, 'Site2' : 0, 'Site3' : 1 } )
+
+  def test_execute_getCounters_fails( self ):
+    """test ResetCounters execute does not reset the counters if the jobs cannot be counted.........."""
+    self.agent.jobmon.getCounters.return_value = S_ERROR( "no jobmon" )
+    self.assertFalse( self.agent.execute()['OK'] )
+    self.assertFalse( self.agent.ovc.setJobsAtSites.called )
+
+  def test_execute_getSites_fails( self ):
+    """test ResetCounters execute fails if the sites cannot be obtained.............................."""
+    self.agent.ovc.getSites.return_value = S_ERROR( "no sites" )
+    self.assertFalse( self.agent.execute()['OK'] )
+    self.assertFalse( self.agent.jobmon.getCounters.called )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( TestResetCounters )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
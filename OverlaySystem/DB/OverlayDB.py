@@ -2,7 +2,10 @@
 """
 __RCSID__ = "$Id$"
 
-from DIRAC                                                             import gLogger, S_OK, S_ERROR
+import time
+from math import ceil
+
+from DIRAC                                                             import gConfig, gLogger, S_OK, S_ERROR
 from DIRAC.Core.Base.DB                                                import DB
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations            import Operations
 
@@ -21,20 +24,36 @@ class OverlayDB ( DB ):
                                                        },
                                             'PrimaryKey' : 'Site',
                                             'Indexes': {'Index':['Site']}
-                                          }
+                                          },
+                          "OverlayLeases" : { 'Fields' : { 'JobID' : "INTEGER NOT NULL",
+                                                           'Site' : "VARCHAR(255) NOT NULL",
+                                                           'Expiry' : "DATETIME NOT NULL"
+                                                         },
+                                              'PrimaryKey' : 'JobID',
+                                              'Indexes': {'SiteExpiry':['Site', 'Expiry']}
+                                            },
+                          "OverlayQueue" : { 'Fields' : { 'TicketID' : "INTEGER NOT NULL AUTO_INCREMENT",
+                                                          'JobID' : "INTEGER UNIQUE NOT NULL",
+                                                          'Site' : "VARCHAR(255) NOT NULL",
+                                                          'LastPoll' : "DATETIME NOT NULL"
+                                                        },
+                                             'PrimaryKey' : 'TicketID',
+                                             'Indexes': {'SiteTicket':['Site', 'TicketID']}
+                                           }
                         }
                       )
-    limits = self.ops.getValue("/Overlay/MaxConcurrentRunning", 200)
+    self.leaseDuration = self.ops.getValue("/Overlay/LeaseDuration", 1800)
+    self.queueTimeout = self.ops.getValue("/Overlay/QueueTimeout", 1800)
+    self.defaultHoldTime = self.ops.getValue("/Overlay/EstimatedDownloadTime", 600)
+    ## in memory bookkeeping for the estimate of the waiting time
+    self.holdTimes = {}
+    self.leaseStart = {}
+    ## The limits are cached and read again from the CS when they are too old or the CS changed
+    self.limitsCacheTime = self.ops.getValue("/Overlay/LimitsCacheTime", 300)
     self.limits = {}
-    self.limits["default"] = limits
-    res = self.ops.getSections("/Overlay/Sites/")
-    sites = []
-    if res['OK']:
-      sites = res['Value']
-    for tempsite in sites:
-      res = self.ops.getValue("/Overlay/Sites/%s/MaxConcurrentRunning" % tempsite, 200)
-      self.limits[tempsite] = res
-    self.logger.info("Using the following restrictions : %s" % self.limits)
+    self.limitsLoaded = 0
+    self._loadLimits()
+    gConfig.addListenerToNewVersionEvent(self._expireLimits)
 
   #####################################################################
   # Private methods
@@ -62,31 +81,60 @@ class OverlayDB ( DB ):
     else:
       return S_ERROR("Could not find any site %s"%(site))
     
-  def _addSite(self, site, connection = False ):
-    """ Add a new site to the DB
-    """ 
-    connection = self.__getConnection( connection )
-    req = "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('%s',1);" % site
-    res = self._update( req, connection )
-    if not res['OK']:
-      return res
-    return res
+  def _loadLimits(self):
+    """ Read the limits of jobs for all sites from the CS, the new limits replace the old ones at once
+    """
+    limits = {}
+    limits["default"] = self.ops.getValue("/Overlay/MaxConcurrentRunning", 200)
+    res = self.ops.getSections("/Overlay/Sites/")
+    sites = []
+    if res['OK']:
+      sites = res['Value']
+    for tempsite in sites:
+      limits[tempsite] = self.ops.getValue("/Overlay/Sites/%s/MaxConcurrentRunning" % tempsite, 200)
+    if limits != self.limits:
+      self.logger.info("Using the following restrictions : %s" % limits)
+    self.limits = limits
+    self.limitsLoaded = time.time()
+    return S_OK(limits)
+
+  def _expireLimits(self, _eventName=None, _params=None):
+    """ Called with the event name and parameters when a new version of the CS arrives: the limits are read
+    again when they are needed next
+    """
+    self.limitsLoaded = 0
+
+  def _getLimits(self):
+    """ Get the limits of jobs for all sites, read them again from the CS if the cached ones expired
+    """
+    if time.time() - self.limitsLoaded > self.limitsCacheTime:
+      self._loadLimits()
+    return self.limits
 
   def _limitForSite(self, site):
     """ Get the current limit of jobs for a given site.
     """
-    if site in self.limits.keys():
-      return self.limits[site]   
-    return self.limits['default']
+    limits = self._getLimits()
+    return limits.get(site, limits['default'])
 
-  def _addNewJob(self, site, nbjobs, connection = False ):
-    """ Add a new running job in the DB
+  def _admitJob(self, site, limit, connection = False ):
+    """ Increment the number of jobs at the site only if it is below the limit,
+    check and increment are a single statement
+
+    :returns: S_OK with the number of affected rows: 1 if the job was admitted, 0 otherwise
     """
     connection = self.__getConnection( connection )
-    nbjobs += 1  
-    req = "UPDATE OverlayData SET NumberOfJobs=%s WHERE Site='%s';" % (nbjobs, site)
-    self._update( req, connection )
-    return S_OK()
+    req = "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='%s' AND NumberOfJobs<%d;" % (site, limit)
+    return self._update( req, connection )
+
+  def _addSite(self, site, connection = False ):
+    """ Add a new site to the DB with one running job, nothing happens if the site already exists
+
+    :returns: S_OK with the number of affected rows: 1 if the site was added, 0 otherwise
+    """
+    connection = self.__getConnection( connection )
+    req = "INSERT IGNORE INTO OverlayData (Site,NumberOfJobs) VALUES ('%s',1);" % site
+    return self._update( req, connection )
 
 ### Methods to fix the site
   def getSites(self, connection = False):
@@ -103,15 +151,17 @@ class OverlayDB ( DB ):
     return S_OK(sites)
 
   def setJobsAtSites(self, sitedict, connection = False):
-    """ As name suggests: set the number of jobs running at the site.
+    """ As name suggests: set the number of jobs running at the sites.
+    All sites are set with a single statement, sites not in the DB yet are added
     """
+    if not sitedict:
+      return S_OK()
     connection = self.__getConnection( connection )
-    for site, nbjobs in sitedict.items():
-      req = "UPDATE OverlayData SET NumberOfJobs=%i WHERE Site='%s';" % (int(nbjobs), site)
-      res = self._update( req, connection )
-      if not res['OK']:
-        return S_ERROR("Could not set number of jobs at site %s" % site)
-      
+    values = ",".join( "('%s',%i)" % (site, int(nbjobs)) for site, nbjobs in sorted(sitedict.items()) )
+    req = "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES %s ON DUPLICATE KEY UPDATE NumberOfJobs=VALUES(NumberOfJobs);" % values
+    res = self._update( req, connection )
+    if not res['OK']:
+      return S_ERROR("Could not set number of jobs at sites %s" % ", ".join(sorted(sitedict)))
     return S_OK()
 ### Useful methods for the users
   
@@ -126,42 +176,246 @@ class OverlayDB ( DB ):
     nbjobs = res['Value'][0][0]
     return S_OK(nbjobs)
 
+  def getSiteLimits(self, connection = False ):
+    """ Get the limit and the number of jobs for all sites with a limit or with running jobs
+
+    :returns: S_OK with a dictionary of site: {'Limit': int, 'Running': int}, the limit for
+              all other sites is under the key 'default'
+    """
+    connection = self.__getConnection( connection )
+    limits = self._getLimits()
+    res = self._query( "SELECT Site, NumberOfJobs FROM OverlayData;", connection )
+    if not res['OK']:
+      return S_ERROR("Could not get sites")
+    running = dict( (site, int(nbjobs)) for site, nbjobs in res['Value'] )
+    siteLimits = {}
+    for site in set(limits) | set(running):
+      siteLimits[site] = {'Limit': limits.get(site, limits['default']), 'Running': running.get(site, 0)}
+    return S_OK(siteLimits)
+
 ### Important methods
   
   def canRun(self, site, connection = False ):
     """ Can the job run at that site?
+
+    The comparison with the limit and the increment of the number of jobs are
+    done by the DB in one statement, so concurrent calls cannot exceed the limit.
     """
     connection = self.__getConnection( connection )
-    res = self._checkSite(site, connection)
-    nbjobs = 0
+    limit = self._limitForSite(site)
+    res = self._admitJob(site, limit, connection)
     if not res['OK']:
-      self._addSite(site, connection)
-      nbjobs = 1
-    else:
-      nbjobs = res['Value'][0][0]
-    if nbjobs < self._limitForSite(site):
-      res = self._addNewJob(site, nbjobs, connection)
-      if not res['OK']:
-        return res
+      return res
+    if res['Value']:
       return S_OK(True)
-    else:
+    ## Either the site is full or it is not known yet
+    if limit < 1:
       return S_OK(False)
-  
+    res = self._addSite(site, connection)
+    if not res['OK']:
+      return res
+    if res['Value']:
+      return S_OK(True)
+    ## Another job added the site in the mean time, try once more
+    res = self._admitJob(site, limit, connection)
+    if not res['OK']:
+      return res
+    return S_OK(bool(res['Value']))
+
   def jobDone(self, site, connection = False ):
-    """ Remove a job from the DB, should not remove a job from the DB 
-        if the Site does not exist, but this should never happen
+    """ Remove a job from the DB, the number of jobs never goes below 0
     """
     connection = self.__getConnection( connection )
-    res = self._checkSite(site, connection)
+    req = "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs-1 WHERE Site='%s' AND NumberOfJobs>0;" % site
+    res = self._update( req, connection )
     if not res['OK']:
       return res
-    nbjobs = res['Value'][0][0]
-    if nbjobs == 1:
-      return S_OK()
-    nbjobs -= 1
-    req = "UPDATE OverlayData SET NumberOfJobs=%s WHERE Site='%s';" % (nbjobs, site)
+    return S_OK()
+
+### Leases: slots held by a given job, which are given back if the job does not renew them in time
+
+  def acquireLease(self, site, jobID, connection = False ):
+    """ Try to get a slot at the site for the job, the lease is valid for
+    `/Overlay/LeaseDuration` seconds and must be renewed by the job
+
+    :param str site: site where the job is running
+    :param int jobID: ID of the job asking for the slot
+    :returns: S_OK(True) if the job holds a lease, S_OK(False) if the site is full
+    """
+    connection = self.__getConnection( connection )
+    ## The job might already hold a lease, e.g. if the reply to a previous call was lost
+    res = self.renewLease(jobID, connection)
+    if not res['OK']:
+      return res
+    if res['Value']:
+      return S_OK(True)
+    res = self.reclaimExpiredLeases(site, connection)
+    if not res['OK']:
+      self.logger.warn("Could not reclaim expired leases", res['Message'])
+    res = self.canRun(site, connection)
+    if not res['OK'] or not res['Value']:
+      return res
+    req = "INSERT INTO OverlayLeases (JobID,Site,Expiry) VALUES (%d,'%s',UTC_TIMESTAMP() + INTERVAL %d SECOND);" % \
+          (int(jobID), site, self.leaseDuration)
+    res = self._update( req, connection )
+    if not res['OK']:
+      self.jobDone(site, connection)
+      return res
+    self.leaseStart[int(jobID)] = time.time()
+    return S_OK(True)
+
+  def renewLease(self, jobID, connection = False ):
+    """ Extend the lease of the job by `/Overlay/LeaseDuration` seconds
+
+    :returns: S_OK(True) if the job holds a lease, S_OK(False) if it has none or it already expired
+    """
+    connection = self.__getConnection( connection )
+    req = "UPDATE OverlayLeases SET Expiry=UTC_TIMESTAMP() + INTERVAL %d SECOND WHERE JobID=%d;" % \
+          (self.leaseDuration, int(jobID))
     res = self._update( req, connection )
     if not res['OK']:
-      return res   
-    return S_OK()    
-  
\ No newline at end of file
+      return res
+    if res['Value']:
+      return S_OK(True)
+    ## Nothing changed if the lease was renewed within the same second
+    res = self._query( "SELECT JobID FROM OverlayLeases WHERE JobID=%d;" % int(jobID), connection )
+    if not res['OK']:
+      return S_ERROR("Could not get lease")
+    return S_OK(bool(res['Value']))
+
+  def releaseLease(self, jobID, connection = False ):
+    """ Give back the slot held by the job
+
+    :returns: S_OK(True) if the lease was released, S_OK(False) if the job held no lease
+    """
+    connection = self.__getConnection( connection )
+    res = self._query( "SELECT Site FROM OverlayLeases WHERE JobID=%d;" % int(jobID), connection )
+    if not res['OK']:
+      return S_ERROR("Could not get lease")
+    if not res['Value']:
+      return S_OK(False)
+    site = res['Value'][0][0]
+    res = self._update( "DELETE FROM OverlayLeases WHERE JobID=%d;" % int(jobID), connection )
+    if not res['OK']:
+      return res
+    ## Only whoever deleted the lease gives back the slot
+    if not res['Value']:
+      return S_OK(False)
+    res = self.jobDone(site, connection)
+    if not res['OK']:
+      return res
+    start = self.leaseStart.pop(int(jobID), None)
+    if start is not None:
+      holdTime = self.holdTimes.get(site, self.defaultHoldTime)
+      self.holdTimes[site] = 0.9 * holdTime + 0.1 * (time.time() - start)
+    return S_OK(True)
+
+  def reclaimExpiredLeases(self, site = None, connection = False ):
+    """ Remove the leases which were not renewed in time and give back their slots
+
+    :param str site: only reclaim leases at this site, all sites if None
+    :returns: S_OK with the number of reclaimed leases
+    """
+    connection = self.__getConnection( connection )
+    req = "SELECT JobID, Site FROM OverlayLeases WHERE Expiry<UTC_TIMESTAMP()"
+    if site:
+      req += " AND Site='%s'" % site
+    res = self._query( req + ";", connection )
+    if not res['OK']:
+      return S_ERROR("Could not get expired leases")
+    reclaimed = 0
+    for jobID, leaseSite in res['Value']:
+      req = "DELETE FROM OverlayLeases WHERE JobID=%d AND Expiry<UTC_TIMESTAMP();" % int(jobID)
+      res = self._update( req, connection )
+      if not res['OK']:
+        return res
+      if not res['Value']:
+        continue
+      self.leaseStart.pop(int(jobID), None)
+      res = self.jobDone(leaseSite, connection)
+      if not res['OK']:
+        return res
+      reclaimed += 1
+    if reclaimed:
+      self.logger.info("Reclaimed %d expired leases" % reclaimed)
+    return S_OK(reclaimed)
+
+### Queue: jobs waiting for a slot get a ticket and are given slots in the order they arrived
+
+  def enqueue(self, site, jobID, connection = False ):
+    """ Put the job in the queue of the site, if it is not queued already, and check its ticket
+
+    :param str site: site where the job is running
+    :param int jobID: ID of the job waiting for a slot
+    :returns: S_OK with the status of the ticket, see :func:`pollTicket`
+    """
+    connection = self.__getConnection( connection )
+    req = "INSERT IGNORE INTO OverlayQueue (JobID,Site,LastPoll) VALUES (%d,'%s',UTC_TIMESTAMP());" % (int(jobID), site)
+    res = self._update( req, connection )
+    if not res['OK']:
+      return res
+    res = self._query( "SELECT TicketID FROM OverlayQueue WHERE JobID=%d;" % int(jobID), connection )
+    if not res['OK']:
+      return S_ERROR("Could not get ticket")
+    if not res['Value']:
+      ## The job was given a slot by a concurrent call and left the queue
+      return self.__ticketStatus(None, jobID, site, connection)
+    return self.pollTicket(res['Value'][0][0], connection)
+
+  def pollTicket(self, ticket, connection = False ):
+    """ Check if the job holding the ticket can be given a slot. Only the jobs at the
+    front of the queue can be, the slot is then held as a lease, see :func:`acquireLease`
+
+    :param int ticket: ticket returned by :func:`enqueue`
+    :returns: S_OK with a dictionary with the keys Ticket, Granted, Position (number of jobs in
+              front of this one) and EstimatedWait (seconds)
+    """
+    connection = self.__getConnection( connection )
+    res = self._query( "SELECT JobID, Site FROM OverlayQueue WHERE TicketID=%d;" % int(ticket), connection )
+    if not res['OK']:
+      return S_ERROR("Could not get ticket")
+    if not res['Value']:
+      return S_ERROR("Unknown ticket %s" % ticket)
+    jobID, site = res['Value'][0]
+    res = self._update( "UPDATE OverlayQueue SET LastPoll=UTC_TIMESTAMP() WHERE TicketID=%d;" % int(ticket), connection )
+    if not res['OK']:
+      return res
+    ## Jobs which stopped polling are not waiting anymore
+    req = "DELETE FROM OverlayQueue WHERE Site='%s' AND LastPoll<UTC_TIMESTAMP() - INTERVAL %d SECOND;" % \
+          (site, self.queueTimeout)
+    res = self._update( req, connection )
+    if not res['OK']:
+      return res
+    return self.__ticketStatus(ticket, jobID, site, connection)
+
+  def __ticketStatus(self, ticket, jobID, site, connection):
+    """ Give a slot to the job if it is at the front of the queue and return the status of its ticket
+    """
+    res = self.reclaimExpiredLeases(site, connection)
+    if not res['OK']:
+      self.logger.warn("Could not reclaim expired leases", res['Message'])
+    position = 0
+    if ticket is not None:
+      req = "SELECT COUNT(*) FROM OverlayQueue WHERE Site='%s' AND TicketID<%d;" % (site, int(ticket))
+      res = self._query( req, connection )
+      if not res['OK']:
+        return S_ERROR("Could not get position in queue")
+      position = int(res['Value'][0][0])
+    running = self.getJobsAtSite(site, connection)['Value']
+    freeSlots = self._limitForSite(site) - running
+    granted = False
+    if position < freeSlots:
+      res = self.acquireLease(site, jobID, connection)
+      if not res['OK']:
+        return res
+      granted = res['Value']
+    if granted and ticket is not None:
+      res = self._update( "DELETE FROM OverlayQueue WHERE TicketID=%d;" % int(ticket), connection )
+      if not res['OK']:
+        self.logger.warn("Could not remove ticket from queue", res['Message'])
+    estimatedWait = 0
+    if not granted:
+      ## Every slot frees up after about one download, all slots work in parallel
+      waves = ceil((position - freeSlots + 1) / float(max(self._limitForSite(site), 1)))
+      estimatedWait = int(max(waves, 1) * self.holdTimes.get(site, self.defaultHoldTime))
+    return S_OK({'Ticket': ticket, 'Granted': granted, 'Position': position, 'EstimatedWait': estimatedWait})
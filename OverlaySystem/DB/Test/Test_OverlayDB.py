@@ -2,11 +2,17 @@
 Tests for OverlayDB
 
 """
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from mock import patch, MagicMock as Mock
 
 from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracFailsWith, assertDiracSucceeds, \
-  assertDiracSucceedsWith_equals, assertMockCalls
+  assertDiracSucceedsWith_equals, assertMockCalls, assertEqualsImproved
 from DIRAC import S_OK, S_ERROR
 
 __RCSID__ = "$Id$"
@@ -22,12 +28,16 @@ class TestOverlayDB( unittest.TestCase ):
     from ILCDIRAC.OverlaySystem.DB.OverlayDB import OverlayDB
     from DIRAC.Core.Base.DB import DB
     value_dict = { '/Overlay/MaxConcurrentRunning' : 10, '/Overlay/Sites/testSite1/MaxConcurrentRunning' : 2,
-                   '/Overlay/Sites/myOtherSite/MaxConcurrentRunning' : 2 }
+                   '/Overlay/Sites/myOtherSite/MaxConcurrentRunning' : 2, '/Overlay/LeaseDuration' : 600,
+                   '/Overlay/QueueTimeout' : 1800, '/Overlay/EstimatedDownloadTime' : 600,
+                   '/Overlay/LimitsCacheTime' : 300 }
+    self.value_dict = value_dict
     sections_dict = { '/Overlay/Sites/' : [ 'testSite1', 'myOtherSite' ] }
     self.ops_mock = Mock()
     self.ops_mock.getValue.side_effect = lambda x, _ : value_dict[x]
     self.ops_mock.getSections.side_effect = lambda x : S_OK( sections_dict[x] )
     with patch('%s.Operations' % MODULE_NAME, new=Mock(return_value=self.ops_mock)), \
+         patch('%s.gConfig' % MODULE_NAME, new=Mock()) as self.gconfig_mock, \
          patch.object(OverlayDB, '_createTables', new=Mock()), \
          patch.object(DB, '__init__', new=Mock()):
       self.odb = OverlayDB()
@@ -59,22 +69,18 @@ class TestOverlayDB( unittest.TestCase ):
     con_mock = Mock()
     with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK())) as update_mock:
       assertDiracSucceeds( self.odb.setJobsAtSites( { 'MyTestSite1' : 1487, 'other_site' : '138', 'large_testsite' : 40913.2 }, con_mock ), self )
-      assertMockCalls( update_mock, [
-        ( "UPDATE OverlayData SET NumberOfJobs=1487 WHERE Site='MyTestSite1';", con_mock ),
-        ( "UPDATE OverlayData SET NumberOfJobs=138 WHERE Site='other_site';", con_mock ),
-        ( "UPDATE OverlayData SET NumberOfJobs=40913 WHERE Site='large_testsite';", con_mock ) ], self )
+      update_mock.assert_called_once_with(
+        "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('MyTestSite1',1487),('large_testsite',40913),('other_site',138) "
+        "ON DUPLICATE KEY UPDATE NumberOfJobs=VALUES(NumberOfJobs);", con_mock )
 
   def test_setjobsatsites_nothingtodo( self ):
-    assertDiracSucceeds( self.odb.setJobsAtSites( {}, Mock() ), self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock()) as update_mock:
+      assertDiracSucceeds( self.odb.setJobsAtSites( {}, Mock() ), self )
+      self.assertFalse( update_mock.called )
 
   def test_setjobsatsites_update_fails( self ):
-    def replace_update( request ):
-      """ Mocks the return value of the _update method """
-      if 'other_site' in request:
-        return S_ERROR()
-      return S_OK()
-    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=lambda request, _ : replace_update( request ))):
-      assertDiracFailsWith( self.odb.setJobsAtSites( { 'MyTestSite1' : 1487, 'other_site' : '138', 'large_testsite' : 40913.2 }, Mock() ), 'could not set number of jobs at site', self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_ERROR())):
+      assertDiracFailsWith( self.odb.setJobsAtSites( { 'MyTestSite1' : 1487, 'other_site' : '138', 'large_testsite' : 40913.2 }, Mock() ), 'could not set number of jobs at sites', self )
 
   def test_getjobsatsite( self ):
     con_mock = Mock()
@@ -92,55 +98,275 @@ class TestOverlayDB( unittest.TestCase ):
     with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([]))):
       assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( 'nonexistent_site_testme', con_mock ), 0, self )
 
+  def test_limits_cached( self ):
+    self.value_dict['/Overlay/Sites/testSite1/MaxConcurrentRunning'] = 5
+    assertEqualsImproved( self.odb._limitForSite( 'testSite1' ), 2, self )
+    assertEqualsImproved( self.odb._limitForSite( 'unknownSite' ), 10, self )
+
+  def test_limits_reloaded_after_cachetime( self ):
+    self.value_dict['/Overlay/Sites/testSite1/MaxConcurrentRunning'] = 5
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=time.time() + 301)):
+      assertEqualsImproved( self.odb._limitForSite( 'testSite1' ), 5, self )
+
+  def test_limits_reloaded_after_cs_change( self ):
+    self.value_dict['/Overlay/Sites/testSite1/MaxConcurrentRunning'] = 5
+    self.value_dict['/Overlay/MaxConcurrentRunning'] = 20
+    self.odb._expireLimits()
+    assertEqualsImproved( self.odb._limitForSite( 'testSite1' ), 5, self )
+    assertEqualsImproved( self.odb._limitForSite( 'unknownSite' ), 20, self )
+
+  def test_limits_reloaded_by_cs_listener( self ):
+    self.value_dict['/Overlay/Sites/testSite1/MaxConcurrentRunning'] = 5
+    assertEqualsImproved( self.odb._limitForSite( 'testSite1' ), 2, self )
+    listener = self.gconfig_mock.addListenerToNewVersionEvent.call_args[0][0]
+    listener( 'newVersion', None )
+    assertEqualsImproved( self.odb._limitForSite( 'testSite1' ), 5, self )
+
+  def test_getsitelimits( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK((('testSite1', 1), ('tenJobSite', 4))))) as query_mock:
+      assertDiracSucceedsWith_equals( self.odb.getSiteLimits( con_mock ),
+                                      { 'default' : { 'Limit' : 10, 'Running' : 0 },
+                                        'testSite1' : { 'Limit' : 2, 'Running' : 1 },
+                                        'myOtherSite' : { 'Limit' : 2, 'Running' : 0 },
+                                        'tenJobSite' : { 'Limit' : 10, 'Running' : 4 } }, self )
+      query_mock.assert_called_once_with( 'SELECT Site, NumberOfJobs FROM OverlayData;', con_mock )
+
+  def test_getsitelimits_query_fails( self ):
+    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR())):
+      assertDiracFailsWith( self.odb.getSiteLimits( Mock() ), 'could not get sites', self )
+
   def test_canrun_toomanyjobs( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[2]]))) as query_mock:
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(0), S_OK(0), S_OK(0)])) as update_mock:
       assertDiracSucceedsWith_equals( self.odb.canRun( 'testSite1', con_mock ), False, self )
-      query_mock.assert_called_once_with( "SELECT NumberOfJobs FROM OverlayData WHERE Site='testSite1';",
-                                          con_mock )
+      assertMockCalls( update_mock,
+                       [ ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='testSite1' AND NumberOfJobs<2;", con_mock ),
+                         ( "INSERT IGNORE INTO OverlayData (Site,NumberOfJobs) VALUES ('testSite1',1);", con_mock ),
+                         ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='testSite1' AND NumberOfJobs<2;", con_mock ) ], self )
+
+  def test_canrun_admitted( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock:
+      assertDiracSucceedsWith_equals( self.odb.canRun( 'testSite1', con_mock ), True, self )
+      update_mock.assert_called_once_with( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='testSite1' AND NumberOfJobs<2;",
+                                           con_mock )
 
   def test_canrun_add_to_new_site( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR())), \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK())) as update_mock:
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(0), S_OK(1)])) as update_mock:
       assertDiracSucceedsWith_equals( self.odb.canRun( 'tenJobSite', con_mock ), True, self )
       assertMockCalls( update_mock,
-                       [ ( "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('tenJobSite',1);", con_mock ),
-                         ( "UPDATE OverlayData SET NumberOfJobs=2 WHERE Site='tenJobSite';", con_mock ) ], self )
+                       [ ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='tenJobSite' AND NumberOfJobs<10;", con_mock ),
+                         ( "INSERT IGNORE INTO OverlayData (Site,NumberOfJobs) VALUES ('tenJobSite',1);", con_mock ) ], self )
+
+  def test_canrun_site_added_concurrently( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(0), S_OK(0), S_OK(1)])):
+      assertDiracSucceedsWith_equals( self.odb.canRun( 'tenJobSite', Mock() ), True, self )
+
+  def test_canrun_update_fails( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_ERROR('update_test_err'))):
+      assertDiracFailsWith( self.odb.canRun( 'tenJobSite', Mock() ), 'update_test_err', self )
 
   def test_canrun_addsite_fails( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR())), \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_ERROR('update_test_err'), S_OK()])) as update_mock:
-      assertDiracSucceedsWith_equals( self.odb.canRun( 'tenJobSite', con_mock ), True, self )
-      assertMockCalls( update_mock,
-                       [ ( "INSERT INTO OverlayData (Site,NumberOfJobs) VALUES ('tenJobSite',1);", con_mock ),
-                         ( "UPDATE OverlayData SET NumberOfJobs=2 WHERE Site='tenJobSite';", con_mock ) ], self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(0), S_ERROR('update_test_err')])):
+      assertDiracFailsWith( self.odb.canRun( 'tenJobSite', con_mock ), 'update_test_err', self )
 
   def test_jobdone( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[148]]))) as query_mock, \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK())) as update_mock:
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock:
       assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', con_mock ), self )
-      query_mock.assert_called_once_with( "SELECT NumberOfJobs FROM OverlayData WHERE Site='my_TestSite1';",
-                                          con_mock )
-      update_mock.assert_called_once_with( "UPDATE OverlayData SET NumberOfJobs=147 WHERE Site='my_TestSite1';",
+      update_mock.assert_called_once_with( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs-1 WHERE Site='my_TestSite1' AND NumberOfJobs>0;",
                                            con_mock )
 
-  def test_jobdone_checksite_fails( self ):
+  def test_jobdone_nojobs( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))):
+      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', Mock() ), self )
+
+  def test_jobdone_update_fails( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_ERROR('update_test_err'))):
+      assertDiracFailsWith( self.odb.jobDone( 'my_TestSite1', con_mock ), 'update_test_err', self )
+
+  def test_acquirelease( self ):
     con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(0), S_OK(1), S_OK(1)])) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(side_effect=[S_OK(()), S_OK(())])):
+      assertDiracSucceedsWith_equals( self.odb.acquireLease( 'testSite1', 1234, con_mock ), True, self )
+      assertMockCalls( update_mock,
+                       [ ( "UPDATE OverlayLeases SET Expiry=UTC_TIMESTAMP() + INTERVAL 600 SECOND WHERE JobID=1234;", con_mock ),
+                         ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs+1 WHERE Site='testSite1' AND NumberOfJobs<2;", con_mock ),
+                         ( "INSERT INTO OverlayLeases (JobID,Site,Expiry) VALUES (1234,'testSite1',UTC_TIMESTAMP() + INTERVAL 600 SECOND);", con_mock ) ], self )
+
+  def test_acquirelease_already_held( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock:
+      assertDiracSucceedsWith_equals( self.odb.acquireLease( 'testSite1', 1234, Mock() ), True, self )
+      self.assertEquals( update_mock.call_count, 1 )
+
+  def test_acquirelease_site_full( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK(()))):
+      assertDiracSucceedsWith_equals( self.odb.acquireLease( 'testSite1', 1234, Mock() ), False, self )
+      for args, _kwargs in update_mock.call_args_list:
+        self.assertNotIn( 'INSERT INTO OverlayLeases', args[0] )
+
+  def test_acquirelease_reclaims_expired( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(0), S_OK(1), S_OK(1), S_OK(1), S_OK(1)])) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(side_effect=[S_OK(()), S_OK(((987, 'testSite1'),))])) as query_mock:
+      assertDiracSucceedsWith_equals( self.odb.acquireLease( 'testSite1', 1234, con_mock ), True, self )
+      query_mock.assert_called_with( "SELECT JobID, Site FROM OverlayLeases WHERE Expiry<UTC_TIMESTAMP() AND Site='testSite1';", con_mock )
+      self.assertEquals( update_mock.call_args_list[1][0][0], "DELETE FROM OverlayLeases WHERE JobID=987 AND Expiry<UTC_TIMESTAMP();" )
+      self.assertEquals( update_mock.call_args_list[2][0][0], "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs-1 WHERE Site='testSite1' AND NumberOfJobs>0;" )
+
+  def test_renewlease_same_second( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))), \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK(((1234,),)))):
+      assertDiracSucceedsWith_equals( self.odb.renewLease( 1234, Mock() ), True, self )
+
+  def test_renewlease_expired( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))), \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK(()))):
+      assertDiracSucceedsWith_equals( self.odb.renewLease( 1234, Mock() ), False, self )
+
+  def test_releaselease( self ):
+    con_mock = Mock()
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK((('testSite1',),)))):
+      assertDiracSucceedsWith_equals( self.odb.releaseLease( 1234, con_mock ), True, self )
+      assertMockCalls( update_mock,
+                       [ ( "DELETE FROM OverlayLeases WHERE JobID=1234;", con_mock ),
+                         ( "UPDATE OverlayData SET NumberOfJobs=NumberOfJobs-1 WHERE Site='testSite1' AND NumberOfJobs>0;", con_mock ) ], self )
+
+  def test_releaselease_nolease( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock()) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK(()))):
+      assertDiracSucceedsWith_equals( self.odb.releaseLease( 1234, Mock() ), False, self )
+      self.assertFalse( update_mock.called )
+
+  def test_releaselease_reclaimed_concurrently( self ):
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(0))) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK((('testSite1',),)))):
+      assertDiracSucceedsWith_equals( self.odb.releaseLease( 1234, Mock() ), False, self )
+      self.assertEquals( update_mock.call_count, 1 )
+
+  def test_reclaimexpiredleases_query_fails( self ):
     with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_ERROR())):
-      assertDiracFailsWith( self.odb.jobDone( 'my_TestSite1', con_mock ), 'Could not get site', self )
+      assertDiracFailsWith( self.odb.reclaimExpiredLeases( connection = Mock() ), 'could not get expired leases', self )
 
-  def test_jobdone_nojobs( self ):
+  def test_enqueue_granted( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[1]]))) as query_mock:
-      assertDiracSucceeds( self.odb.jobDone( 'my_TestSite1', con_mock ), self )
-      query_mock.assert_called_once_with( "SELECT NumberOfJobs FROM OverlayData WHERE Site='my_TestSite1';",
-                                          con_mock )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(side_effect=[S_OK(1), S_OK(1), S_OK(0), S_OK(0), S_OK(1), S_OK(1), S_OK(1)])) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(side_effect=[S_OK(((5,),)), S_OK(((1234, 'testSite1'),)), S_OK(()),
+                                                                          S_OK(((0,),)), S_OK(((1,),)), S_OK(()), S_OK(())])):
+      assertDiracSucceedsWith_equals( self.odb.enqueue( 'testSite1', 1234, con_mock ),
+                                      { 'Ticket' : 5, 'Granted' : True, 'Position' : 0, 'EstimatedWait' : 0 }, self )
+      self.assertEquals( update_mock.call_args_list[0][0][0],
+                         "INSERT IGNORE INTO OverlayQueue (JobID,Site,LastPoll) VALUES (1234,'testSite1',UTC_TIMESTAMP());" )
+      self.assertEquals( update_mock.call_args_list[-1][0][0], "DELETE FROM OverlayQueue WHERE TicketID=5;" )
 
-  def test_jobdone_update_fails( self ):
+  def test_pollticket_waiting( self ):
     con_mock = Mock()
-    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK([[148]]))), \
-         patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_ERROR('update_test_err'))):
-      assertDiracFailsWith( self.odb.jobDone( 'my_TestSite1', con_mock ), 'update_test_err', self )
+    with patch('%s.OverlayDB._update' % MODULE_NAME, new=Mock(return_value=S_OK(1))) as update_mock, \
+         patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(side_effect=[S_OK(((1234, 'testSite1'),)), S_OK(()),
+                                                                          S_OK(((3,),)), S_OK(((2,),))])) as query_mock:
+      assertDiracSucceedsWith_equals( self.odb.pollTicket( 5, con_mock ),
+                                      { 'Ticket' : 5, 'Granted' : False, 'Position' : 3, 'EstimatedWait' : 1200 }, self )
+      query_mock.assert_any_call( "SELECT COUNT(*) FROM OverlayQueue WHERE Site='testSite1' AND TicketID<5;", con_mock )
+      assertMockCalls( update_mock,
+                       [ ( "UPDATE OverlayQueue SET LastPoll=UTC_TIMESTAMP() WHERE TicketID=5;", con_mock ),
+                         ( "DELETE FROM OverlayQueue WHERE Site='testSite1' AND LastPoll<UTC_TIMESTAMP() - INTERVAL 1800 SECOND;", con_mock ) ], self )
+
+  def test_pollticket_unknown( self ):
+    with patch('%s.OverlayDB._query' % MODULE_NAME, new=Mock(return_value=S_OK(()))):
+      assertDiracFailsWith( self.odb.pollTicket( 5, Mock() ), 'unknown ticket 5', self )
+
+
+class SQLiteStandIn( object ):
+  """ Replaces the MySQL layer of the OverlayDB with a sqlite file, each thread uses its own connection """
+  def __init__( self, dbfile ):
+    self.dbfile = dbfile
+    self.local = threading.local()
+    self._update( 'CREATE TABLE OverlayData (Site VARCHAR(255) PRIMARY KEY NOT NULL, NumberOfJobs INTEGER DEFAULT 0);' )
+
+  def _connection( self ):
+    """ Return the connection of the current thread """
+    if not hasattr( self.local, 'con' ):
+      self.local.con = sqlite3.connect( self.dbfile, timeout = 60, isolation_level = None )
+    return self.local.con
+
+  def _query( self, req, _connection = None ):
+    """ Replaces DB._query """
+    return S_OK( tuple( self._connection().execute( req ).fetchall() ) )
+
+  def _update( self, req, _connection = None ):
+    """ Replaces DB._update, returns the number of affected rows like MySQL """
+    return S_OK( self._connection().execute( req.replace( 'INSERT IGNORE', 'INSERT OR IGNORE' ) ).rowcount )
+
+
+class TestOverlayDBConcurrency( unittest.TestCase ):
+  """ Hammer canRun and jobDone from many threads and check the limit is never exceeded """
+  def setUp( self ):
+    from ILCDIRAC.OverlaySystem.DB.OverlayDB import OverlayDB
+    from DIRAC.Core.Base.DB import DB
+    self.tmpdir = tempfile.mkdtemp()
+    self.standIn = SQLiteStandIn( os.path.join( self.tmpdir, 'OverlayDB.sqlite' ) )
+    ops_mock = Mock()
+    ops_mock.getValue.side_effect = lambda x, _ : { '/Overlay/MaxConcurrentRunning' : 10,
+                                                    '/Overlay/Sites/smallSite/MaxConcurrentRunning' : 3,
+                                                    '/Overlay/LeaseDuration' : 600,
+                                                    '/Overlay/QueueTimeout' : 1800,
+                                                    '/Overlay/EstimatedDownloadTime' : 600,
+                                                    '/Overlay/LimitsCacheTime' : 300 }[x]
+    ops_mock.getSections.return_value = S_OK( [ 'smallSite' ] )
+    with patch('%s.Operations' % MODULE_NAME, new=Mock(return_value=ops_mock)), \
+         patch('%s.gConfig' % MODULE_NAME, new=Mock()), \
+         patch.object(OverlayDB, '_createTables', new=Mock()), \
+         patch.object(DB, '__init__', new=Mock()):
+      self.odb = OverlayDB()
+    self.odb._getConnection = Mock( return_value = S_OK( None ) )
+    self.odb._query = self.standIn._query
+    self.odb._update = self.standIn._update
+
+  def tearDown( self ):
+    shutil.rmtree( self.tmpdir )
+
+  def test_limit_never_exceeded( self ):
+    nThreads = 25
+    nLoops = 40
+    running = { 'smallSite' : 0, 'bigSite' : 0 }
+    limits = { 'smallSite' : 3, 'bigSite' : 10 }
+    lock = threading.Lock()
+    errors = []
+
+    def hammer( site ):
+      """ Try to get admitted many times, keep track of the admitted jobs """
+      for _ in xrange( nLoops ):
+        res = self.odb.canRun( site )
+        if not res['OK']:
+          errors.append( res['Message'] )
+          continue
+        if not res['Value']:
+          continue
+        with lock:
+          running[site] += 1
+          if running[site] > limits[site]:
+            errors.append( 'Too many jobs at %s: %s' % ( site, running[site] ) )
+        time.sleep( 0.001 )
+        with lock:
+          running[site] -= 1
+        res = self.odb.jobDone( site )
+        if not res['OK']:
+          errors.append( res['Message'] )
+
+    threads = [ threading.Thread( target = hammer, args = ( site, ) )
+                for site in ( 'smallSite', 'bigSite' ) for _ in xrange( nThreads ) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertFalse( errors, errors[:10] )
+    for site in limits:
+      assertDiracSucceedsWith_equals( self.odb.getJobsAtSite( site ), 0, self )
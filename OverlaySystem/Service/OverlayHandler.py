@@ -1,10 +1,15 @@
 """ Services for Overlay System
 """
 
-from types import StringTypes, DictType
+import random
+import threading
+import time
+from types import StringTypes, DictType, IntType, LongType
 
-from DIRAC                                              import S_OK
+from DIRAC                                              import S_OK, gLogger
 from DIRAC.Core.DISET.RequestHandler                    import RequestHandler
+from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
+from DIRAC.Resources.Catalog.FileCatalogClient          import FileCatalogClient
 
 from ILCDIRAC.OverlaySystem.DB.OverlayDB                import OverlayDB
 
@@ -14,14 +19,67 @@ __RCSID__ = "$Id$"
 
 # This is a global instance of the OverlayDB class
 OVERLAY_DB = False
+# This is a global instance of the BackgroundFileLists class
+FILE_LISTS = False
 
 def initializeOverlayHandler( serviceInfo ):
   """ Global initialize for the Overlay service handler
   """
-  global OVERLAY_DB
+  global OVERLAY_DB, FILE_LISTS
   OVERLAY_DB = OverlayDB()
+  FILE_LISTS = BackgroundFileLists()
   return S_OK()
 
+class BackgroundFileLists(object):
+  """ Lists of background files found in the catalog for a given metadata query. The lists are kept
+  for `/Overlay/FileListCacheTime` seconds, so the jobs do not all repeat the same catalog query.
+  At most `/Overlay/FileListCacheEntries` lists are kept, the oldest ones are dropped first
+  """
+  def __init__(self):
+    self.ops = Operations()
+    self.fcc = FileCatalogClient()
+    self.log = gLogger.getSubLogger('BackgroundFileLists')
+    self.lists = {}
+    self.locks = {}
+    self.lock = threading.Lock()
+
+  def getFiles(self, meta):
+    """ Get a random sample of `/Overlay/FileListSampleSize` LFNs matching the metadata query
+
+    :param dict meta: metadata query for the background files
+    :returns: S_OK with a dictionary with the keys Version (time of the catalog query),
+              NbFiles (number of files matching the query) and LFNs (the sample)
+    """
+    key = tuple(sorted(meta.items()))
+    with self.lock:
+      keyLock = self.locks.setdefault(key, threading.Lock())
+    ## Only one catalog query per metadata query at a time, the other jobs wait for its result
+    with keyLock:
+      version, lfns = self.lists.get(key, (0, []))
+      if time.time() - version > self.ops.getValue("/Overlay/FileListCacheTime", 3600):
+        res = self.fcc.findFilesByMetadata(meta)
+        if not res['OK']:
+          return res
+        version, lfns = int(time.time()), res['Value']
+        with self.lock:
+          self.lists[key] = (version, lfns)
+          self.__removeOldestLists()
+        self.log.info("Found %d files for %s" % (len(lfns), meta))
+    sampleSize = min(len(lfns), self.ops.getValue("/Overlay/FileListSampleSize", 200))
+    return S_OK({'Version': version, 'NbFiles': len(lfns), 'LFNs': random.sample(lfns, sampleSize)})
+
+  def __removeOldestLists(self):
+    """ Drop the oldest lists above `/Overlay/FileListCacheEntries`, called holding self.lock.
+    The lock of a query without a list is dropped if no job is using it
+    """
+    maxEntries = self.ops.getValue("/Overlay/FileListCacheEntries", 50)
+    for key in sorted(self.lists, key=lambda key: self.lists[key][0])[:max(0, len(self.lists) - maxEntries)]:
+      del self.lists[key]
+      self.log.verbose("Removed the file list of %s from the cache" % dict(key))
+    ## Also the locks of the queries which failed
+    for key in [key for key, keyLock in self.locks.items() if key not in self.lists and not keyLock.locked()]:
+      del self.locks[key]
+
 class OverlayHandler(RequestHandler):
   """ Service for Overlay
   """
@@ -50,10 +108,57 @@ class OverlayHandler(RequestHandler):
     """
     return OVERLAY_DB.getSites()
   
+  types_getSiteLimits = []
+  def export_getSiteLimits(self):
+    """ Get the current limit and number of jobs for each site,
+    the limits follow the changes in the CS without restart
+    """
+    return OVERLAY_DB.getSiteLimits()
+
+  types_getBackgroundFiles = [ DictType ]
+  def export_getBackgroundFiles(self, meta):
+    """ Get a random sample of the background files matching the
+    metadata query, the file lists are cached by the service
+    """
+    return FILE_LISTS.getFiles(meta)
+
   types_setJobsAtSites = [ DictType ]
   def export_setJobsAtSites(self, sitedict):
     """ Set the number of jobs running at each site: 
     called from the ResetCounter agent
     """
     return OVERLAY_DB.setJobsAtSites(sitedict)
-  
\ No newline at end of file
+
+  types_acquireLease = [StringTypes, (IntType, LongType)]
+  def export_acquireLease(self, site, jobID):
+    """ Get a slot at the site for the given job, the lease
+    has to be renewed before it expires, or the slot is given back
+    """
+    return OVERLAY_DB.acquireLease(site, jobID)
+
+  types_renewLease = [(IntType, LongType)]
+  def export_renewLease(self, jobID):
+    """ Extend the lease of the given job
+    """
+    return OVERLAY_DB.renewLease(jobID)
+
+  types_releaseLease = [(IntType, LongType)]
+  def export_releaseLease(self, jobID):
+    """ Report that the given job is done downloading the files
+    and give back its slot
+    """
+    return OVERLAY_DB.releaseLease(jobID)
+
+  types_enqueue = [StringTypes, (IntType, LongType)]
+  def export_enqueue(self, site, jobID):
+    """ Put the job in the queue for a slot at the given site, returns
+    a ticket, the position in the queue and the estimated waiting time
+    """
+    return OVERLAY_DB.enqueue(site, jobID)
+
+  types_pollTicket = [(IntType, LongType)]
+  def export_pollTicket(self, ticket):
+    """ Check if the job holding the ticket was given a slot, the
+    slot is held as a lease which has to be renewed
+    """
+    return OVERLAY_DB.pollTicket(ticket)
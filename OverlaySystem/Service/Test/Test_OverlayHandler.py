@@ -0,0 +1,78 @@
+"""
+Tests for the BackgroundFileLists of the OverlayHandler
+
+"""
+import unittest
+from mock import patch, MagicMock as Mock
+
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertDiracFailsWith, assertEqualsImproved
+from DIRAC import S_OK, S_ERROR
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.OverlaySystem.Service.OverlayHandler'
+
+NOW = 1500000000
+
+# pylint: disable=protected-access
+class TestBackgroundFileLists( unittest.TestCase ):
+  """ Tests of the cache of background file lists """
+  def setUp( self ):
+    """ Prepare BackgroundFileLists object
+    """
+    from ILCDIRAC.OverlaySystem.Service.OverlayHandler import BackgroundFileLists
+    self.value_dict = { '/Overlay/FileListCacheTime' : 3600, '/Overlay/FileListSampleSize' : 2,
+                        '/Overlay/FileListCacheEntries' : 2 }
+    ops_mock = Mock()
+    ops_mock.getValue.side_effect = lambda opt, _default : self.value_dict[opt]
+    with patch('%s.Operations' % MODULE_NAME, new=Mock(return_value=ops_mock)), \
+         patch('%s.FileCatalogClient' % MODULE_NAME, new=Mock()):
+      self.lists = BackgroundFileLists()
+    self.lists.fcc.findFilesByMetadata.side_effect = lambda meta : S_OK( [ '%s_%d' % ( meta['EvtType'], i )
+                                                                           for i in range( 10 ) ] )
+
+  def test_getFiles( self ):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(return_value=NOW)):
+      res = self.lists.getFiles( { 'EvtType' : 'gghad' } )
+    assertEqualsImproved( ( res['OK'], res['Value']['Version'], res['Value']['NbFiles'] ),
+                          ( True, NOW, 10 ), self )
+    assertEqualsImproved( len( res['Value']['LFNs'] ), 2, self )
+    self.assertTrue( set( res['Value']['LFNs'] ) <= set( 'gghad_%d' % i for i in range( 10 ) ) )
+
+  def test_getFiles_cached( self ):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(side_effect=[ NOW, NOW, NOW + 1000 ])):
+      self.lists.getFiles( { 'EvtType' : 'gghad' } )
+      res = self.lists.getFiles( { 'EvtType' : 'gghad' } )
+    assertEqualsImproved( res['Value']['Version'], NOW, self )
+    self.lists.fcc.findFilesByMetadata.assert_called_once_with( { 'EvtType' : 'gghad' } )
+
+  def test_getFiles_expired( self ):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(side_effect=[ NOW, NOW, NOW + 5000, NOW + 5000 ])):
+      self.lists.getFiles( { 'EvtType' : 'gghad' } )
+      res = self.lists.getFiles( { 'EvtType' : 'gghad' } )
+    assertEqualsImproved( res['Value']['Version'], NOW + 5000, self )
+    assertEqualsImproved( self.lists.fcc.findFilesByMetadata.call_count, 2, self )
+
+  def test_getFiles_fails( self ):
+    self.lists.fcc.findFilesByMetadata.side_effect = None
+    self.lists.fcc.findFilesByMetadata.return_value = S_ERROR( 'catalog down' )
+    assertDiracFailsWith( self.lists.getFiles( { 'EvtType' : 'gghad' } ), 'catalog down', self )
+    assertEqualsImproved( self.lists.lists, {}, self )
+
+  def test_cache_size_limited( self ):
+    with patch('%s.time.time' % MODULE_NAME, new=Mock(side_effect=[ NOW, NOW, NOW + 1, NOW + 1, NOW + 2, NOW + 2 ])):
+      for evtType in [ 'gghad', 'pairs', 'aa_lowpt' ]:
+        self.lists.getFiles( { 'EvtType' : evtType } )
+    assertEqualsImproved( sorted( self.lists.lists ), [ ( ( 'EvtType', 'aa_lowpt' ), ), ( ( 'EvtType', 'pairs' ), ) ],
+                          self )
+    assertEqualsImproved( sorted( self.lists.locks ), sorted( self.lists.lists ), self )
+
+  def test_locks_of_failed_queries_removed( self ):
+    self.lists.fcc.findFilesByMetadata.side_effect = [ S_ERROR( 'catalog down' ), S_OK( [ 'pairs_1' ] ) ]
+    self.lists.getFiles( { 'EvtType' : 'gghad' } )
+    self.lists.getFiles( { 'EvtType' : 'pairs' } )
+    assertEqualsImproved( self.lists.locks.keys(), [ ( ( 'EvtType', 'pairs' ), ) ], self )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( TestBackgroundFileLists )
+  unittest.TextTestRunner( verbosity = 2 ).run( SUITE )
@@ -146,6 +146,7 @@ exit $$appstatus
                              callbackFunction = self.redirectLogOutput,
                              bufferLimit = 20971520
                            )
+    self.closeApplicationLog()
 
     # Check results
 
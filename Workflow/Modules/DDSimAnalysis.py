@@ -199,7 +199,7 @@ class DDSimAnalysis(DD4hepMixin, ModuleBase):
     We need to set DD4hepINSTALL !
     """
     ##Need to fetch the new LD_LIBRARY_PATH
-    newLDLibraryPath = getNewLDLibs(platform, appname, appversion)
+    newLDLibraryPath = getNewLDLibs(platform, appname, appversion, cache=self._getEnvironmentCache())
     softwareFolder = getSoftwareFolder(platform, appname, appversion)
     if not softwareFolder['OK']:
       return softwareFolder
@@ -151,6 +151,7 @@ exit $?
                         callbackFunction = self.redirectLogOutput,
                         bufferLimit = 20971520
                       )
+    self.closeApplicationLog()
 
     # Check results
     status = result['Value'][0]
@@ -151,7 +151,7 @@ class LCSIMAnalysis(CompactMixin, ModuleBase):
       return res
     lcsim_name = res['Value']
     ##Need to fetch the new LD_LIBRARY_PATH
-    new_ld_lib_path = getNewLDLibs(self.platform, self.applicationName, self.applicationVersion)
+    new_ld_lib_path = getNewLDLibs(self.platform, self.applicationName, self.applicationVersion, cache=self._getEnvironmentCache())
 
     runonslcio = []
     if len(self.InputFile):
@@ -234,24 +234,14 @@ class MarlinAnalysis(DD4hepMixin, ModuleBase):
   def prepareMARLIN_DLL(self, env_script_path):
     """ Prepare the run time environment: MARLIN_DLL in particular.
     """
-    #to fix the MARLIN_DLL, we need to get it first
-    with open("temp.sh",'w') as script:
-      script.write("#!/bin/bash\n")
-      lines = []
-      lines.append("source %s" % env_script_path)
-      lines.append('echo $MARLIN_DLL')
-      script.write("\n".join(lines))
-    os.chmod("temp.sh", 0755)
-    res = shellCall(0, "./temp.sh")
+    #to fix the MARLIN_DLL, we need to get it first, the environment is only sourced once per job
+    res = self._getEnvironmentCache().getScriptEnvironment(self.platform, self.applicationName,
+                                                           self.applicationVersion, env_script_path)
     if not res['OK']:
       self.log.error("Could not get the MARLIN_DLL env")
       return S_ERROR("Failed getting the MARLIN_DLL")
-    marlindll = res["Value"][1].rstrip()
+    marlindll = res["Value"].get("MARLIN_DLL", "").rstrip()
     marlindll = marlindll.rstrip(":")
-    try:
-      os.remove('temp.sh')
-    except EnvironmentError, e:
-      self.log.warn("Failed to delete the temp file", str(e))
 
     if not marlindll:
       return S_ERROR("Empty MARLIN_DLL env variable!")
@@ -437,7 +427,7 @@ fi
     removeLibc(myMarlinDir + "/LDLibs")
 
     ##Need to fetch the new LD_LIBRARY_PATH
-    new_ld_lib_path = getNewLDLibs(sysconfig, "marlin", appversion)
+    new_ld_lib_path = getNewLDLibs(sysconfig, "marlin", appversion, cache=self._getEnvironmentCache())
 
     marlindll = ""
     if os.path.exists("%s/MARLIN_DLL" % myMarlinDir):
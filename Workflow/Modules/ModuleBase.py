@@ -9,17 +9,17 @@ Stolen by S. Poss from LHCbSystem.Workflow.Modules
 """
 
 import os
-import re
 import shutil
 import string
 import sys
+import threading
 import urllib
 
+from collections import deque
 from random import choice
 
 from DIRAC                                                import S_OK, S_ERROR, gLogger
 from DIRAC.Core.Security.ProxyInfo                        import getProxyInfoAsString
-from DIRAC.Core.Utilities.Adler                           import fileAdler
 from DIRAC.Core.Utilities.Subprocess                      import shellCall
 from DIRAC.TransformationSystem.Client.FileReport         import FileReport
 from DIRAC.WorkloadManagementSystem.Client.JobReport      import JobReport
@@ -31,6 +31,8 @@ from DIRAC.RequestManagementSystem.Client.Operation       import Operation
 from DIRAC.RequestManagementSystem.Client.File            import File
 
 from ILCDIRAC.Core.Utilities.CombinedSoftwareInstallation import getSoftwareFolder, checkCVMFS
+from ILCDIRAC.Core.Utilities.EnvironmentCache             import EnvironmentCache, ENVIRONMENT_CACHE
+from ILCDIRAC.Core.Utilities.FileUtils                    import getFileChecksums
 from ILCDIRAC.Core.Utilities.FindSteeringFileDir          import getSteeringFileDir
 from ILCDIRAC.Core.Utilities.InputFilesUtilities          import getNumberOfEvents
 
@@ -41,6 +43,40 @@ def generateRandomString(length=8, chars = string.letters + string.digits):
   """
   return ''.join([choice(chars) for _ in xrange(length)])
 
+## number of lines of the standard error of the application kept in ModuleBase.stdError
+STDERR_MAX_LINES = 1000
+
+class ApplicationLog(object):
+  """ Log file of the application, kept open while the application runs
+
+  The file is line buffered, so every line is in the file as soon as it is written, but
+  it is not opened and closed for every line. Several threads can write to the same log,
+  e.g. the parallel downloads of the OverlayInput.
+  """
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.logFile = None
+    self.lock = threading.RLock()
+
+  def open(self):
+    """ Open the log file if it is not yet open, creates the file """
+    with self.lock:
+      if self.logFile is None:
+        self.logFile = open(self.fileName, 'a', 1)
+      return self.logFile
+
+  def write(self, message):
+    """ Write the message as a line to the log file """
+    with self.lock:
+      self.open().write(message+'\n')
+
+  def close(self):
+    """ Close the log file, it is opened again for the next message """
+    with self.lock:
+      if self.logFile is not None:
+        self.logFile.close()
+        self.logFile = None
+
 class ModuleBase(object):
   """ Base class of the ILCDIRAC modules. Several common utilities are defined here.
   In particular, all sub classes should call the :func:`resolveInputVariables` method, and implement
@@ -75,6 +111,9 @@ class ModuleBase(object):
     self.ignoremissingInput = False
     self.OutputFile = ''
     self.jobType = ''
+    self._applicationLogFile = None
+    self._applicationLogLock = threading.Lock()
+    self._stdErrorLines = deque(maxlen=STDERR_MAX_LINES)
     self.stdError = ''
     self.debug = False
     self.extraCLIarguments = ""
@@ -96,6 +135,30 @@ class ModuleBase(object):
     ## Make sure this is set everywhere
     os.environ['OMP_NUM_THREADS'] = '1'
 
+  @property
+  def stdError(self):
+    """ The last :data:`STDERR_MAX_LINES` messages of the application to the standard error """
+    return ''.join(self._stdErrorLines)
+
+  @stdError.setter
+  def stdError(self, value):
+    """ The modules reset the standard error before running the application, this also closes the
+    log file of the previous run, which the modules may have removed
+    """
+    self._stdErrorLines.clear()
+    if value:
+      self._stdErrorLines.append(value)
+    self.closeApplicationLog()
+
+  def closeApplicationLog(self):
+    """ Close the log file of the application, called once the application is done. It is opened
+    again if there are more messages
+    """
+    with self._applicationLogLock:
+      if self._applicationLogFile is not None:
+        self._applicationLogFile.close()
+        self._applicationLogFile = None
+
   #############################################################################
   def setApplicationStatus(self, status, sendFlag=True):
     """Wraps around setJobApplicationStatus of state update client
@@ -324,9 +387,12 @@ class ModuleBase(object):
       fileDict = {}
       fileDict['LFN'] = metadata['lfn']
       fileDict['Size'] = os.path.getsize(fileName)
-      fileDict['Addler'] = fileAdler(fileName)
-      fileDict['ADLER32'] = fileAdler(fileName)
-      fileDict['Checksum'] = fileAdler(fileName)
+      ## the file is read only once, the checksum is kept for the other modules
+      checksums = getFileChecksums(fileName)
+      checksum = checksums['Value']['ADLER32'] if checksums['OK'] else False
+      fileDict['Addler'] = checksum
+      fileDict['ADLER32'] = checksum
+      fileDict['Checksum'] = checksum
       fileDict['ChecksumType'] = "ADLER32"
       fileDict['GUID'] = metadata['GUID']
       fileDict['Status'] = "Waiting"
@@ -363,6 +429,13 @@ class ModuleBase(object):
       self.workflow_commons['JobReport'] = JobReport( self.jobID )
     return self.workflow_commons['JobReport']
 
+  def _getEnvironmentCache( self ):
+    """ just return the cache of the application environments (object, shared by all steps of the job)
+    """
+    if ENVIRONMENT_CACHE not in self.workflow_commons:
+      self.workflow_commons[ENVIRONMENT_CACHE] = EnvironmentCache()
+    return self.workflow_commons[ENVIRONMENT_CACHE]
+
 
   def resolveInputVariables(self):
     """ Common utility for all sub classes, resolve the workflow parameters
@@ -500,7 +573,10 @@ class ModuleBase(object):
       if os.path.exists(os.path.basename(self.SteeringFile)):
         self.log.verbose("Found local copy of %s" % self.SteeringFile)
 
-    appres = self.runIt()
+    try:
+      appres = self.runIt()
+    finally:
+      self.closeApplicationLog()
     if not appres["OK"]:
       self.log.error("Somehow the application did not exit properly")
 
@@ -611,32 +687,36 @@ class ModuleBase(object):
     if not message:
       return
     if fd == 1:
-      self.stdError += message
+      self._stdErrorLines.append(message)
 
     if isinstance(self.eventstring, basestring):
       self.eventstring = [self.eventstring]
 
+    ## the event strings are matched as plain strings, as they were escaped for the regular expression
     if self.eventstring is None:
       print message
 
     elif self.eventstring and self.eventstring[0]:
-      for mystring in self.eventstring:
-        if re.search(re.escape(mystring), message):
-          print message
-          break
+      if any(mystring in message for mystring in self.eventstring):
+        print message
 
     if not self.applicationLog:
       self.log.error("Application Log file not defined")
       return
 
-    with open(self.applicationLog, 'a') as log:
-      if self.excludeAllButEventString and self.eventstring is not None and len(self.eventstring) and len(self.eventstring[0]):
-        for mystring in self.eventstring:
-          if re.search(re.escape(mystring), message):
-            log.write(message+'\n')
-            break
-      elif not self.excludeAllButEventString:
-        log.write(message+'\n')
+    with self._applicationLogLock:
+      if self._applicationLogFile is None or self._applicationLogFile.fileName != self.applicationLog:
+        if self._applicationLogFile is not None:
+          self._applicationLogFile.close()
+        self._applicationLogFile = ApplicationLog(self.applicationLog)
+      log = self._applicationLogFile
+    ## the log file is created for every message, even if the message is not written
+    log.open()
+    if self.excludeAllButEventString and self.eventstring is not None and len(self.eventstring) and len(self.eventstring[0]):
+      if any(mystring in message for mystring in self.eventstring):
+        log.write(message)
+    elif not self.excludeAllButEventString:
+      log.write(message)
 
   def addRemovalRequests(self, lfnList):
     """Create removalRequests for lfns in lfnList and add it to the common request"""
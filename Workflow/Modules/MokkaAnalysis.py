@@ -435,7 +435,7 @@ done
     
     mySoftwareRoot = os.sep.join(myMokkaDir.rstrip(os.sep).split(os.sep)[0:-1])
     ##Need to fetch the new LD_LIBRARY_PATH
-    new_ld_lib_path = getNewLDLibs(self.platform, "mokka", self.applicationVersion)
+    new_ld_lib_path = getNewLDLibs(self.platform, "mokka", self.applicationVersion, cache=self._getEnvironmentCache())
 
     ##Remove libc
     removeLibc(myMokkaDir)
@@ -11,20 +11,24 @@ import glob
 import os
 import random
 import subprocess
+import threading
 import time
 from math import ceil
+from multiprocessing.pool import ThreadPool
 
 import DIRAC
 from DIRAC.DataManagementSystem.Client.DataManager           import DataManager
 from DIRAC.Resources.Catalog.FileCatalogClient               import FileCatalogClient
 from DIRAC.Core.DISET.RPCClient                              import RPCClient
 from DIRAC.Core.Utilities.Subprocess                         import shellCall
+from DIRAC.Core.Utilities.List                               import breakListIntoChunks
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations     import Operations
 from DIRAC                                                   import S_OK, S_ERROR, gLogger
 
 from ILCDIRAC.Workflow.Modules.ModuleBase                    import ModuleBase
-from ILCDIRAC.Core.Utilities.WasteCPU                        import wasteCPUCycles
+from ILCDIRAC.Core.Utilities.Backoff                         import Backoff
 from ILCDIRAC.Core.Utilities.OverlayFiles                    import energyWithLowerCaseUnit
+from ILCDIRAC.Core.Utilities.OverlayCache                    import OverlayCache, checkFile
 
 
 __RCSID__ = "$Id$"
@@ -69,6 +73,8 @@ class OverlayInput (ModuleBase):
     self.energy = 0
     self.nbofeventsperfile = 100
     self.lfns = []
+    ## Number of background files available, self.lfns can be a random sample of them
+    self.nbAvailableFiles = 0
     self.nbfilestoget = 0
     self.BkgEvtType = 'gghad'
     self.metaEventType = self.BkgEvtType
@@ -84,6 +90,12 @@ class OverlayInput (ModuleBase):
     self.machine = 'clic_cdr'
     self.pathToOverlayFiles = ''
     self.processorName = ''
+    self.leaseDuration = 1800
+    self.leaseRenewed = 0
+    self.overlayCache = None
+    self.fileMetadata = {}
+    ## the parallel downloads share the result of the copy scripts and the watchdog file
+    self.downloadLock = threading.Lock()
 
   def applicationSpecificInputs(self):
 
@@ -204,6 +216,14 @@ class OverlayInput (ModuleBase):
       meta['ProdID'] = self.prodid
     self.log.info("Using %s as metadata" % (meta))
 
+    ##The Overlay service keeps the file lists, so not every job repeats the same query
+    res = RPCClient('Overlay/Overlay', timeout=60).getBackgroundFiles(meta)
+    if res['OK']:
+      self.log.info("Got %d of %d files from the list of %s" % (len(res['Value']['LFNs']), res['Value']['NbFiles'],
+                                                                 time.ctime(res['Value']['Version'])))
+      self.nbAvailableFiles = res['Value']['NbFiles']
+      return S_OK(res['Value']['LFNs'])
+    self.log.warn("Could not get the file list from the Overlay service, querying the catalog:", res['Message'])
     return self.fcc.findFilesByMetadata(meta)
 
 
@@ -271,8 +291,8 @@ class OverlayInput (ModuleBase):
     """ Download the files.
     """
     numberofeventstoget = ceil(self.BXOverlay * self.ggtohadint)
-    nbfiles = len(self.lfns)
-    availableevents = nbfiles * self.nbofeventsperfile
+    ## The Overlay service only returns a sample of the files, but counts all of them
+    availableevents = max(self.nbAvailableFiles, len(self.lfns)) * self.nbofeventsperfile
     if availableevents < numberofeventstoget:
       return S_ERROR("Number of %s events available is less than requested" % ( self.BkgEvtType ))
 
@@ -307,39 +327,14 @@ class OverlayInput (ModuleBase):
 #      max_concurrent_running = res['Value']
     self.__disableWatchDog()
     overlaymon = RPCClient('Overlay/Overlay', timeout=60)
+    self.leaseDuration = self.ops.getValue("/Overlay/LeaseDuration", self.leaseDuration)
     ##Now need to check that there are not that many concurrent jobs getting the overlay at the same time
-    error_count = 0
-    count = 0
-    while 1:
-      if error_count > 10 :
-        self.log.error('OverlayDB returned too many errors')
-        return S_ERROR('Failed to get number of concurrent overlay jobs')
-      #jobMonitor = RPCClient('WorkloadManagement/JobMonitoring',timeout=60)
-      #res = jobMonitor.getCurrentJobCounters(jobpropdict)
-      #if not res['OK']:
-      #  error_count += 1
-      #  time.sleep(60)
-      #  continue
-      #running = 0
-      #if 'Running' in res['Value']:
-      #  running = res['Value']['Running']
-
-      res = overlaymon.canRun(self.site)
-      if not res['OK']:
-        error_count += 1
-        time.sleep(60)
-        continue
-      error_count = 0
-      #if running < max_concurrent_running:
-      if res['Value']:
-        break
-      else:
-        count += 1
-        if count > 300:
-          return S_ERROR("Waited too long: 5h, so marking job as failed")
-        if count % 10 == 0 :
-          self.setApplicationStatus("Overlay standby number %s" % count)
-        time.sleep(60)
+    if self.jobID:
+      res = self.__waitInQueue(overlaymon)
+    else:
+      res = self.__pollForSlot(overlaymon)
+    if not res['OK']:
+      return res
 
     self.__enableWatchDog()
 
@@ -354,8 +349,28 @@ class OverlayInput (ModuleBase):
     fail = False
     fail_count = 0
 
+    ##The files can be shared with the other jobs on the node
+    cacheDir = self.ops.getValue("/Overlay/NodeCache/Directory", "")
+    if cacheDir and os.path.isabs(str(cacheDir)):
+      cacheSize = self.ops.getValue("/Overlay/NodeCache/MaxSizeGB", 20)
+      self.log.info("Using the overlay cache in %s" % cacheDir)
+      self.overlayCache = OverlayCache(cacheDir, int(cacheSize * 1024**3))
+      self.__getCatalogMetadata()
+
     max_fail_allowed = self.ops.getValue("/Overlay/MaxFailedAllowed", 20)
-    while not len(filesobtained) == totnboffilestoget:
+    ## Wait between files to spread the load on the storage, longer after failures
+    waitBetweenFiles = Backoff(initial = self.ops.getValue("/Overlay/WaitBetweenFiles", 180),
+                               maximum = self.ops.getValue("/Overlay/MaxWaitBetweenFiles", 900),
+                               jitter = 0.2, jobDir = self.curdir)
+    nbWorkers = self.ops.getValue("/Overlay/ParallelDownloads", 1)
+    if nbWorkers > 1:
+      res = self.__getFilesParallel(totnboffilestoget, max_fail_allowed, nbWorkers, overlaymon)
+      fail = not res['OK']
+      if res['OK']:
+        filesobtained = res['Value']
+    ## The files are taken from the sample we got
+    nbfiles = len(self.lfns)
+    while not fail and not len(filesobtained) == totnboffilestoget:
       if fail_count > max_fail_allowed:
         fail = True
         break
@@ -364,48 +379,27 @@ class OverlayInput (ModuleBase):
       if fileindex not in usednumbers:
           
         usednumbers.append(fileindex)
+        self.__renewLease(overlaymon)
 
-        triedDataManager = False
-
-        if self.site == 'LCG.CERN.ch':
-          res = self.getEOSFile(self.lfns[fileindex])
-        elif self.site == 'LCG.IN2P3-CC.fr':
-          res = self.getLyonFile(self.lfns[fileindex])
-        elif self.site == 'LCG.UKI-LT2-IC-HEP.uk':
-          res = self.getImperialFile(self.lfns[fileindex])
-        elif  self.site == 'LCG.RAL-LCG2.uk':
-          res = self.getRALFile(self.lfns[fileindex])
-        elif  self.site == 'LCG.KEK.jp':
-          res = self.getKEKFile(self.lfns[fileindex])
-        else:
-          self.__disableWatchDog()
-          res = self.datMan.getFile(self.lfns[fileindex])
-          triedDataManager = True
-
-        #in case the specific copying did not work (mostly because the fileqs do
-        #not exist locally) try again to get the file via the DataManager
-        if (not res['OK']) and (not triedDataManager):
-          res = self.datMan.getFile(self.lfns[fileindex])
-
+        res = self.__getCachedFile(self.lfns[fileindex], self.datMan)
         if not res['OK']:
           self.log.warn('Could not obtain %s' % self.lfns[fileindex])
           fail_count += 1
+          if fail_count <= max_fail_allowed and len(usednumbers) < nbfiles:
+            waitBetweenFiles.wait()
           continue
         
+        waitBetweenFiles.reset()
         filesobtained.append(self.lfns[fileindex])
         print "files now",filesobtained
-      ##If no file could be obtained, need to make sure the job fails  
-      if len(usednumbers) == nbfiles and not filesobtained:
+      ##If not enough files could be obtained from the sample, need to make sure the job fails
+      if len(usednumbers) == nbfiles and len(filesobtained) < totnboffilestoget:
         fail = True
         break
 
       if len(filesobtained) < totnboffilestoget:
         ##Now wait for a random time around 3 minutes
-        ###Actually, waste CPU time !!!
-        self.log.verbose("Waste happily some CPU time (on average 3 minutes)")
-        res = wasteCPUCycles(60 * random.gauss(3, 0.1))
-        if not res['OK']:
-          self.log.error("Could not waste as much CPU time as wanted, but whatever!")
+        waitBetweenFiles.wait()
 
     ## Remove all scripts remaining
     scripts = glob.glob("*.sh")
@@ -417,7 +411,7 @@ class OverlayInput (ModuleBase):
     self.log.info("List of Overlay files:")
     self.log.info("\n".join(mylist))
     os.chdir(self.curdir)
-    res = overlaymon.jobDone(self.site)
+    res = self.__releaseSlot(overlaymon)
     if not res['OK']:
       self.log.error("Could not declare the job as finished getting the files")
     if fail:
@@ -426,7 +420,129 @@ class OverlayInput (ModuleBase):
     self.log.info('Got all files needed.')
     return S_OK()
 
-  def getCASTORFile(self, lfn):
+  def __getCachedFile(self, lfn, datMan, scriptName = "overlayinput.sh"):
+    """ Get one file from the overlay cache of the node if there is one, otherwise download it
+    and add it to the cache
+
+    :returns: S_OK, S_ERROR
+    """
+    if not self.overlayCache:
+      return self.__getFile(lfn, datMan, scriptName)
+    metadata = self.fileMetadata.get(lfn, {})
+    checksum = metadata.get('Checksum')
+    res = self.overlayCache.getFile(lfn, checksum, os.getcwd())
+    if res['OK']:
+      self.log.verbose("Got %s from the overlay cache" % lfn)
+      return res
+    res = self.__getFile(lfn, datMan, scriptName)
+    localFile = os.path.basename(lfn)
+    if res['OK'] and checksum and os.path.exists(localFile):
+      ## a corrupt file must neither be used nor shared with the other jobs of the node
+      resCheck = checkFile(localFile, checksum, metadata.get('Size'), metadata.get('ChecksumType', 'AD'))
+      if not resCheck['OK']:
+        self.log.warn("The downloaded file does not match the catalog", resCheck['Message'])
+        os.remove(localFile)
+        return resCheck
+      resCache = self.overlayCache.addFile(lfn, checksum, localFile, size = metadata.get('Size'),
+                                           checksumType = metadata.get('ChecksumType', 'AD'))
+      if not resCache['OK']:
+        self.log.warn("Could not add file to the overlay cache", resCache['Message'])
+    return res
+
+  def __getCatalogMetadata(self):
+    """ Get the size and checksum of all the overlay files from the catalog, with one call for many
+    files. They are needed to look up the files in the overlay cache and to check the downloads
+    """
+    for lfnChunk in breakListIntoChunks(self.lfns, 1000):
+      res = self.fcc.getFileMetadata(lfnChunk)
+      if not res['OK']:
+        self.log.warn("Could not get the metadata of the overlay files:", res['Message'])
+        continue
+      self.fileMetadata.update(res['Value']['Successful'])
+
+  def __getFile(self, lfn, datMan, scriptName = "overlayinput.sh"):
+    """ Get one file with the copy method of the site, or with the DataManager if that does not work
+
+    :param str lfn: LFN of the file
+    :param datMan: DataManager used for the download
+    :param str scriptName: name of the script used by the copy methods of the sites
+    :returns: S_OK, S_ERROR
+    """
+    triedDataManager = False
+
+    if self.site == 'LCG.CERN.ch':
+      res = self.getEOSFile(lfn, scriptName)
+    elif self.site == 'LCG.IN2P3-CC.fr':
+      res = self.getLyonFile(lfn, scriptName)
+    elif self.site == 'LCG.UKI-LT2-IC-HEP.uk':
+      res = self.getImperialFile(lfn, scriptName)
+    elif  self.site == 'LCG.RAL-LCG2.uk':
+      res = self.getRALFile(lfn, scriptName)
+    elif  self.site == 'LCG.KEK.jp':
+      res = self.getKEKFile(lfn, scriptName)
+    else:
+      self.__disableWatchDog()
+      res = datMan.getFile(lfn)
+      triedDataManager = True
+
+    #in case the specific copying did not work (mostly because the fileqs do
+    #not exist locally) try again to get the file via the DataManager
+    if (not res['OK']) and (not triedDataManager):
+      res = datMan.getFile(lfn)
+
+    return res
+
+  def __getFilesParallel(self, totnboffilestoget, max_fail_allowed, nbWorkers, overlaymon):
+    """ Download the files with several workers at the same time. The files are chosen at random,
+    each round downloads as many files as there are workers and the lease is renewed between rounds.
+    The job holds one slot at the site, so the load on the site is still limited by the Overlay service
+
+    :returns: S_OK with the list of LFNs obtained, S_ERROR if not enough files could be obtained
+    """
+    candidates = random.sample(self.lfns, len(self.lfns))
+    filesobtained = []
+    fail_count = 0
+    self.__disableWatchDog()
+    self.log.info("Getting the files with %d parallel downloads" % nbWorkers)
+
+    def getOneFile(lfn):
+      """ Download the file in a worker thread, each worker uses its own script and DataManager. The
+      results are returned to the main thread, which counts the files obtained and the failures
+      """
+      return lfn, self.__getCachedFile(lfn, DataManager(), "overlayinput_%s.sh" % os.path.basename(lfn))
+
+    pool = ThreadPool(nbWorkers)
+    try:
+      while len(filesobtained) < totnboffilestoget:
+        if fail_count > max_fail_allowed or not candidates:
+          return S_ERROR("Failed to get files")
+        nbToGet = min(nbWorkers, totnboffilestoget - len(filesobtained), len(candidates))
+        batch, candidates = candidates[:nbToGet], candidates[nbToGet:]
+        self.__renewLease(overlaymon)
+        for lfn, res in pool.map(getOneFile, batch):
+          if not res['OK']:
+            self.log.warn('Could not obtain %s' % lfn)
+            fail_count += 1
+            continue
+          filesobtained.append(lfn)
+        self.log.info("Obtained %d of %d files" % (len(filesobtained), totnboffilestoget))
+    finally:
+      pool.close()
+      pool.join()
+    return S_OK(filesobtained)
+
+  def __runCopyScript(self, scriptName):
+    """ Run the script copying a file, its output goes to the application log
+
+    :returns: the result of the shellCall, also kept in self.result
+    """
+    comm = 'sh -c "./%s"' % scriptName
+    result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    with self.downloadLock:
+      self.result = result
+    return result
+
+  def getCASTORFile(self, lfn, scriptName = "overlayinput.sh"):
     """ USe xrdcp or rfcp to get the files from castor
     """
     prependpath = "/castor/cern.ch/grid"
@@ -439,9 +555,9 @@ class OverlayInput (ModuleBase):
 
     basename = os.path.basename(lfile)
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -459,9 +575,8 @@ if [ ! -s %s ]; then
 fi\n""" % (basename, lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0755)
+    self.__runCopyScript(scriptName)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -469,7 +584,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getEOSFile(self, lfn):
+  def getEOSFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use xrdcp to get the files from EOS
     """
     prependpath = "/eos/experiment/clicdp/grid"
@@ -479,9 +594,9 @@ fi\n""" % (basename, lfile))
       lfile = lfn
     self.log.info("Getting %s" % lfile)
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('################################\n')
       script.write('# Dynamically generated script #\n')
@@ -491,9 +606,8 @@ fi\n""" % (basename, lfile))
       script.write("xrdcp -s root://eospublic.cern.ch/%s ./ \n" % lfile.rstrip() )
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0755)
+    self.__runCopyScript(scriptName)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -501,7 +615,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getLyonFile(self, lfn):
+  def getLyonFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use xrdcp to get the files from Lyon
     """
     prependpath = '/pnfs/in2p3.fr/data'
@@ -514,9 +628,9 @@ fi\n""" % (basename, lfile))
     #comm = []
     #comm.append("cp $X509_USER_PROXY /tmp/x509up_u%s"%os.getuid())
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh", "w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -531,9 +645,8 @@ fi\n""" % (basename, lfile))
 #fi\n"""%(basename,lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0755)
+    self.__runCopyScript(scriptName)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -541,7 +654,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getImperialFile(self, lfn):
+  def getImperialFile(self, lfn, scriptName = "overlayinput.sh"):
     """ USe dccp to get the files from the Imperial SE
     """
     prependpath = '/pnfs/hep.ph.ic.ac.uk/data'
@@ -553,9 +666,9 @@ fi\n""" % (basename, lfile))
     ###Don't check for CPU time as other wise, job can get killed
     self.__disableWatchDog()
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -568,9 +681,8 @@ fi\n""" % (basename, lfile))
 #fi\n"""%(basename,lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0755)
+    self.__runCopyScript(scriptName)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -578,7 +690,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getRALFile(self, lfn):
+  def getRALFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use rfcp to get the files from RAL castor
     """
     prependpath = '/castor/ads.rl.ac.uk/prod'
@@ -614,9 +726,9 @@ fi\n""" % (basename, lfile))
 #      print res
     basename = os.path.basename(lfile)
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh","w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -624,9 +736,8 @@ fi\n""" % (basename, lfile))
       script.write("/usr/bin/rfcp 'rfio://cgenstager.ads.rl.ac.uk:9002?svcClass=ilcTape&path=%s' %s\n" % (lfile, basename))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
-    os.chmod("overlayinput.sh", 0755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0755)
+    self.__runCopyScript(scriptName)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -634,7 +745,7 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
-  def getKEKFile(self, lfn):
+  def getKEKFile(self, lfn, scriptName = "overlayinput.sh"):
     """ Use cp to get the files from kek-se
     """
     prependpath = '/grid'
@@ -642,9 +753,9 @@ fi\n""" % (basename, lfile))
     self.log.info("Getting %s" % lfile)
     self.__disableWatchDog()
 
-    if os.path.exists("overlayinput.sh"):
-      os.unlink("overlayinput.sh")
-    with open("overlayinput.sh", "w") as script:
+    if os.path.exists(scriptName):
+      os.unlink(scriptName)
+    with open(scriptName, "w") as script:
       script.write('#!/bin/sh \n')
       script.write('###############################\n')
       script.write('# Dynamically generated scrip #\n')
@@ -653,9 +764,8 @@ fi\n""" % (basename, lfile))
       script.write('declare -x appstatus=$?\n')
       script.write('exit $appstatus\n')
 
-    os.chmod("overlayinput.sh", 0755)
-    comm = 'sh -c "./overlayinput.sh"'
-    self.result = shellCall(600, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    os.chmod(scriptName, 0755)
+    self.__runCopyScript(scriptName)
 
     localfile = os.path.basename(lfile)
     if os.path.exists(localfile):
@@ -663,6 +773,118 @@ fi\n""" % (basename, lfile))
 
     return S_ERROR("Failed")
 
+  def __pollForSlot(self, overlaymon):
+    """ Ask the Overlay service if the job can start downloading, with exponential backoff and jitter
+    """
+    backoff = Backoff(initial = 60, maximum = self.ops.getValue("/Overlay/MaxPollInterval", 600), jobDir = self.curdir)
+    maxWaitingTime = self.ops.getValue("/Overlay/MaxWaitingTime", 5 * 3600)
+    error_count = 0
+    count = 0
+    while 1:
+      if error_count > 10 :
+        self.log.error('OverlayDB returned too many errors')
+        return S_ERROR('Failed to get number of concurrent overlay jobs')
+      #jobMonitor = RPCClient('WorkloadManagement/JobMonitoring',timeout=60)
+      #res = jobMonitor.getCurrentJobCounters(jobpropdict)
+      #if not res['OK']:
+      #  error_count += 1
+      #  time.sleep(60)
+      #  continue
+      #running = 0
+      #if 'Running' in res['Value']:
+      #  running = res['Value']['Running']
+
+      res = self.__acquireSlot(overlaymon)
+      if not res['OK']:
+        error_count += 1
+        backoff.wait()
+        continue
+      error_count = 0
+      #if running < max_concurrent_running:
+      if res['Value']:
+        break
+      else:
+        count += 1
+        if backoff.waited > maxWaitingTime:
+          return S_ERROR("Waited too long: %dh, so marking job as failed" % (maxWaitingTime / 3600))
+        if count % 10 == 0 :
+          self.setApplicationStatus("Overlay standby number %s" % count)
+        backoff.wait()
+    return S_OK()
+
+  def __acquireSlot(self, overlaymon):
+    """ Ask the Overlay service for a slot at the site, with a lease if the job ID is known
+    so the slot is given back if the job dies before releasing it
+    """
+    if not self.jobID:
+      return overlaymon.canRun(self.site)
+    res = overlaymon.acquireLease(self.site, int(self.jobID))
+    if res['OK'] and res['Value']:
+      self.leaseRenewed = time.time()
+    return res
+
+  def __waitInQueue(self, overlaymon):
+    """ Wait in the queue of the Overlay service until the job is given a slot. The service is
+    polled with exponential backoff and jitter, bounded by the estimated waiting time
+    """
+    res = overlaymon.enqueue(self.site, int(self.jobID))
+    if not res['OK']:
+      self.log.warn("Could not enter the overlay queue, polling instead:", res['Message'])
+      return self.__pollForSlot(overlaymon)
+    backoff = Backoff(initial = 30, maximum = self.ops.getValue("/Overlay/MaxPollInterval", 600), jobDir = self.curdir)
+    maxWaitingTime = self.ops.getValue("/Overlay/MaxWaitingTime", 5 * 3600)
+    interval = None
+    error_count = 0
+    position = None
+    ticket = None
+    start = time.time()
+    while 1:
+      if not res['OK']:
+        error_count += 1
+        if error_count > 10:
+          self.log.error('OverlayDB returned too many errors')
+          return S_ERROR('Failed to get number of concurrent overlay jobs')
+        ## The ticket is forgotten if we did not poll for too long, so enter the queue again
+        ticket = None
+      else:
+        error_count = 0
+        ticket = res['Value']['Ticket']
+        if res['Value']['Granted']:
+          self.leaseRenewed = time.time()
+          return S_OK()
+        if res['Value']['Position'] != position:
+          position = res['Value']['Position']
+          self.setApplicationStatus("Overlay standby, position %s" % position)
+        ## no need to poll much earlier than the service expects to give us a slot
+        interval = max(res['Value']['EstimatedWait'], 15)
+      if time.time() - start > maxWaitingTime:
+        return S_ERROR("Waited too long: %dh, so marking job as failed" % (maxWaitingTime / 3600))
+      backoff.wait(interval)
+      if ticket is None:
+        res = overlaymon.enqueue(self.site, int(self.jobID))
+      else:
+        res = overlaymon.pollTicket(ticket)
+
+  def __renewLease(self, overlaymon):
+    """ Renew the lease on the overlay slot once half of its duration has passed
+    """
+    if not self.jobID or time.time() - self.leaseRenewed < self.leaseDuration / 2.:
+      return
+    res = overlaymon.renewLease(int(self.jobID))
+    if not res['OK']:
+      self.log.warn("Could not renew the lease on the overlay slot:", res['Message'])
+      return
+    if not res['Value']:
+      self.log.warn("The lease on the overlay slot expired")
+    self.leaseRenewed = time.time()
+
+  def __releaseSlot(self, overlaymon):
+    """ Give back the overlay slot
+    """
+    if not self.jobID:
+      return overlaymon.jobDone(self.site)
+    return overlaymon.releaseLease(int(self.jobID))
+
 
   def execute(self):
     """ Run the module, called rom Workflow
@@ -708,6 +930,7 @@ fi\n""" % (basename, lfile))
 
 
     res = self.__getFilesLocaly()
+    self.closeApplicationLog()
     ###Now that module is finished,resume CPU time checks
     self.__enableWatchDog()
 
@@ -729,9 +952,10 @@ fi\n""" % (basename, lfile))
     """create the watchdog disable if it does not exists"""
     watchDogFilename = 'DISABLE_WATCHDOG_CPU_WALLCLOCK_CHECK'
     fullPath = os.path.join( self.curdir, watchDogFilename )
-    if not os.path.exists( fullPath ):
-      with open( fullPath, 'w' ) as checkFile:
-        checkFile.write('Dont look at cpu')
+    with self.downloadLock:
+      if not os.path.exists( fullPath ):
+        with open( fullPath, 'w' ) as checkFile:
+          checkFile.write('Dont look at cpu')
 
   def __enableWatchDog( self ):
     """remove the watchdog disable file if it exists"""
@@ -100,7 +100,7 @@ class PythiaAnalysis(ModuleBase):
     #self.lumifile = path+"/%s.ep"%depdir
     lumifile = "%s/%s" % (randomName, os.path.basename(originpath).replace(".ep",""))
     ##Need to fetch the new LD_LIBRARY_PATH
-    new_ld_lib_path = getNewLDLibs(self.platform, self.applicationName, self.applicationVersion)
+    new_ld_lib_path = getNewLDLibs(self.platform, self.applicationName, self.applicationVersion, cache=self._getEnvironmentCache())
     new_ld_lib_path = myappDir + "/lib:" + new_ld_lib_path
 
     scriptName = '%s_%s_Run_%s.sh' % (self.applicationName, self.applicationVersion, self.STEP_NUMBER)
@@ -132,6 +132,7 @@ class PythiaAnalysis(ModuleBase):
     self.setApplicationStatus('%s %s step %s' % (self.applicationName, self.applicationVersion, self.STEP_NUMBER))
     self.stdError = ''
     self.result = shellCall(0, comm, callbackFunction = self.redirectLogOutput, bufferLimit = 20971520)
+    self.closeApplicationLog()
     if not self.result['OK']:
       self.log.error('Something wrong during running:', self.result['Message'])
       self.setApplicationStatus('Error during running %s'% self.applicationName)
@@ -200,7 +200,7 @@ class SLICAnalysis(CompactMixin, ModuleBase):
 
 
     ##Need to fetch the new LD_LIBRARY_PATH
-    new_ld_lib_path = getNewLDLibs(sysconfig, appname, appversion)
+    new_ld_lib_path = getNewLDLibs(sysconfig, appname, appversion, cache=self._getEnvironmentCache())
     #res = getSoftwareFolder(sysconfig, appname, appversion)
     #if not res['OK']:
     #  self.log.error('Directory %s was not found in either the local area or shared area' % (slicDir))
@@ -222,9 +222,9 @@ fi
     removeLibc(myslicPandoraDir + "/LDLibs")
 
     ##Need to fetch the new LD_LIBRARY_PATH
-    new_ld_lib_path = getNewLDLibs(sysconfig, appname, appversion)
+    new_ld_lib_path = getNewLDLibs(sysconfig, appname, appversion, cache=self._getEnvironmentCache())
 
-    new_path = getNewPATH(sysconfig, appname, appversion)
+    new_path = getNewPATH(sysconfig, appname, appversion, cache=self._getEnvironmentCache())
 
     prefixpath = ""
     if os.path.exists("PandoraFrontend"):
@@ -105,6 +105,7 @@ exit $?
                              callbackFunction = self.redirectLogOutput,
                              bufferLimit = 20971520
                            )
+    self.closeApplicationLog()
 
     # Check results
 
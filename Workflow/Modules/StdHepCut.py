@@ -162,7 +162,7 @@ class StdHepCut(ModuleBase):
   def prepareScript(self, mySoftDir):
     """ Prepare the script
     """
-    new_ld_lib_path = getNewLDLibs(self.platform, self.applicationName, self.applicationVersion)
+    new_ld_lib_path = getNewLDLibs(self.platform, self.applicationName, self.applicationVersion, cache=self._getEnvironmentCache())
     new_ld_lib_path = mySoftDir + "/lib:" + new_ld_lib_path
     if os.path.exists("./lib"):
       new_ld_lib_path = "./lib:" + new_ld_lib_path
@@ -113,7 +113,7 @@ class StdHepSplit(ModuleBase):
       return res
     
     mysplitDir = res['Value']
-    new_ld_lib = getNewLDLibs(self.platform, "stdhepsplit", self.applicationVersion)
+    new_ld_lib = getNewLDLibs(self.platform, "stdhepsplit", self.applicationVersion, cache=self._getEnvironmentCache())
     LD_LIBRARY_PATH = os.path.join(mysplitDir, "lib") + ":" + new_ld_lib
 
 
@@ -175,6 +175,7 @@ exit $?
                              callbackFunction = self.redirectLogOutput,
                              bufferLimit = 20971520
                            )
+    self.closeApplicationLog()
 
     resultTuple = self.result['Value']
     status      = resultTuple[0]
@@ -17,6 +17,7 @@ __RCSID__ = "$Id$"
 #pylint: disable=missing-docstring, protected-access
 
 MODULE_NAME = 'ILCDIRAC.Workflow.Modules.MarlinAnalysis'
+ENV_MODULE_NAME = 'ILCDIRAC.Core.Utilities.EnvironmentCache'
 
 class MarlinAnalysisFixture( object ):
   """ Contains the commonly used setUp and tearDown methods of the Tests"""
@@ -442,59 +443,26 @@ class MarlinAnalysisPrepareDLLCase( MarlinAnalysisFixture, unittest.TestCase ):
     exists_dict = { './lib/marlin_dll' : True }
     def replace_exists( path ):
       return exists_dict[path]
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
-         patch('%s.os.chmod' % MODULE_NAME) as chmod_mock, \
-         patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARlin_DLL/path: ', 'other_return_value_from_shell' ]))) as shell_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=[ True ])) as remove_mock, \
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARLIN_DLL=MARlin_DLL/path: \0OTHER=value\0', 'other_return_value_from_shell' ]))) as shell_mock, \
          patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=replace_exists)) as exists_mock, \
          patch('%s.glob.glob' % MODULE_NAME, new=Mock(return_value=[ 'mytestlibrary.so', 'secondLibrary.veryUseful.so' ])) as glob_mock:
-      open_mock.side_effect = (h for h in handles)
       result = self.marAna.prepareMARLIN_DLL( 'some_path' )
-      open_mock.assert_called_once_with( 'temp.sh', 'w' )
-      assertMockCalls( handles[0].__enter__().write,
-                       [ '#!/bin/bash\n', 'source some_path\necho $MARLIN_DLL' ], self )
-      assertEqualsImproved( len( handles ), 1, self )
-      chmod_mock.assert_called_once_with( 'temp.sh', 0755 )
-      shell_mock.assert_called_once_with( 0, './temp.sh' )
-      remove_mock.assert_called_once_with( 'temp.sh' )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
       exists_mock.assert_called_once_with( './lib/marlin_dll' )
       glob_mock.assert_called_once_with( './lib/marlin_dll/*.so' )
       assertDiracSucceedsWith( result, 'MARlin_DLL/path:mytestlibrary.so:secondLibrary.veryUseful.so',
                                self )
 
   def test_preparemarlindll_shellcall_fails( self ):
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
-         patch('%s.os.chmod' % MODULE_NAME) as chmod_mock, \
-         patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_ERROR('some_test_err'))) as shell_mock:
-      open_mock.side_effect = (h for h in handles)
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_ERROR('some_test_err'))) as shell_mock:
       result = self.marAna.prepareMARLIN_DLL( 'some_path' )
-      open_mock.assert_called_once_with( 'temp.sh', 'w' )
-      assertMockCalls( handles[0].__enter__().write,
-                       [ '#!/bin/bash\n', 'source some_path\necho $MARLIN_DLL' ], self )
-      assertEqualsImproved( len( handles ), 1, self )
-      chmod_mock.assert_called_once_with( 'temp.sh', 0755 )
-      shell_mock.assert_called_once_with( 0, './temp.sh' )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
       assertDiracFailsWith( result, 'failed getting the marlin_dll', self )
 
   def test_preparemarlindll_empty_marlindll( self ):
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
-         patch('%s.os.chmod' % MODULE_NAME) as chmod_mock, \
-         patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK( [0, '', 'other_value'] ))) as shell_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=EnvironmentError('something?'))) :
-      open_mock.side_effect = (h for h in handles)
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_OK( [0, 'OTHER=value\0', 'other_value'] ))) as shell_mock:
       result = self.marAna.prepareMARLIN_DLL( 'some_path' )
-      open_mock.assert_called_once_with( 'temp.sh', 'w' )
-      assertMockCalls( handles[0].__enter__().write,
-                       [ '#!/bin/bash\n', 'source some_path\necho $MARLIN_DLL' ], self )
-      assertEqualsImproved( len( handles ), 1, self )
-      chmod_mock.assert_called_once_with( 'temp.sh', 0755 )
-      shell_mock.assert_called_once_with( 0, './temp.sh' )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
       assertDiracFailsWith( result, 'empty marlin_dll env var', self )
 
   def test_preparemarlindll_procstoinclude( self ):
@@ -502,23 +470,11 @@ class MarlinAnalysisPrepareDLLCase( MarlinAnalysisFixture, unittest.TestCase ):
     exists_dict = { './lib/marlin_dll' : True }
     def replace_exists( path ):
       return exists_dict[path]
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
-         patch('%s.os.chmod' % MODULE_NAME) as chmod_mock, \
-         patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARlin_DLL/path', 'other_return_value_from_shell' ]))) as shell_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=[ True ])) as remove_mock, \
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARLIN_DLL=MARlin_DLL/path\0OTHER=value\0', 'other_return_value_from_shell' ]))) as shell_mock, \
          patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=replace_exists)) as exists_mock, \
          patch('%s.glob.glob' % MODULE_NAME, new=Mock(return_value=[ 'mytestlibrary.so', 'secondLibrary.veryUseful.so', 'MARlin_DLL/path' ])) as glob_mock:
-      open_mock.side_effect = (h for h in handles)
       result = self.marAna.prepareMARLIN_DLL( 'some_path' )
-      open_mock.assert_called_once_with( 'temp.sh', 'w' )
-      assertMockCalls( handles[0].__enter__().write,
-                       [ '#!/bin/bash\n', 'source some_path\necho $MARLIN_DLL' ], self )
-      assertEqualsImproved( len( handles ), 1, self )
-      chmod_mock.assert_called_once_with( 'temp.sh', 0755 )
-      shell_mock.assert_called_once_with( 0, './temp.sh' )
-      remove_mock.assert_called_once_with( 'temp.sh' )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
       exists_mock.assert_called_once_with( './lib/marlin_dll' )
       glob_mock.assert_called_once_with( './lib/marlin_dll/*.so' )
       assertDiracSucceedsWith( result, 'secondLibrary.veryUseful.so', self )
@@ -528,23 +484,11 @@ class MarlinAnalysisPrepareDLLCase( MarlinAnalysisFixture, unittest.TestCase ):
     exists_dict = { './lib/marlin_dll' : True }
     def replace_exists( path ):
       return exists_dict[path]
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
-         patch('%s.os.chmod' % MODULE_NAME) as chmod_mock, \
-         patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARlin_DLL/path', 'other_return_value_from_shell' ]))) as shell_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=[ True ])) as remove_mock, \
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARLIN_DLL=MARlin_DLL/path\0OTHER=value\0', 'other_return_value_from_shell' ]))) as shell_mock, \
          patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=replace_exists)) as exists_mock, \
          patch('%s.glob.glob' % MODULE_NAME, new=Mock(return_value=[ 'mytestlibrary.so', 'secondLibrary.veryUseful.so' ])) as glob_mock:
-      open_mock.side_effect = (h for h in handles)
       result = self.marAna.prepareMARLIN_DLL( 'some_path' )
-      open_mock.assert_called_once_with( 'temp.sh', 'w' )
-      assertMockCalls( handles[0].__enter__().write,
-                       [ '#!/bin/bash\n', 'source some_path\necho $MARLIN_DLL' ], self )
-      assertEqualsImproved( len( handles ), 1, self )
-      chmod_mock.assert_called_once_with( 'temp.sh', 0755 )
-      shell_mock.assert_called_once_with( 0, './temp.sh' )
-      remove_mock.assert_called_once_with( 'temp.sh' )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
       exists_mock.assert_called_once_with( './lib/marlin_dll' )
       glob_mock.assert_called_once_with( './lib/marlin_dll/*.so' )
       assertDiracSucceedsWith( result, 'MARlin_DLL/path:mytestlibrary.so', self )
@@ -553,49 +497,39 @@ class MarlinAnalysisPrepareDLLCase( MarlinAnalysisFixture, unittest.TestCase ):
     exists_dict = { './lib/marlin_dll' : False }
     def replace_exists( path ):
       return exists_dict[path]
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
-         patch('%s.os.chmod' % MODULE_NAME) as chmod_mock, \
-         patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARlin_DLL/path: ', 'other_return_value_from_shell' ]))) as shell_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=[ True ])) as remove_mock, \
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARLIN_DLL=MARlin_DLL/path: \0OTHER=value\0', 'other_return_value_from_shell' ]))) as shell_mock, \
          patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=replace_exists)) as exists_mock, \
          patch('%s.glob.glob' % MODULE_NAME, new=Mock(return_value=[ 'mytestlibrary.so', 'secondLibrary.veryUseful.so' ])) as glob_mock:
-      open_mock.side_effect = (h for h in handles)
       result = self.marAna.prepareMARLIN_DLL( 'some_path' )
-      open_mock.assert_called_once_with( 'temp.sh', 'w' )
-      assertMockCalls( handles[0].__enter__().write,
-                       [ '#!/bin/bash\n', 'source some_path\necho $MARLIN_DLL' ], self )
-      assertEqualsImproved( len( handles ), 1, self )
-      chmod_mock.assert_called_once_with( 'temp.sh', 0755 )
-      shell_mock.assert_called_once_with( 0, './temp.sh' )
-      remove_mock.assert_called_once_with( 'temp.sh' )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
       exists_mock.assert_called_once_with( './lib/marlin_dll' )
       self.assertFalse( glob_mock.called )
       assertDiracSucceedsWith( result, 'MARlin_DLL/path', self )
 
+  def test_preparemarlindll_cached( self ):
+    self.marAna.workflow_commons = {}
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARLIN_DLL=MARlin_DLL/path\0', '' ]))) as shell_mock, \
+         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value=False)):
+      assertDiracSucceedsWith( self.marAna.prepareMARLIN_DLL( 'some_path' ), 'MARlin_DLL/path', self )
+      ## the next step of the job does not source the script again
+      nextStep = MarlinAnalysis()
+      nextStep.workflow_commons = self.marAna.workflow_commons
+      assertDiracSucceedsWith( nextStep.prepareMARLIN_DLL( 'some_path' ), 'MARlin_DLL/path', self )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
+      ## unless it uses another script
+      assertDiracSucceedsWith( nextStep.prepareMARLIN_DLL( 'other_path' ), 'MARlin_DLL/path', self )
+      self.assertEquals( shell_mock.call_count, 2 )
+
   def test_preparemarlindll_swaplibpositions( self ):
     self.marAna.ProcessorListToExclude = [ 'mytestlibrary.so' ]
     exists_dict = { './lib/marlin_dll' : True }
     def replace_exists( path ):
       return exists_dict[path]
-    file_contents = [[]]
-    handles = FileUtil.getMultipleReadHandles( file_contents )
-    with patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
-         patch('%s.os.chmod' % MODULE_NAME) as chmod_mock, \
-         patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARlin_DLL/path', 'other_return_value_from_shell' ]))) as shell_mock, \
-         patch('%s.os.remove' % MODULE_NAME, new=Mock(side_effect=[ True ])) as remove_mock, \
+    with patch('%s.systemCall' % ENV_MODULE_NAME, new=Mock(return_value=S_OK([ 0, 'MARLIN_DLL=MARlin_DLL/path\0OTHER=value\0', 'other_return_value_from_shell' ]))) as shell_mock, \
          patch('%s.os.path.exists' % MODULE_NAME, new=Mock(side_effect=replace_exists)) as exists_mock, \
          patch('%s.glob.glob' % MODULE_NAME, new=Mock(return_value=[ 'testlibLCFIPlus.so', 'testlibLCFIVertex.1.so'  ])) as glob_mock:
-      open_mock.side_effect = (h for h in handles)
       result = self.marAna.prepareMARLIN_DLL( 'some_path' )
-      open_mock.assert_called_once_with( 'temp.sh', 'w' )
-      assertMockCalls( handles[0].__enter__().write,
-                       [ '#!/bin/bash\n', 'source some_path\necho $MARLIN_DLL' ], self )
-      assertEqualsImproved( len( handles ), 1, self )
-      chmod_mock.assert_called_once_with( 'temp.sh', 0755 )
-      shell_mock.assert_called_once_with( 0, './temp.sh' )
-      remove_mock.assert_called_once_with( 'temp.sh' )
+      shell_mock.assert_called_once_with( 0, [ 'bash', '-c', 'source "$0" > /dev/null; status=$?; env -0; exit $status', 'some_path' ] )
       exists_mock.assert_called_once_with( './lib/marlin_dll' )
       glob_mock.assert_called_once_with( './lib/marlin_dll/*.so' )
       assertDiracSucceedsWith( result, 'MARlin_DLL/path:testlibLCFIVertex.1.so:testlibLCFIPlus.so', self )
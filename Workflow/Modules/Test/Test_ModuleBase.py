@@ -2,7 +2,11 @@
 """ Test the ModuleBase module """
 
 from StringIO import StringIO
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 from mock import patch, call, mock_open, MagicMock as Mock
 
@@ -378,7 +382,7 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
     adler_dict = { 'testfile_allworks.stdhep' : '9803531', 'myothertest_file' : 'checksum1230#' }
     with patch('%s.makeGuid' % MODULE_NAME, new=Mock(side_effect=lambda path: guid_dict[path])) as guid_mock, \
          patch('%s.os.path.getsize' % MODULE_NAME, new=Mock(side_effect=lambda path: size_dict[path])), \
-         patch('%s.fileAdler' % MODULE_NAME, new=Mock(side_effect=lambda path: adler_dict[path])), \
+         patch('%s.getFileChecksums' % MODULE_NAME, new=Mock(side_effect=lambda path: S_OK({'ADLER32': adler_dict[path]}))) as checksum_mock, \
          patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/cur/working/test/')):
       candidateFiles = { 'testfile_allworks.stdhep' : {
         'lfn': 'testfile_allworks.stdhep', 'path' : '/test/clic/ilc/mytestfile.txt',
@@ -407,6 +411,21 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
             'GUID': 'test_myGuid_2'} }
       assertDiracSucceedsWith_equals( result, expected_dict, self )
       assertMockCalls( guid_mock, [ 'testfile_allworks.stdhep', 'myothertest_file' ], self )
+      assertMockCalls( checksum_mock, [ 'testfile_allworks.stdhep', 'myothertest_file' ], self )
+
+  def test_getfilemetadata_checksum_fails( self ):
+    with patch('%s.makeGuid' % MODULE_NAME, new=Mock(return_value='test_myGuid_1')), \
+         patch('%s.os.path.getsize' % MODULE_NAME, new=Mock(return_value=24852)), \
+         patch('%s.getFileChecksums' % MODULE_NAME, new=Mock(return_value=S_ERROR('cannot read'))), \
+         patch('%s.os.getcwd' % MODULE_NAME, new=Mock(return_value='/cur/working/test/')):
+      candidateFiles = { 'testfile_allworks.stdhep' : {
+        'lfn': 'testfile_allworks.stdhep', 'path' : '/test/clic/ilc/mytestfile.txt',
+        'workflowSE': 'testSE_dip4_allgood' } }
+      result = self.moba.getFileMetadata( candidateFiles )
+      assertDiracSucceeds( result, self )
+      fileDict = result['Value']['testfile_allworks.stdhep']['filedict']
+      self.assertFalse( fileDict['Checksum'] )
+      self.assertFalse( fileDict['ADLER32'] )
 
   def test_resolveinputvars( self ):
     mb = self.moba
@@ -741,7 +760,7 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
       self.assertIsNone( self.moba.redirectLogOutput( 1, 'mytestmessage' ) )
       if print_mock.getvalue() not in [ 'mytestmessage\n', '' ]:
         self.fail( 'Suitable output not found' )
-      open_mock.assert_any_call( 'appLog.txt', 'a' )
+      open_mock.assert_any_call( 'appLog.txt', 'a', 1 )
       open_mock = open_mock()
       open_mock.write.assert_called_once_with( 'mytestmessage\n' )
       assertEqualsImproved( self.moba.stdError, 'mytestmessage', self )
@@ -756,7 +775,7 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
          patch('%s.open' % MODULE_NAME, mock_open()) as open_mock:
       self.assertIsNone( self.moba.redirectLogOutput( 0, 'mytestmessage' ) )
       assert print_mock.getvalue() == ''
-      open_mock.assert_any_call( 'appLog.txt', 'a' )
+      open_mock.assert_any_call( 'appLog.txt', 'a', 1 )
       self.assertFalse( open_mock().called )
 
   def test_redirectlogoutput_writetofile_3( self ):
@@ -769,7 +788,7 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
          patch('%s.open' % MODULE_NAME, mock_open()) as open_mock:
       self.assertIsNone( self.moba.redirectLogOutput( 0, 'mytestmessage' ) )
       assert print_mock.getvalue() == ''
-      open_mock.assert_any_call( 'appLog.txt', 'a' )
+      open_mock.assert_any_call( 'appLog.txt', 'a', 1 )
       open_mock = open_mock()
       self.assertFalse( open_mock.write.called )
 
@@ -784,11 +803,77 @@ class ModuleBaseTestCase( unittest.TestCase ): #pylint: disable=too-many-public-
       self.assertIsNone( self.moba.redirectLogOutput( 1, '1390specialTestEvente89f' ) )
       if print_mock.getvalue() not in [ '1390specialTestEvente89f\n', '' ]:
         self.fail( 'Suitable output not found' )
-      open_mock.assert_any_call( 'appLog.txt', 'a' )
+      open_mock.assert_any_call( 'appLog.txt', 'a', 1 )
       open_mock = open_mock()
       open_mock.write.assert_called_once_with( '1390specialTestEvente89f\n' )
       assertEqualsImproved( self.moba.stdError, '1390specialTestEvente89f', self )
 
+  def test_redirectlogoutput_keeps_file_open( self ):
+    self.moba.eventstring = None
+    self.moba.log = Mock()
+    self.moba.applicationLog = 'appLog.txt'
+    self.moba.excludeAllButEventString = False
+    with patch('sys.stdout', new_callable=StringIO), \
+         patch('%s.open' % MODULE_NAME, mock_open()) as open_mock:
+      for index in xrange( 3 ):
+        self.assertIsNone( self.moba.redirectLogOutput( 0, 'message %d' % index ) )
+      open_mock.assert_called_once_with( 'appLog.txt', 'a', 1 )
+      logfile_mock = open_mock.return_value
+      assertMockCalls( logfile_mock.write, [ 'message 0\n', 'message 1\n', 'message 2\n' ], self )
+      self.assertFalse( logfile_mock.close.called )
+      ## a new run of the application starts with a new file
+      self.moba.stdError = ''
+      logfile_mock.close.assert_called_once_with()
+      self.assertIsNone( self.moba.redirectLogOutput( 0, 'message 3' ) )
+      self.assertEquals( open_mock.call_count, 2 )
+
+  def test_execute_closes_applicationlog( self ):
+    self.moba.eventstring = None
+    self.moba.applicationLog = 'appLog.txt'
+    def runIt():
+      """ run an application printing one line """
+      self.moba.redirectLogOutput( 0, 'message' )
+      return S_OK()
+    with patch('sys.stdout', new_callable=StringIO), \
+         patch('%s.open' % MODULE_NAME, mock_open()) as open_mock, \
+         patch('%s.ModuleBase.runIt' % MODULE_NAME, new=Mock(side_effect=runIt)):
+      assertDiracSucceeds( self.moba.execute(), self )
+      open_mock.return_value.close.assert_called_once_with()
+
+  def test_applicationlog_threads( self ):
+    from ILCDIRAC.Workflow.Modules.ModuleBase import ApplicationLog
+    tmpdir = tempfile.mkdtemp()
+    try:
+      appLog = ApplicationLog( os.path.join( tmpdir, 'appLog.txt' ) )
+      def writeLines( thread ):
+        """ write many lines from one thread """
+        for index in xrange( 500 ):
+          appLog.write( '%d %d' % ( thread, index ) )
+      threads = [ threading.Thread( target = writeLines, args = ( thread, ) ) for thread in xrange( 4 ) ]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      appLog.close()
+      with open( appLog.fileName ) as logFile:
+        lines = logFile.read().splitlines()
+      assertEqualsImproved( sorted( lines ), sorted( '%d %d' % ( thread, index ) for thread in xrange( 4 )
+                                                     for index in xrange( 500 ) ), self )
+    finally:
+      shutil.rmtree( tmpdir )
+
+  def test_redirectlogoutput_stderror_bounded( self ):
+    from ILCDIRAC.Workflow.Modules.ModuleBase import STDERR_MAX_LINES
+    self.moba.eventstring = ''
+    self.moba.log = Mock()
+    self.moba.applicationLog = ''
+    for index in xrange( STDERR_MAX_LINES + 10 ):
+      self.moba.redirectLogOutput( 1, '%d;' % index )
+    self.assertTrue( self.moba.stdError.startswith( '10;' ) )
+    self.assertTrue( self.moba.stdError.endswith( '%d;' % ( STDERR_MAX_LINES + 9 ) ) )
+    self.moba.stdError = ''
+    assertEqualsImproved( self.moba.stdError, '', self )
+
   def test_cleanup( self ):
     file_mock = Mock()
     with patch('%s.File' % MODULE_NAME, new=Mock(return_value=file_mock)):
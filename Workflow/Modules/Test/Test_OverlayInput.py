@@ -11,7 +11,7 @@ from DIRAC import gLogger, S_OK, S_ERROR
 from ILCDIRAC.Workflow.Modules.OverlayInput import OverlayInput
 from ILCDIRAC.Tests.Utilities.GeneralUtils import assertEqualsImproved, \
   assertDiracFailsWith, assertDiracSucceeds, assertDiracSucceedsWith, \
-  assertDiracSucceedsWith_equals
+  assertDiracSucceedsWith_equals, assertMockCalls
 from ILCDIRAC.Tests.Utilities.FileUtils import FileUtil
 
 __RCSID__ = "$Id$"
@@ -387,11 +387,252 @@ class TestOverlayExecute( unittest.TestCase ):
          patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
          patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
          patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=S_OK('Nothing'))), \
-         patch('%s.wasteCPUCycles' % MODULE_NAME):
+         patch('%s.Backoff' % MODULE_NAME):
       result = self.over.execute()
       assertDiracSucceedsWith_equals( result, 'OverlayInput finished successfully', self )
       assertEqualsImproved( self.over.applicationLog, os.getcwd() + '/Overlay_input.log', self )
 
+  def test_execute_with_lease( self ):
+    rpc_mock = Mock()
+    rpc_mock.enqueue.return_value = S_ERROR('Unknown method')
+    rpc_mock.acquireLease.return_value = S_OK(True)
+    rpc_mock.releaseLease.return_value = S_OK(True)
+    self.over.jobID = '1234'
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(return_value=2)), \
+         patch('%s.FileCatalogClient.findFilesByMetadata' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt']))), \
+         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)), \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=S_OK('Nothing'))), \
+         patch('%s.Backoff' % MODULE_NAME):
+      assertDiracSucceedsWith_equals( self.over.execute(), 'OverlayInput finished successfully', self )
+      rpc_mock.acquireLease.assert_called_once_with( 'SomeSite', 1234 )
+      rpc_mock.releaseLease.assert_called_once_with( 1234 )
+      self.assertFalse( rpc_mock.canRun.called )
+      self.assertFalse( rpc_mock.jobDone.called )
+
+  def test_execute_queue( self ):
+    rpc_mock = Mock()
+    rpc_mock.enqueue.side_effect = [ S_OK( { 'Ticket' : 17, 'Granted' : False, 'Position' : 3, 'EstimatedWait' : 100 } ),
+                                     S_OK( { 'Ticket' : 18, 'Granted' : False, 'Position' : 0, 'EstimatedWait' : 10 } ) ]
+    rpc_mock.pollTicket.side_effect = [ S_OK( { 'Ticket' : 17, 'Granted' : False, 'Position' : 1, 'EstimatedWait' : 50 } ),
+                                        S_ERROR( 'Unknown ticket 17' ),
+                                        S_OK( { 'Ticket' : 18, 'Granted' : True, 'Position' : 0, 'EstimatedWait' : 0 } ) ]
+    rpc_mock.releaseLease.return_value = S_OK(True)
+    self.over.jobID = '1234'
+    options = { '/Overlay/MaxNbFilesToGet' : 2 }
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(side_effect=lambda opt, default : options.get( opt, default ))), \
+         patch('%s.FileCatalogClient.findFilesByMetadata' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt']))), \
+         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)), \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.allowedBkg' % MODULE_NAME, new=Mock(return_value=S_OK(2))), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=S_OK('Nothing'))), \
+         patch('%s.time.sleep' % MODULE_NAME) as sleep_mock:
+      assertDiracSucceedsWith_equals( self.over.execute(), 'OverlayInput finished successfully', self )
+      assertEqualsImproved( rpc_mock.enqueue.call_count, 2, self )
+      assertEqualsImproved( rpc_mock.pollTicket.call_args_list, [ call( 17 ), call( 17 ), call( 18 ) ], self )
+      rpc_mock.releaseLease.assert_called_once_with( 1234 )
+      self.assertFalse( rpc_mock.acquireLease.called )
+      for args, _kwargs in sleep_mock.call_args_list:
+        self.assertTrue( 7.5 <= args[0] <= 900 * 1.2 ) # jitter of 20% on top of MaxWaitBetweenFiles
+
+  def test_execute_queue_toolong( self ):
+    rpc_mock = Mock()
+    rpc_mock.enqueue.return_value = S_OK( { 'Ticket' : 17, 'Granted' : False, 'Position' : 3, 'EstimatedWait' : 100 } )
+    rpc_mock.pollTicket.return_value = S_OK( { 'Ticket' : 17, 'Granted' : False, 'Position' : 3, 'EstimatedWait' : 100 } )
+    self.over.jobID = '1234'
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(return_value=2)), \
+         patch('%s.OverlayInput._OverlayInput__getFilesFromPath' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt']))), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.time.time' % MODULE_NAME, new=Mock(side_effect=[0, 1, 100000])), \
+         patch('%s.time.sleep' % MODULE_NAME):
+      assertDiracFailsWith( self.over.execute(), 'failed to get files locally', self )
+      self.assertFalse( rpc_mock.releaseLease.called )
+
+  def test_execute_parallel( self ):
+    rpc_mock = Mock()
+    rpc_mock.canRun.return_value = S_OK(True)
+    options = { '/Overlay/MaxNbFilesToGet' : 2, '/Overlay/ParallelDownloads' : 3 }
+    getfile_mock = Mock(side_effect=lambda lfn : S_ERROR('no replica') if lfn == 'file2.ppt' else S_OK('Nothing'))
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(side_effect=lambda opt, default : options.get( opt, default ))), \
+         patch('%s.OverlayInput._OverlayInput__getFilesFromPath' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt', 'file3.slcio']))), \
+         patch('%s.allowedBkg' % MODULE_NAME, new=Mock(return_value=S_OK(2))), \
+         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)), \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=getfile_mock), \
+         patch('%s.Backoff' % MODULE_NAME) as backoff_mock:
+      assertDiracSucceedsWith_equals( self.over.execute(), 'OverlayInput finished successfully', self )
+      self.assertIn( getfile_mock.call_count, [ 2, 3 ] )
+      self.assertFalse( backoff_mock.return_value.wait.called )
+      rpc_mock.jobDone.assert_called_once_with( 'SomeSite' )
+
+  def test_execute_parallel_fails( self ):
+    rpc_mock = Mock()
+    rpc_mock.canRun.return_value = S_OK(True)
+    options = { '/Overlay/MaxNbFilesToGet' : 2, '/Overlay/ParallelDownloads' : 3 }
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(side_effect=lambda opt, default : options.get( opt, default ))), \
+         patch('%s.OverlayInput._OverlayInput__getFilesFromPath' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt', 'file3.slcio']))), \
+         patch('%s.allowedBkg' % MODULE_NAME, new=Mock(return_value=S_OK(2))), \
+         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)), \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=S_ERROR('no replica'))) as getfile_mock:
+      assertDiracFailsWith( self.over.execute(), 'failed to get files locally', self )
+      assertEqualsImproved( getfile_mock.call_count, 3, self )
+      rpc_mock.jobDone.assert_called_once_with( 'SomeSite' )
+
+  def test_getfiles_parallel_log( self ):
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir( tmpdir )
+    self.over.site = 'LCG.KEK.jp'
+    self.over.curdir = tmpdir
+    self.over.lfns = [ '/ilc/prod/gghad_%d.slcio' % index for index in xrange( 8 ) ]
+    self.over.applicationLog = os.path.join( tmpdir, 'Overlay_input.log' )
+    self.over.eventstring = ''
+    def copyFile( _timeout, comm, callbackFunction, **_kwargs ):
+      """ run the copy script: print many lines and create the file """
+      scriptName = comm.split( './' )[1].rstrip( '"' )
+      for index in xrange( 100 ):
+        callbackFunction( 0, '%s %d' % ( scriptName, index ) )
+      open( scriptName[ len( 'overlayinput_' ) : -len( '.sh' ) ], 'w' ).close()
+      return S_OK( ( 0, '', '' ) )
+    try:
+      with patch('%s.shellCall' % MODULE_NAME, new=Mock(side_effect=copyFile)), \
+           patch('%s.DataManager' % MODULE_NAME):
+        result = self.over._OverlayInput__getFilesParallel( 8, 0, 4, Mock() )
+      self.over.closeApplicationLog()
+      assertEqualsImproved( sorted( result['Value'] ), sorted( self.over.lfns ), self )
+      with open( self.over.applicationLog ) as logFile:
+        lines = logFile.read().splitlines()
+      assertEqualsImproved( sorted( lines ), sorted( 'overlayinput_gghad_%d.slcio.sh %d' % ( fileIndex, index )
+                                                     for fileIndex in xrange( 8 ) for index in xrange( 100 ) ), self )
+      assertEqualsImproved( self.over.result, S_OK( ( 0, '', '' ) ), self )
+    finally:
+      os.chdir( curdir )
+      cleanup( tmpdir )
+
+  def test_execute_with_cache( self ):
+    rpc_mock = Mock()
+    rpc_mock.canRun.return_value = S_OK(True)
+    cache_mock = Mock()
+    cache_mock.getFile.side_effect = lambda lfn, _checksum, _dest : S_OK() if lfn == 'file1.txt' else S_ERROR('File not in cache')
+    cache_mock.addFile.return_value = S_OK()
+    options = { '/Overlay/MaxNbFilesToGet' : 2, '/Overlay/NodeCache/Directory' : '/scratch/overlaycache' }
+    metadata = S_OK( { 'Successful' : { 'file1.txt' : { 'Checksum' : 'abc', 'Size' : 10, 'ChecksumType' : 'AD' },
+                                        'file2.ppt' : { 'Checksum' : 'def', 'Size' : 20, 'ChecksumType' : 'AD' } },
+                       'Failed' : {} } )
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(side_effect=lambda opt, default : options.get( opt, default ))), \
+         patch('%s.OverlayInput._OverlayInput__getFilesFromPath' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt']))), \
+         patch('%s.allowedBkg' % MODULE_NAME, new=Mock(return_value=S_OK(2))), \
+         patch('%s.FileCatalogClient.getFileMetadata' % MODULE_NAME, new=Mock(return_value=metadata)) as metadata_mock, \
+         patch('%s.OverlayCache' % MODULE_NAME, new=Mock(return_value=cache_mock)) as cache_class_mock, \
+         patch('%s.checkFile' % MODULE_NAME, new=Mock(return_value=S_OK())) as check_mock, \
+         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)) as remove_mock, \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=S_OK('Nothing'))) as getfile_mock, \
+         patch('%s.Backoff' % MODULE_NAME):
+      assertDiracSucceedsWith_equals( self.over.execute(), 'OverlayInput finished successfully', self )
+      cache_class_mock.assert_called_once_with( '/scratch/overlaycache', 20 * 1024**3 )
+      metadata_mock.assert_called_once_with( [ 'file1.txt', 'file2.ppt' ] )
+      getfile_mock.assert_called_once_with( 'file2.ppt' )
+      check_mock.assert_called_once_with( 'file2.ppt', 'def', 20, 'AD' )
+      cache_mock.addFile.assert_called_once_with( 'file2.ppt', 'def', 'file2.ppt', size = 20, checksumType = 'AD' )
+      self.assertNotIn( call( 'file2.ppt' ), remove_mock.call_args_list )
+
+  def test_execute_with_cache_corrupt_download( self ):
+    rpc_mock = Mock()
+    rpc_mock.canRun.return_value = S_OK(True)
+    cache_mock = Mock()
+    cache_mock.getFile.return_value = S_ERROR('File not in cache')
+    cache_mock.addFile.return_value = S_OK()
+    options = { '/Overlay/MaxNbFilesToGet' : 1, '/Overlay/NodeCache/Directory' : '/scratch/overlaycache' }
+    metadata = S_OK( { 'Successful' : { 'file1.txt' : { 'Checksum' : 'abc', 'Size' : 10 },
+                                        'file2.ppt' : { 'Checksum' : 'def', 'Size' : 20 } },
+                       'Failed' : {} } )
+    check = lambda localFile, _checksum, _size, _type : S_ERROR( 'Checksum of %s is 123' % localFile ) \
+            if localFile == 'file2.ppt' else S_OK()
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(side_effect=lambda opt, default : options.get( opt, default ))), \
+         patch('%s.OverlayInput._OverlayInput__getFilesFromPath' % MODULE_NAME, new=Mock(return_value=S_OK(['file1.txt', 'file2.ppt']))), \
+         patch('%s.allowedBkg' % MODULE_NAME, new=Mock(return_value=S_OK(2))), \
+         patch('%s.FileCatalogClient.getFileMetadata' % MODULE_NAME, new=Mock(return_value=metadata)), \
+         patch('%s.OverlayCache' % MODULE_NAME, new=Mock(return_value=cache_mock)), \
+         patch('%s.checkFile' % MODULE_NAME, new=Mock(side_effect=check)), \
+         patch('%s.random.randrange' % MODULE_NAME, new=Mock(side_effect=[ 1, 0 ])), \
+         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)) as remove_mock, \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=S_OK('Nothing'))) as getfile_mock, \
+         patch('%s.Backoff' % MODULE_NAME):
+      assertDiracSucceedsWith_equals( self.over.execute(), 'OverlayInput finished successfully', self )
+      assertMockCalls( getfile_mock, [ 'file2.ppt', 'file1.txt' ], self )
+      remove_mock.assert_any_call( 'file2.ppt' )
+      cache_mock.addFile.assert_called_once_with( 'file1.txt', 'abc', 'file1.txt', size = 10, checksumType = 'AD' )
+
+  def execute_with_sample( self, getfile_return ):
+    """ Run execute with a sample of three files out of the 20000 counted by the Overlay service
+
+    :returns: the result of execute and the mock of DataManager.getFile
+    """
+    sample = [ 'file1.slcio', 'file2.slcio', 'file3.slcio' ]
+    def getFilesFromPath():
+      """ the service counts more files than it returns """
+      self.over.nbAvailableFiles = 20000
+      return S_OK( list( sample ) )
+    rpc_mock = Mock()
+    rpc_mock.canRun.return_value = S_OK(True)
+    ## 15 events are needed, the sample only has 12
+    self.over.nbofeventsperfile = 4
+    options = { '/Overlay/MaxNbFilesToGet' : 2 }
+    with patch('%s.Operations.getValue' % MODULE_NAME, new=Mock(side_effect=lambda opt, default : options.get( opt, default ))), \
+         patch('%s.OverlayInput._OverlayInput__getFilesFromPath' % MODULE_NAME, new=Mock(side_effect=getFilesFromPath)), \
+         patch('%s.allowedBkg' % MODULE_NAME, new=Mock(return_value=S_OK(2))), \
+         patch('%s.os.path.exists' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.remove' % MODULE_NAME, new=Mock(return_value=True)), \
+         patch('%s.open' % MODULE_NAME, mock_open(), create=True), \
+         patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)), \
+         patch('%s.os.mkdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.os.chdir' % MODULE_NAME, new=Mock(return_value = True)), \
+         patch('%s.DataManager.getFile' % MODULE_NAME, new=Mock(return_value=getfile_return)) as getfile_mock, \
+         patch('%s.Backoff' % MODULE_NAME):
+      result = self.over.execute()
+    for args, _kwargs in getfile_mock.call_args_list:
+      self.assertIn( args[0], sample )
+    return result, getfile_mock
+
+  def test_execute_sample_of_larger_list( self ):
+    result, getfile_mock = self.execute_with_sample( S_OK('Nothing') )
+    assertDiracSucceedsWith_equals( result, 'OverlayInput finished successfully', self )
+    assertEqualsImproved( getfile_mock.call_count, 2, self )
+    assertEqualsImproved( self.over.nbAvailableFiles, 20000, self )
+
+  def test_execute_sample_of_larger_list_all_fail( self ):
+    result, getfile_mock = self.execute_with_sample( S_ERROR('no such file') )
+    assertDiracFailsWith( result, 'failed to get files locally', self )
+    ## each file of the sample is tried once, then the job gives up
+    assertEqualsImproved( sorted( args[0] for args, _kwargs in getfile_mock.call_args_list ),
+                          [ 'file1.slcio', 'file2.slcio', 'file3.slcio' ], self )
+
   def test_execute_resolve_fails( self ):
     result = self.over.execute()
     assertDiracFailsWith( result, 'no background to overlay', self )
@@ -437,7 +678,10 @@ class TestOverlayExecute( unittest.TestCase ):
     fcc_mock = Mock()
     fcc_mock.findFilesByMetadata.return_value = S_OK( 9824 )
     self.over.fcc = fcc_mock
-    result = self.over._OverlayInput__getFilesFromFC()
+    rpc_mock = Mock()
+    rpc_mock.getBackgroundFiles.return_value = S_ERROR( 'Unknown method' )
+    with patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)):
+      result = self.over._OverlayInput__getFilesFromFC()
     assertDiracSucceedsWith_equals( result, 9824, self )
     fcc_mock.findFilesByMetadata.assert_called_once_with(
       { 'Energy' : '123', 'EvtType' : 'someTestEventType', 'ProdID' : 98421, 'Datatype' : 'SIM',
@@ -460,7 +704,10 @@ class TestOverlayExecute( unittest.TestCase ):
     fcc_mock = Mock()
     fcc_mock.findFilesByMetadata.return_value = S_OK( 2948 )
     self.over.fcc = fcc_mock
-    result = self.over._OverlayInput__getFilesFromFC()
+    rpc_mock = Mock()
+    rpc_mock.getBackgroundFiles.return_value = S_ERROR( 'Unknown method' )
+    with patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)):
+      result = self.over._OverlayInput__getFilesFromFC()
     assertDiracSucceedsWith_equals( result, 2948, self )
     fcc_mock.findFilesByMetadata.assert_called_once_with(
       { 'EvtType' : 'ilc_evt_testme', 'ProdID' : 82492, 'Datatype' : 'SIM', 'Machine' : 'ilc' } )
@@ -472,16 +719,46 @@ class TestOverlayExecute( unittest.TestCase ):
     fcc_mock = Mock()
     fcc_mock.findFilesByMetadata.return_value = S_OK( '1245' )
     self.over.fcc = fcc_mock
+    rpc_mock = Mock()
+    rpc_mock.getBackgroundFiles.return_value = S_ERROR( 'Unknown method' )
     self.over.energy = 9842
     self.over.useEnergyForFileLookup = True
     self.over.detectormodel = 'myTestDetectorv021'
     self.over.machine = 'clic_cdr'
     self.over.detector = 'overlaydetector'
-    assertDiracSucceeds( self.over._OverlayInput__getFilesFromFC(), self )
+    with patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)):
+      assertDiracSucceeds( self.over._OverlayInput__getFilesFromFC(), self )
     fcc_mock.findFilesByMetadata.assert_called_once_with(
       { 'Energy' : '9842', 'EvtType' : None, 'Datatype' : 'SIM', 'DetectorModel' : 'myTestDetectorv021',
         'Machine' : 'clic', 'ProdID' : '1245' } )
 
+  def test_getfilesfromFC_service( self ):
+    ops_mock = Mock()
+    ops_mock.getValue.side_effect = [ '1245', 2849, 'gghad' ]
+    self.over.ops = ops_mock
+    fcc_mock = Mock()
+    self.over.fcc = fcc_mock
+    self.over.energy = 9842
+    self.over.useEnergyForFileLookup = True
+    self.over.detectormodel = 'myTestDetectorv021'
+    self.over.machine = 'clic_cdr'
+    rpc_mock = Mock()
+    rpc_mock.getBackgroundFiles.return_value = S_OK( { 'Version' : 1500000000, 'NbFiles' : 20000, 'LFNs' : [ 'file1.slcio', 'file2.slcio' ] } )
+    with patch('%s.RPCClient' % MODULE_NAME, new=Mock(return_value=rpc_mock)):
+      assertDiracSucceedsWith_equals( self.over._OverlayInput__getFilesFromFC(), [ 'file1.slcio', 'file2.slcio' ], self )
+    rpc_mock.getBackgroundFiles.assert_called_once_with(
+      { 'Energy' : '9842', 'EvtType' : 'gghad', 'Datatype' : 'SIM', 'DetectorModel' : 'myTestDetectorv021',
+        'Machine' : 'clic', 'ProdID' : '1245' } )
+    assertEqualsImproved( self.over.nbAvailableFiles, 20000, self )
+    self.assertFalse( fcc_mock.findFilesByMetadata.called )
+
+  def test_getfileslocally_not_enough_events( self ):
+    self.over.BXOverlay = 60
+    self.over.ggtohadint = 10
+    self.over.nbofeventsperfile = 100
+    self.over.lfns = [ 'file1.slcio', 'file2.slcio' ]
+    assertDiracFailsWith( self.over._OverlayInput__getFilesLocaly(), 'events available is less than requested', self )
+
   def test_getfilesfromlyon( self ):
     import subprocess
     popen_mock = Mock()
@@ -335,8 +335,10 @@ class TestSLICPandora( unittest.TestCase ):
         chmod_mock.assert_called_once_with( 'SLICPandora.sh', 0755 )
       getsoft_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
       removelib_mock.assert_called_once_with( '/my/dir/test/me/LDLibs' )
-      getlib_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
-      getpath_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
+      getlib_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2',
+                                            cache = self.spa._getEnvironmentCache() )
+      getpath_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2',
+                                            cache = self.spa._getEnvironmentCache() )
       open_mock.assert_any_call( 'SLICPandora.sh', 'w' )
       open_mock = open_mock()
       assertMockCalls( open_mock.write, [
@@ -376,8 +378,10 @@ class TestSLICPandora( unittest.TestCase ):
       assertDiracSucceedsWith_equals( result, '/abs/test/path/SLICPandora.sh', self )
       getsoft_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
       removelib_mock.assert_called_once_with( '/my/dir/test/me/LDLibs' )
-      getlib_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
-      getpath_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
+      getlib_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2',
+                                            cache = self.spa._getEnvironmentCache() )
+      getpath_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2',
+                                            cache = self.spa._getEnvironmentCache() )
       open_mock.assert_any_call( 'SLICPandora.sh', 'w' )
       open_mock = open_mock()
       assertMockCalls( open_mock.write, [
@@ -401,8 +405,10 @@ class TestSLICPandora( unittest.TestCase ):
       assertDiracFailsWith( result, 'missing pandorafrontend binary', self )
       getsoft_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
       removelib_mock.assert_called_once_with( '/my/dir/test/me/LDLibs' )
-      getlib_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
-      getpath_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2' )
+      getlib_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2',
+                                            cache = self.spa._getEnvironmentCache() )
+      getpath_mock.assert_called_once_with( 'mytestsysconfig', 'SLIC Pandora', 'V2',
+                                            cache = self.spa._getEnvironmentCache() )
       self.assertFalse( open_mock.called )
       self.assertFalse( chmod_mock.called )
       assertMockCalls( exists_mock, [ 'PandoraFrontend', '/my/dir/test/me/Executable/PandoraFrontend' ], self )
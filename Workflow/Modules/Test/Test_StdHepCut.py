@@ -90,7 +90,7 @@ class StdHepCutTestCase( unittest.TestCase ):
       mo.side_effect = ( h for h in handles )
       self.shc.prepareScript( 'test_software/dir' )
       remove_mock.assert_called_once_with( 'TestApp_vT_Run_148.sh' )
-      getldlibs_mock.assert_called_once_with( 'testPlatformV1', 'TestApp', 'vT' )
+      getldlibs_mock.assert_called_once_with( 'testPlatformV1', 'TestApp', 'vT', cache = self.shc._getEnvironmentCache() )
       assertMockCalls( exists_mock, [ './lib', 'TestApp_vT_Run_148.sh' ], self )
       mo.assert_called_once_with( 'TestApp_vT_Run_148.sh', 'w' )
       assertEqualsImproved( len( handles ), 1, self )
@@ -117,7 +117,7 @@ class StdHepCutTestCase( unittest.TestCase ):
       mo.side_effect = ( h for h in handles )
       self.shc.prepareScript( 'test_software/dir' )
       self.assertFalse( remove_mock.called )
-      getldlibs_mock.assert_called_once_with( 'testPlatformV1', 'TestApp', 'vT' )
+      getldlibs_mock.assert_called_once_with( 'testPlatformV1', 'TestApp', 'vT', cache = self.shc._getEnvironmentCache() )
       assertMockCalls( exists_mock, [ './lib', 'TestApp_vT_Run_148.sh' ], self )
       mo.assert_called_once_with( 'TestApp_vT_Run_148.sh', 'w' )
       assertEqualsImproved( len( handles ), 1, self )
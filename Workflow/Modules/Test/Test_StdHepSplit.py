@@ -139,7 +139,7 @@ exit $?
          patch('%s.os.chmod' % MODULE_NAME, new=Mock()) as chmod_mock, \
          patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK( ( 0, ) ))) as shell_mock:
       assertDiracFailsWith( self.shs.execute(), 'failed reading the log file', self )
-      getlibs_mock.assert_called_once_with( 'TestPlatV1', 'stdhepsplit', 12 )
+      getlibs_mock.assert_called_once_with( 'TestPlatV1', 'stdhepsplit', 12, cache = self.shs._getEnvironmentCache() )
       file_mock.assert_called_once_with( 'StdHepSplit_12_Run_4.tcl', 'w' )
       open_mock.close.assert_called_once_with()
       open_mock.write.assert_called_once_with( expected_script )
@@ -183,7 +183,7 @@ exit $?
          patch('%s.os.chmod' % MODULE_NAME, new=Mock()) as chmod_mock, \
          patch('%s.shellCall' % MODULE_NAME, new=Mock(return_value=S_OK( ( 0, ) ))) as shell_mock:
       assertDiracFailsWith( self.shs.execute(), 'failed reading the log file', self )
-      getlibs_mock.assert_called_once_with( 'TestPlatV1', 'stdhepsplit', 'V3' )
+      getlibs_mock.assert_called_once_with( 'TestPlatV1', 'stdhepsplit', 'V3', cache = self.shs._getEnvironmentCache() )
       file_mock.assert_called_once_with( 'StdHepSplit_V3_Run_4.tcl', 'w' )
       open_mock.close.assert_called_once_with()
       open_mock.write.assert_called_once_with( expected_script )
@@ -284,7 +284,7 @@ class WhizardAnalysisTestCase( unittest.TestCase ):
          patch('%s.WhizardAnalysis.setApplicationStatus' % MODULE_NAME) as setappstatus_mock:
       assertDiracFailsWith( self.wha.runIt(), 'something_fails_test', self )
       setappstatus_mock.assert_called_once_with('Failed finding software')
-      getlibs_mock.assert_called_once_with( 'myTestPlatform', 'whizard', '' )
+      getlibs_mock.assert_called_once_with( 'myTestPlatform', 'whizard', '', cache = self.wha._getEnvironmentCache() )
       resolvdep_mock.assert_called_once_with( 'myTestPlatform', 'whizard', '' )
       removlib_mock.assert_called_once_with( 'my/test/soft/dir/lib' )
       assertMockCalls( getsoft_mock, [ ( 'myTestPlatform', 'whizard', '' ),
@@ -14,9 +14,13 @@ __RCSID__ = "$Id$"
 from DIRAC.Core.DISET.RPCClient                                     import RPCClient
 from DIRAC.Resources.Storage.StorageElement                         import StorageElement
 from DIRAC.Core.Utilities.Os                                        import getDiskSpace
+from DIRAC.ConfigurationSystem.Client.Helpers.Operations            import Operations
 from DIRAC                                                          import S_OK, S_ERROR, gLogger
 
-import os, tempfile, random
+from ILCDIRAC.Core.Utilities.resolvePathsAndNames                   import DOWNLOADING_SUFFIX, DOWNLOAD_FAILED_SUFFIX
+
+from multiprocessing.pool import ThreadPool
+import atexit, os, shutil, tempfile, random, threading, time
 
 COMPONENT_NAME = 'DownloadInputData'
 
@@ -42,6 +46,15 @@ class DownloadInputData:
     self.inputDataDirectory = argumentsDict.get( 'InputDataDirectory', 'PerFile' )
     self.jobID = None
     self.counter = 1
+    self.counterLock = threading.Lock()
+    # Status of the StorageElements, obtained once per execution
+    self.seStatus = {}
+    # Number of files downloaded at the same time
+    self.nbWorkers = Operations().getValue( '/%s/Workers' % COMPONENT_NAME, 1 )
+    # Only download the first file before the job starts, the others are downloaded while it runs
+    self.backgroundDownloads = Operations().getValue( '/%s/BackgroundDownloads' % COMPONENT_NAME, False )
+    # ThreadPool of the background downloads, joined at the end of the job
+    self.backgroundPool = None
 
 
   #############################################################################
@@ -74,7 +87,7 @@ class DownloadInputData:
     diskSEs = set()
     tapeSEs = set()
     for localSE in [se for se in localSEList if se]:
-      seStatus = StorageElement( localSE ).getStatus()['Value']
+      seStatus = self.__getSEStatus( localSE )
       if seStatus['Read'] and seStatus['DiskSE']:
         diskSEs.add( localSE )
       elif seStatus['Read'] and seStatus['TapeSE']:
@@ -144,64 +157,35 @@ class DownloadInputData:
 
     resolvedData = {}
     localSECount = 0
-    for lfn in downloadReplicas:
-      seName = downloadReplicas[lfn]['SE']
-      guid = downloadReplicas[lfn]['GUID']
-      reps = replicas.get( lfn, {} )
-      if seName:
-        result = StorageElement( seName ).getFileMetadata( lfn )
-        if not result['OK']:
-          self.log.error( "Error getting metadata", result['Message'] )
-          failedReplicas.add( lfn )
-          continue
-        if lfn in result['Value']['Failed']:
-          self.log.error( 'Could not get Storage Metadata for %s at %s: %s' % ( lfn, seName, result['Value']['Failed'][lfn] ) )
-          failedReplicas.add( lfn )
-          continue
-        metadata = result['Value']['Successful'][lfn]
-        if metadata['Lost']:
-          error = "PFN has been Lost by the StorageElement"
-        elif metadata['Unavailable']:
-          error = "PFN is declared Unavailable by the StorageElement"
-        elif seName in tapeSEs and not metadata['Cached']:
-          error = "PFN is no longer in StorageElement Cache"
-        else:
-          error = ''
-        if error:
-          self.log.error( error, lfn )
-          failedReplicas.add( lfn )
-          continue
-
-        self.log.info( 'Preliminary checks OK, download %s from %s:' % ( lfn, seName ) )
-        result = self._downloadFromSE( lfn, seName, reps, guid )
-        if not result['OK']:
-          self.log.error( "Download failed", "Tried downloading from SE %s: %s" % ( seName, result['Message'] ) )
-      else:
-        result = {'OK':False}
+    downloadTimes = {}
+    downloadArgs = [ ( lfn, replicas.get( lfn, {} ), downloadReplicas[lfn], tapeSEs ) for lfn in sorted( downloadReplicas ) ]
+    if self.backgroundDownloads and len( downloadArgs ) > 1:
+      resolvedData.update( self.__startBackgroundDownloads( downloadArgs[1:] ) )
+      downloadArgs = downloadArgs[:1]
+
+    if self.nbWorkers > 1 and len( downloadArgs ) > 1:
+      self.log.info( 'Downloading %d files with %d workers' % ( len( downloadArgs ), self.nbWorkers ) )
+      pool = ThreadPool( min( self.nbWorkers, len( downloadArgs ) ) )
+      try:
+        results = pool.map( self.__downloadFileArgs, downloadArgs )
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [ self.__downloadFile( *args ) for args in downloadArgs ]
 
+    for ( lfn, _reps, _downloadReplica, _tapeSEs ), ( result, fromLocalSE, downloadTime ) in zip( downloadArgs, results ):
+      downloadTimes[lfn] = downloadTime
       if not result['OK']:
-        reps.pop( seName, None )
-        # Check the other SEs
-        if reps:
-          self.log.info( 'Trying to download from any SE' )
-          result = self._downloadFromBestSE( lfn, reps, guid )
-          if not result['OK']:
-            self.log.error( "Download from best SE failed", "Tried downloading %s: %s" % ( lfn, result['Message'] ) )
-            failedReplicas.add( lfn )
-        else:
-          failedReplicas.add( lfn )
-      else:
+        failedReplicas.add( lfn )
+        continue
+      if fromLocalSE:
         localSECount += 1
-      if result['OK']:
-        # Rename file if downloaded FileName does not match the LFN... How can this happen?
-        lfnName = os.path.basename( lfn )
-        oldPath = result['Value']['path']
-        fileName = os.path.basename( oldPath )
-        if lfnName != fileName:
-          newPath = os.path.join( os.path.dirname( oldPath ), lfnName )
-          os.rename( oldPath, newPath )
-          result['Value']['path'] = newPath
-        resolvedData[lfn] = result['Value']
+      resolvedData[lfn] = result['Value']
+
+    if downloadTimes:
+      self.__setJobParam( '%sTimes' % COMPONENT_NAME,
+                          '\n'.join( '%s %.1fs' % ( lfn, downloadTimes[lfn] ) for lfn in sorted( downloadTimes ) ) )
 
     # Report datasets that could not be downloaded
     report = ''
@@ -217,6 +201,144 @@ class DownloadInputData:
     failedReplicas = [lfn for lfn in sorted( failedReplicas ) if lfn not in resolvedData]
     return S_OK( {'Successful': resolvedData, 'Failed':failedReplicas} )
 
+  #############################################################################
+  def __downloadFileArgs( self, args ):
+    """ Call __downloadFile with the tuple of arguments, for the ThreadPool """
+    return self.__downloadFile( *args )
+
+  def __downloadFile( self, lfn, reps, downloadReplica, tapeSEs, downloadDir = None ):
+    """ Download one file, from the selected local SE first, then from any SE
+
+    :returns: tuple of the result, if the file came from the local SE, and the time spent
+    """
+    startTime = time.time()
+    seName = downloadReplica['SE']
+    guid = downloadReplica['GUID']
+    if seName:
+      result = StorageElement( seName ).getFileMetadata( lfn )
+      if not result['OK']:
+        self.log.error( "Error getting metadata", result['Message'] )
+        return result, False, time.time() - startTime
+      if lfn in result['Value']['Failed']:
+        self.log.error( 'Could not get Storage Metadata for %s at %s: %s' % ( lfn, seName, result['Value']['Failed'][lfn] ) )
+        return S_ERROR( result['Value']['Failed'][lfn] ), False, time.time() - startTime
+      metadata = result['Value']['Successful'][lfn]
+      if metadata['Lost']:
+        error = "PFN has been Lost by the StorageElement"
+      elif metadata['Unavailable']:
+        error = "PFN is declared Unavailable by the StorageElement"
+      elif seName in tapeSEs and not metadata['Cached']:
+        error = "PFN is no longer in StorageElement Cache"
+      else:
+        error = ''
+      if error:
+        self.log.error( error, lfn )
+        return S_ERROR( error ), False, time.time() - startTime
+
+      self.log.info( 'Preliminary checks OK, download %s from %s:' % ( lfn, seName ) )
+      result = self._downloadFromSE( lfn, seName, reps, guid, downloadDir )
+      if not result['OK']:
+        self.log.error( "Download failed", "Tried downloading from SE %s: %s" % ( seName, result['Message'] ) )
+    else:
+      result = {'OK':False}
+
+    fromLocalSE = result['OK']
+    if not result['OK']:
+      reps.pop( seName, None )
+      # Check the other SEs
+      if reps:
+        self.log.info( 'Trying to download from any SE' )
+        result = self._downloadFromBestSE( lfn, reps, guid, downloadDir )
+        if not result['OK']:
+          self.log.error( "Download from best SE failed", "Tried downloading %s: %s" % ( lfn, result['Message'] ) )
+      else:
+        result = S_ERROR( "No replica to download %s" % lfn )
+    if result['OK']:
+      # Rename file if downloaded FileName does not match the LFN... How can this happen?
+      lfnName = os.path.basename( lfn )
+      oldPath = result['Value']['path']
+      fileName = os.path.basename( oldPath )
+      if lfnName != fileName:
+        newPath = os.path.join( os.path.dirname( oldPath ), lfnName )
+        os.rename( oldPath, newPath )
+        result['Value']['path'] = newPath
+    return result, fromLocalSE, time.time() - startTime
+
+  def __startBackgroundDownloads( self, downloadArgs ):
+    """ Start the download of the files in background threads, which keep running while the job runs
+
+    The files appear in their download directory once they are complete. Until then a marker file
+    with DOWNLOADING_SUFFIX is next to them, which :func:`~ILCDIRAC.Core.Utilities.resolvePathsAndNames.resolveIFpaths`
+    waits for. If the download fails a marker file with DOWNLOAD_FAILED_SUFFIX is left instead.
+
+    :returns: dictionary of the LFNs and the file dictionaries with the paths the files will have
+    """
+    self.log.info( 'Downloading %d files in the background' % len( downloadArgs ) )
+    self.finalize()
+    self.backgroundPool = ThreadPool( max( 1, self.nbWorkers ) )
+    # the job wrapper process exits at the end of the job
+    atexit.register( self.finalize )
+    resolvedData = {}
+    for args in downloadArgs:
+      lfn, reps, downloadReplica, _tapeSEs = args
+      seName = downloadReplica['SE']
+      localFile = os.path.join( self.__getDownloadDir(), os.path.basename( lfn ) )
+      open( localFile + DOWNLOADING_SUFFIX, 'w' ).close()
+      resolvedData[lfn] = {'turl':'Downloaded',
+                           'protocol':'Downloaded',
+                           'se':seName,
+                           'pfn':reps.get( seName, '' ),
+                           'guid':downloadReplica['GUID'],
+                           'path':localFile}
+      self.backgroundPool.apply_async( self.__downloadInBackground, ( localFile, args ) )
+    # the threads of the pool finish the downloads and stop
+    self.backgroundPool.close()
+    return resolvedData
+
+  def finalize( self ):
+    """ Wait for the background downloads to finish, so that no download is cut off at the end of the job """
+    if self.backgroundPool is None:
+      return
+    self.backgroundPool.close()
+    self.backgroundPool.join()
+    self.backgroundPool = None
+
+  def __downloadInBackground( self, localFile, args ):
+    """ Download one file to a staging directory and move it to localFile once it is complete """
+    stagingDir = tempfile.mkdtemp( prefix = '.staging_', dir = os.path.dirname( localFile ) )
+    try:
+      try:
+        result, _fromLocalSE, downloadTime = self.__downloadFile( *args, downloadDir = stagingDir )
+        if result['OK'] and os.path.dirname( result['Value']['path'] ) == stagingDir:
+          shutil.move( result['Value']['path'], localFile )
+          self.log.info( 'Downloaded %s in the background in %.1fs' % ( args[0], downloadTime ) )
+        elif result['OK'] and result['Value']['path'] != localFile:
+          # files already present in the working directory are not downloaded again, but must be at localFile
+          self.__linkFile( result['Value']['path'], localFile )
+      except Exception as e: #pylint: disable=broad-except
+        result = S_ERROR( "Exception during download: %s" % repr( e ) )
+      if not result['OK']:
+        self.log.error( 'Background download failed', '%s: %s' % ( args[0], result['Message'] ) )
+        with open( localFile + DOWNLOAD_FAILED_SUFFIX, 'w' ) as failedMarker:
+          failedMarker.write( str( result['Message'] ) )
+    finally:
+      shutil.rmtree( stagingDir, ignore_errors = True )
+      os.remove( localFile + DOWNLOADING_SUFFIX )
+
+  def __linkFile( self, existingFile, localFile ):
+    """ Make existingFile available as localFile, copy it if it cannot be linked """
+    self.log.info( 'File %s already exists locally, linking it to %s' % ( existingFile, localFile ) )
+    try:
+      os.link( existingFile, localFile )
+    except OSError:
+      shutil.copy2( existingFile, localFile )
+
+  def __getSEStatus( self, seName ):
+    """ Return the status of the StorageElement, obtained only once per execution """
+    if seName not in self.seStatus:
+      self.seStatus[seName] = StorageElement( seName ).getStatus()['Value']
+    return self.seStatus[seName]
+
   #############################################################################
   def __checkDiskSpace( self, totalSize ):
     """Compare available disk space to the file size reported from the catalog
@@ -240,16 +362,18 @@ class DownloadInputData:
 
   def __getDownloadDir( self, incrementCounter = True ):
     if self.inputDataDirectory == "PerFile":
-      if incrementCounter:
-        self.counter += 1
-      return tempfile.mkdtemp( prefix = 'InputData_%s' % ( self.counter ), dir = os.getcwd() )
+      with self.counterLock:
+        if incrementCounter:
+          self.counter += 1
+        counter = self.counter
+      return tempfile.mkdtemp( prefix = 'InputData_%s' % ( counter ), dir = os.getcwd() )
     elif self.inputDataDirectory == "CWD":
       return os.getcwd()
     else:
       return self.inputDataDirectory
 
   #############################################################################
-  def _downloadFromBestSE( self, lfn, reps, guid ):
+  def _downloadFromBestSE( self, lfn, reps, guid, downloadDir = None ):
     """ Download a local copy of a single LFN from a list of Storage Elements.
         This is used as a last resort to attempt to retrieve the file.
     """
@@ -257,7 +381,7 @@ class DownloadInputData:
     diskSEs = set()
     tapeSEs = set()
     for seName in reps:
-      seStatus = StorageElement( seName ).getStatus()['Value']
+      seStatus = self.__getSEStatus( seName )
       # FIXME: This is simply terrible - this notion of "DiskSE" vs "TapeSE" should NOT be used here!
       if seStatus['Read'] and seStatus['DiskSE']:
         diskSEs.add( seName )
@@ -267,7 +391,7 @@ class DownloadInputData:
     for seName in list( diskSEs ) + list( tapeSEs ):
       if seName in diskSEs or _isCached( lfn, seName ):
         # On disk or cached from tape
-        result = self._downloadFromSE( lfn, seName, reps, guid )
+        result = self._downloadFromSE( lfn, seName, reps, guid, downloadDir )
         if result['OK']:
           return result
         else:
@@ -276,7 +400,7 @@ class DownloadInputData:
     return S_ERROR( "Unable to download the file from any SE" )
 
   #############################################################################
-  def _downloadFromSE( self, lfn, seName, reps, guid ):
+  def _downloadFromSE( self, lfn, seName, reps, guid, downloadDir = None ):
     """ Download a local copy from the specified Storage Element.
     """
     if not lfn:
@@ -284,7 +408,8 @@ class DownloadInputData:
 
     self.log.verbose( "Attempting to download file %s from %s:" % ( lfn, seName ) )
 
-    downloadDir = self.__getDownloadDir()
+    if downloadDir is None:
+      downloadDir = self.__getDownloadDir()
     fileName = os.path.basename( lfn )
     for localFile in ( os.path.join( os.getcwd(), fileName ), os.path.join( downloadDir, fileName ) ):
       if os.path.exists( localFile ):
@@ -0,0 +1,243 @@
+"""Test the DownloadInputData module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock as Mock, patch
+
+from DIRAC import S_OK, S_ERROR
+
+from ILCDIRAC.Core.Utilities.resolvePathsAndNames import DOWNLOADING_SUFFIX, DOWNLOAD_FAILED_SUFFIX
+from ILCDIRAC.Tests.Utilities.GeneralUtils import assertEqualsImproved
+
+__RCSID__ = "$Id$"
+
+MODULE_NAME = 'ILCDIRAC.WorkloadManagementSystem.Client.DownloadInputData'
+
+LFNS = [ '/ilc/prod/file%d.slcio' % i for i in range( 3 ) ]
+
+# pylint: disable=protected-access
+class TestDownloadInputData( unittest.TestCase ):
+  """Test the DownloadInputData module"""
+
+  def setUp( self ):
+    self.curdir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir( self.tmpdir )
+    self.failingLFNs = set()
+    self.value_dict = { '/DownloadInputData/Workers' : 1, '/DownloadInputData/BackgroundDownloads' : False }
+    self.seMocks = {}
+    self.rpcMock = Mock( name = 'JobStateUpdate' )
+    self.rpcMock.setJobParameter.return_value = S_OK()
+    self.patches = [ patch( '%s.StorageElement' % MODULE_NAME, new = Mock( side_effect = self.getSE ) ),
+                     patch( '%s.RPCClient' % MODULE_NAME, new = Mock( return_value = self.rpcMock ) ),
+                     patch( '%s.getDiskSpace' % MODULE_NAME, new = Mock( return_value = 100000 ) ),
+                     patch( '%s.atexit' % MODULE_NAME, new = Mock() ) ]
+    for patcher in self.patches:
+      patcher.start()
+
+  def tearDown( self ):
+    for patcher in self.patches:
+      patcher.stop()
+    os.chdir( self.curdir )
+    shutil.rmtree( self.tmpdir )
+
+  def getSE( self, seName ):
+    """ Mock of the StorageElement constructor, one mock per SE """
+    if seName not in self.seMocks:
+      seMock = Mock( name = seName )
+      seMock.getStatus.return_value = S_OK( { 'Read' : True, 'DiskSE' : True, 'TapeSE' : False } )
+      seMock.getFileMetadata.side_effect = lambda lfn : S_OK( { 'Successful' : { lfn : { 'Lost' : False,
+                                                                                         'Unavailable' : False,
+                                                                                         'Cached' : True } },
+                                                                'Failed' : {} } )
+      seMock.getFile.side_effect = lambda lfn, localPath : self.getFile( seName, lfn, localPath )
+      self.seMocks[seName] = seMock
+    return self.seMocks[seName]
+
+  def getFile( self, seName, lfn, localPath ):
+    """ Mock of StorageElement.getFile, which writes the file into localPath """
+    if ( lfn, seName ) in self.failingLFNs:
+      return S_OK( { 'Successful' : {}, 'Failed' : { lfn : 'No such file' } } )
+    with open( os.path.join( localPath, os.path.basename( lfn ) ), 'w' ) as localFile:
+      localFile.write( lfn )
+    return S_OK( { 'Successful' : { lfn : 10 }, 'Failed' : {} } )
+
+  def getDataObject( self, lfns, otherSEs = () ):
+    """ Create the DownloadInputData object for the lfns, all available at the local SE and otherSEs """
+    from ILCDIRAC.WorkloadManagementSystem.Client.DownloadInputData import DownloadInputData
+    replicas = {}
+    for lfn in lfns:
+      replicas[lfn] = dict( ( seName, 'pfn:%s:%s' % ( seName, lfn ) ) for seName in ( 'LocalSE', ) + tuple( otherSEs ) )
+      replicas[lfn].update( { 'Size' : 10, 'GUID' : 'guid_%s' % lfn } )
+    opsMock = Mock()
+    opsMock.getValue.side_effect = lambda opt, _default : self.value_dict[opt]
+    with patch( '%s.Operations' % MODULE_NAME, new = Mock( return_value = opsMock ) ):
+      return DownloadInputData( { 'InputData' : list( lfns ),
+                                  'Configuration' : { 'LocalSEList' : [ 'LocalSE' ], 'JobID' : 123 },
+                                  'FileCatalog' : S_OK( { 'Successful' : replicas } ) } )
+
+  def test_background_downloads( self ):
+    """test DownloadInputData downloads all but the first file in the background........................"""
+    self.value_dict['/DownloadInputData/BackgroundDownloads'] = True
+    dataObj = self.getDataObject( LFNS )
+    res = dataObj.execute()
+    self.assertTrue( res['OK'] )
+    assertEqualsImproved( ( sorted( res['Value']['Successful'] ), res['Value']['Failed'] ), ( LFNS, [] ), self )
+    self.assertIsNotNone( dataObj.backgroundPool )
+    dataObj.finalize()
+    self.assertIsNone( dataObj.backgroundPool )
+    for lfn in LFNS:
+      path = res['Value']['Successful'][lfn]['path']
+      with open( path ) as localFile:
+        assertEqualsImproved( localFile.read(), lfn, self )
+      self.assertFalse( os.path.exists( path + DOWNLOADING_SUFFIX ) )
+      self.assertFalse( os.path.exists( path + DOWNLOAD_FAILED_SUFFIX ) )
+      assertEqualsImproved( os.listdir( os.path.dirname( path ) ), [ os.path.basename( path ) ], self )
+    # only the first file is downloaded before the job starts
+    self.assertIn( LFNS[0], self.rpcMock.setJobParameter.call_args_list[0][0][2] )
+    self.assertNotIn( LFNS[1], self.rpcMock.setJobParameter.call_args_list[0][0][2] )
+
+  def test_background_downloads_failure( self ):
+    """test DownloadInputData leaves a marker for files which cannot be downloaded in the background...."""
+    self.value_dict['/DownloadInputData/BackgroundDownloads'] = True
+    self.failingLFNs.add( ( LFNS[1], 'LocalSE' ) )
+    dataObj = self.getDataObject( LFNS )
+    res = dataObj.execute()
+    dataObj.finalize()
+    path = res['Value']['Successful'][LFNS[1]]['path']
+    self.assertFalse( os.path.exists( path ) )
+    self.assertFalse( os.path.exists( path + DOWNLOADING_SUFFIX ) )
+    with open( path + DOWNLOAD_FAILED_SUFFIX ) as marker:
+      self.assertIn( 'No replica to download %s' % LFNS[1], marker.read() )
+    self.assertTrue( os.path.exists( res['Value']['Successful'][LFNS[2]]['path'] ) )
+
+  def test_background_downloads_file_in_cwd( self ):
+    """test DownloadInputData puts files already in the working directory at their download path........"""
+    self.value_dict['/DownloadInputData/BackgroundDownloads'] = True
+    with open( os.path.basename( LFNS[1] ), 'w' ) as existingFile:
+      existingFile.write( 'existing' )
+    dataObj = self.getDataObject( LFNS )
+    res = dataObj.execute()
+    dataObj.finalize()
+    path = res['Value']['Successful'][LFNS[1]]['path']
+    self.assertNotEqual( os.path.dirname( path ), self.tmpdir )
+    with open( path ) as localFile:
+      assertEqualsImproved( localFile.read(), 'existing', self )
+    self.assertFalse( os.path.exists( path + DOWNLOADING_SUFFIX ) )
+    self.assertFalse( os.path.exists( path + DOWNLOAD_FAILED_SUFFIX ) )
+    downloaded = [ getFileCall[0][0] for getFileCall in self.seMocks['LocalSE'].getFile.call_args_list ]
+    assertEqualsImproved( sorted( downloaded ), [ LFNS[0], LFNS[2] ], self )
+
+  def test_background_downloads_joined_at_exit( self ):
+    """test DownloadInputData joins the background downloads at the end of the job......................"""
+    from ILCDIRAC.WorkloadManagementSystem.Client import DownloadInputData as module
+    self.value_dict['/DownloadInputData/BackgroundDownloads'] = True
+    dataObj = self.getDataObject( LFNS )
+    dataObj.execute()
+    module.atexit.register.assert_called_once_with( dataObj.finalize )
+    dataObj.finalize()
+
+  def test_no_background_downloads_single_file( self ):
+    """test DownloadInputData downloads a single file directly.........................................."""
+    self.value_dict['/DownloadInputData/BackgroundDownloads'] = True
+    dataObj = self.getDataObject( LFNS[:1] )
+    res = dataObj.execute()
+    self.assertIsNone( dataObj.backgroundPool )
+    self.assertTrue( os.path.exists( res['Value']['Successful'][LFNS[0]]['path'] ) )
+    dataObj.finalize()
+
+  def test_parallel_downloads( self ):
+    """test DownloadInputData downloads the files with /DownloadInputData/Workers threads..............."""
+    from multiprocessing.pool import ThreadPool
+    self.value_dict['/DownloadInputData/Workers'] = 2
+    dataObj = self.getDataObject( LFNS )
+    with patch( '%s.ThreadPool' % MODULE_NAME, new = Mock( side_effect = ThreadPool ) ) as poolMock:
+      res = dataObj.execute()
+    poolMock.assert_called_once_with( 2 )
+    self.assertTrue( res['OK'] )
+    assertEqualsImproved( ( sorted( res['Value']['Successful'] ), res['Value']['Failed'] ), ( LFNS, [] ), self )
+    paths = [ res['Value']['Successful'][lfn]['path'] for lfn in LFNS ]
+    for lfn, path in zip( LFNS, paths ):
+      with open( path ) as localFile:
+        assertEqualsImproved( localFile.read(), lfn, self )
+    # the counter is increased under its lock, each file gets its own directory
+    assertEqualsImproved( len( set( os.path.dirname( path ) for path in paths ) ), 3, self )
+    assertEqualsImproved( dataObj.counter, 4, self )
+
+  def test_parallel_downloads_partial_failure( self ):
+    """test DownloadInputData reports the files which could not be downloaded by the threads............"""
+    self.value_dict['/DownloadInputData/Workers'] = 3
+    self.failingLFNs.add( ( LFNS[1], 'LocalSE' ) )
+    dataObj = self.getDataObject( LFNS )
+    res = dataObj.execute()
+    self.assertTrue( res['OK'] )
+    assertEqualsImproved( ( sorted( res['Value']['Successful'] ), res['Value']['Failed'] ),
+                          ( [ LFNS[0], LFNS[2] ], [ LFNS[1] ] ), self )
+    self.assertFalse( os.path.exists( os.path.join( os.path.dirname( res['Value']['Successful'][LFNS[0]]['path'] ),
+                                                    os.path.basename( LFNS[1] ) ) ) )
+
+  def test_download_times_parameter( self ):
+    """test DownloadInputData sets the DownloadInputDataTimes job parameter for all files..............."""
+    self.value_dict['/DownloadInputData/Workers'] = 3
+    self.failingLFNs.add( ( LFNS[2], 'LocalSE' ) )
+    dataObj = self.getDataObject( LFNS )
+    dataObj.execute()
+    params = dict( ( args[1], args[2] ) for args, _kwargs in self.rpcMock.setJobParameter.call_args_list )
+    self.assertTrue( all( args[0] == 123 for args, _kwargs in self.rpcMock.setJobParameter.call_args_list ) )
+    times = params['DownloadInputDataTimes'].split( '\n' )
+    assertEqualsImproved( [ line.split()[0] for line in times ], LFNS, self )
+    self.assertTrue( all( line.split()[1].endswith( 's' ) for line in times ) )
+    self.assertIn( 'Downloaded 2 / 2 files from local Storage Elements', params['DownloadInputData'] )
+
+  def test_download_from_other_se( self ):
+    """test DownloadInputData downloads the file from another SE if the local SE fails.................."""
+    self.failingLFNs.add( ( LFNS[0], 'LocalSE' ) )
+    dataObj = self.getDataObject( LFNS[:1], otherSEs = [ 'OtherSE' ] )
+    res = dataObj.execute()
+    assertEqualsImproved( ( res['Value']['Successful'][LFNS[0]]['se'], res['Value']['Failed'] ),
+                          ( 'OtherSE', [] ), self )
+    self.assertIn( 'Downloaded 0 / 1 files from local Storage Elements', self.rpcMock.setJobParameter.call_args[0][2] )
+
+  def test_download_lost_file( self ):
+    """test DownloadInputData does not download a file lost by the local SE............................."""
+    dataObj = self.getDataObject( LFNS[:1] )
+    self.getSE( 'LocalSE' ).getFileMetadata.side_effect = None
+    self.getSE( 'LocalSE' ).getFileMetadata.return_value = S_OK( { 'Successful' : { LFNS[0] : { 'Lost' : True } },
+                                                                   'Failed' : {} } )
+    res = dataObj.execute()
+    assertEqualsImproved( ( res['Value']['Successful'], res['Value']['Failed'] ), ( {}, [ LFNS[0] ] ), self )
+    self.assertFalse( self.getSE( 'LocalSE' ).getFile.called )
+
+  def test_download_metadata_fails( self ):
+    """test DownloadInputData reports a file as failed if the SE metadata cannot be obtained............"""
+    dataObj = self.getDataObject( LFNS[:1] )
+    self.getSE( 'LocalSE' ).getFileMetadata.side_effect = None
+    self.getSE( 'LocalSE' ).getFileMetadata.return_value = S_ERROR( 'SE down' )
+    res = dataObj.execute()
+    assertEqualsImproved( res['Value']['Failed'], [ LFNS[0] ], self )
+    self.assertFalse( self.getSE( 'LocalSE' ).getFile.called )
+
+  def test_se_status_cached( self ):
+    """test DownloadInputData gets the status of each SE only once......................................"""
+    self.failingLFNs.update( ( lfn, 'LocalSE' ) for lfn in LFNS )
+    dataObj = self.getDataObject( LFNS, otherSEs = [ 'OtherSE' ] )
+    res = dataObj.execute()
+    assertEqualsImproved( sorted( res['Value']['Successful'] ), LFNS, self )
+    assertEqualsImproved( ( self.getSE( 'LocalSE' ).getStatus.call_count, self.getSE( 'OtherSE' ).getStatus.call_count ),
+                          ( 1, 1 ), self )
+    assertEqualsImproved( sorted( dataObj.seStatus ), [ 'LocalSE', 'OtherSE' ], self )
+
+  def test_single_worker( self ):
+    """test DownloadInputData does not start threads with a single worker..............................."""
+    dataObj = self.getDataObject( LFNS )
+    with patch( '%s.ThreadPool' % MODULE_NAME ) as poolMock:
+      res = dataObj.execute()
+    self.assertFalse( poolMock.called )
+    assertEqualsImproved( sorted( res['Value']['Successful'] ), LFNS, self )
+
+if __name__ == "__main__":
+  SUITE = unittest.defaultTestLoader.loadTestsFromTestCase( TestDownloadInputData )
+  TESTRESULT = unittest.TextTestRunner( verbosity = 2 ).run( SUITE )